@@ -6,9 +6,13 @@
 
 from pytadbit.utils.extraviews         import colorize, tadbit_savefig
 from pytadbit.utils.extraviews         import _tad_density_plot
-from random                            import random, shuffle
+from random                            import random
 from sys                               import stdout
+from time                              import time
+from numpy.random                      import RandomState
 from pytadbit.boundary_aligner.aligner import align
+import multiprocessing as mu
+import numpy as np
 
 
 try:
@@ -447,24 +451,48 @@ def _interpolation(experiments):
     return interp1d(win, cnt)
 
 
+# data needed to generate random TADs and align them, shared by the processes
+# computing randomized alignments
+_RANDOMIZATION_DATA = None
+
 def randomization_test(xpers, score=None, num=1000, verbose=False, max_dist=100000,
-                       rnd_method='interpolate', r_size=None, method='reciprocal'):
+                       rnd_method='interpolate', r_size=None, method='reciprocal',
+                       n_cpus=1, seed=None, early_stop=None, batch=20,
+                       progressive=False):
     """
     Return the probability that original alignment is better than an
     alignment of randomized boundaries.
 
+    Randomizations are computed by batches, in parallel. Each randomization
+    uses its own random generator, seeded with seed plus its number, so that
+    results do not depend on the number of CPUs or on the size of the
+    batches.
+
     :param tads: original TADs of each experiment to align
     :param distr: the function to interpolate TAD lengths from probability
     :param None score: just to print it when verbose
     :param 1000 num: number of random alignment to generate for comparison
-    :param False verbose: to print something nice
+    :param False verbose: to print something nice (progress and timing)
     :param interpolate method: how to generate random tads (alternative is
        'shuffle'). 'interpolate' will calculate the distribution of TAD lengths,
        and generate a random set of TADs according to this distribution (see
        :func:`pytadbit.alignment.generate_rnd_tads`). In contrast, the 'shuffle'
        method uses directly the set of observed TADs and shuffle them (see
        :func:`pytadbit.alignment.generate_shuffle_tads`).
+    :param 1 n_cpus: number of randomizations computed in parallel
+    :param None seed: seed of the random generators (by default taken from
+       the python random module)
+    :param None early_stop: stop after this number of randomized alignments
+       better than the observed one. The p-value is then this number divided
+       by the number of randomizations done (sequential Monte Carlo p-value,
+       Besag and Clifford 1991), resolved long before num randomizations when
+       the alignment is not significant
+    :param 20 batch: number of randomizations computed at a time by each
+       process
+    :param False progressive: progressive multiple alignment of the
+       randomized boundaries (see :func:`pytadbit.boundary_aligner.aligner.align`)
     """
+    global _RANDOMIZATION_DATA
     if not rnd_method in ['interpolate', 'shuffle']:
         raise Exception('method should be either "interpolate" or ' +
                         '"shuffle"\n')
@@ -476,52 +504,83 @@ def randomization_test(xpers, score=None, num=1000, verbose=False, max_dist=1000
             raise Exception('No TADs defined, use find_tad function.\n')
         tads.append([(t['end'] - t['start']) * \
                      xpr.resolution for t in xpr.tads.values()])
-    rnd_distr = []
-    # rnd_len = []
+    if seed is None:
+        seed = int(random() * 2**31)
     distr = _interpolation(xpers) if rnd_method is 'interpolate' else None
-    rnd_exp = lambda : tads[int(random() * len(tads))]
-    for val in xrange(num):
-        if verbose:
-            val = float(val)
-            if not val / num * 100 % 5:
-                stdout.write('\r' + ' ' * 10 + 
-                             ' randomizing: '
-                             '%.2f completed' % (100 * val/num))
-                stdout.flush()
-        if rnd_method is 'interpolate':
-            rnd_tads = [generate_rnd_tads(r_size, distr)
-                        for _ in xrange(len(tads))]
-            # rnd_len.append(float(sum([len(r) for r in rnd_tads]))
-            #                / len(rnd_tads))
+    _RANDOMIZATION_DATA = (tads, distr, r_size, rnd_method, method, max_dist,
+                           seed, progressive)
+    batches = [(beg, min(batch, num - beg)) for beg in xrange(0, num, batch)]
+    pool = mu.Pool(n_cpus) if n_cpus > 1 else None
+    try:
+        if pool:
+            procs = pool.imap(_randomizations, batches)
         else:
-            rnd_tads = [generate_shuffle_tads(rnd_exp())
-                        for _ in xrange(len(tads))]
-            # rnd_len.append(len(tads))
-        rnd_distr.append(align(rnd_tads, verbose=False, method=method,
-                               max_dist=max_dist)[1])
-        # aligns, sc = align(rnd_tads, verbose=False)
-        # rnd_distr.append(sc)
-        # for xpr in aligns:
-        #     print sc, '|'.join(['%5s' % (str(x/1000)[:-2] \
-        # if x!='-' else '-' * 4)\
-        #                         for x in xpr])
-        # print ''
-    pval = float(len([n for n in rnd_distr if n > score])) / len(rnd_distr)
+            procs = (_randomizations(args) for args in batches)
+        rnd_distr = []
+        better = 0
+        t0 = time()
+        for scores in procs:
+            for rnd_score in scores:
+                rnd_distr.append(rnd_score)
+                better += rnd_score > score
+                if better == early_stop:
+                    break
+            if verbose:
+                elapsed = time() - t0
+                stdout.write('\r' + ' ' * 10 + ' randomizing: '
+                             '%.2f completed (%d s, ~%d s left)' % (
+                                 100. * len(rnd_distr) / num, elapsed,
+                                 elapsed * (num - len(rnd_distr)) /
+                                 len(rnd_distr)))
+                stdout.flush()
+            if better == early_stop:
+                break
+    finally:
+        # enough randomizations are done, or one failed and the others are
+        # not waited for
+        if pool:
+            pool.terminate()
+            pool.join()
+        _RANDOMIZATION_DATA = None
+    pval = float(better) / len(rnd_distr)
     if verbose:
-        stdout.write('\n %s randomizations finished.' % (num))
+        stdout.write('\n %s randomizations finished in %.1f s.' % (
+            len(rnd_distr), time() - t0))
         stdout.flush()
         print '  Observed alignment score: %s' % (score)
-        # print '  Mean number of boundaries: {}; observed: {}'.format (
-        #     sum(rnd_len)/len(rnd_len),
-        #     str([len(self.experiments[e].brks)
-        #          for e in self.experiments]))
         print 'Randomized scores between %s and %s; observed: %s' % (
             min(rnd_distr), max(rnd_distr), score)
         print 'p-value: %s' % (pval if pval else '<%s' % (1./num))
     return pval
 
 
-def generate_rnd_tads(chromosome_len, distr, start=0):
+def _randomizations(args):
+    """
+    Scores of the alignments of a batch of random TAD sets (the data needed
+    is in _RANDOMIZATION_DATA)
+
+    :param args: number of the first randomization, and number of
+       randomizations
+    """
+    beg, num = args
+    (tads, distr, r_size, rnd_method, method, max_dist,
+     seed, progressive) = _RANDOMIZATION_DATA
+    scores = []
+    for val in xrange(beg, beg + num):
+        rnd = RandomState((seed + val) % 2**32)
+        if rnd_method is 'interpolate':
+            rnd_tads = [generate_rnd_tads(r_size, distr, rnd=rnd)
+                        for _ in xrange(len(tads))]
+        else:
+            rnd_tads = [generate_shuffle_tads(tads[rnd.randint(len(tads))],
+                                              rnd=rnd)
+                        for _ in xrange(len(tads))]
+        scores.append(align(rnd_tads, verbose=False, method=method,
+                            max_dist=max_dist, progressive=progressive)[1])
+    return scores
+
+
+def generate_rnd_tads(chromosome_len, distr, start=0, rnd=None):
     """
     Generates random TADs over a chromosome of a given size according to a given
     distribution of lengths of TADs.
@@ -530,32 +589,34 @@ def generate_rnd_tads(chromosome_len, distr, start=0):
     :param distr: function that returns a TAD length depending on a p value
     :param bin_size: size of the bin of the Hi-C experiment
     :param 0 start: starting position in the chromosome
+    :param None rnd: numpy RandomState used to draw the lengths (by default
+       the one of numpy.random)
     
     :returns: list of TADs
     """
+    rnd = rnd or np.random
     pos = start
     tads = []
     while True:
-        pos += distr(random())
-        if pos > chromosome_len:
+        # TAD lengths are drawn by groups
+        ends = pos + np.cumsum(distr(rnd.random_sample(100)))
+        if ends[-1] > chromosome_len:
+            tads.extend(ends[ends <= chromosome_len].tolist())
             break
-        tads.append(float(pos))
+        tads.extend(ends.tolist())
+        pos = ends[-1]
     return tads
 
 
-def generate_shuffle_tads(tads):
+def generate_shuffle_tads(tads, rnd=None):
     """
     Returns a shuffle version of a given list of TADs
 
     :param tads: list of TADs
+    :param None rnd: numpy RandomState used to shuffle (by default the one of
+       numpy.random)
 
     :returns: list of shuffled TADs
     """
-    rnd_tads = tads[:]
-    shuffle(rnd_tads)
-    tads = []
-    for tad in rnd_tads:
-        if tads:
-            tad += tads[-1]
-        tads.append(tad)
-    return tads
+    rnd = rnd or np.random
+    return np.cumsum(rnd.permutation(tads)).tolist()
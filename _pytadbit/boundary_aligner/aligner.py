@@ -5,6 +5,7 @@
 """
 from pytadbit.boundary_aligner.globally     import needleman_wunsch
 from pytadbit.boundary_aligner.reciprocally import reciprocal
+import numpy as np
 
 
 def consensusize(ali1, ali2, passed):
@@ -32,7 +33,40 @@ def consensusize(ali1, ali2, passed):
     return consensus
 
 
-def align(sequences, method='reciprocal', **kwargs):
+def guide_order(sequences, aligner, **kwargs):
+    """
+    Order sequences for a progressive multiple alignment. All pairwise
+    alignments are computed once; the alignment starts with the best scoring
+    pair, and each following sequence is the one with the highest mean score
+    against the sequences already aligned.
+
+    :param sequences: list of TAD boundaries
+    :param aligner: pairwise alignment function (e.g.
+       :func:`pytadbit.boundary_aligner.globally.needleman_wunsch`)
+
+    :returns: the order of the sequences, and the result of the aligner for
+       the first pair
+    """
+    nseqs = len(sequences)
+    scores = np.empty((nseqs, nseqs))
+    scores.fill(-np.inf)
+    pairs = {}
+    for i in xrange(nseqs):
+        for j in xrange(i + 1, nseqs):
+            pairs[i, j] = aligner(sequences[i], sequences[j], **kwargs)
+            scores[i, j] = scores[j, i] = pairs[i, j][1]
+    i, j = np.unravel_index(np.argmax(scores), scores.shape)
+    first = int(min(i, j)), int(max(i, j))
+    order = list(first)
+    left = [i for i in xrange(nseqs) if not i in order]
+    while left:
+        best = max(left, key=lambda k: scores[order, k].mean())
+        order.append(best)
+        left.remove(best)
+    return order, pairs[first]
+
+
+def align(sequences, method='reciprocal', progressive=False, **kwargs):
     """
     Align Topologically Associating Domain borders. Supports multiple alignment
     by building a consensus TAD sequence and aligning each experiment to it.
@@ -45,6 +79,10 @@ def align(sequences, method='reciprocal', **kwargs):
       reduce this problem.
 
     :param reciprocal method: method used to align
+    :param False progressive: with more than two sequences, instead of
+       sorting experiments by their first boundary, start from the most
+       similar pair and add experiments by decreasing similarity to the ones
+       already aligned (see :func:`guide_order`)
     :returns: the result of the aligner used
     """
     if method == 'global':
@@ -55,26 +93,33 @@ def align(sequences, method='reciprocal', **kwargs):
         raise NotImplementedError(('Only "global" and "reciprocal" are ' +
                                    'implemented right now.\n'))
     if len(sequences) > 2:
+        first_pair = None
+        if progressive:
+            order, first_pair = guide_order(sequences, aligner, **kwargs)
+        else:
+            order = [i for i, _ in sorted(enumerate(sequences),
+                                          key=lambda x: x[1])]
         dico = {}
-        reference = None
-        for j, (i, seq) in enumerate(sorted(enumerate(sequences),
-                                            key=lambda x: x[1])):
-            reference = reference or seq
+        for j, i in enumerate(order):
             dico[j] = {'sort':i,
-                       'seq' :seq}
+                       'seq' :sequences[i]}
+        reference = dico[0]['seq']
         aligneds = []
         scores = 0
         perc1 = 0
         perc2 = 0
         for other in xrange(1, len(sequences)):
-            try:
-                ([align1, align2], score,
-                 p1, p2) = aligner(reference, dico[other]['seq'], **kwargs)
+            if other == 1 and first_pair:
+                result = first_pair
+            else:
+                result = aligner(reference, dico[other]['seq'], **kwargs)
+            # global aligner returns no percentage of identity
+            if len(result) == 4:
+                [align1, align2], score, p1, p2 = result
                 perc1 += p1
                 perc2 += p2
-            except ValueError:
-                [align1, align2], score = aligner(reference, dico[other]['seq'],
-                                                  **kwargs)
+            else:
+                [align1, align2], score = result
             scores += score
             if len(reference) != len(align1):
                 for pos in xrange(len(align1)):
@@ -98,4 +143,3 @@ def align(sequences, method='reciprocal', **kwargs):
                 perc1 / (len(sequences) - 1.),
                 perc2 / (len(sequences) - 1.))
     return aligner(sequences[0], sequences[1], **kwargs)
-
@@ -4,12 +4,112 @@
 global aligner for Topologically Associated Domains
 """
 from math import log
+import numpy as np
 
 
 def needleman_wunsch(tads1, tads2, penalty=-6., ext_pen=-5.6,
                      max_dist=500000, verbose=False):
     """
     Align two lists of TAD boundaries using a Needleman-Wunsh implementation
+
+    The score matrix is filled with NumPy, one anti-diagonal at a time (all
+    the cells of an anti-diagonal only depend on the two previous ones).
+    
+    :param tads1: list of boundaries for one chromosome under one condition
+    :param tads2: list of boundaries for the same chromosome under other
+        conditions
+    :param -0.1 penalty: penalty to open a gap in the alignment of boundaries
+    :param 500000 max_dist: distance from which match are denied. A bin_size
+        of 20Kb the number of bins corresponding to 0.5Mb is 25
+    :param False verbose: print the Needleman-Wunsch score matrix, and the
+        alignment of boundaries
+
+    :returns: the max score in the Needleman-Wunsch score matrix.
+    """
+    tads1 = [0.0] + list(tads1)
+    tads2 = [0.0] + list(tads2)
+    l_tads1  = len(tads1)
+    l_tads2  = len(tads2)
+    max_dist = log(1. / (abs(max_dist) + 1))
+    # matrices are stored by anti-diagonals: cell (i, j) is at (i + j, i)
+    n_diags = l_tads1 + l_tads2 - 1
+    rows = np.arange(l_tads1)
+    cols = np.arange(n_diags)[:, None] - rows[None, :]
+    inside = (cols >= 0) & (cols < l_tads2)
+    dists = np.zeros((n_diags, l_tads1))
+    dists[inside] = np.log(1. / (np.abs(
+        np.array(tads2, dtype=float)[cols[inside]] -
+        np.array(tads1, dtype=float)[np.nonzero(inside)[1]]) + 1))
+    scores = np.zeros((n_diags, l_tads1))
+    scores[np.arange(l_tads2), 0] = penalty * np.arange(l_tads2)
+    scores[rows, rows] = penalty * rows
+    # the gap penalty is only used in the first cell, then the extension
+    pen = penalty
+    for diag in xrange(2, n_diags):
+        beg, end = max(1, diag - l_tads2 + 1), min(l_tads1, diag)
+        d_dist = dists[diag, beg:end]
+        gap = np.maximum(scores[diag - 1, beg - 1:end - 1],
+                         scores[diag - 1, beg:end]) + pen
+        scores[diag, beg:end] = np.where(
+            d_dist < max_dist, gap,
+            np.maximum(d_dist + scores[diag - 2, beg - 1:end - 1], gap))
+        pen = ext_pen
+    # cells are only read along the path
+    dist = dists.item
+    score = scores.item
+    align1 = []
+    align2 = []
+    i = l_tads1 -1
+    j = l_tads2 -1
+    max_score = None
+    while i and j:
+        current = score(i + j, i)
+        if current > max_score:
+            max_score = current
+        value   = score(i + j - 2, i - 1) + dist(i + j, i)
+        if _equal(current, value):
+            align1.append(tads1[i])
+            align2.append(tads2[j])
+            i -= 1
+            j -= 1
+        elif (_equal(current, score(i + j - 1, i - 1) + penalty) or
+              _equal(current, score(i + j - 1, i - 1) + ext_pen)):
+            align1.append(tads1[i])
+            align2.append('-')
+            i -= 1
+        elif (_equal(current, score(i + j - 1, i) + penalty) or
+              _equal(current, score(i + j - 1, i) + ext_pen)):
+            align1.append('-')
+            align2.append(tads2[j])
+            j -= 1
+        else:
+            raise Exception('Something  is failing and it is my fault...',
+                            i, j, tads1[i], tads2[j])
+    while i:
+        align1.append(tads1[i])
+        align2.append('-')
+        i -= 1
+    while j:
+        align1.append('-')
+        align2.append(tads2[j])
+        j -= 1
+    align1.reverse()
+    align2.reverse()
+        
+    if verbose:
+        print '\n Alignment:'
+        print 'TADS 1: '+'|'.join(['%9s' % (str(int(x)) if x!='-' else '-'*3) \
+                                   for x in align1])
+        print 'TADS 2: '+'|'.join(['%9s' % (str(int(x)) if x!='-' else '-'*3) \
+                                   for x in align2])
+    return [align1, align2], max_score
+
+
+def needleman_wunsch_loops(tads1, tads2, penalty=-6., ext_pen=-5.6,
+                           max_dist=500000, verbose=False):
+    """
+    Align two lists of TAD boundaries using a Needleman-Wunsh implementation
+    (pure python implementation, see needleman_wunsch)
     
     :param tads1: list of boundaries for one chromosome under one condition
     :param tads2: list of boundaries for the same chromosome under other
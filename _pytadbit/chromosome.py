@@ -357,7 +357,8 @@ class Chromosome(object):
 
     def align_experiments(self, names=None, verbose=False, randomize=False,
                           rnd_method='interpolate', rnd_num=1000,
-                          get_score=False, **kwargs):
+                          get_score=False, n_cpus=1, seed=None,
+                          early_stop=None, **kwargs):
         """
         Align the predicted boundaries of two different experiments. The 
         resulting alignment will be stored in the self.experiment list.
@@ -381,10 +382,20 @@ class Chromosome(object):
            distribution. The alternative method is 'shuffle', where TADs are
            simply shuffled
         :param 1000 rnd_num: number of randomizations to do
+        :param 1 n_cpus: number of randomizations computed in parallel
+        :param None seed: seed of the randomizations (see
+           :func:`pytadbit.alignment.randomization_test`)
+        :param None early_stop: stop randomizing after this number of random
+           alignments better than the observed one (see
+           :func:`pytadbit.alignment.randomization_test`)
         :param reciprocal method: if global, Needleman-Wunsch is used to align
             (see :func:`pytadbit.boundary_aligner.globally.needleman_wunsch`);
             if reciprocal, a method based on reciprocal closest boundaries is
             used (see :func:`pytadbit.boundary_aligner.reciprocally.reciprocal`)
+        :param False progressive: when aligning more than two experiments,
+           add them to the multiple alignment by decreasing similarity, as
+           guided by all their pairwise alignments (see
+           :func:`pytadbit.boundary_aligner.aligner.guide_order`)
 
         :returns: the alignment or the score, p-value of the alignment
         """
@@ -412,7 +423,8 @@ class Chromosome(object):
                 return ali
         p_value = randomization_test(xpers, score=score, rnd_method=rnd_method,
                                      verbose=verbose, r_size=self.r_size,
-                                     num=rnd_num, **kwargs)
+                                     num=rnd_num, n_cpus=n_cpus, seed=seed,
+                                     early_stop=early_stop, **kwargs)
         return ali, (score, p_value, perc1, perc2)
 
 
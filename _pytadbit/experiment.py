@@ -131,6 +131,9 @@ class Experiment(object):
        the TADs
     :param True filter_columns: filter the columns with unexpectedly high 
        content of low values
+    :param None focus: in the case of binary matrices (see
+       :func:`pytadbit.parsers.hic_binary_parser.write_hic_binary`), load
+       only a chromosome, or a region (e.g. ('chr1', 1000000, 2000000))
     :param None kw_descr: any other argument passed would be stored as
        complementary descriptive field. For example::
        
@@ -159,7 +162,8 @@ class Experiment(object):
     def __init__(self, name, resolution, hic_data=None, norm_data=None,
                  tad_def=None, parser=None, no_warn=False, weights=None,
                  conditions=None, identifier=None,
-                 cell_type=None, enzyme=None, exp_type='Hi-C', **kw_descr):
+                 cell_type=None, enzyme=None, exp_type='Hi-C', focus=None,
+                 **kw_descr):
         self.name            = name
         self.resolution      = resolution
         self.identifier      = identifier
@@ -183,9 +187,9 @@ class Experiment(object):
         self._zeros          = {}
         self._zscores        = {}
         if hic_data:
-            self.load_hic_data(hic_data, parser, **kw_descr)
+            self.load_hic_data(hic_data, parser, focus=focus, **kw_descr)
         if norm_data:
-            self.load_norm_data(norm_data, parser, **kw_descr)
+            self.load_norm_data(norm_data, parser, focus=focus, **kw_descr)
         if tad_def:
             self.load_tad_def(tad_def, weights=weights)
         elif not hic_data and not no_warn and not norm_data:
@@ -477,9 +481,13 @@ class Experiment(object):
         :param True filter_columns: filter the columns with unexpectedly high 
            content of low values
         :param False silent: does not warn for removed columns
+        :param None focus: in the case of binary matrices (see
+           :func:`pytadbit.parsers.hic_binary_parser.write_hic_binary`), load
+           only a chromosome, or a region (e.g. ('chr1', 1000000, 2000000))
 
         """
-        self.hic_data = read_matrix(hic_data, parser=parser, one=False)
+        self.hic_data = read_matrix(hic_data, parser=parser, one=False,
+                                    focus=kwargs.get('focus'))
         self._ori_size       = self.size       = len(self.hic_data[0])
         self._ori_resolution = self.resolution = data_resolution or self._ori_resolution
         wanted_resolution = wanted_resolution or self.resolution
@@ -517,9 +525,13 @@ class Experiment(object):
         :param True filter_columns: filter the columns with unexpectedly high 
            content of low values
         :param False silent: does not warn for removed columns
+        :param None focus: in the case of binary matrices (see
+           :func:`pytadbit.parsers.hic_binary_parser.write_hic_binary`), load
+           only a chromosome, or a region (e.g. ('chr1', 1000000, 2000000))
         
         """
-        self.norm = read_matrix(norm_data, parser=parser, hic=False, one=False)
+        self.norm = read_matrix(norm_data, parser=parser, hic=False, one=False,
+                                focus=kwargs.get('focus'))
         self._ori_size       = self.size       = len(self.norm[0])
         self._ori_resolution = self.resolution = resolution or self._ori_resolution
         if not self._zeros: # in case we do not have original Hi-C data
@@ -703,7 +715,7 @@ class Experiment(object):
     def model_region(self, start=1, end=None, n_models=5000, n_keep=1000,
                      n_cpus=1, verbose=0, keep_all=False, close_bins=1,
                      outfile=None, config=CONFIG['dmel_01'],
-                     container=None):
+                     container=None, checkpoint=None, backend='imp'):
         """
         Generates of three-dimentional models using IMP, for a given segment of
         chromosome.
@@ -733,6 +745,11 @@ class Experiment(object):
            micrometers length and 0.5 micrometer of width), these values could be 
            used: ['cylinder', 250, 1500, 50], and for a typical mammalian nuclei
            (6 micrometers diameter): ['cylinder', 3000, 0, 50]
+        :param None checkpoint: path to a file where finished models are
+           saved, an interrupted run resuming from them (see
+           :func:`pytadbit.imp.imp_modelling.generate_3d_models`)
+        :param imp backend: library used to generate the models, 'imp' or
+           'numpy' (to model without IMP installed)
         :param CONFIG['dmel_01'] config: a dictionary containing the standard
            parameters used to generate the models. The dictionary should
            contain the keys kforce, maxdist, upfreq and lowfreq.
@@ -791,7 +808,8 @@ class Experiment(object):
                                   outfile=outfile, n_keep=n_keep, n_cpus=n_cpus,
                                   verbose=verbose, keep_all=keep_all, first=0,
                                   close_bins=close_bins, config=config, container=container,
-                                  experiment=self, coords=coords, zeros=zeros)
+                                  experiment=self, coords=coords, zeros=zeros,
+                                  checkpoint=checkpoint, backend=backend)
 
 
     def optimal_imp_parameters(self, start=1, end=None, n_models=500, n_keep=100,
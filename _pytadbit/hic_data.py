@@ -6,27 +6,35 @@ December 12, 2014.
 from pytadbit.utils.extraviews      import plot_compartments
 from pytadbit.utils.extraviews      import plot_compartments_summary
 from pytadbit.utils.hic_filtering   import filter_by_mean, filter_by_zero_count
-from pytadbit.utils.normalize_hic   import iterative, expected
+from pytadbit.utils.normalize_hic   import iterative, iterative_sparse, expected
+from pytadbit.utils.normalize_hic   import _upper_triangle
 from pytadbit.parsers.genome_parser import parse_fasta
 from pytadbit.parsers.bed_parser    import parse_bed
 from pytadbit.utils.file_handling   import mkdir
 from pytadbit.utils.hmm             import gaussian_prob, best_path, train
 from numpy.linalg                   import LinAlgError
-from numpy                          import corrcoef, nansum, array, isnan, mean
+from numpy                          import corrcoef, array, isnan, mean
 from numpy                          import meshgrid, asarray, exp, linspace, std
 from numpy                          import nanpercentile as npperc, log as nplog
 from numpy                          import nanmax
 from scipy.special                  import gammaincc
 from scipy.cluster.hierarchy        import linkage, fcluster, dendrogram
 from scipy.sparse.linalg            import eigsh
+from scipy.signal                   import fftconvolve
 from pytadbit.utils.tadmaths        import calinski_harabasz
 from scipy.stats                    import ttest_ind
 from collections                    import OrderedDict
 from warnings                       import warn
 from bisect                         import bisect_right as bisect
-from scipy.sparse                   import csr_matrix
+from scipy.sparse                   import csr_matrix, coo_matrix
+import multiprocessing as mu
+import numpy as np
 import os
 
+# Hi-C data (and upper triangle of its matrix) used by the processes searching
+# for compartments in each chromosome
+_COMPARTMENT_DATA = None
+
 class HiC_data(dict):
     """
     This may also hold the print/write-to-file matrix functions
@@ -55,6 +63,39 @@ class HiC_data(dict):
             self.sections = dict([((None, i), i)
                                   for i in xrange(0, self.__size)])
 
+    @property
+    def bias(self):
+        return self._bias
+
+    @bias.setter
+    def bias(self, bias):
+        # decay profiles depend on the biases
+        self._bias = bias
+        self._decay_cache = {}
+
+    @property
+    def bads(self):
+        return self._bads
+
+    @bads.setter
+    def bads(self, bads):
+        self._bads = bads
+        self._decay_cache = {}
+
+    def __getstate__(self):
+        # the cache of expected values is rebuilt when needed
+        state = self.__dict__.copy()
+        state.pop('_decay_cache', None)
+        return state
+
+    def __setstate__(self, state):
+        # objects pickled before bias and bads became properties
+        for key in ('bias', 'bads'):
+            if key in state:
+                state['_' + key] = state.pop(key)
+        self.__dict__.update(state)
+        self._decay_cache = {}
+
     def _update_size(self, size):
         self.__size +=  size
         self._size2 = self.__size**2
@@ -106,15 +147,10 @@ class HiC_data(dict):
 
         :returns: scipy sparse matrix in Compressed Sparse Row format
         """
-        values = []
-        cols = []
-        rows = []
-        for key, value in self.iteritems():
-            row, col = round(key / self.__size), key % self.__size
-            values.append(float(value))
-            cols.append(col)
-            rows.append(row)
-                
+        nnz = dict.__len__(self)
+        pos = np.fromiter(self.iterkeys(), dtype=np.int64, count=nnz)
+        values = np.fromiter(self.itervalues(), dtype=float, count=nnz)
+        rows, cols = np.divmod(pos, self.__size)
         return csr_matrix((values, (rows, cols)), shape=(self.__size,self.__size))
         
     def add_sections_from_fasta(self, fasta):
@@ -313,7 +349,71 @@ class HiC_data(dict):
                 norm_sum += v
         return norm_sum
 
-    def normalize_hic(self, iterations=0, max_dev=0.1, silent=False, factor=1):
+    def get_decay(self, normalized=False, bads=None):
+        """
+        Interactions at each distance from the diagonal (decay profile), for
+        each chromosome. Cells in filtered (bad) rows or columns are skipped.
+
+        Profiles are computed in a single pass over the sparse matrix, and
+        kept until the biases or the filtered columns change (changes in the
+        counts of a HiC_data object built from a dictionary are not tracked).
+
+        :param False normalized: use the interactions divided by the biases
+        :param None bads: columns to skip, by default the filtered columns
+           of the Hi-C data
+
+        :returns: a dictionary with, for each chromosome, three arrays indexed
+           by the distance (in bins): the sum of interactions, the number of
+           cells, and the mean number of interactions (0 if no cell)
+        """
+        if normalized and not self.bias:
+            raise Exception('ERROR: experiment not normalized yet')
+        if bads is None:
+            bads = self.bads
+        key = normalized, frozenset(bads)
+        try:
+            return self._decay_cache[key]
+        except KeyError:
+            pass
+        size = len(self)
+        sections = self.section_pos or {None: (0, size)}
+        good = self._good_array(bads) if bads else np.ones(size, dtype=bool)
+        # each bin points to the first bin of its chromosome
+        first = np.empty(size, dtype=np.int64)
+        first.fill(-1)
+        for beg, end in sections.itervalues():
+            first[beg:end] = beg
+        upper = _upper_triangle(self).tocoo()
+        rows = upper.row.astype(np.int64)
+        cols = upper.col.astype(np.int64)
+        keep = ((first[rows] == first[cols]) & (first[rows] >= 0) &
+                good[rows] & good[cols])
+        rows = rows[keep]
+        cols = cols[keep]
+        vals = upper.data[keep].astype(float)
+        if normalized:
+            bias = np.array([self.bias.get(i, np.nan) for i in xrange(size)])
+            vals /= bias[rows] * bias[cols]
+        # the sum at distance d of a chromosome is stored at its first bin + d
+        sums = np.bincount(first[rows] + cols - rows, weights=vals,
+                           minlength=size)
+        decay = {}
+        for crm, (beg, end) in sections.iteritems():
+            # number of pairs of good bins at each distance
+            sec_good = good[beg:end].astype(float)
+            if end > beg:
+                counts = fftconvolve(sec_good, sec_good[::-1])[end - beg - 1:]
+                counts = np.round(counts).astype(int)
+            else:
+                counts = np.zeros(0, dtype=int)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                means = np.where(counts > 0, sums[beg:end] / counts, 0.)
+            decay[crm] = sums[beg:end], counts, means
+        self._decay_cache[key] = decay
+        return decay
+
+    def normalize_hic(self, iterations=0, max_dev=0.1, silent=False, factor=1,
+                      sparse=None, log=None):
         """
         Normalize the Hi-C data.
 
@@ -326,10 +426,22 @@ class HiC_data(dict):
         :param False silent: does not warn when overwriting weights
         :param 1 factor: final mean number of normalized interactions wanted
            per cell (excludes filtered, or bad, out columns)
+        :param None sparse: use the vectorized implementation of the iterative
+           correction (:func:`pytadbit.utils.normalize_hic.iterative_sparse`),
+           by default only used with SparseHiC_data objects
+        :param None log: path to a file where to write the convergence log of
+           the vectorized iterative correction
         """
-        bias = iterative(self, iterations=iterations,
-                         max_dev=max_dev, bads=self.bads,
-                         verbose=not silent)
+        if sparse is None:
+            sparse = isinstance(self, SparseHiC_data)
+        if sparse:
+            bias = iterative_sparse(self, iterations=iterations,
+                                    max_dev=max_dev, bads=self.bads,
+                                    verbose=not silent, log=log)
+        else:
+            bias = iterative(self, iterations=iterations,
+                             max_dev=max_dev, bads=self.bads,
+                             verbose=not silent)
         if factor:
             if not silent:
                 print 'rescaling to factor %d' % factor
@@ -340,11 +452,72 @@ class HiC_data(dict):
             bias = dict([(b, bias[b] * target) for b in bias])
         self.bias = bias
 
+    def _focus_coords(self, focus):
+        if focus:
+            if isinstance(focus, tuple) and isinstance(focus[0], int):
+                if len(focus) == 2:
+                    start1, end1 = focus
+                    start2, end2 = focus
+                else:
+                    start1, end1, start2, end2 = focus
+                start1 -= 1
+                start2 -= 1
+            elif isinstance(focus, tuple) and isinstance(focus[0], str):
+                start1, end1 = self.section_pos[focus[0]]
+                start2, end2 = self.section_pos[focus[1]]
+            else:
+                start1, end1 = self.section_pos[focus]
+                start2, end2 = self.section_pos[focus]
+        else:
+            start1 = start2 = 0
+            end1   = end2   = len(self)
+        return start1, end1, start2, end2
+
     def get_as_tuple(self):
         return tuple([self[i, j]
                       for j in xrange(len(self))
                       for i in xrange(len(self))])
 
+    def get_as_band(self, band, focus=None):
+        """
+        Returns the diagonal band of the matrix, as used by the banded version
+        of TADbit (see :func:`pytadbit.tadbit.tadbit`). Non-symmetric matrices
+        are symmetricized by summing both sides of the diagonal.
+
+        :param band: number of diagonals, above the main diagonal, to keep
+        :param None focus: a tuple with the (start, end) position of the desired
+           window of data (start, starting at 1, and both start and end are
+           inclusive). Alternatively a chromosome name can be input
+
+        :returns: a contiguous numpy array of int32, of length
+           size * (band + 1), where size is the number of rows in the window.
+           The count of cell (i, j), with 0 <= j - i <= band, is at position
+           i * (band + 1) + j - i
+        """
+        beg, end = self._focus_coords(focus)[:2]
+        size = end - beg
+        nnz = dict.__len__(self)
+        pos = np.fromiter(self.iterkeys(), dtype=np.int64, count=nnz)
+        vals = np.fromiter(self.itervalues(), dtype=float, count=nnz)
+        rows, cols = np.divmod(pos, len(self))
+        rows -= beg
+        cols -= beg
+        keep = ((rows >= 0) & (rows < size) & (cols >= 0) & (cols < size) &
+                (np.abs(cols - rows) <= band))
+        rows, cols, vals = rows[keep], cols[keep], vals[keep]
+        upper = cols >= rows
+        lower = cols <= rows
+        result = np.zeros(size * (band + 1), dtype=np.int32)
+        result[rows[upper] * (band + 1) + cols[upper] - rows[upper]] = vals[upper]
+        transp = np.zeros(size * (band + 1), dtype=np.int32)
+        transp[cols[lower] * (band + 1) + rows[lower] - cols[lower]] = vals[lower]
+        if not np.array_equal(result, transp):
+            warn('WARNING: input matrix not symmetric: symmetrizing')
+            diag = np.arange(size) * (band + 1)
+            transp[diag] = 0
+            result += transp
+        return result
+
     def write_matrix(self, fname, focus=None, diagonal=True, normalized=False):
         """
         writes the matrix to a file.
@@ -461,10 +634,33 @@ class HiC_data(dict):
                         mtrx[i][i] = 1 if mtrx[i][i] else 0
                 return mtrx
 
+    def _good_array(self, bads=None):
+        good = np.ones(len(self), dtype=bool)
+        bads = bads or self.bads
+        if bads:
+            good[np.fromiter((b for b in bads if b < len(self)),
+                             dtype=np.int64)] = False
+        return good
+
+    def _filter_for_compartments(self, **kwargs):
+        """
+        filters columns, if not already done, before searching for
+        compartments (see :func:`pytadbit.hic_data.HiC_data.find_compartments`)
+        """
+        if not self.bads:
+            if kwargs.get('verbose', False):
+                print 'Filtering bad columns %d' % 99
+            self.filter_columns(perc_zero=kwargs.get('perc_zero', 99),
+                                by_mean=False, silent=True)
+            if len(self.bads) == len(self):
+                self.bads = {}
+                warn('WARNING: all columns would have been filtered out, '
+                     'filtering disabled')
+
     def find_compartments(self, crms=None, savefig=None, savedata=None,
                           savecorr=None, show=False, suffix='', how='',
                           label_compartments='hmm', log=None, max_mean_size=10000,
-                          ev_index=None, rich_in_A=None, **kwargs):
+                          ev_index=None, rich_in_A=None, n_cpus=1, **kwargs):
         """
         Search for A/B copartments in each chromsome of the Hi-C matrix.
         Hi-C matrix is normalized by the number interaction expected at a given
@@ -512,9 +708,7 @@ class HiC_data(dict):
            cluster.
         :param 'ratio' how: ratio divide by column, subratio divide by
            compartment, diagonal only uses diagonal
-           
-
-        TODO: this is really slow...
+        :param 1 n_cpus: number of chromosomes processed in parallel
 
         Notes: building the distance matrix using the amount of interactions
                instead of the mean correlation, gives generally worse results.
@@ -522,15 +716,7 @@ class HiC_data(dict):
         :returns: a dictionary with the two first eigen vectors used to define
            compartment borders for each chromosome (keys are chromosome names)
         """
-        if not self.bads:
-            if kwargs.get('verbose', False):
-                print 'Filtering bad columns %d' % 99
-            self.filter_columns(perc_zero=kwargs.get('perc_zero', 99),
-                                by_mean=False, silent=True)
-            if len(self.bads) == len(self):
-                self.bads = {}
-                warn('WARNING: all columns would have been filtered out, '
-                     'filtering disabled')
+        self._filter_for_compartments(**kwargs)
         if not self.expected:
             if kwargs.get('verbose', False):
                 print 'Normalizing by expected values'
@@ -553,148 +739,43 @@ class HiC_data(dict):
         cmprts = {}
         firsts = {}
         ev_nums = {}
-        count = 0
+        secs = [sec for sec in self.section_pos if not crms or sec in crms]
 
-        for sec in self.section_pos:
-            if crms and sec not in crms:
-                continue
-            if kwargs.get('verbose', False):
-                print 'Processing chromosome', sec
-            matrix = [[(float(self[i,j]) / self.expected[abs(j-i)]
-                       / self.bias[i] / self.bias[j])
-                      for i in xrange(*self.section_pos[sec])
-                       if not i in self.bads]
-                     for j in xrange(*self.section_pos[sec])
-                      if not j in self.bads]
-            if not matrix: # MT chromosome will fall there
-                warn('Chromosome %s is probably MT :)' % (sec))
-                cmprts[sec] = []
-                count += 1
-                continue
-            for i in xrange(len(matrix)):
-                for j in xrange(i+1, len(matrix)):
-                    matrix[i][j] = matrix[j][i]
-            try:
-                matrix = [list(m) for m in corrcoef(matrix)]
-            except TypeError:
-                # very small chromosome?
-                warn('Chromosome %s is probably MT :)' % (sec))
-                cmprts[sec] = []
-                count += 1
-                continue
-            # write correlation matrix to file. replaces filtered row/columns by NaN
-            if savecorr:
-                out = open(os.path.join(savecorr, '%s_corr-matrix.tsv' % (sec)),
-                           'w')
-                start1, end1 = self.section_pos[sec]
-                out.write('# MASKED %s\n' % (' '.join([str(k - start1)
-                                                       for k in self.bads.keys()
-                                                       if start1 <= k <= end1])))
-                rownam = ['%s\t%d-%d' % (k[0],
-                                         k[1] * self.resolution,
-                                         (k[1] + 1) * self.resolution)
-                          for k in sorted(self.sections,
-                                          key=lambda x: self.sections[x])
-                          if k[0] == sec]
-                length = self.section_pos[sec][1] - self.section_pos[sec][0]
-                empty = 'NaN\t' * (length - 1) + 'NaN\n'
-                badrows = 0
-                for row in xrange(length):
-                    if row in self.bads:
-                        out.write(rownam.pop(0) + '\t' +empty)
-                        badrows += 1
-                        continue
-                    vals = []
-                    badcols = 0
-                    for col in xrange(length):
-                        if col in self.bads:
-                            vals.append('NaN')
-                            badcols += 1
-                            continue
-                        vals.append(str(matrix[row-badrows][col-badcols]))
-                    out.write(rownam.pop(0) + '\t' +'\t'.join(vals) + '\n')
-                out.close()
+        # chromosomes are processed in parallel, sharing the Hi-C data
+        global _COMPARTMENT_DATA
+        upper = _upper_triangle(self)
+        _COMPARTMENT_DATA = self, upper
+        n_cpus = min(n_cpus, len(secs))
+        pool = mu.Pool(n_cpus) if n_cpus > 1 else None
+        try:
+            procs = []
+            for count, sec in enumerate(secs):
+                args = (sec, ev_index[count] if ev_index else None,
+                        max_mean_size, savecorr, label_compartments, rich_in_A,
+                        how, log, suffix, bool(savefig or show),
+                        kwargs.get('verbose', False))
+                if pool:
+                    procs.append(pool.apply_async(_sec_compartments,
+                                                  args=args))
+                else:
+                    procs.append(_sec_compartments(*args))
+            if pool:
+                pool.close()
+                procs = [proc.get() for proc in procs]
+        finally:
+            # all results are collected, or a job failed and the others are
+            # not waited for
+            if pool:
+                pool.terminate()
+                pool.join()
+            _COMPARTMENT_DATA = None
 
-            try:
-                # This eighs is very very fast, only ask for one eigvector
-                _, evect = eigsh(array(matrix), k=ev_index[count] if ev_index else 2)
-            except (LinAlgError, ValueError):
-                warn('Chromosome %s too small to compute PC1' % (sec))
-                cmprts[sec] = [] # Y chromosome, or so...
-                count += 1
+        for sec, result in zip(secs, procs):
+            cmprts[sec], two_first, ev_num, first, matrix = result
+            if two_first is None:
                 continue
-            index = ev_index[count] if ev_index else 1
-            two_first = [list(evect[:, -1]), list(evect[:, -2])]
-            for ev_num in range(index, 3):
-                first = list(evect[:, -ev_num])
-                breaks = [i for i, (a, b) in
-                          enumerate(zip(first[1:], first[:-1]))
-                          if a * b < 0] + [len(first) - 1]
-                breaks = [{'start': breaks[i-1] + 1 if i else 0, 'end': b}
-                          for i, b in enumerate(breaks)]
-                if (self.resolution * (len(breaks) - 1.0) / len(matrix)
-                    > max_mean_size):
-                    warn('WARNING: number of compartments found with the '
-                         'EigenVector number %d is too low (%d compartments '
-                         'in %d rows), for chromosome %s' % (
-                             ev_num, len(breaks), len(matrix), sec))
-                else:
-                    break
-            if (self.resolution * (len(breaks) - 1.0) / len(matrix)
-                > max_mean_size):
-                warn('WARNING: keeping first eigenvector, for chromosome %s' % (
-                    sec))
-                ev_num = 1
-            ev_nums[sec] = ev_num
-            beg, end = self.section_pos[sec]
-            bads = [k - beg for k in self.bads if beg <= k <= end]
-            for evect in two_first:
-                _ = [evect.insert(b, float('nan')) for b in bads]
-            _ = [first.insert(b, 0) for b in bads]
-            _ = [matrix.insert(b, [float('nan')] * len(matrix[0]))
-                 for b in bads]
-            _ = [matrix[i].insert(b, float('nan'))
-                 for b in bads for i in xrange(len(first))]
-            breaks = [i for i, (a, b) in
-                      enumerate(zip(first[1:], first[:-1]))
-                      if a * b < 0] + [len(first) - 1]
-            breaks = [{'start': breaks[i-1] + 1 if i else 0, 'end': b}
-                      for i, b in enumerate(breaks)]
-            cmprts[sec] = breaks
-            
             firsts[sec] = two_first
-            # needed for the plotting
-            self._apply_metric(cmprts, sec, rich_in_A, how=how)
-            
-            if label_compartments == 'cluster':
-                if log:
-                    logf = os.path.join(log, sec + suffix + '.log')
-                else:
-                    logf = None
-
-                gammas = {}
-                for n_clust in range(2, 4):
-                    for gamma in range(0, 101, 1):
-                        scorett, tt, prop = _cluster_ab_compartments(
-                            float(gamma)/100, matrix, breaks, cmprts[sec],
-                            rich_in_A, ev_num=ev_num, log=logf, save=False,
-                            verbose=kwargs.get('verbose', False),
-                            n_clust=n_clust)
-                        gammas[gamma] = scorett, tt, prop
-                    gamma = min(gammas.keys(), key=lambda k: gammas[k][0])
-                    if gammas[gamma][0] - gammas[gamma][1] > 7:
-                        print (' WARNING: minimum showing very low '
-                               'intermeagling of A/B compartments, trying '
-                               'with 3 clusters, for chromosome %s', sec)
-                        gammas = {}
-                        continue
-                    if kwargs.get('verbose', False):
-                        print '   ====>  minimum:', gamma
-                    break
-                _ = _cluster_ab_compartments(float(gamma)/100, matrix, breaks,
-                                          cmprts[sec], rich_in_A, save=True,
-                                          log=logf, ev_num=ev_num, n_clust=n_clust)
-
+            ev_nums[sec] = ev_num
             if savefig or show:
                 vmin = kwargs.get('vmin', -1)
                 vmax = kwargs.get('vmax',  1)
@@ -709,15 +790,16 @@ class HiC_data(dict):
                 plot_compartments_summary(
                     sec, cmprts, show,
                     savefig + '/chr' + sec + suffix + '_summ.pdf' if savefig else None)
-            count += 1
 
         if label_compartments == 'hmm':
             x = {}
             for sec in self.section_pos:
-                try:
-                    x[sec] = firsts[sec][ev_nums[sec] - 1]
-                except KeyError:
+                if not sec in firsts:
                     continue
+                # eigenvector without the filtered columns
+                beg = self.section_pos[sec][0]
+                x[sec] = [v for i, v in enumerate(firsts[sec][ev_nums[sec] - 1])
+                          if not i + beg in self.bads]
 
             # train two HMMs on the genomic data:
             #  - one with 2 states A B
@@ -738,12 +820,13 @@ class HiC_data(dict):
                 if kwargs.get('verbose', False):
                     print 'Chromosome', sec
                 beg, end = self.section_pos[sec]
-                bads = [k - beg for k in self.bads if beg <= k <= end]
+                bads = [k - beg for k in self.bads if beg <= k < end]
                 n_states, breaks = _hmm_refine_compartments(
                     x, sec, models, bads, kwargs.get('verbose', False))
                 results[sec] = n_states, breaks
                 cmprts[sec] = breaks
-                self._apply_metric(cmprts, sec, rich_in_A, how=how)
+                oe = None if rich_in_A else self._compartment_oe(sec, upper)[0]
+                self._apply_metric(cmprts, sec, rich_in_A, how=how, oe=oe)
                 
                 if rich_in_A:
                     test = lambda x: x >= 1
@@ -796,11 +879,171 @@ class HiC_data(dict):
                                     ev_nums=ev_nums)
         return firsts
 
-    def _apply_metric(self, cmprts, sec, rich_in_A, how='ratio'):
+    def _compartment_oe(self, sec, upper=None):
+        """
+        Observed / expected interactions, normalized by visibility, of a
+        chromosome, computed from the upper triangle of the matrix.
+
+        :param sec: chromosome name
+        :param None upper: upper triangle of the full matrix, as a scipy CSR
+           matrix
+
+        :returns: the observed/expected matrix (with zeroes in the rows and
+           columns of filtered columns) and the mask of the columns kept
+        """
+        if upper is None:
+            upper = _upper_triangle(self)
+        beg, end = self.section_pos[sec]
+        good = self._good_array()[beg:end]
+        bias = np.array([self.bias.get(i, np.nan) for i in xrange(beg, end)])
+        expc = np.array([self.expected[d] for d in xrange(end - beg)],
+                        dtype=float)
+        dist = np.arange(end - beg)
+        dist = np.abs(dist[:, None] - dist[None, :])
+        with np.errstate(divide='ignore', invalid='ignore'):
+            oe = (upper[beg:end, beg:end].toarray().astype(float) /
+                  expc[dist] / bias[:, None] / bias[None, :])
+        # symmetric matrix from the upper triangle
+        oe = np.triu(oe) + np.triu(oe, 1).T
+        oe[~good] = 0
+        oe[:, ~good] = 0
+        return oe, good
+
+    def _sec_compartments(self, sec, upper, ev_index, max_mean_size, savecorr,
+                          label_compartments, rich_in_A, how, log, suffix,
+                          keep_matrix, verbose):
+        """
+        Search for compartments in one chromosome (see
+        :func:`pytadbit.hic_data.HiC_data.find_compartments`)
+
+        :returns: the list of compartments, the two first eigenvectors, the
+           index of the eigenvector used, and the eigenvector and correlation
+           matrix used (None if keep_matrix is False)
+        """
+        if verbose:
+            print 'Processing chromosome', sec
+        oe, good = self._compartment_oe(sec, upper)
+        if good.sum() < 2:
+            # MT chromosome will fall there
+            warn('Chromosome %s is probably MT :)' % (sec))
+            return [], None, None, None, None
+        matrix = corrcoef(oe[good][:, good])
+        # write correlation matrix to file. replaces filtered row/columns by NaN
+        if savecorr:
+            out = open(os.path.join(savecorr, '%s_corr-matrix.tsv' % (sec)),
+                       'w')
+            out.write('# MASKED %s\n' % (' '.join([str(k) for k in
+                                                   np.flatnonzero(~good)])))
+            if self.sections:
+                bins = [k[1] for k in sorted(self.sections,
+                                             key=lambda x: self.sections[x])
+                        if k[0] == sec]
+            else:
+                bins = range(len(good))
+            rownam = ['%s\t%d-%d' % (sec, k * self.resolution,
+                                     (k + 1) * self.resolution) for k in bins]
+            empty = '\t'.join(['NaN'] * len(good)) + '\n'
+            cols = np.flatnonzero(good)
+            for row in xrange(len(good)):
+                if not good[row]:
+                    out.write(rownam.pop(0) + '\t' + empty)
+                    continue
+                vals = ['NaN'] * len(good)
+                for col, val in zip(cols, matrix[good[:row].sum()]):
+                    vals[col] = str(val)
+                out.write(rownam.pop(0) + '\t' + '\t'.join(vals) + '\n')
+            out.close()
+
+        try:
+            # This eighs is very very fast, only ask for one eigvector.
+            # The starting vector is fixed, so that the sign of the
+            # eigenvectors does not depend on the order in which chromosomes
+            # are processed
+            v0 = np.random.RandomState(1).uniform(-1, 1, len(matrix))
+            _, evect = eigsh(matrix, k=ev_index or 2, v0=v0)
+        except (LinAlgError, ValueError):
+            warn('Chromosome %s too small to compute PC1' % (sec))
+            return [], None, None, None, None # Y chromosome, or so...
+        index = ev_index or 1
+        two_first = [evect[:, -1], evect[:, -2]]
+        for ev_num in range(index, 3):
+            first = evect[:, -ev_num]
+            breaks = _sign_changes(first)
+            if (self.resolution * (len(breaks) - 1.0) / len(matrix)
+                > max_mean_size):
+                warn('WARNING: number of compartments found with the '
+                     'EigenVector number %d is too low (%d compartments '
+                     'in %d rows), for chromosome %s' % (
+                         ev_num, len(breaks), len(matrix), sec))
+            else:
+                break
+        if (self.resolution * (len(breaks) - 1.0) / len(matrix)
+            > max_mean_size):
+            warn('WARNING: keeping first eigenvector, for chromosome %s' % (
+                sec))
+            ev_num = 1
+        # back to the full chromosome, with filtered columns
+        full = np.empty(len(good))
+        full.fill(np.nan)
+        for i, evect in enumerate(two_first):
+            two_first[i] = full.copy()
+            two_first[i][good] = evect
+            two_first[i] = two_first[i].tolist()
+        full[:] = 0
+        full[good] = first
+        first = full.tolist()
+        full = np.empty((len(good), len(good)))
+        full.fill(np.nan)
+        full[np.ix_(good, good)] = matrix
+        matrix = full
+        cmprts = {sec: _sign_changes(first)}
+        self._apply_metric(cmprts, sec, rich_in_A, how=how, oe=oe)
+
+        if label_compartments == 'cluster':
+            if log:
+                logf = os.path.join(log, sec + suffix + '.log')
+            else:
+                logf = None
+
+            # the correlation between compartments does not depend on gamma
+            cmprt_corr = _compartments_correlation(matrix, cmprts[sec])
+            gammas = {}
+            for n_clust in range(2, 4):
+                for gamma in range(0, 101, 1):
+                    scorett, tt, prop = _cluster_ab_compartments(
+                        float(gamma)/100, matrix, cmprts[sec], cmprts[sec],
+                        rich_in_A, ev_num=ev_num, log=logf, save=False,
+                        verbose=verbose, n_clust=n_clust,
+                        cmprt_corr=cmprt_corr)
+                    gammas[gamma] = scorett, tt, prop
+                gamma = min(gammas.keys(), key=lambda k: gammas[k][0])
+                if gammas[gamma][0] - gammas[gamma][1] > 7:
+                    print (' WARNING: minimum showing very low '
+                           'intermeagling of A/B compartments, trying '
+                           'with 3 clusters, for chromosome %s', sec)
+                    gammas = {}
+                    continue
+                if verbose:
+                    print '   ====>  minimum:', gamma
+                break
+            _ = _cluster_ab_compartments(float(gamma)/100, matrix, cmprts[sec],
+                                         cmprts[sec], rich_in_A, save=True,
+                                         log=logf, ev_num=ev_num,
+                                         n_clust=n_clust, cmprt_corr=cmprt_corr)
+        if not keep_matrix:
+            first = matrix = None
+        return cmprts[sec], two_first, ev_num, first, matrix
+
+    def _apply_metric(self, cmprts, sec, rich_in_A, how='ratio', oe=None):
         """
         calculate compartment internal density if no rich_in_A, otherwise
         sum this list
+
+        :param None oe: observed/expected matrix of the chromosome (see
+           :func:`pytadbit.hic_data.HiC_data._compartment_oe`)
         """
+        if not rich_in_A and oe is None:
+            oe, _ = self._compartment_oe(sec)
         for cmprt in cmprts[sec]:
             if rich_in_A:
                 beg1, end1 = cmprt['start'], cmprt['end'] + 1
@@ -812,34 +1055,22 @@ class HiC_data(dict):
                 except ZeroDivisionError:
                     cmprt['dens'] = 0.
             else:
-                beg, end = self.section_pos[sec]
-                beg1, end1 = cmprt['start'] + beg, cmprt['end'] + beg + 1
+                beg1, end1 = cmprt['start'], cmprt['end'] + 1
                 if 'diagonal' in how:
-                    sec_matrix = [(self[i,i] / self.expected[0] / self.bias[i]**2)
-                                  for i in xrange(beg1, end1) if not i in self.bads]
+                    sec_matrix = oe.diagonal()[beg1:end1].sum()
                 else: #if 'compartment' in how:
-                    sec_matrix = [(self[i,j] / self.expected[abs(j-i)]
-                                   / self.bias[i] / self.bias[j])
-                                  for i in xrange(beg1, end1) if not i in self.bads
-                                  for j in xrange(beg1, end1) if not j in self.bads]
+                    sec_matrix = oe[beg1:end1, beg1:end1].sum()
                 if '/compartment' in how: # diagonal / compartment
-                    sec_column = [(self[i,j] / self.expected[abs(j-i)]
-                                   / self.bias[i] / self.bias[j])
-                                  for i in xrange(beg1, end1) if not i in self.bads
-                                  for j in xrange(beg1, end1) if not j in self.bads]
+                    sec_column = oe[beg1:end1, beg1:end1].sum()
                 elif '/column' in how:
-                    sec_column = [(self[i,j] / self.expected[abs(j-i)]
-                                   / self.bias[i] / self.bias[j])
-                                  for i in xrange(beg1, end1) if not i in self.bads
-                                  for j in range(beg, end)
-                                  if not j in self.bads]
+                    sec_column = oe[beg1:end1].sum()
                 else:
-                    sec_column = [1.]
+                    sec_column = 1.
                 try:
                     if 'type' in cmprt and isnan(cmprt['type']):
                         cmprt['dens'] = 1.
                     else:
-                        cmprt['dens'] = float(sum(sec_matrix)) / sum(sec_column)
+                        cmprt['dens'] = float(sec_matrix) / float(sec_column)
                 except ZeroDivisionError:
                     cmprt['dens'] = 1.
         # normalize to 1.0
@@ -966,6 +1197,459 @@ class HiC_data(dict):
                            [0] + 
                            [self[i, j] for j in xrange(i + 1, end1)])
 
+class SparseHiC_data(HiC_data):
+    """
+    HiC_data object storing the interaction matrix as NumPy arrays instead of a
+    python dictionary.
+
+    Only the upper triangle of the (symmetric) matrix is kept, in Compressed
+    Sparse Row format (int32 column indices and uint32 counts, or float32 for
+    non-integer values). Cells are still accessible through
+    ``hic_data[i, j]`` or the linear position ``hic_data[i * size + j]``, and
+    the usual attributes (sections, section_pos, bads, bias...) are unchanged.
+
+    WARNING: as the matrix is symmetric, setting the value of cell (i, j) also
+       sets the value of cell (j, i).
+
+    :param items: iterable of (position, value) as for
+       :class:`pytadbit.hic_data.HiC_data`
+    :param size: number of rows (or columns) of the matrix
+    :param None dtype: numpy type to store values, by default inferred from the
+       values passed (uint32 for integers, float32 otherwise)
+    """
+    def __init__(self, items, size, chromosomes=None, dict_sec=None,
+                 resolution=1, masked=None, symmetricized=False, dtype=None):
+        super(SparseHiC_data, self).__init__((), size, chromosomes=chromosomes,
+                                             dict_sec=dict_sec,
+                                             resolution=resolution,
+                                             masked=masked,
+                                             symmetricized=symmetricized)
+        rows = []
+        cols = []
+        vals = []
+        for pos, val in items:
+            i, j = divmod(pos, size)
+            if i > j: # symmetric, lower triangle is redundant
+                continue
+            rows.append(i)
+            cols.append(j)
+            vals.append(val)
+        vals = np.asarray(vals)
+        if dtype is None:
+            dtype = (np.float32 if len(vals) and vals.dtype.kind == 'f'
+                     else np.uint32)
+        self._dtype = dtype
+        self._pending = {}
+        self._set_upper(coo_matrix((vals.astype(dtype), (rows, cols)),
+                                   shape=(size, size)))
+
+    @classmethod
+    def from_pairs(cls, rows, cols, size, **kwargs):
+        """
+        Creates a SparseHiC_data object from a list of interacting bins (one
+        entry per read).
+
+        :param rows: array with the bin of the first read of each pair
+        :param cols: array with the bin of the second read of each pair
+        :param size: number of rows (or columns) of the matrix
+        :param kwargs: passed to :class:`pytadbit.hic_data.SparseHiC_data`
+
+        :returns: a SparseHiC_data object
+        """
+        hic = cls((), size, **kwargs)
+        hic.add_pairs(rows, cols)
+        return hic
+
+    @classmethod
+    def from_coo(cls, rows, cols, vals, size, **kwargs):
+        """
+        Creates a SparseHiC_data object from the cells of the upper triangle of
+        the matrix.
+
+        :param rows: array with the row of each cell (rows <= cols)
+        :param cols: array with the column of each cell
+        :param vals: array with the value of each cell
+        :param size: number of rows (or columns) of the matrix
+        :param kwargs: passed to :class:`pytadbit.hic_data.SparseHiC_data`
+
+        :returns: a SparseHiC_data object
+        """
+        vals = np.asarray(vals)
+        if kwargs.get('dtype') is None:
+            kwargs['dtype'] = (np.float32 if vals.dtype.kind == 'f'
+                               else np.uint32)
+        hic = cls((), size, **kwargs)
+        hic._set_upper(coo_matrix((vals.astype(hic._dtype),
+                                   (np.asarray(rows), np.asarray(cols))),
+                                  shape=(size, size)))
+        return hic
+
+    def add_pairs(self, rows, cols):
+        """
+        Add interactions between pairs of bins (one entry per read). As in
+        :func:`pytadbit.parsers.hic_parser.load_hic_data_from_reads`, each pair
+        counts in cell (i, j) and in cell (j, i), which means that pairs falling
+        in the diagonal count twice.
+
+        :param rows: array with the bin of the first read of each pair
+        :param cols: array with the bin of the second read of each pair
+        """
+        rows = np.asarray(rows, dtype=np.int64)
+        cols = np.asarray(cols, dtype=np.int64)
+        if not len(rows):
+            return
+        beg = np.minimum(rows, cols)
+        end = np.maximum(rows, cols)
+        vals = np.where(beg == end, 2, 1).astype(self._dtype)
+        size = len(self)
+        self._consolidate()
+        self._set_upper(self._get_upper() + coo_matrix(
+            (vals, (beg, end)), shape=(size, size)).tocsr())
+
+    def _set_upper(self, mtrx):
+        """
+        stores a scipy sparse matrix (upper triangle) as CSR arrays
+        """
+        self._decay_cache = {}
+        mtrx = mtrx.tocsr()
+        mtrx.sum_duplicates()
+        mtrx.eliminate_zeros()
+        self._indptr  = mtrx.indptr.astype(np.int64)
+        self._indices = mtrx.indices.astype(np.int32)
+        self._data    = mtrx.data.astype(self._dtype)
+
+    def _get_upper(self):
+        """
+        :returns: the upper triangle of the matrix as a scipy CSR matrix
+        """
+        size = len(self)
+        indptr = self._indptr
+        if len(indptr) < size + 1: # size has changed (e.g. add_sections)
+            indptr = np.concatenate((indptr, [indptr[-1]] *
+                                     (size + 1 - len(indptr))))
+        return csr_matrix((self._data, self._indices, indptr[:size + 1]),
+                          shape=(size, size))
+
+    def _consolidate(self):
+        """
+        moves the cells modified through __setitem__ into the CSR arrays
+        """
+        if not self._pending:
+            return
+        size = len(self)
+        upper = self._get_upper().tocoo()
+        rows, cols = zip(*self._pending.keys())
+        rows = np.array(rows, dtype=np.int64)
+        cols = np.array(cols, dtype=np.int64)
+        vals = np.array(self._pending.values(), dtype=self._dtype)
+        keep = ~np.in1d(upper.row.astype(np.int64) * size + upper.col,
+                        rows * size + cols)
+        self._pending = {}
+        self._set_upper(coo_matrix(
+            (np.concatenate((upper.data[keep], vals)),
+             (np.concatenate((upper.row[keep], rows)),
+              np.concatenate((upper.col[keep], cols)))),
+            shape=(size, size)))
+
+    def _lookup(self, row, col):
+        if row > col:
+            row, col = col, row
+        try:
+            return self._pending[row, col]
+        except KeyError:
+            pass
+        if row + 1 >= len(self._indptr):
+            return 0
+        beg, end = self._indptr[row], self._indptr[row + 1]
+        pos = beg + self._indices[beg:end].searchsorted(col)
+        if pos < end and self._indices[pos] == col:
+            return self._data[pos].item()
+        return 0
+
+    def __getitem__(self, row_col):
+        try:
+            row, col = row_col
+        except TypeError:
+            if row_col > self._size2:
+                raise IndexError(
+                    'ERROR: position %d larger than %s^2' % (row_col,
+                                                             len(self)))
+            row, col = divmod(row_col, len(self))
+        if row * len(self) + col > self._size2:
+            raise IndexError(
+                'ERROR: row or column larger than %s' % len(self))
+        return self._lookup(row, col)
+
+    def __setitem__(self, row_col, val):
+        try:
+            row, col = row_col
+        except TypeError:
+            if row_col > self._size2:
+                raise IndexError(
+                    'ERROR: position %d larger than %s^2' % (row_col,
+                                                             len(self)))
+            row, col = divmod(row_col, len(self))
+        if row * len(self) + col > self._size2:
+            raise IndexError(
+                'ERROR: row or column larger than %s' % len(self))
+        if row > col:
+            row, col = col, row
+        self._pending[row, col] = val
+        if self._decay_cache:
+            self._decay_cache = {}
+
+    def __contains__(self, pos):
+        return self[pos] != 0
+
+    def __nonzero__(self):
+        return bool(self._pending) or bool(len(self._data))
+
+    def __eq__(self, other):
+        if not isinstance(other, HiC_data) or len(self) != len(other):
+            return False
+        if isinstance(other, SparseHiC_data):
+            diff = self.get_hic_data_as_csr() - other.get_hic_data_as_csr()
+            return not diff.nnz or not np.any(diff.data)
+        return dict(self.iteritems()) == dict(other.iteritems())
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __reduce__(self):
+        # avoid dictionary pickling, the storage is in the object attributes
+        self._consolidate()
+        from copy_reg import __newobj__
+        return __newobj__, (self.__class__,), self.__dict__
+
+    def _update_size(self, size):
+        self._consolidate()
+        super(SparseHiC_data, self)._update_size(size)
+
+    def get(self, pos, default=None):
+        val = self[pos]
+        return val if val else default
+
+    def nnz(self):
+        """
+        :returns: number of non-zero cells stored (upper triangle)
+        """
+        self._consolidate()
+        return len(self._data)
+
+    def iteritems(self):
+        """
+        Yields (position, value) for all non-zero cells of the full matrix,
+        as a HiC_data dictionary would.
+        """
+        self._consolidate()
+        size = len(self)
+        indptr, indices, data = self._indptr, self._indices, self._data
+        for i in xrange(len(indptr) - 1):
+            row = i * size
+            for k in xrange(indptr[i], indptr[i + 1]):
+                j = int(indices[k])
+                v = data[k].item()
+                yield row + j, v
+                if i != j:
+                    yield j * size + i, v
+
+    def items(self):
+        return list(self.iteritems())
+
+    def iterkeys(self):
+        for k, _ in self.iteritems():
+            yield k
+
+    __iter__ = iterkeys
+
+    def keys(self):
+        return list(self.iterkeys())
+
+    def itervalues(self):
+        for _, v in self.iteritems():
+            yield v
+
+    def values(self):
+        return list(self.itervalues())
+
+    def _bias_array(self, bias=None):
+        bias = bias or self.bias
+        return np.array([bias[i] for i in xrange(len(self))], dtype=float)
+
+    def sum(self, bias=None, bads=None):
+        """
+        Sum Hi-C data matrix
+        WARNING: parameters are not meant to be used by external users
+
+        :params None bias: expects a dictionary of biases to use normalized matrix
+        :params None bads: extends computed bad columns
+
+        :returns: the sum of the Hi-C matrix skipping bad columns
+        """
+        self._consolidate()
+        upper = self._get_upper().tocoo()
+        good = self._good_array(bads)
+        keep = good[upper.row] & good[upper.col]
+        rows = upper.row[keep]
+        cols = upper.col[keep]
+        vals = upper.data[keep].astype(float)
+        vals[rows != cols] *= 2
+        if bias:
+            bias = self._bias_array(bias)
+            return float((vals / bias[rows] / bias[cols]).sum())
+        vals = vals.sum()
+        return int(vals) if self._dtype == np.uint32 else float(vals)
+
+    def get_as_band(self, band, focus=None):
+        """
+        Returns the diagonal band of the matrix, as used by the banded version
+        of TADbit (see :func:`pytadbit.tadbit.tadbit`).
+
+        :param band: number of diagonals, above the main diagonal, to keep
+        :param None focus: a tuple with the (start, end) position of the desired
+           window of data (start, starting at 1, and both start and end are
+           inclusive). Alternatively a chromosome name can be input
+
+        :returns: a contiguous numpy array of int32, of length
+           size * (band + 1), where size is the number of rows in the window.
+           The count of cell (i, j), with 0 <= j - i <= band, is at position
+           i * (band + 1) + j - i
+        """
+        beg, end = self._focus_coords(focus)[:2]
+        size = end - beg
+        self._consolidate()
+        block = self._get_upper()[beg:end, beg:end].tocoo()
+        keep = block.col - block.row <= band
+        rows = block.row[keep].astype(np.int64)
+        cols = block.col[keep].astype(np.int64)
+        result = np.zeros(size * (band + 1), dtype=np.int32)
+        result[rows * (band + 1) + cols - rows] = block.data[keep]
+        return result
+
+    def get_hic_data_as_csr(self):
+        """
+        Returns a scipy sparse matrix in Compressed Sparse Row format of the HiC
+        data (full symmetric matrix)
+
+        :returns: scipy sparse matrix in Compressed Sparse Row format
+        """
+        self._consolidate()
+        upper = self._get_upper().astype(float)
+        diag = coo_matrix((upper.diagonal(), (np.arange(len(self)),
+                                              np.arange(len(self)))),
+                          shape=upper.shape)
+        return (upper + upper.T - diag).tocsr()
+
+    def _dense_block(self, upper, beg1, end1, beg2, end2, normalized):
+        """
+        builds a dense sub-matrix of the full symmetric matrix from its upper
+        triangle
+        """
+        dtype = float if normalized or self._dtype != np.uint32 else np.int64
+        block = (upper[beg1:end1, beg2:end2].toarray().astype(dtype) +
+                 upper[beg2:end2, beg1:end1].T.toarray().astype(dtype))
+        # the diagonal has been added twice
+        diag = np.arange(max(beg1, beg2), min(end1, end2))
+        if len(diag):
+            block[diag - beg1, diag - beg2] -= upper.diagonal()[diag]
+        if normalized:
+            bias = self._bias_array()
+            block = block / bias[beg1:end1, None] / bias[None, beg2:end2]
+        return block
+
+    def get_matrix(self, focus=None, diagonal=True, normalized=False):
+        """
+        returns a matrix.
+
+        :param None focus: a tuple with the (start, end) position of the desired
+           window of data (start, starting at 1, and both start and end are
+           inclusive). Alternatively a chromosome name can be input or a tuple
+           of chromosome name, in order to retrieve a specific inter-chromosomal
+           region
+        :param True diagonal: if False, diagonal is replaced by ones, or zeroes
+           if normalized
+        :param False normalized: get normalized data
+
+        :returns: matrix (a list of lists of values)
+        """
+        if normalized and not self.bias:
+            raise Exception('ERROR: experiment not normalized yet')
+        start1, end1, start2, end2 = self._focus_coords(focus)
+        self._consolidate()
+        mtrx = self._dense_block(self._get_upper(), start1, end1, start2, end2,
+                                 normalized)
+        if not diagonal and start1 == start2:
+            diag = np.arange(min(mtrx.shape))
+            if normalized:
+                mtrx[diag, diag] = 0
+            else:
+                mtrx[diag, diag] = mtrx[diag, diag] != 0
+        return mtrx.tolist()
+
+    def yield_matrix(self, focus=None, diagonal=True, normalized=False):
+        """
+        Yields a matrix line by line.
+        Bad row/columns are returned as null row/columns.
+
+        :param None focus: a tuple with the (start, end) position of the desired
+           window of data (start, starting at 1, and both start and end are
+           inclusive). Alternatively a chromosome name can be input or a tuple
+           of chromosome name, in order to retrieve a specific inter-chromosomal
+           region
+        :param True diagonal: if False, diagonal is replaced by zeroes
+        :param False normalized: get normalized data
+
+        :yields: matrix line by line (a line being a list of values)
+        """
+        if normalized and not self.bias:
+            raise Exception('ERROR: experiment not normalized yet')
+        start1, end1, start2, end2 = self._focus_coords(focus)
+        self._consolidate()
+        upper = self._get_upper()
+        chunk = 256 # rows densified at a time
+        for beg in xrange(start2, end2, chunk):
+            end = min(beg + chunk, end2)
+            block = self._dense_block(upper, beg, end, start1, end1, normalized)
+            for i in xrange(beg, end):
+                line = block[i - beg]
+                if i in self.bads:
+                    line[:] = 0
+                elif not diagonal and start1 == start2:
+                    line[i - start1] = 0
+                yield line.tolist()
+
+
+def _sec_compartments(sec, *args):
+    """
+    Search for compartments in one chromosome of the Hi-C data stored in
+    _COMPARTMENT_DATA (see :func:`pytadbit.hic_data.HiC_data._sec_compartments`)
+    """
+    hic_data, upper = _COMPARTMENT_DATA
+    return hic_data._sec_compartments(sec, upper, *args)
+
+def _sign_changes(first):
+    """
+    :returns: the list of compartments, delimited by the changes of sign of
+       the eigenvector
+    """
+    first = asarray(first)
+    breaks = np.flatnonzero(first[1:] * first[:-1] < 0).tolist() + [
+        len(first) - 1]
+    return [{'start': breaks[i-1] + 1 if i else 0, 'end': b}
+            for i, b in enumerate(breaks)]
+
+def _compartments_correlation(matrix, cmprtsec):
+    """
+    :returns: the mean correlation between each pair of compartments (NaNs,
+       from filtered columns, being ignored)
+    """
+    starts = [cmprt['start'] for cmprt in cmprtsec]
+    sizes = array([cmprt['end'] + 1 - cmprt['start'] for cmprt in cmprtsec],
+                  dtype=float)
+    sums = np.add.reduceat(np.add.reduceat(np.where(isnan(matrix), 0, matrix),
+                                           starts, axis=0), starts, axis=1)
+    return sums / sizes[None, :] / sizes[:, None]
+
 def _hmm_refine_compartments(x, sec, models, bads, verbose):
     prevll = float('-inf')
     prevdf = 0
@@ -1024,30 +1708,23 @@ def _training(x, n, verbose):
     
 def _cluster_ab_compartments(gamma, matrix, breaks, cmprtsec, rich_in_A, save=True,
                              ev_num=1, log=None, verbose=False, savefig=None,
-                             n_clust=2):
-    # function to convert correlation into distances
-
+                             n_clust=2, cmprt_corr=None):
+    """
+    :param None cmprt_corr: mean correlation between each pair of
+       compartments (see _compartments_correlation), computed from the
+       correlation matrix if not given
+    """
+    if cmprt_corr is None:
+        cmprt_corr = _compartments_correlation(matrix, cmprtsec)
+    # convert correlation into distances
     gamma += 1
-    func = lambda x: -abs(x)**gamma / x
-    funczero = lambda x: 0.0
-    # calculate distance_matrix
-    dist_matrix = [[0 for _ in xrange(len(breaks))]
-                   for _ in xrange(len(breaks))]
-    scores = {}
-    for k, cmprt in enumerate(cmprtsec):
-        beg1, end1 = cmprt['start'], cmprt['end'] + 1
-        diff1 = end1 - beg1
-        scores[(k,k)] = dist_matrix[k][k] = -1
-        for l in xrange(k + 1, len(cmprtsec)):
-            beg2, end2 = cmprtsec[l]['start'], cmprtsec[l]['end'] + 1
-            val = nansum([matrix[i][j] for i in xrange(beg1, end1)
-                          for j in xrange(beg2, end2)]) / (end2 - beg2) / diff1
-            try:
-                scores[(k,l)] = dist_matrix[k][l] = scores[(l,k)] = dist_matrix[l][k] = func(val)
-            except ZeroDivisionError:
-                scores[(k,l)] = dist_matrix[k][l] = scores[(l,k)] = dist_matrix[l][k] = funczero(val)
-            if isnan(scores[(k,l)]):
-                scores[(k,l)] = dist_matrix[k][l] = scores[(l,k)] = dist_matrix[l][k] = funczero(0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        dist_matrix = np.triu(-abs(cmprt_corr)**gamma / cmprt_corr, 1)
+    dist_matrix[isnan(dist_matrix)] = 0.
+    dist_matrix += dist_matrix.T
+    np.fill_diagonal(dist_matrix, -1)
+    scores = dict(((k, l), dist_matrix[k, l])
+                  for k in xrange(len(cmprtsec)) for l in xrange(len(cmprtsec)))
     # cluster compartments according to their correlation score
     try:
         clust = linkage(dist_matrix, method='ward')
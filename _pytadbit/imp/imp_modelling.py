@@ -6,30 +6,45 @@
 from pytadbit.imp.CONFIG           import CONFIG, NROUNDS, STEPS, LSTEPS
 from pytadbit.imp.structuralmodels import StructuralModels
 from pytadbit.imp.impmodel         import IMPmodel
+from pytadbit.imp.numpy_modelling  import generate_numpy_model
 from scipy                         import polyfit
 from math                          import fabs, pow as power
-from cPickle                       import load, dump
+from cPickle                       import load, dump, HIGHEST_PROTOCOL
+from cPickle                       import UnpicklingError
+from heapq                         import heappush, heappop
+from functools                     import partial
+from hashlib                       import md5
+from tempfile                      import TemporaryFile
 from sys                           import stdout
 from os.path                       import exists
+from os                            import remove
+from time                          import time
 import multiprocessing as mu
+import numpy as np
 
-import IMP.core
-import IMP.algebra
-import IMP.display
-from IMP.container import ListSingletonContainer
-from IMP import Model
-from IMP import FloatKey
+try:
+    import IMP.core
+    import IMP.algebra
+    import IMP.display
+    from IMP.container import ListSingletonContainer
+    from IMP import Model
+    from IMP import FloatKey
+    IMP.set_check_level(IMP.NONE)
+    IMP.set_log_level(IMP.SILENT)
+except ImportError:
+    # models can still be generated with the numpy backend
+    IMP = None
 
-
-IMP.set_check_level(IMP.NONE)
-IMP.set_log_level(IMP.SILENT)
+# restraints between particles, as returned by addHarmonicPair(dry=True)
+RESTRAINT_TYPES = ('addHn', 'addHu', 'addHa', 'addHl')
 
 
 def generate_3d_models(zscores, resolution, nloci, start=1, n_models=5000,
                        n_keep=1000, close_bins=1, n_cpus=1, keep_all=False,
                        verbose=0, outfile=None, config=None,
                        values=None, experiment=None, coords=None, zeros=None,
-                       first=None, container=None):
+                       first=None, container=None, checkpoint=None,
+                       backend='imp'):
     """
     This function generates three-dimensional models starting from Hi-C data. 
     The final analysis will be performed on the n_keep top models.
@@ -113,11 +128,24 @@ def generate_3d_models(zscores, resolution, nloci, start=1, n_models=5000,
        micrometers length and 0.5 micrometer of width), these values could be 
        used: ['cylinder', 250, 1500, 50], and for a typical mammalian nuclei
        (6 micrometers diameter): ['cylinder', 3000, 0, 50]
+    :param None checkpoint: path to a file where finished models are saved
+       while they are generated. An interrupted run resumes from the models
+       in this file (the file is removed once all models are done)
+    :param imp backend: library used to build and optimize the models, 'imp'
+       or 'numpy' (same restraints and optimization schedule, implemented
+       with NumPy, see :func:`pytadbit.imp.numpy_modelling.generate_numpy_model`)
 
     :returns: a StructuralModels object
 
     """
 
+    if backend not in ('imp', 'numpy'):
+        raise ValueError('ERROR: backend should be either "imp" or "numpy", '
+                         'not "%s"\n' % backend)
+    if backend == 'imp' and IMP is None:
+        raise ImportError('IMP not found, check PYTHONPATH, or use '
+                          'backend="numpy"\n')
+
     # Main config parameters
     global CONFIG
     CONFIG = config or CONFIG['dmel_01']
@@ -180,9 +208,14 @@ def generate_3d_models(zscores, resolution, nloci, start=1, n_models=5000,
     global VERBOSE
     VERBOSE = verbose
     #VERBOSE = 3
+    # restraints are the same for all models, computed once here and
+    # inherited by the processes generating the models
+    global RESTRAINTS
+    RESTRAINTS = compute_restraints()
 
     models, bad_models = multi_process_model_generation(
-        n_cpus, n_models, n_keep, keep_all)
+        n_cpus, n_models, n_keep, keep_all, checkpoint=checkpoint,
+        backend=backend)
 
     try:
         xpr = experiment
@@ -228,113 +261,214 @@ def generate_3d_models(zscores, resolution, nloci, start=1, n_models=5000,
 def _get_restraints():
     """
     Same function as addAllHarmonic but just to get restraints
-    """
-    model = {'rk'    : IMP.FloatKey("radius"),
-             'model' : Model(),
-             'rs'    : None, # 2.6.1 compat 
-             'ps'    : None}
-    model['ps'] = ListSingletonContainer(IMP.core.create_xyzr_particles(
-        model['model'], len(LOCI), RADIUS, 100000))
-    model['ps'].set_name("")
 
-    # set container
-    try:
-        model['rs'] = IMP.RestraintSet(model['model']) # 2.6.1 compat 
-    except:
-        pass
-    model['container'] = CONFIG['container']
-    if model['container']['shape'] == 'cylinder':
-         # define a segment of a given size
-        segment = IMP.algebra.Segment3D(
-            IMP.algebra.Vector3D(0,0,0),
-            IMP.algebra.Vector3D(model['container']['height'],0,0))
-        bb = IMP.algebra.get_bounding_box(segment)
-        rb = IMP.container.SingletonsRestraint(
-            IMP.core.BoundingBox3DSingletonScore(
-                IMP.core.HarmonicUpperBound(model['container']['radius'],
-                                            model['container']['cforce']), bb),
-            model['ps'])
-	try:
-	       model['model'].add_restraint(rb)
-	except:
-	       model['rs'].add_restraint(rb) # 2.6.1 compat
-        rb.evaluate(False)
-    # elif model['container']['shape']:
-    #     raise noti
-    
-    for i in range(0, len(LOCI)):
-        p = model['ps'].get_particle(i)
-        p.set_name(str(LOCI[i]))
-        #p.set_value(model['rk'], RADIUS)
+    :returns: a dictionary with, for each pair of particle names, the type
+       of restraint (H, L, U or C), the distance and the force
+    """
+    kinds, pairs, dists, kforces = RESTRAINTS
     restraints = {}
-    for i in range(len(LOCI)):
-        p1 = model['ps'].get_particle(i)
-        x = p1.get_name()
-        if model['container']['shape'] == 'sphere':
-            ub  = IMP.core.HarmonicUpperBound(
-                model['container']['properties'][0], CONFIG['kforce'] * 10)
-            ss  = IMP.core.DistanceToSingletonScore(
-                ub, model['container']['center'])
-            rss = IMP.core.SingletonRestraint(ss, p1)
-            try:
-	            model['model'].add_restraint(rss) 
-            except:
-	            model['rs'].add_restraint(rss) # 2.6.1 compat
-            rss.evaluate(False)
-        for j in range(i+1, len(LOCI)):
-            p2 = model['ps'].get_particle(j)
-            y = p2.get_name()
-            typ, dist, frc = addHarmonicPair(model, p1, p2, x, y, j, dry=True)
-            if VERBOSE >= 1:
-                stdout.write('%s\t%s\t%s\t%s\t%s\n' % (typ, x, y, dist, frc))
-            if typ[-1] == 'a':
-                typ = 'H'
-            elif typ[-1] == 'l':
-                typ = 'L'
-            elif typ[-1] == 'u':
-                typ = 'U'
-            elif typ[-1] == 'n':
-                typ = 'C'
-            else:
-                continue
-            restraints[tuple(sorted((x, y)))] = typ[-1], dist, frc
+    for kind, (i, j), dist, frc in zip(kinds.tolist(), pairs.tolist(),
+                                       dists.tolist(), kforces.tolist()):
+        x, y = str(LOCI[i]), str(LOCI[j])
+        typ = RESTRAINT_TYPES[kind]
+        if VERBOSE >= 1:
+            stdout.write('%s\t%s\t%s\t%s\t%s\n' % (typ, x, y, dist, frc))
+        # H: harmonic, L: lower bound, U: upper bound, C: neighbors
+        restraints[tuple(sorted((x, y)))] = 'CUHL'[kind], dist, frc
     return restraints
 
 
-def multi_process_model_generation(n_cpus, n_models, n_keep, keep_all):
+def compute_restraints():
+    """
+    Computes the restraints between all pairs of particles (see
+    :func:`addHarmonicPair`). They only depend on the Z-scores and on the
+    modelling parameters, so they are computed once for all the models.
+
+    :returns: four arrays, with, for each restraint, its type (index in
+       RESTRAINT_TYPES), the indexes of the two particles, the distance and
+       the force
+    """
+    names = [str(l) for l in LOCI]
+    kinds   = []
+    pairs   = []
+    dists   = []
+    kforces = []
+    for i in xrange(len(LOCI)):
+        for j in xrange(i + 1, len(LOCI)):
+            typ, dist, kforce = pair_restraint(names[i], names[j])
+            if typ == 'no':
+                continue
+            kinds.append(RESTRAINT_TYPES.index(typ))
+            pairs.append((i, j))
+            dists.append(dist)
+            kforces.append(kforce)
+    return (np.array(kinds, dtype=np.int8),
+            np.array(pairs, dtype=np.int32).reshape(-1, 2),
+            np.array(dists, dtype=float), np.array(kforces, dtype=float))
+
+
+def multi_process_model_generation(n_cpus, n_models, n_keep, keep_all,
+                                   checkpoint=None, backend='imp'):
     """
     Parallelize the
     :func:`pytadbit.imp.imp_model.StructuralModels.generate_IMPmodel`.
 
+    Models are collected as they are finished, only the best n_keep being
+    kept in memory (the others are written to a temporary file if keep_all,
+    discarded otherwise).
+
     :param n_cpus: number of CPUs to use
     :param n_models: number of models to generate
+    :param None checkpoint: path to a file where each finished model is
+       saved. If the file exists, the models already in it are not computed
+       again (it must have been written with the same particles, parameters
+       and restraints). The file is removed once all models are generated.
+    :param imp backend: library used to build and optimize the models, 'imp'
+       or 'numpy'
     """
+    rand_inits = range(START, n_models + START)
+    kept = []
+    spill = TemporaryFile() if keep_all else None
+    def collect(rand_init, model):
+        # heap on the worst model kept (higher objfun, then higher rand_init)
+        heappush(kept, (-model['objfun'], -rand_init, model))
+        if len(kept) > n_keep:
+            _, rand_init, model = heappop(kept)
+            if keep_all:
+                dump((-rand_init, model), spill, HIGHEST_PROTOCOL)
+
+    done = set()
+    out = None
+    if checkpoint and exists(checkpoint):
+        for rand_init, model in _load_checkpoint(checkpoint, backend):
+            if rand_init in done or not START <= rand_init < n_models + START:
+                continue
+            done.add(rand_init)
+            collect(rand_init, model)
+        if VERBOSE:
+            stdout.write('Resuming from %s: %d models already computed\n' % (
+                checkpoint, len(done)))
+        out = open(checkpoint, 'ab')
+    elif checkpoint:
+        out = open(checkpoint, 'wb')
+        dump(_checkpoint_header(backend), out, HIGHEST_PROTOCOL)
+        out.flush()
 
     pool = mu.Pool(n_cpus)
-    jobs = {}
-    for rand_init in xrange(START, n_models + START):
-        jobs[rand_init] = pool.apply_async(generate_IMPmodel,
-                                           args=(rand_init,))
-
-    pool.close()
-    pool.join()
-
-    results = []
-    for rand_init in xrange(START, n_models + START):
-        results.append((rand_init, jobs[rand_init].get()))   
+    try:
+        for rand_init, model in pool.imap_unordered(
+            partial(_generate_model, backend=backend),
+            [r for r in rand_inits if not r in done]):
+            if out:
+                dump((rand_init, model), out, HIGHEST_PROTOCOL)
+                out.flush()
+            collect(rand_init, model)
+    finally:
+        # all models are generated, or one failed (or the run was
+        # interrupted) and the others are not waited for
+        pool.terminate()
+        pool.join()
 
     models = {}
     bad_models = {}
-    for i, (_, m) in enumerate(
-        sorted(results, key=lambda x: x[1]['objfun'])[:n_keep]):
+    for i, (_, _, m) in enumerate(sorted(kept, reverse=True)):
         models[i] = m
     if keep_all:
-        for i, (_, m) in enumerate(
-        sorted(results, key=lambda x: x[1]['objfun'])[n_keep:]):
-            bad_models[i+n_keep] = m
+        spill.seek(0)
+        results = []
+        while True:
+            try:
+                results.append(load(spill))
+            except EOFError:
+                break
+        spill.close()
+        for i, (_, m) in enumerate(sorted(results,
+                                          key=lambda x: (x[1]['objfun'], x[0]))):
+            bad_models[i + n_keep] = m
+    if out:
+        out.close()
+        remove(checkpoint)
     return models, bad_models
 
 
+def _checkpoint_header(backend):
+    """
+    First record of a checkpoint file, describing the run: the particles,
+    the modelling parameters (and backend) and a hash of the Z-scores and
+    restraints.
+    """
+    digest = md5(repr(sorted((i, sorted(PDIST[i].items())) for i in PDIST)))
+    for array in RESTRAINTS:
+        digest.update(np.ascontiguousarray(array).data)
+    return {'loci'      : (LOCI[0], len(LOCI)),
+            'radius'    : RADIUS,
+            'config'    : CONFIG,
+            'backend'   : backend,
+            'restraints': digest.hexdigest()}
+
+
+def _load_checkpoint(checkpoint, backend):
+    """
+    Checks the header of a checkpoint file (see :func:`_checkpoint_header`),
+    and returns an iterator over the models saved in it.
+
+    :raises: ValueError if the checkpoint was written by a different run
+    """
+    handler = open(checkpoint, 'r+b')
+    header = _checkpoint_header(backend)
+    try:
+        saved = load(handler)
+    except (EOFError, UnpicklingError, ValueError, KeyError, IndexError):
+        # interrupted while writing the header: no model saved
+        handler.seek(0)
+        handler.truncate()
+        dump(header, handler, HIGHEST_PROTOCOL)
+        saved = header
+    if saved != header:
+        handler.close()
+        raise ValueError(('ERROR: checkpoint %s was written with other ' +
+                          'particles, parameters or Z-scores, remove it or ' +
+                          'use another file\n') % (checkpoint))
+    return _iter_checkpoint(handler)
+
+
+def _iter_checkpoint(handler):
+    """
+    Iterates over the models saved in a checkpoint file. Stops at the first
+    incomplete one (in case the run was interrupted while saving it), and
+    truncates the file there, so that new models can be appended.
+    """
+    while True:
+        good = handler.tell()
+        try:
+            yield load(handler)
+        except (EOFError, UnpicklingError, ValueError, KeyError, IndexError):
+            break
+    handler.truncate(good)
+    handler.close()
+
+
+def _generate_model(rand_init, backend='imp'):
+    """
+    Generates one model with the selected backend (see
+    :func:`generate_IMPmodel` and
+    :func:`pytadbit.imp.numpy_modelling.generate_numpy_model`)
+
+    :param rand_init: random number kept as model key, for reproducibility
+    :param imp backend: 'imp' or 'numpy'
+
+    :returns: the random initial number and the model
+    """
+    if backend == 'numpy':
+        verbose = VERBOSE
+        if rand_init == START and verbose == 0.5:
+            verbose = 1
+        return rand_init, generate_numpy_model(
+            rand_init, RESTRAINTS, len(LOCI), RADIUS, CONFIG['kforce'],
+            container=CONFIG['container'], verbose=verbose)
+    return rand_init, generate_IMPmodel(rand_init)
+
+
 def generate_IMPmodel(rand_init):
     """
     Generates one IMP model
@@ -346,6 +480,7 @@ def generate_IMPmodel(rand_init):
 
     """
     verbose = VERBOSE
+    t0 = time()
     IMP.random_number_generator.seed(rand_init)
 
     log_energies = []
@@ -450,6 +585,7 @@ def generate_IMPmodel(rand_init):
          "nrounds: %i, steps: %i, lsteps: %i" % (NROUNDS, STEPS, LSTEPS)
 
     # Start optimization and save an VRML after 100 MC moves
+    t1 = time()
     try:
 	     log_energies.append(model['model'].evaluate(False))
     except:
@@ -525,6 +661,9 @@ def generate_IMPmodel(rand_init):
         if verbose >= 2 or not rand_init % 100:
             print 'Model %s IMP Objective Function: %s' % (
                 rand_init, log_energies[-1])
+        if verbose >= 2:
+            print '   setup: %.3f s, optimization: %.3f s' % (t1 - t0,
+                                                             time() - t1)
     x, y, z, radius = (FloatKey("x"), FloatKey("y"),
                        FloatKey("z"), FloatKey("radius"))
     result = IMPmodel({'log_objfun' : log_energies,
@@ -549,15 +688,16 @@ def generate_IMPmodel(rand_init):
 
 def addAllHarmonics(model):
     """
-    Add harmonics to all pair of particles.
+    Add harmonics to all pair of particles, replaying the restraints computed
+    once for all models (see :func:`compute_restraints`).
     """
-    for i in range(len(LOCI)):
-        p1 = model['ps'].get_particle(i)
-        x = p1.get_name()
-        for j in range(i+1, len(LOCI)):
-            p2 = model['ps'].get_particle(j)
-            y = p2.get_name()
-            addHarmonicPair(model, p1, p2, x, y, j)
+    adders = (addHarmonicNeighborsRestraints, addHarmonicUpperBoundRestraints,
+              addHarmonicRestraints, addHarmonicLowerBoundRestraints)
+    kinds, pairs, dists, kforces = RESTRAINTS
+    particle = model['ps'].get_particle
+    for kind, (i, j), dist, kforce in zip(kinds.tolist(), pairs.tolist(),
+                                          dists.tolist(), kforces.tolist()):
+        adders[kind](model, particle(i), particle(j), dist, kforce)
 
 
 def addHarmonicPair(model, p1, p2, x, y, j, dry=False):
@@ -571,8 +711,32 @@ def addHarmonicPair(model, p1, p2, x, y, j, dry=False):
     :param x: first particle name
     :param y: second particle name
     :param j: id of second particle
-    :param num_loci1: index of the first particle
-    :param num_loci2: index of the second particle
+    :param False dry: only return the restraint (see :func:`pair_restraint`)
+    """
+    restraint = pair_restraint(x, y)
+    if dry:
+        return restraint
+    typ, dist, kforce = restraint
+    if typ == 'addHn':
+        addHarmonicNeighborsRestraints(model, p1, p2, dist, kforce)
+    elif typ == 'addHu':
+        addHarmonicUpperBoundRestraints(model, p1, p2, dist, kforce)
+    elif typ == 'addHa':
+        addHarmonicRestraints(model, p1, p2, dist, kforce)
+    elif typ == 'addHl':
+        addHarmonicLowerBoundRestraints(model, p1, p2, dist, kforce)
+
+
+def pair_restraint(x, y):
+    """
+    Restraint between a given pair of particles (all particles having a
+    radius RADIUS)
+
+    :param x: first particle name
+    :param y: second particle name
+
+    :returns: the type of restraint (one of RESTRAINT_TYPES, or 'no'), the
+       distance and the force
     """
     num_loci1, num_loci2 = int(x), int(y)
     seqdist = num_loci2 - num_loci1
@@ -582,29 +746,16 @@ def addHarmonicPair(model, p1, p2, x, y, j, dry=False):
     if seqdist == 1:
         kforce = CONFIG['kforce']
         if x in PDIST and y in PDIST[x] and PDIST[x][y] > CONFIG['upfreq']:
-            dist = distConseq12(PDIST[p1.get_name()][p2.get_name()])
-            if not dry:
-                addHarmonicNeighborsRestraints(model, p1, p2, dist, kforce)
-            else:
-                return ("addHn", dist, kforce)
+            dist = distConseq12(PDIST[x][y])
+            return ("addHn", dist, kforce)
         else:
-            dist = (p1.get_value(model['rk']) + p2.get_value(model['rk']))
-            # dist = (p1.get_value(rk) + p2.get_value(rk))
-            if not dry:
-                addHarmonicUpperBoundRestraints(model, p1, p2, dist, kforce)
-            else:
-                return ("addHu", dist, kforce)
+            dist = RADIUS + RADIUS
+            return ("addHu", dist, kforce)
     # SHORT RANGE DISTANCE BETWEEN TWO SEQDIST = 2
     elif seqdist == 2:
-        p3 = model['ps'].get_particle(j-1)
         kforce = CONFIG['kforce']
-        dist = (p1.get_value(model['rk']) + p2.get_value(model['rk'])
-                + 2.0 * p3.get_value(model['rk']))
-        # dist = (p1.get_value(rk) + p2.get_value(rk))
-        if not dry:
-            addHarmonicUpperBoundRestraints(model, p1, p2, dist, kforce)
-        else:
-            return ("addHu", dist, kforce)
+        dist = RADIUS + RADIUS + 2.0 * RADIUS
+        return ("addHu", dist, kforce)
     # LONG RANGE DISTANCE DISTANCE BETWEEN TWO NON-CONSECUTIVE LOCI
     elif x in PDIST and y in PDIST[x]:
         freq = PDIST[x][y]
@@ -633,19 +784,12 @@ def addHarmonicPair(model, p1, p2, x, y, j, dry=False):
 
     # FREQUENCY > UPFREQ
     if freq > CONFIG['upfreq']:
-        if not dry:
-            addHarmonicRestraints(model, p1, p2, distance(freq), kforce)
-        else:
-            return ("addHa", distance(freq), kforce)
+        return ("addHa", distance(freq), kforce)
     # FREQUENCY > LOW THIS HAS TO BE THE THRESHOLD FOR
     # "PHYSICAL INTERACTIONS"
     elif freq < CONFIG['lowfreq']:
-        if not dry:
-            addHarmonicLowerBoundRestraints(model, p1, p2, distance(freq), kforce)
-        else:
-            return ("addHl", distance(freq), kforce)
-    if dry:
-        return restraint
+        return ("addHl", distance(freq), kforce)
+    return restraint
 
 def distConseq12(freq):
     """
@@ -0,0 +1,290 @@
+"""
+18 Oct 2026
+
+Generation of 3D models without IMP. The restraints, the excluded volume,
+the container and the Monte Carlo with local optimization schedule are the
+same as in :func:`pytadbit.imp.imp_modelling.generate_IMPmodel`, with the
+objective function and its gradient computed with NumPy.
+"""
+
+from pytadbit.imp.CONFIG   import NROUNDS, STEPS, LSTEPS
+from pytadbit.imp.impmodel import IMPmodel
+from scipy.optimize        import minimize
+from itertools             import product
+from math                  import fabs, exp
+from time                  import time
+import numpy as np
+
+
+# neighboring cells of a cell list, each pair of cells being seen only once
+_HALF_SHELL = [off for off in product((-1, 0, 1), repeat=3) if off > (0, 0, 0)]
+# below this number of particles, comparing all pairs is faster than the cell
+# list
+CELL_LIST_MIN = 150
+
+
+def generate_numpy_model(rand_init, restraints, nloci, radius, kforce,
+                         container=None, verbose=0):
+    """
+    Generates one model
+
+    :param rand_init: random number kept as model key, for reproducibility
+    :param restraints: restraints between particles, as returned by
+       :func:`pytadbit.imp.imp_modelling.compute_restraints`
+    :param nloci: number of particles
+    :param radius: radius of the particles
+    :param kforce: force of the excluded volume restraint
+    :param None container: dictionary describing the container (see
+       :func:`pytadbit.imp.imp_modelling.generate_3d_models`)
+    :param 0 verbose: print the objective function of the model (1, every
+       100 models; 2, all models), and the optimization (3)
+
+    :returns: a model, that is a dictionary with the log of the objective
+       function value optimization, and the coordinates of each particles.
+    """
+    t0 = time()
+    rnd = np.random.RandomState(rand_init)
+    energy = ObjectiveFunction(restraints, nloci, radius, kforce, container)
+    # same initial box as IMP.core.create_xyzr_particles
+    coords = rnd.uniform(0, 100000, size=(nloci, 3))
+    log_energies = [energy(coords)]
+    t1 = time()
+
+    # simulated annealing, with the same schedule as the IMP models
+    endLoopCount = 0
+    stopCount = 10
+    endLoopValue = 0.00001
+    alpha = 1.0 * nloci
+    hightemp = int(0.025 * NROUNDS)
+    lownrj = log_energies[-1]
+    for i in range(0, NROUNDS):
+        temperature = alpha * (1.1 * NROUNDS - i) / NROUNDS
+        coords, nrj = _monte_carlo(coords, log_energies[-1], energy,
+                                   temperature, rnd)
+        log_energies.append(nrj)
+        if verbose == 3:
+            print i, log_energies[-1], temperature
+        # During the firsts hightemp iterations, do not stop the optimization
+        if i < hightemp:
+            lownrj = log_energies[-1]
+            continue
+        if lownrj > 0:
+            deltaE = fabs((log_energies[-1] - lownrj) / lownrj)
+        else:
+            deltaE = log_energies[-1]
+        if (deltaE < endLoopValue and endLoopCount == stopCount):
+            break
+        elif (deltaE < endLoopValue and endLoopCount < stopCount):
+            endLoopCount += 1
+            lownrj = log_energies[-1]
+        else:
+            endLoopCount = 0
+            lownrj = log_energies[-1]
+    log_energies.append(energy(coords))
+    if verbose >= 1:
+        if verbose >= 2 or not rand_init % 100:
+            print 'Model %s NumPy Objective Function: %s' % (
+                rand_init, log_energies[-1])
+        if verbose >= 2:
+            print '   setup: %.3f s, optimization: %.3f s' % (t1 - t0,
+                                                             time() - t1)
+    return IMPmodel({'log_objfun' : log_energies,
+                     'objfun'     : log_energies[-1],
+                     'x'          : coords[:, 0].tolist(),
+                     'y'          : coords[:, 1].tolist(),
+                     'z'          : coords[:, 2].tolist(),
+                     'radius'     : radius,
+                     'cluster'    : 'Singleton',
+                     'rand_init'  : str(rand_init)})
+
+
+def _monte_carlo(coords, current, energy, temperature, rnd):
+    """
+    STEPS steps of Monte Carlo with local optimization (as
+    IMP.core.MonteCarloWithLocalOptimization, returning the best
+    configuration found): each particle is moved following a normal
+    distribution, the move is relaxed with LSTEPS steps of conjugate
+    gradients and accepted following the Metropolis criterion.
+
+    :param coords: array of coordinates, one row per particle
+    :param current: objective function of these coordinates
+
+    :returns: the best coordinates, and their objective function
+    """
+    shape = coords.shape
+    best = current
+    best_coords = coords
+    for _ in xrange(STEPS):
+        moved = coords + rnd.normal(0, 0.25, size=shape)
+        result = minimize(energy.with_gradient, moved.ravel(), jac=True,
+                          method='CG', options={'maxiter': LSTEPS})
+        nrj = result.fun
+        if nrj < current or rnd.random_sample() < exp(
+            -(nrj - current) / temperature):
+            coords = result.x.reshape(shape)
+            current = nrj
+            if nrj < best:
+                best = nrj
+                best_coords = coords
+    return best_coords, best
+
+
+class ObjectiveFunction(object):
+    """
+    Objective function of a model: harmonic restraints between particles
+    (harmonic, upper and lower bounds), excluded volume between particles,
+    and container.
+
+    :param restraints: restraints between particles, as returned by
+       :func:`pytadbit.imp.imp_modelling.compute_restraints`
+    :param nloci: number of particles
+    :param radius: radius of the particles
+    :param kforce: force of the excluded volume restraint
+    :param None container: dictionary describing the container (only
+       cylinders are supported, as with IMP)
+    """
+    def __init__(self, restraints, nloci, radius, kforce, container=None):
+        kinds, pairs, dists, kforces = restraints
+        self.nloci   = nloci
+        self.radius  = radius
+        self.kforce  = kforce
+        self.pairs   = pairs.astype(int)
+        self.dists   = dists
+        self.kforces = kforces
+        # neighbors (0) and harmonic (2) restraints apply at any distance
+        self.harmonic = (kinds == 0) | (kinds == 2)
+        self.upper    = kinds == 1
+        self.lower    = kinds == 3
+        if nloci < CELL_LIST_MIN:
+            self.all_pairs = np.triu_indices(nloci, 1)
+        else:
+            self.all_pairs = None
+        if container and container.get('shape') == 'cylinder':
+            self.container = (container['radius'], container['height'],
+                              container['cforce'])
+        else:
+            self.container = None
+
+    def __call__(self, coords):
+        """
+        :param coords: array of coordinates, one row per particle
+
+        :returns: the value of the objective function
+        """
+        return self.with_gradient(coords, gradient=False)
+
+    def with_gradient(self, coords, gradient=True):
+        """
+        :param coords: array of coordinates, one row per particle, or
+           flattened
+        :param True gradient: also compute the gradient
+
+        :returns: the value of the objective function, and its gradient (as
+           a flat array)
+        """
+        coords = coords.reshape(self.nloci, 3)
+        grad = np.zeros_like(coords) if gradient else None
+        nrj = _pair_harmonics(coords, self.pairs[:, 0], self.pairs[:, 1],
+                              self.dists, self.kforces, self.harmonic,
+                              self.upper, self.lower, grad)
+        # excluded volume (soft spheres)
+        diameter = 2. * self.radius
+        if self.all_pairs is None:
+            idx1, idx2 = close_pairs(coords, diameter)
+        else:
+            idx1, idx2 = self.all_pairs
+            diff = coords[idx1] - coords[idx2]
+            close = (diff**2).sum(axis=1) < diameter**2
+            idx1, idx2 = idx1[close], idx2[close]
+        nrj += _pair_harmonics(coords, idx1, idx2, diameter, self.kforce,
+                               False, False, True, grad)
+        if self.container:
+            nrj += _cylinder(coords, grad, *self.container)
+        if gradient:
+            return nrj, grad.ravel()
+        return nrj
+
+
+def _pair_harmonics(coords, idx1, idx2, dists, kforces, harmonic, upper,
+                    lower, grad=None):
+    """
+    Harmonic restraints on the distances between pairs of particles, the
+    gradient being added to grad (if not None)
+    """
+    diff = coords[idx1] - coords[idx2]
+    dist = np.sqrt((diff**2).sum(axis=1))
+    resid = dist - dists
+    active = harmonic | (upper & (resid > 0)) | (lower & (resid < 0))
+    resid = np.where(active, resid, 0.)
+    nrj = 0.5 * (kforces * resid**2).sum()
+    if grad is not None and len(dist):
+        with np.errstate(divide='ignore', invalid='ignore'):
+            force = np.where(dist > 0, kforces * resid / dist, 0.)
+        force = diff * force[:, None]
+        nloci = len(coords)
+        for axis in xrange(3):
+            grad[:, axis] += (np.bincount(idx1, force[:, axis], nloci) -
+                              np.bincount(idx2, force[:, axis], nloci))
+    return nrj
+
+
+def _cylinder(coords, grad, radius, height, cforce):
+    """
+    Harmonic upper bound on the distance of each particle to the axis of the
+    cylinder (segment from the origin to (height, 0, 0)), the gradient being
+    added to grad (if not None)
+    """
+    diff = coords.copy()
+    diff[:, 0] = np.where(coords[:, 0] < 0, coords[:, 0],
+                          np.maximum(coords[:, 0] - height, 0))
+    dist = np.sqrt((diff**2).sum(axis=1))
+    resid = np.maximum(dist - radius, 0)
+    if grad is not None:
+        with np.errstate(divide='ignore', invalid='ignore'):
+            force = np.where(resid > 0, cforce * resid / dist, 0.)
+        grad += diff * force[:, None]
+    return 0.5 * cforce * (resid**2).sum()
+
+
+def close_pairs(coords, cutoff):
+    """
+    Pairs of particles closer than a given distance, found with a cell list:
+    space is divided in cubic cells of side cutoff, and each particle is only
+    compared to the particles in its cell and in the neighboring ones.
+
+    :param coords: array of coordinates, one row per particle
+    :param cutoff: distance
+
+    :returns: two arrays with the indexes of the first and second particles
+       of each pair
+    """
+    nloci = len(coords)
+    cells = np.floor(coords / cutoff).astype(np.int64)
+    cells -= cells.min(axis=0) - 1
+    dims = cells.max(axis=0) + 2
+    keys = (cells[:, 0] * dims[1] + cells[:, 1]) * dims[2] + cells[:, 2]
+    order = np.argsort(keys, kind='mergesort')
+    uniq, starts, counts = np.unique(keys[order], return_index=True,
+                                     return_counts=True)
+    idx1 = []
+    idx2 = []
+    for off in [(0, 0, 0)] + _HALF_SHELL:
+        nkeys = keys + (off[0] * dims[1] + off[1]) * dims[2] + off[2]
+        pos = np.minimum(np.searchsorted(uniq, nkeys), len(uniq) - 1)
+        cnt = np.where(uniq[pos] == nkeys, counts[pos], 0)
+        total = cnt.sum()
+        if not total:
+            continue
+        # each particle against all the particles of the neighboring cell
+        first = np.repeat(np.arange(nloci), cnt)
+        shift = np.arange(total) - np.repeat(np.cumsum(cnt) - cnt, cnt)
+        second = order[np.repeat(starts[pos], cnt) + shift]
+        if off == (0, 0, 0):
+            keep = first < second
+            first, second = first[keep], second[keep]
+        idx1.append(first)
+        idx2.append(second)
+    idx1 = np.concatenate(idx1)
+    idx2 = np.concatenate(idx2)
+    close = ((coords[idx1] - coords[idx2])**2).sum(axis=1) < cutoff**2
+    return idx1[close], idx2[close]
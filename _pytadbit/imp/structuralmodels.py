@@ -3,7 +3,8 @@
 """
 from pytadbit.utils.three_dim_stats import calc_consistency, mass_center
 from pytadbit.utils.three_dim_stats import dihedral, calc_eqv_rmsd
-from pytadbit.utils.three_dim_stats import get_center_of_mass, distance
+from pytadbit.utils.three_dim_stats import calc_eqv_rmsd_matrix
+from pytadbit.utils.three_dim_stats import eqv_rmsd_scores
 from pytadbit.utils.tadmaths        import calinski_harabasz, nozero_log_list
 from pytadbit.utils.tadmaths        import mean_none
 from pytadbit.utils.extraviews      import plot_3d_model, setup_plot
@@ -21,13 +22,18 @@ from math                           import acos, degrees, pi, sqrt
 from numpy                          import median as np_median
 from numpy                          import mean as np_mean
 from numpy                          import std as np_std, log2
-from numpy                          import array, cross, dot, ma, isnan
+from numpy                          import array, cross, ma, isnan
 from numpy                          import histogram, linspace
+from numpy                          import empty, arccos, rad2deg, where
+from numpy                          import triu_indices, bincount, triu
+from numpy                          import nonzero, float32
+from numpy                          import sqrt as np_sqrt, nan as np_nan
 from numpy.linalg                   import norm
 from scipy.cluster.hierarchy        import linkage, fcluster
 from scipy.stats                    import spearmanr, pearsonr, chisquare
 from scipy.stats                    import linregress
 from scipy.stats                    import normaltest, norm as sc_norm
+from scipy.spatial.distance         import pdist, squareform
 from warnings                       import warn
 from string                         import uppercase as uc, lowercase as lc
 from random                         import random
@@ -111,6 +117,7 @@ class StructuralModels(object):
         self.experiment     = experiment
         self._restraints    = restraints
         self.description    = description
+        self._comparisons   = None           # pairwise comparison of models
 
     def __getitem__(self, nam):
         if isinstance(nam, str):
@@ -153,6 +160,9 @@ class StructuralModels(object):
     def _extend_models(self, models):
         """
         add new models to structural models
+
+        The comparisons between the models already clustered are kept, and only
+        the ones involving new models are computed when calling cluster_models
         """
         nbest = len(self.__models)
         nall  = len(self.__models) + len(self._bad_models)
@@ -354,7 +364,8 @@ class StructuralModels(object):
         :param None tmp_file: path to a temporary file created during
            the clustering computation. Default will be created in /tmp/ folder
         :param True verbose: same as print StructuralModels.clusters
-        :param 1 n_cpus: number of cpus to use in MCL clustering
+        :param 1 n_cpus: number of cpus to use in the pairwise comparison of
+           models and in MCL clustering
         :param mclargs: list with any other command line argument to be passed
            to mcl (i.e,: mclargs=['-pi', '10', '-I', '2.0'])
         :param False external: if True returns the cluster found instead of
@@ -367,8 +378,8 @@ class StructuralModels(object):
             ''.join([(uc + lc)[int(random() * 52)] for _ in xrange(4)]))
         if not dcutoff:
             dcutoff = int(1.5 * self.resolution * self._config['scale'])
-        scores = calc_eqv_rmsd(self.__models, self.nloci, self._zeros, dcutoff,
-                               what=what, normed=True)
+        scores = eqv_rmsd_scores(self._compare_models(dcutoff, n_cpus),
+                                 what=what, normed=True)
         from distutils.spawn import find_executable
         if not find_executable(mcl_bin):
             print('\nWARNING: MCL not found in path using WARD clustering\n')
@@ -378,10 +389,7 @@ class StructuralModels(object):
             model['cluster'] = 'Singleton'
         if method == 'ward':
 
-            matrix = [[0.0 for _ in xrange(len(self))]
-                      for _ in xrange(len(self))]
-            for (i, j), score in scores.iteritems():
-                matrix[i][j] = score if score > fact * self.nloci else 0.0
+            matrix = where(scores > fact * self.nloci, scores, 0.0)
             clust = linkage(matrix, method='ward')
             # score each possible cut in hierarchical clustering
             solutions = {}
@@ -411,12 +419,11 @@ class StructuralModels(object):
                     key=lambda x: self[str(x)]['objfun'])
         else:
             out_f = open(tmp_file, 'w')
-            uniqs = list(set([tuple(sorted((m1, m2))) for m1, m2 in scores]))
             cut = fact * (self.nloci - self._zeros.count(False))
-            for md1, md2 in uniqs:
-                score = scores[(md1, md2)]
-                if score >= cut:
-                    out_f.write('model_%s\tmodel_%s\t%s\n' % (md1, md2, score))
+            md1s, md2s = nonzero(triu(scores >= cut, 1))
+            for md1, md2, score in zip(md1s.tolist(), md2s.tolist(),
+                                       scores[md1s, md2s].tolist()):
+                out_f.write('model_%s\tmodel_%s\t%s\n' % (md1, md2, score))
             out_f.close()
             Popen('%s %s --abc -te %s -V all -o %s.mcl %s' % (
                 mcl_bin, tmp_file, n_cpus, tmp_file, ' '.join(
@@ -451,6 +458,35 @@ class StructuralModels(object):
                    ' singletons: %s)') % (singletons - new_singles, singletons)
             print self.clusters
 
+    def _compare_models(self, dcutoff, n_cpus=1):
+        """
+        Internal function returning the number of equivalent positions, the
+        RMSD and the dRMSD of all pairs of models (see
+        :func:`pytadbit.utils.three_dim_stats.calc_eqv_rmsd_matrix`).
+
+        The comparisons are kept, and reused for the models (identified by
+        their random seed) already compared with the same dcutoff.
+        """
+        models = [self.__models[m] for m in xrange(len(self.__models))]
+        rand_inits = [m['rand_init'] for m in models]
+        stats = empty((3, len(models), len(models)), dtype=float32)
+        stats.fill(np_nan)
+        if self._comparisons and self._comparisons['dcutoff'] == dcutoff:
+            index = dict((r, i) for i, r in
+                         enumerate(self._comparisons['rand_inits']))
+            known = [(i, index[r]) for i, r in enumerate(rand_inits)
+                     if r in index]
+            if known:
+                new, old = array(known).T
+                stats[:, new[:, None], new] = self._comparisons['stats'][
+                    :, old[:, None], old]
+        stats = calc_eqv_rmsd_matrix(models, self.nloci, self._zeros, dcutoff,
+                                     n_cpus=n_cpus, stats=stats)
+        self._comparisons = {'dcutoff'   : dcutoff,
+                             'rand_inits': rand_inits,
+                             'stats'     : stats}
+        return stats
+
     def _build_distance_matrix(self, n_best_clusters):
         """
         """
@@ -552,22 +588,19 @@ class StructuralModels(object):
             models = [self[str(m)]['index'] for m in self.clusters[cluster]]
         else:
             models = [m for m in self.__models]
-        matrix = [[float('nan') for _ in xrange(self.nloci)]
-                  for _ in xrange(self.nloci)]
         if not cutoff:
             cutoff = int(2 * self.resolution * self._config['scale'])
         cutoff = cutoff**2
-        for i in xrange(self.nloci):
-            if not self._zeros[i]:
-                continue
-            for j in xrange(i + 1, self.nloci):
-                if not self._zeros[j]:
-                    continue
-                val = len([k for k in self.__square_3d_dist(
-                    i + 1, j + 1, models=models)
-                    if k < cutoff])
-                matrix[i][j] = matrix[j][i] = float(val) / len(models)  # * 100
-        return matrix
+        coords = self._get_coordinates(models)
+        counts = 0
+        for mdl in coords:
+            counts = counts + (pdist(mdl, 'sqeuclidean') < cutoff)
+        matrix = squareform(counts / float(len(models)))  # * 100
+        zeros = array([bool(self._zeros[i]) for i in xrange(self.nloci)])
+        matrix[~zeros] = np_nan
+        matrix[:, ~zeros] = np_nan
+        matrix.flat[::self.nloci + 1] = np_nan
+        return matrix.tolist()
 
     def define_best_models(self, nbest):
         """
@@ -618,7 +651,8 @@ class StructuralModels(object):
         :param None tmp_file: path to a temporary file created during
            the clustering computation. Default will be created in /tmp/ folder
         :param True verbose: same as print StructuralModels.clusters
-        :param 1 n_cpus: number of cpus to use in MCL clustering
+        :param 1 n_cpus: number of cpus to use in the pairwise comparison of
+           models and in MCL clustering
         :param mclargs: list with any other command line argument to be passed
            to mcl (i.e,: mclargs=['-pi', '10', '-I', '2.0'])
         :param 10 n_best_clusters: number of clusters to represent
@@ -991,35 +1025,31 @@ class StructuralModels(object):
 
     def _get_density(self, models, interval, use_mass_center):
         dists = [[None] * len(models)] * interval
-        for p in range(interval, self.nloci - interval):
-            part1, part2, part3 = p - interval, p, p + interval
-            if use_mass_center:
-                subdists = []
-                for m in models:
-                    try:
-                        coord1 = get_center_of_mass(
-                            self[m]['x'][part1:part2],
-                            self[m]['y'][part1:part2],
-                            self[m]['z'][part1:part2],
-                            self._zeros)
-                        coord2 = get_center_of_mass(
-                            self[m]['x'][part2:part3],
-                            self[m]['y'][part2:part3],
-                            self[m]['z'][part2:part3],
-                            self._zeros)
-                        subdists.append(distance(coord1, coord2))
-                    except ZeroDivisionError:  # part1==part2 or part2==part3
-                        subdists.append(float('nan'))
-                dists.append([float(interval * self.resolution) / d for d in subdists])
-            else:
-                dist1 = self.median_3d_dist(part1 + 1, part2 + 1, models,
-                                            plot=False, median=False)
-                dist2 = self.median_3d_dist(part2 + 1, part3 + 1, models,
-                                            plot=False, median=False)
-                dist = [(d1 + d2) for d1, d2 in zip(dist1, dist2)]
-                dists.append([float(interval * self.resolution * 2) / d
-                              for d in dist])
-        return dists
+        if self.nloci <= 2 * interval:
+            return dists
+        coords = self._get_coordinates(models)
+        size = self.nloci - interval
+        if use_mass_center:
+            # center of mass of the particles n to n+interval, for each n (the
+            # filtered columns are, as in get_center_of_mass, the ones of the
+            # first particles)
+            used = [i for i in xrange(interval) if self._zeros[i]]
+            if used:
+                centers = sum(coords[:, i:i + size] for i in used) / len(used)
+                diff = centers[:, interval:] - centers[:, :-interval]
+                dist = np_sqrt(diff[..., 0]**2 + diff[..., 1]**2 +
+                               diff[..., 2]**2)
+                dens = float(interval * self.resolution) / dist
+            else:  # part1==part2 or part2==part3
+                dens = empty((len(models), size - interval))
+                dens.fill(np_nan)
+        else:
+            # distance between each particle and the one interval after
+            diff = coords[:, interval:] - coords[:, :size]
+            step = np_sqrt(diff[..., 0]**2 + diff[..., 1]**2 + diff[..., 2]**2)
+            dens = (float(interval * self.resolution * 2) /
+                    (step[:, :-interval] + step[:, interval:]))
+        return dists + dens.T.tolist()
 
     def density_plot(self, models=None, cluster=None, steps=(1, 2, 3, 4, 5),
                      interval=1, use_mass_center=False, error=False, axe=None,
@@ -1088,17 +1118,13 @@ class StructuralModels(object):
         if not cutoff:
             cutoff = int(2 * self.resolution * self._config['scale'])
         cutoff2 = cutoff**2
-        for i in xrange(self.nloci):
-            for m in models:
-                val = 0
-                mdl = self[m]
-                for j in xrange(self.nloci):
-                    if i == j:
-                        continue
-                    val += ((mdl['x'][i] - mdl['x'][j])**2 +
-                            (mdl['y'][i] - mdl['y'][j])**2 +
-                            (mdl['z'][i] - mdl['z'][j])**2) < cutoff2
-                    # val += self.__square_3d_dist(i + 1, j + 1, models=[m])[0] < cutoff2
+        # pairs of particles in the order of pdist
+        part1, part2 = triu_indices(self.nloci, 1)
+        for mdl in self._get_coordinates(models):
+            close = pdist(mdl, 'sqeuclidean') < cutoff2
+            vals = (bincount(part1[close], minlength=self.nloci) +
+                    bincount(part2[close], minlength=self.nloci))
+            for i, val in enumerate(vals.tolist()):
                 interactions[i].append(val)
         return interactions
 
@@ -1315,12 +1341,12 @@ class StructuralModels(object):
             raise ValueError('ERROR: last element of span should be negative')
         
         rads = [[None] * len(models)] * (-span[0])
-        for res in xrange(-span[0], self.nloci - span[-1]):
-            subrad = self.dihedral_angle(res + span[0], res + span[1],
-                                         res + span[2],
-                                         res + span[3], res + span[4], models)
-            # rads.append([None] * abs(span[0]) + subrad + [None] * span[3])
-            rads.append(subrad)
+        coords = self._get_coordinates(models)
+        # particles of the planes, for each residue (particle numbers start at
+        # one)
+        res = array(range(-span[0], self.nloci - span[-1]))
+        if len(res):
+            rads += dihedral(*[coords[:, res + s - 1] for s in span]).T.tolist()
         rads += [[None] * len(models)] * (span[-1])
         radsk, errorn, errorp = self._windowize(rads, steps, interval=0,
                                                 average=False, minerr=-360)
@@ -1403,28 +1429,24 @@ class StructuralModels(object):
         if not isinstance(steps, tuple):
             steps = (steps,)
         models = self._get_models(models, cluster)
-        rads = []
-        ones = array([1., 1., 1.])
-        sign = 1
-        for model in models:
-            mox = self[model]['x']
-            moy = self[model]['y']
-            moz = self[model]['z']
-            subrad = [None] * 3
-            for res in xrange(1, self.nloci - 5):
-                subrad.append(self.angle_between_3_particles(
-                    res, res + 3, res + 6, models=[model], all_angles=False))
-                if signed:
-                    res1 = array([mox[res - 1], moy[res - 1], moz[res - 1]])  # faster than get_particle coordinate
-                    res2 = array([mox[res + 2], moy[res + 2], moz[res + 2]])
-                    res3 = array([mox[res + 5], moy[res + 5], moz[res + 5]])
-                    vec1 = res1 - res2 / norm(res1 - res2)
-                    vec2 = res1 - res3 / norm(res1 - res3)
-                    sign = dot(ones, cross(vec1, vec2))
-                    sign = -1 if sign < 0 else 1
-                subrad[-1] *= sign
-            subrad += [None] * 3
-            rads.append(subrad)
+        coords = self._get_coordinates(models)
+        # angle between particles res, res + 3 and res + 6, for all models
+        res1 = coords[:, :-6]
+        res2 = coords[:, 3:-3]
+        res3 = coords[:, 6:]
+        diff = res2 - res3
+        a2 = diff[..., 0]**2 + diff[..., 1]**2 + diff[..., 2]**2
+        diff = res1 - res2
+        c2 = diff[..., 0]**2 + diff[..., 1]**2 + diff[..., 2]**2
+        diff = res1 - res3
+        b2 = diff[..., 0]**2 + diff[..., 1]**2 + diff[..., 2]**2
+        cosg = (a2 - b2 + c2) / (2 * a2**0.5 * c2**0.5)
+        rad = rad2deg(arccos(where(abs(cosg) > 1, 1., cosg)))
+        if signed:
+            vec1 = res1 - res2 / norm(res1 - res2, axis=-1)[..., None]
+            vec2 = res1 - res3 / norm(res1 - res3, axis=-1)[..., None]
+            rad = where(cross(vec1, vec2).sum(axis=-1) < 0, -rad, rad)
+        rads = [[None] * 3 + subrad + [None] * 3 for subrad in rad.tolist()]
 
         radsk, errorn, errorp = self._windowize(zip(*rads), steps, interval=0,
                                                 average=False, minerr=-360)
@@ -2071,20 +2093,9 @@ class StructuralModels(object):
         :param None cluster: compute the angle only for the models in the
            cluster number 'cluster'
         """
-        pa -= 1
-        pb -= 1
-        pc -= 1
-        pd -= 1
-        pe -= 1
-        dangles = []
-        for m in models:
-            parta = array([self[m]['x'][pa], self[m]['y'][pa], self[m]['z'][pa]])
-            partb = array([self[m]['x'][pb], self[m]['y'][pb], self[m]['z'][pb]])
-            partc = array([self[m]['x'][pc], self[m]['y'][pc], self[m]['z'][pc]])
-            partd = array([self[m]['x'][pd], self[m]['y'][pd], self[m]['z'][pd]])
-            parte = array([self[m]['x'][pe], self[m]['y'][pe], self[m]['z'][pe]])
-            dangles.append(dihedral(parta, partb, partc, partd, parte))
-        return dangles
+        coords = self._get_coordinates(models)
+        return dihedral(*[coords[:, p - 1]
+                          for p in (pa, pb, pc, pd, pe)]).tolist()
 
     def median_3d_dist(self, part1, part2, models=None, cluster=None,
                        plot=True, median=True, axe=None, savefig=None):
@@ -2120,9 +2131,9 @@ class StructuralModels(object):
         elif cluster > -1 and len(self.clusters) > 0:
             models = [self[str(m)]['index'] for m in self.clusters[cluster]]
         else:
-            models = self.__models
-        models = [self[mdl] for mdl in models]
-        dists = [mdl.distance(part1, part2) for mdl in models]
+            models = [m for m in self.__models]
+        dists = np_sqrt(self.__square_3d_dist(part1, part2,
+                                              models=models)).tolist()
         if not plot:
             if median:
                 return np_median(dists)
@@ -2143,11 +2154,9 @@ class StructuralModels(object):
             models = [self[str(m)]['index'] for m in self.clusters[cluster]]
         else:
             models = [m for m in self.__models]
-        models = [self[mdl] for mdl in models]
-        return [(mdl['x'][part1] - mdl['x'][part2])**2 +
-                (mdl['y'][part1] - mdl['y'][part2])**2 +
-                (mdl['z'][part1] - mdl['z'][part2])**2
-                for mdl in models]
+        coords = self._get_coordinates(models, parts=[part1, part2])
+        diff = coords[:, 0] - coords[:, 1]
+        return (diff[:, 0]**2 + diff[:, 1]**2 + diff[:, 2]**2).tolist()
 
     def objective_function_model(self, model, log=False, smooth=True, axe=None,
                                  savefig=None):
@@ -2480,6 +2489,26 @@ class StructuralModels(object):
             models = [m for m in self.__models]
         return models
 
+    def _get_coordinates(self, models, parts=None):
+        """
+        Internal function returning the coordinates of a list of models as an
+        array of shape (number of models, number of particles, 3).
+
+        The array is built from the models each time (models may be modified
+        in place, e.g. by align_models), and can be restricted to a list of
+        particle indexes (starting at 0).
+        """
+        size = self.nloci if parts is None else len(parts)
+        coords = empty((len(models), size, 3))
+        for i, m in enumerate(models):
+            mdl = self[m]
+            for j, axis in enumerate(('x', 'y', 'z')):
+                if parts is None:
+                    coords[i, :, j] = mdl[axis]
+                else:
+                    coords[i, :, j] = [mdl[axis][p] for p in parts]
+        return coords
+
     def _windowize(self, dists, steps, average=True, interval=0, minerr=0.):
         lmodels = len(dists[0])
         distsk = {1: dists}
@@ -1,7 +1,9 @@
 from pytadbit.utils.file_handling         import mkdir
 from pytadbit.mapping.restriction_enzymes import map_re_sites
+from pytadbit.utils.extsort               import write_sorted_chunks
+from pytadbit.utils.extsort               import reduce_sorted_files, iter_merged
 from itertools                            import combinations
-from os                                   import path, system
+from os                                   import path, system, remove
 from sys                                  import stdout
 from collections import OrderedDict
 
@@ -94,7 +96,9 @@ def merge_2d_beds(path1, path2, outpath):
     out.close()
     return nreads
     
-def get_intersection(fname1, fname2, out_path, verbose=False):
+def get_intersection(fname1, fname2, out_path, verbose=False, stream=False,
+                     sort_by='coordinate', nthreads=1, tmp_dir=None,
+                     chunk_size=1000000, max_memory=None, fan_in=64):
     """
     Merges the two files corresponding to each reads sides. Reads found in both
        files are merged and written in an output file.
@@ -115,6 +119,24 @@ def get_intersection(fname1, fname2, out_path, verbose=False):
        :func:`pytadbit.parsers.sam_parser.parse_sam`
     :param out_path: path to an outfile. It will written in a similar format as
        the inputs
+    :param False stream: bounded memory intersection. Pairs of reads are
+       sorted in temporary files of chunk_size lines that are then merged (the
+       result is the same)
+    :param 'coordinate' sort_by: in stream mode, order of the pairs of reads
+       in the output file, either by genomic coordinate of the upstream read
+       ('coordinate', as needed to filter duplicates) or by read ID ('read',
+       in which case no temporary file is used)
+    :param 1 nthreads: in stream mode, number of processes used to sort and
+       write temporary files, and to merge them
+    :param None tmp_dir: in stream mode, directory where to write temporary
+       files (by default the directory of the output file)
+    :param 1000000 chunk_size: in stream mode, maximum number of pairs of
+       reads per temporary file
+    :param None max_memory: in stream mode, maximum size (in Mb, approximate)
+       of the pairs of reads kept in memory before being written to a
+       temporary file
+    :param 64 fan_in: in stream mode, maximum number of temporary files merged
+       at a time
 
     :returns: final number of pair of interacting fragments, and a dictionary with
        the number of multiple contacts (keys of the dictionary being the number of
@@ -154,6 +176,21 @@ def get_intersection(fname1, fname2, out_path, verbose=False):
             CHROM_START[crm] = cum_pos
             cum_pos += int(pos)
     lchunk = cum_pos / nchunks
+
+    if stream:
+        if sort_by not in ['coordinate', 'read']:
+            raise Exception('ERROR: sort_by should be "coordinate" or "read"')
+        multiples = {}
+        pairs = _joined_reads(reads1, line1, reads2, line2)
+        if verbose:
+            print ('Getting intersection of reads 1 and reads 2:')
+        count = _stream_intersection(pairs, header1, out_path, multiples,
+                                     lchunk, sort_by, nthreads, tmp_dir,
+                                     chunk_size, max_memory, fan_in)
+        if verbose:
+            print 'Found %d pair of reads mapping uniquely' % count
+        return count, multiples
+
     buf = dict([(i, []) for i in xrange(nchunks + 1)])
     # prepare temporary directories
     tmp_dir = out_path + '_tmp_files'
@@ -232,6 +269,83 @@ def get_intersection(fname1, fname2, out_path, verbose=False):
     system('rm -rf ' + tmp_dir)
     return count, multiples
 
+def _joined_reads(reads1, line1, reads2, line2):
+    """
+    yields the pairs of lines with the same read ID in two files sorted by read
+    ID (line1 and line2 being the current lines of each file)
+    """
+    read1 = line1.split('\t', 1)[0]
+    read2 = line2.split('\t', 1)[0]
+    try:
+        while True:
+            if eq_reads(read1, read2):
+                yield line1, line2
+                line1 = reads1.next()
+                read1 = line1.split('\t', 1)[0]
+                line2 = reads2.next()
+                read2 = line2.split('\t', 1)[0]
+            elif gt_reads(read1, read2):
+                line2 = reads2.next()
+                read2 = line2.split('\t', 1)[0]
+            else:
+                line1 = reads1.next()
+                read1 = line1.split('\t', 1)[0]
+    except StopIteration:
+        reads1.close()
+        reads2.close()
+
+def _coordinate_key(line):
+    """
+    sorting key of the pairs of reads written by _stream_intersection: same
+    order as the one of the temporary files of get_intersection (chunk of the
+    genome, position of the upstream read, then chromosome and position of
+    the downstream read and RE fragment of the upstream read)
+    """
+    x = line.split('\t', 11)
+    return int(x[0]), x[1], x[9], x[10], x[7]
+
+def _stream_intersection(pairs, header, out_path, multiples, lchunk, sort_by,
+                         nthreads, tmp_dir, chunk_size, max_memory, fan_in):
+    """
+    writes the pairwise contacts of the pairs of lines to the output file,
+    sorted with an external merge sort in the case of the coordinate order
+
+    :returns: number of pairs of lines
+    """
+    count = [0]
+    if sort_by == 'read':
+        out = open(out_path, 'w')
+        out.write(header)
+        for line1, line2 in pairs:
+            count[0] += 1
+            out.writelines('%s\n' % pair for _, pair in
+                           _pair_lines(line1, line2, multiples))
+        out.close()
+        return count[0]
+
+    def _lines():
+        for line1, line2 in pairs:
+            count[0] += 1
+            for idx, pair in _pair_lines(line1, line2, multiples):
+                yield '%d\t%d\t%s\n' % (idx / lchunk, idx, pair)
+
+    tmp_files, _ = write_sorted_chunks(_lines(), out_path, tmp_dir=tmp_dir,
+                                       chunk_size=chunk_size,
+                                       max_memory=max_memory,
+                                       key=_coordinate_key, nthreads=nthreads)
+    tmp_files = reduce_sorted_files(tmp_files, out_path, fan_in=fan_in,
+                                    nthreads=nthreads, tmp_dir=tmp_dir,
+                                    key=_coordinate_key)
+    out = open(out_path, 'w')
+    out.write(header)
+    # remove the genomic chunk and position of the upstream read
+    out.writelines(line.split('\t', 2)[2]
+                   for line in iter_merged(tmp_files, _coordinate_key))
+    out.close()
+    for fnam in tmp_files:
+        remove(fnam)
+    return count[0]
+
 def _loc_reads(r1, r2):
     """
     put upstream read before, get position in buf
@@ -254,6 +368,15 @@ def write_to_files(buf, tmp_dir, nchunks):
         del(buf[b][:])
 
 def _process_lines(line1, line2, buf, multiples, lchunk):
+    for idx, pair in _pair_lines(line1, line2, multiples):
+        buf[idx / lchunk].append('%d\t%s' % (idx, pair))
+
+def _pair_lines(line1, line2, multiples):
+    """
+    yields the genomic position of the upstream read and the pairwise contacts
+    between the fragments of two lines with the same read ID (one contact per
+    pair of fragments in the case of multiple contacts)
+    """
     # case we have potential multicontacts
     if '|||' in line1 or '|||' in line2:
         elts = {}
@@ -308,15 +431,15 @@ def _process_lines(line1, line2, buf, multiples, lchunk):
             prod_cont = contacts * (contacts + 1) / 2
             for i, (r1, r2) in enumerate(combinations(elts.values(), 2)):
                 r1, r2, idx = _loc_reads(r1, r2)
-                buf[idx / lchunk].append('%d\t%s#%d/%d\t%s\t%s' % (
-                    idx, r1[0], i + 1, prod_cont, '\t'.join(r1[1:]),
-                    '\t'.join(r2[1:])))
+                yield idx, '%s#%d/%d\t%s\t%s' % (
+                    r1[0], i + 1, prod_cont, '\t'.join(r1[1:]),
+                    '\t'.join(r2[1:]))
         elif contacts == 1:
             r1, r2, idx = _loc_reads(elts.values()[0], elts.values()[1])
-            buf[idx / lchunk].append('%d\t%s\t%s' % (idx, '\t'.join(r1), '\t'.join(r2[1:])))
+            yield idx, '%s\t%s' % ('\t'.join(r1), '\t'.join(r2[1:]))
         else:
             r1, r2, idx = _loc_reads(elts1.values()[0], elts2.values()[0])
-            buf[idx / lchunk].append('%d\t%s\t%s' % (idx, '\t'.join(r1), '\t'.join(r2[1:])))
+            yield idx, '%s\t%s' % ('\t'.join(r1), '\t'.join(r2[1:]))
     else:
         r1, r2, idx = _loc_reads(line1.strip().split('\t'), line2.strip().split('\t'))
-        buf[idx / lchunk].append('%d\t%s\t%s' % (idx, '\t'.join(r1), '\t'.join(r2[1:])))
+        yield idx, '%s\t%s' % ('\t'.join(r1), '\t'.join(r2[1:]))
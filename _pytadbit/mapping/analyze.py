@@ -11,9 +11,14 @@ from collections                  import OrderedDict
 from pytadbit.parsers.hic_parser  import load_hic_data_from_reads
 from pytadbit.utils.extraviews    import nicer
 from pytadbit.utils.file_handling import mkdir
+from pytadbit.utils.normalize_hic import _upper_triangle
 from scipy.stats                  import norm as sc_norm, skew, kurtosis
 from scipy.stats                  import pearsonr, spearmanr, linregress
+from scipy.stats                  import rankdata
+from scipy.sparse.linalg          import eigsh, LinearOperator
+from scipy.sparse                 import coo_matrix
 from numpy.linalg                 import eigh
+import multiprocessing as mu
 import numpy as np
 
 try:
@@ -407,23 +412,10 @@ def plot_distance_vs_interactions(data, min_diff=1, max_diff=1000, show=False,
             pass
         fhandler.close()
     elif isinstance(data, HiC_data):
-        if normalized:
-            get_data = lambda x, y: data[x, y] / data.bias[x] / data.bias[y]
-        else:
-            get_data = lambda x, y: data[x, y]
         max_diff = min(len(data), max_diff)
-        if data.section_pos:
-            for crm in data.section_pos:
-                for diff in xrange(min_diff, min(
-                    (max_diff, 1 + data.chromosomes[crm]))):
-                    for i in xrange(data.section_pos[crm][0],
-                                    data.section_pos[crm][1] - diff):
-                        dist_intr[diff] += get_data(i, i + diff)
-        else:
-            for diff in xrange(min_diff, max_diff):
-                for i in xrange(len(data) - diff):
-                    if not np.isnan(data[i, i + diff]):
-                        dist_intr[diff] += get_data(i, diff)
+        for sums, _, _ in data.get_decay(normalized=normalized).itervalues():
+            for diff in xrange(min_diff, min(max_diff, len(sums))):
+                dist_intr[diff] += sums[diff]
     else:
         if genome_seq:
             max_diff = min(max(genome_seq.values()), max_diff)
@@ -824,10 +816,17 @@ def plot_genomic_distribution(fnam, first_read=True, resolution=10000,
 
 def correlate_matrices(hic_data1, hic_data2, max_dist=10, intra=False, axe=None,
                        savefig=None, show=False, savedata=None,
-                       normalized=False, remove_bad_columns=True, **kwargs):
+                       normalized=False, remove_bad_columns=True, smooth=1,
+                       n_cpus=1, **kwargs):
     """
     Compare the iteractions of two Hi-C matrices at a given distance,
-    with spearman rank correlation
+    with spearman rank correlation, and globally with the stratum-adjusted
+    correlation coefficient (SCC) of HiCRep (Yang et al. 2017, Genome
+    Research).
+
+    Diagonals of both matrices are extracted from their sparse upper
+    triangle in a single pass per chromosome (with intra, chromosomes are
+    processed in parallel).
 
     :param hic_data1: Hi-C-data object
     :param hic_data2: Hi-C-data object
@@ -840,56 +839,37 @@ def correlate_matrices(hic_data1, hic_data2, max_dist=10, intra=False, axe=None,
     :param False normalized: use normalized data
     :param True remove_bads: computes the union of bad columns between samples
        and exclude them from the comparison
+    :param 1 smooth: size (in bins, h parameter of HiCRep) of the 2D mean
+       filter applied to the matrices before computing the SCC
+    :param 1 n_cpus: number of chromosomes processed in parallel (with intra)
+    :param False get_scc: also returns the SCC (after the genomic distances)
 
     :returns: list of correlations and list of genomic distances
     """
     corrs = []
     dists = []
 
-    if normalized:
-        get_the_guy1 = lambda i, j: (hic_data1[j, i] / hic_data1.bias[i] /
-                                     hic_data1.bias[j])
-        get_the_guy2 = lambda i, j: (hic_data2[j, i] / hic_data2.bias[i] /
-                                     hic_data2.bias[j])
-    else:
-        get_the_guy1 = lambda i, j: hic_data1[j, i]
-        get_the_guy2 = lambda i, j: hic_data2[j, i]
-    
+    if normalized and not (hic_data1.bias and hic_data2.bias):
+        raise Exception('ERROR: experiment not normalized yet')
+
     if remove_bad_columns:
         # union of bad columns
         bads = hic_data1.bads.copy()
         bads.update(hic_data2.bads)
-
-    if (intra and hic_data1.sections and hic_data2.sections and 
-        hic_data1.sections == hic_data2.sections):
-        for dist in xrange(1, max_dist + 1):
-            diag1 = []
-            diag2 = []
-            for crm in hic_data1.section_pos:
-                for j in xrange(hic_data1.section_pos[crm][0],
-                                hic_data1.section_pos[crm][1] - dist):
-                    i = j + dist
-                    if j in bads or i in bads:
-                        continue
-                    diag1.append(get_the_guy1(i, j))
-                    diag2.append(get_the_guy2(i, j))
-            corrs.append(spearmanr(diag1, diag2)[0])
-            dists.append(dist)
     else:
-        if intra:
-            warn('WARNING: hic_dta does not contain chromosome coordinates, ' +
-                 'intra set to False')
-        for dist in xrange(1, max_dist + 1):
-            diag1 = []
-            diag2 = []
-            for j in xrange(len(hic_data1) - dist):
-                i = j + dist
-                if j in bads or i in bads:
-                    continue
-                diag1.append(get_the_guy1(i, j))
-                diag2.append(get_the_guy2(i, j))
-            corrs.append(spearmanr(diag1, diag2)[0])
-            dists.append(dist)
+        bads = {}
+
+    if intra and not (hic_data1.sections and hic_data2.sections and
+                      hic_data1.sections == hic_data2.sections):
+        warn('WARNING: hic_dta does not contain chromosome coordinates, ' +
+             'intra set to False')
+        intra = False
+    diags = _diagonals(hic_data1, hic_data2, max_dist, bads, normalized,
+                       intra, smooth, n_cpus)
+    for dist, (diag1, diag2, _, _) in enumerate(diags, 1):
+        corrs.append(spearmanr(diag1, diag2)[0])
+        dists.append(dist)
+    scc = _stratum_adjusted_correlation([(d[2], d[3]) for d in diags])
     if show or savefig or axe:
         if not axe:
             fig = plt.figure()
@@ -900,6 +880,7 @@ def correlate_matrices(hic_data1, hic_data2, max_dist=10, intra=False, axe=None,
         axe.plot(dists, corrs, color='orange', linewidth=3, alpha=.8)
         axe.set_xlabel('Genomic distance in bins')
         axe.set_ylabel('Spearman rank correlation')
+        axe.set_title('SCC: %.3f' % (scc))
         axe.set_xlim((0, dists[-1]))
         if savefig:
             tadbit_savefig(savefig)
@@ -909,14 +890,154 @@ def correlate_matrices(hic_data1, hic_data2, max_dist=10, intra=False, axe=None,
             plt.close('all')
     if savedata:
         out = open(savedata, 'w')
+        out.write('# stratum-adjusted correlation coefficient (SCC): %s\n' % (
+            scc))
         out.write('# genomic distance\tSpearman rank correlation\n')
         for i in xrange(len(corrs)):
             out.write('%s\t%s\n' % (dists[i], corrs[i]))
         out.close()
+    results = [corrs, dists]
+    if kwargs.get('get_scc', False):
+        results.append(scc)
     if kwargs.get('get_bads', False):
-        return corrs, dists, bads
+        results.append(bads)
+    return tuple(results)
+
+def _stratum_adjusted_correlation(diags):
+    """
+    Stratum-adjusted correlation coefficient: mean of the Pearson correlation
+    of each diagonal (stratum), weighted by the number of cells and the
+    variance of the ranks of each stratum. Cells empty in both matrices are
+    skipped.
+
+    :param diags: list of pairs of arrays with the values of the cells of a
+       diagonal in each matrix
+
+    :returns: the SCC (NaN if no stratum can be used)
+    """
+    num = den = 0.
+    for diag1, diag2 in diags:
+        keep = (diag1 != 0) | (diag2 != 0)
+        diag1 = diag1[keep]
+        diag2 = diag2[keep]
+        size = len(diag1)
+        if size < 3:
+            continue
+        with np.errstate(divide='ignore', invalid='ignore'):
+            corr = np.corrcoef(diag1, diag2)[0, 1]
+        if np.isnan(corr):
+            continue
+        weight = size * np.sqrt(np.var(rankdata(diag1) / size, ddof=1) *
+                                np.var(rankdata(diag2) / size, ddof=1))
+        num += weight * corr
+        den += weight
+    return num / den if den else float('nan')
+
+# Hi-C data compared (upper triangles of both matrices, their biases and the
+# mask of the columns kept), shared by the processes extracting the diagonals
+# of each chromosome
+_COMPARE_DATA = None
+
+def _diagonals(hic_data1, hic_data2, max_dist, bads, normalized=False,
+               intra=False, smooth=0, n_cpus=1):
+    """
+    Extracts the cells of the two Hi-C matrices at each distance from the
+    diagonal (from 1 to max_dist), skipping bad columns, and, if intra,
+    inter-chromosomal cells (each chromosome is processed independently).
+
+    :returns: a list with, for each distance, the values of the cells in each
+       matrix, and the values smoothed by a 2D mean filter of size smooth
+    """
+    global _COMPARE_DATA
+    size = len(hic_data1)
+    good = np.ones(size, dtype=bool)
+    good[[b for b in bads if b < size]] = False
+    uppers = []
+    biases = []
+    for hic_data in (hic_data1, hic_data2):
+        uppers.append(_upper_triangle(hic_data))
+        biases.append(np.array([hic_data.bias.get(i, np.nan)
+                                for i in xrange(size)]) if normalized else None)
+    if intra:
+        sections = sorted(hic_data1.section_pos.values(),
+                          key=lambda x: x[0] - x[1])
     else:
-        return corrs, dists
+        sections = [(0, size)]
+    _COMPARE_DATA = uppers, biases, good
+    n_cpus = min(n_cpus, len(sections))
+    pool = mu.Pool(n_cpus) if n_cpus > 1 else None
+    procs = []
+    for beg, end in sections:
+        args = (beg, end, max_dist, smooth)
+        if pool:
+            procs.append(pool.apply_async(_section_diagonals, args=args))
+        else:
+            procs.append(_section_diagonals(*args))
+    if pool:
+        pool.close()
+        procs = [proc.get() for proc in procs]
+        pool.join()
+    _COMPARE_DATA = None
+    return [tuple(np.concatenate([proc[dist][num] for proc in procs])
+                  for num in xrange(4))
+            for dist in xrange(max_dist)]
+
+def _section_diagonals(beg, end, max_dist, smooth):
+    """
+    Diagonals of one section of the matrices (see _diagonals), from the data
+    in _COMPARE_DATA
+
+    :returns: for each distance from 1 to max_dist, the values of the cells
+       in each matrix, raw and smoothed
+    """
+    uppers, biases, good = _COMPARE_DATA
+    size = end - beg
+    good = good[beg:end]
+    # band with the diagonals needed, from -2 x smooth to max_dist + 2 x smooth
+    # cell (i, k) of the band corresponds to cell (i, i + k - off) of the matrix
+    off = 2 * smooth
+    width = max_dist + 2 * off + 1
+    rows = np.arange(size)
+    results = [[] for _ in xrange(max_dist)]
+    for upper, bias in zip(uppers, biases):
+        sub = upper[beg:end, beg:end].tocoo()
+        keep = ((sub.col - sub.row <= max_dist + off) &
+                good[sub.row] & good[sub.col])
+        row = sub.row[keep]
+        col = sub.col[keep]
+        vals = sub.data[keep].astype(float)
+        if bias is not None:
+            vals /= bias[beg:end][row] * bias[beg:end][col]
+        band = np.zeros((size, width))
+        band[row, col - row + off] = vals
+        # lower diagonals, from the symmetric cells
+        lower = col - row <= off
+        band[col[lower], row[lower] - col[lower] + off] = vals[lower]
+        if smooth:
+            inside = ((rows[:, None] + np.arange(width) - off >= 0) &
+                      (rows[:, None] + np.arange(width) - off < size))
+            smoothed = np.zeros((size, max_dist))
+            counts = np.zeros((size, max_dist))
+            for a in xrange(-smooth, smooth + 1):
+                # rows of the band in the window
+                ibeg, iend = max(0, -a), min(size, size - a)
+                for b in xrange(-smooth, smooth + 1):
+                    kbeg = 1 + b - a + off
+                    smoothed[ibeg:iend] += band[ibeg + a:iend + a,
+                                                kbeg:kbeg + max_dist]
+                    counts[ibeg:iend] += inside[ibeg + a:iend + a,
+                                                kbeg:kbeg + max_dist]
+            with np.errstate(divide='ignore', invalid='ignore'):
+                smoothed /= counts
+        else:
+            smoothed = band[:, off + 1:off + max_dist + 1]
+        for dist in xrange(1, max_dist + 1):
+            ncells = max(0, size - dist)
+            valid = good[:ncells] & good[dist:dist + ncells]
+            results[dist - 1].append(band[:ncells][valid, dist + off])
+            results[dist - 1].append(smoothed[:ncells][valid, dist - 1])
+    # raw values of both matrices first, then smoothed values
+    return [(diag[0], diag[2], diag[1], diag[3]) for diag in results]
 
 def eig_correlate_matrices(hic_data1, hic_data2, nvect=6, normalized=False, 
                            savefig=None, show=False, savedata=None,
@@ -925,6 +1046,8 @@ def eig_correlate_matrices(hic_data1, hic_data2, nvect=6, normalized=False,
     Compare the iteractions of two Hi-C matrices using their 6 first
     eigenvectors, with pearson correlation
 
+    Only the first eigenvectors are computed, from the sparse matrices.
+
     :param hic_data1: Hi-C-data object
     :param hic_data2: Hi-C-data object
     :param 6 nvect: number of eigenvectors to compare
@@ -937,35 +1060,17 @@ def eig_correlate_matrices(hic_data1, hic_data2, nvect=6, normalized=False,
 
     :returns: matrix of correlations
     """
-    data1 = hic_data1.get_matrix(normalized=normalized)
-    data2 = hic_data2.get_matrix(normalized=normalized)
-    ## reduce matrices to remove bad columns
+    size = len(hic_data1)
+    good = np.ones(size, dtype=bool)
     if remove_bad_columns:
         # union of bad columns
         bads = hic_data1.bads.copy()
         bads.update(hic_data2.bads)
-        # remove them form both matrices
-        for bad in sorted(bads, reverse=True):
-            del(data1[bad])
-            del(data2[bad])
-            for i in xrange(len(data1)):
-                _ = data1[i].pop(bad)
-                _ = data2[i].pop(bad)
-    # get the log
-    size = len(data1)
-    data1 = nozero_log(data1, np.log2)
-    data2 = nozero_log(data2, np.log2)
-    # get the eigenvectors
-    ev1, evect1 = eigh(data1)
-    ev2, evect2 = eigh(data2)
+        good[[b for b in bads if b < size]] = False
+    # get the eigenvectors of the log of the matrices
+    ev1, evect1 = _log_eigenvectors(hic_data1, good, normalized, nvect)
+    ev2, evect2 = _log_eigenvectors(hic_data2, good, normalized, nvect)
     corr = [[0 for _ in xrange(nvect)] for _ in xrange(nvect)]
-    # sort eigenvectors according to their eigenvalues => first is last!!
-    sort_perm = ev1.argsort()
-    ev1.sort()
-    evect1 = evect1[sort_perm]
-    sort_perm = ev2.argsort()
-    ev2.sort()
-    evect2 = evect2[sort_perm]
     # calculate Pearson correlation
     for i in xrange(nvect):
         for j in xrange(nvect):
@@ -1024,6 +1129,47 @@ def eig_correlate_matrices(hic_data1, hic_data2, nvect=6, normalized=False,
     else:
         return corr
 
+def _log_eigenvectors(hic_data, good, normalized, nvect):
+    """
+    Eigenvectors with the largest eigenvalues of the log2 of a Hi-C matrix,
+    restricted to the columns kept, where empty cells take the log of half
+    the minimum count. The matrix is not densified: it is the sum of a
+    constant matrix and of a sparse matrix with the non-empty cells.
+
+    :returns: the eigenvalues (in ascending order) and the eigenvectors (as
+       columns)
+    """
+    upper = _upper_triangle(hic_data).tocoo()
+    keep = good[upper.row] & good[upper.col] & (upper.data != 0)
+    vals = upper.data[keep].astype(float)
+    # index of each column in the matrix without bad columns
+    index = np.cumsum(good) - 1
+    rows = index[upper.row[keep]]
+    cols = index[upper.col[keep]]
+    if normalized:
+        bias = np.array([hic_data.bias.get(i, np.nan)
+                         for i in xrange(len(hic_data))])
+        vals /= bias[upper.row[keep]] * bias[upper.col[keep]]
+    real = vals[~np.isnan(vals)]
+    logminv = np.log2(real.min() / 2 if len(real) else 1)
+    vals = np.log2(vals) - logminv
+    offdiag = rows != cols
+    size = int(good.sum())
+    sparse = coo_matrix((np.concatenate((vals, vals[offdiag])),
+                         (np.concatenate((rows, cols[offdiag])),
+                          np.concatenate((cols, rows[offdiag])))),
+                        shape=(size, size)).tocsr()
+    if size <= nvect + 1:
+        evals, evect = eigh(sparse.toarray() + logminv)
+        return evals[-nvect:], evect[:, -nvect:]
+    operator = LinearOperator(
+        (size, size), dtype=float,
+        matvec=lambda x: sparse.dot(np.ravel(x)) + logminv * np.sum(x))
+    evals, evect = eigsh(operator, k=nvect, which='LA',
+                         v0=np.random.RandomState(1).uniform(-1, 1, size))
+    order = evals.argsort()
+    return evals[order], evect[:, order]
+
 def plot_rsite_reads_distribution(reads_file, outprefix, window=20,
         maxdist=1000):
     de_right={}
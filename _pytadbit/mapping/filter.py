@@ -4,7 +4,24 @@
 
 """
 from pytadbit.mapping.restriction_enzymes import count_re_fragments
+from os                                   import path, remove, stat
+from ast                                  import literal_eval
+from itertools                            import compress, islice, chain
+from array                                import array
+from shutil                               import copyfileobj
 import multiprocessing as mu
+import numpy as np
+
+FILTERS = {1 : 'self-circle',
+           2 : 'dangling-end',
+           3 : 'error',
+           4 : 'extra dangling-end',
+           5 : 'too close from RES',
+           6 : 'too short',
+           7 : 'too large',
+           8 : 'over-represented',
+           9 : 'duplicated',
+           10: 'random breaks'}
 
 def apply_filter(fnam, outfile, masked, filters=None, reverse=False, 
                  verbose=True):
@@ -24,6 +41,11 @@ def apply_filter(fnam, outfile, masked, filters=None, reverse=False,
     :returns: number of reads kept
     """
     filters = filters or masked.keys()
+    bitmask = set(masked[k].get('bitmask') for k in filters)
+    if len(bitmask) == 1 and _check_bitmask(fnam, list(bitmask)[0], masked,
+                                            filters):
+        return _apply_bitmask(fnam, outfile, list(bitmask)[0], filters,
+                              masked, reverse=reverse, verbose=verbose)
     filter_names = []
     filter_handlers = {}
     for k in filters:
@@ -87,10 +109,115 @@ def apply_filter(fnam, outfile, masked, filters=None, reverse=False,
     out.close()
     return count
 
+def _apply_bitmask(fnam, outfile, bitmask, filters, masked, reverse=False,
+                   verbose=True, chunk=1000000):
+    """
+    Same as :func:`pytadbit.mapping.filter.apply_filter`, using the bitmask
+    file written by :func:`pytadbit.mapping.filter.filter_reads` (a single
+    read of the input file, no comparison of read IDs).
+    """
+    bits = np.uint16(sum(1 << (k - 1) for k in filters))
+    keep = np.memmap(bitmask, dtype=np.uint16, mode='r')
+    out = open(outfile, 'w')
+    fhandler = open(fnam)
+    # get the header
+    pos = 0
+    while True:
+        line = fhandler.readline()
+        if not line.startswith('#'):
+            break
+        pos += len(line)
+        out.write(line)
+    fhandler.seek(pos)
+    count = 0
+    for beg in xrange(0, len(keep), chunk):
+        selection = (keep[beg:beg + chunk] & bits) != 0
+        if not reverse:
+            selection = ~selection
+        count += int(selection.sum())
+        out.writelines(compress(islice(fhandler, chunk), selection.tolist()))
+    fhandler.close()
+    out.close()
+    if verbose:
+        print '    saving to file %d reads %s %s.' % (
+            count, 'with' if reverse else 'without',
+            ', '.join(masked[k]['name'] for k in filters))
+    return count
+
+
+def _bitmask_signature(fnam, masked, params):
+    """
+    description of the reads file (size and modification time), of the
+    filters and of the parameters used to build a bitmask
+    """
+    fstat = stat(fnam)
+    return {'reads'  : (fstat.st_size, fstat.st_mtime),
+            'filters': dict((k, (masked[k]['name'], masked[k]['reads']))
+                            for k in masked),
+            'params' : params}
+
+
+def _check_bitmask(fnam, bitmask, masked, filters):
+    """
+    checks that the bitmask file was built from this reads file, with these
+    filters and parameters (the ones recorded in the masked dictionary)
+    """
+    if not bitmask or not path.exists(bitmask):
+        return False
+    try:
+        signature = literal_eval(open(bitmask + '.info').read())
+    except (IOError, SyntaxError, ValueError):
+        return False
+    fstat = stat(fnam)
+    if signature['reads'] != (fstat.st_size, fstat.st_mtime):
+        return False
+    return all(masked[k].get('bitmask_info') == signature and
+               signature['filters'].get(k) == (masked[k]['name'],
+                                               masked[k]['reads'])
+               for k in filters)
+
+
+def _bitmask_from_ids(fnam, masked, bitmask):
+    """
+    writes the bitmask file (one 16 bits integer per read, bit k-1 set if the
+    read is removed by filter k) walking the reads file and the files of
+    filtered read IDs.
+    """
+    handlers = {}
+    for k in masked:
+        fh = open(masked[k]['fnam'])
+        for line in fh:
+            handlers[k] = [line.strip(), fh]
+            break
+    fhandler = open(fnam)
+    line = fhandler.next()
+    while line.startswith('#'):
+        line = fhandler.next()
+    out = open(bitmask, 'wb')
+    mask = array('H')
+    for line in chain([line], fhandler):
+        read = line.split('\t', 1)[0]
+        val = 0
+        for k in handlers.keys():
+            if read != handlers[k][0]:
+                continue
+            val |= 1 << (k - 1)
+            try:
+                handlers[k][0] = handlers[k][1].next().strip()
+            except StopIteration:
+                del handlers[k]
+        mask.append(val)
+        if len(mask) == 1000000:
+            mask.tofile(out)
+            mask = array('H')
+    mask.tofile(out)
+    out.close()
+
+
 def filter_reads(fnam, output=None, max_molecule_length=500,
                  over_represented=0.005, max_frag_size=100000,
                  min_frag_size=100, re_proximity=5, verbose=True,
-                 savedata=None, min_dist_to_re=750, fast=True):
+                 savedata=None, min_dist_to_re=750, fast=True, nthreads=None):
     """
     Filter mapped pair of reads in order to remove experimental artifacts (e.g.
     dangling-ends, self-circle, PCR artifacts...)
@@ -140,10 +267,23 @@ def filter_reads(fnam, output=None, max_molecule_length=500,
        from a RE site (usually 1.5 times the insert size). Applied in filter 10
     :param None savedata: PATH where to write the number of reads retained by
        each filter
-    :param True fast: parallel version, requires 4 CPUs and more RAM memory
+    :param True fast: parallel version, the file is split into chunks
+       (byte ranges) that are filtered independently by nthreads processes.
+       Counts of reads per RE fragment and duplicates at the borders of the
+       chunks are then merged, and only the columns needed to find reads from
+       over-represented fragments are read a second time
+    :param None nthreads: number of processes used in the fast version (all
+       available CPUs by default)
 
     :return: dicitonary with, as keys, the kind of filter applied, and as values
-       a set of read IDs to be removed
+       a set of read IDs to be removed. Each entry also contains the path to
+       a bitmask file ('bitmask' key, output + '_bitmask.bin') with one 16
+       bits integer per read of fnam, where bit k-1 is set if the read was
+       removed by filter k. This file is used by
+       :func:`pytadbit.mapping.filter.apply_filter`, if the reads file, the
+       filters and the parameters are the ones described in the side-car
+       file (output + '_bitmask.bin.info', also stored in the 'bitmask_info'
+       key)
 
     *Note: Filtering is not exclusive, one read can be filtered several times.*
     """
@@ -165,23 +305,26 @@ def filter_reads(fnam, output=None, max_molecule_length=500,
         if verbose:
             print 'filtering over representeds'
         masked.update(_filter_over_represented(fnam, over_represented, output))
+        _bitmask_from_ids(fnam, masked, output + '_bitmask.bin')
     else:
-        pool = mu.Pool(4)
-        a = pool.apply_async(_filter_same_frag,
-                             args=(fnam, max_molecule_length, output))
-        b = pool.apply_async(_filter_from_res,
-                             args=(fnam, max_frag_size, min_dist_to_re,
-                                   re_proximity, min_frag_size, output))
-        c = pool.apply_async(_filter_over_represented,
-                             args=(fnam, over_represented, output))
-        d = pool.apply_async(_filter_duplicates,
-                             args=(fnam,output))
-        pool.close()
-        pool.join()
-        masked, total = d.get()
-        masked.update(b.get())
-        masked.update(c.get())
-        masked.update(a.get())
+        masked, total = _filter_parallel(
+            fnam, max_molecule_length, over_represented, max_frag_size,
+            min_frag_size, re_proximity, min_dist_to_re, output,
+            nthreads or mu.cpu_count())
+    # record what the bitmask was built from, to check it before using it
+    signature = _bitmask_signature(fnam, masked, {
+        'max_molecule_length': max_molecule_length,
+        'over_represented'   : over_represented,
+        'max_frag_size'      : max_frag_size,
+        'min_frag_size'      : min_frag_size,
+        're_proximity'       : re_proximity,
+        'min_dist_to_re'     : min_dist_to_re})
+    out = open(output + '_bitmask.bin.info', 'w')
+    out.write(repr(signature))
+    out.close()
+    for k in masked:
+        masked[k]['bitmask'] = output + '_bitmask.bin'
+        masked[k]['bitmask_info'] = signature
 
     # if savedata or verbose:
     #     bads = len(frozenset().union(*[masked[k]['reads'] for k in masked]))
@@ -205,6 +348,271 @@ def filter_reads(fnam, output=None, max_molecule_length=500,
         #         total) * 100)
     return masked
 
+def _chunk_boundaries(fnam, nchunks):
+    """
+    split a file of reads, after its header, in byte ranges starting at the
+    beginning of a line.
+
+    :returns: list of (start, end) positions in the file
+    """
+    fhandler = open(fnam)
+    beg = 0
+    while True:
+        line = fhandler.readline()
+        if not line.startswith('#'):
+            break
+        beg += len(line)
+    end = path.getsize(fnam)
+    step = max(1, (end - beg) / nchunks)
+    starts = [beg]
+    for i in xrange(1, nchunks):
+        fhandler.seek(beg + i * step)
+        fhandler.readline() # go to the beginning of next line
+        pos = fhandler.tell()
+        if starts[-1] < pos < end:
+            starts.append(pos)
+    fhandler.close()
+    return zip(starts, starts[1:] + [end])
+
+
+def _chunk_fnam(output, k, ichunk):
+    if k is None: # bitmask
+        return '%s_bitmask.bin_%d' % (output, ichunk)
+    return '%s_%s.tsv_%d' % (output, FILTERS[k].replace(' ', '_'), ichunk)
+
+
+def _filter_chunk(fnam, beg, end, ichunk, max_molecule_length, max_frag_size,
+                  min_dist_to_re, re_proximity, min_frag_size, output):
+    """
+    applies, in a single read of the given byte range of the file, all filters
+    except the over-represented one (that needs the count of reads per RE
+    fragment of the whole file).
+
+    :returns: the number of reads filtered by each filter, the number of reads
+       falling in each RE fragment, the number of reads, the ID and the
+       coordinates of the first read and the coordinates of the last read (to
+       find duplicates at the border of two chunks)
+    """
+    counts = dict((k, 0) for k in FILTERS if k != 8)
+    outfil = dict((k, open(_chunk_fnam(output, k, ichunk), 'w'))
+                  for k in counts)
+    frag_count = {}
+    nreads = 0
+    first = first_read = prev_elts = None
+    mask = array('H')
+    fhandler = open(fnam)
+    fhandler.seek(beg)
+    pos = beg
+    while pos < end:
+        line = fhandler.readline()
+        if not line:
+            break
+        pos += len(line)
+        nreads += 1
+        val = 0
+        (read,
+         cr1, pos1, sd1, _, rs1, re1,
+         cr2, pos2, sd2, _, rs2, re2) = line.split('\t')
+        re2 = re2.rstrip()
+        # duplicates
+        new_elts = cr1, pos1, cr2, pos2, sd1, sd2
+        if prev_elts == new_elts:
+            counts[9] += 1
+            outfil[9].write(read + '\n')
+            val |= 256
+        elif prev_elts is None:
+            first, first_read = new_elts, read
+        prev_elts = new_elts
+        # reads per RE fragment
+        try:
+            frag_count[(cr1, rs1)] += 1
+        except KeyError:
+            frag_count[(cr1, rs1)] = 1
+        try:
+            frag_count[(cr2, rs2)] += 1
+        except KeyError:
+            frag_count[(cr2, rs2)] = 1
+        ps1, ps2, sd1, sd2 = map(int, (pos1, pos2, sd1, sd2))
+        # same fragment
+        if cr1 == cr2:
+            if re1 == re2:
+                if sd1 != sd2:
+                    if (ps2 > ps1) == sd2:
+                        counts[1] += 1
+                        outfil[1].write(read + '\n')
+                        val |= 1
+                    else:
+                        counts[2] += 1
+                        outfil[2].write(read + '\n')
+                        val |= 2
+                else:
+                    counts[3] += 1
+                    outfil[3].write(read + '\n')
+                    val |= 4
+            elif (abs(ps1 - ps2) < max_molecule_length
+                  and sd2 != sd1
+                  and (ps2 > ps1) != sd2):
+                counts[4] += 1
+                outfil[4].write(read + '\n')
+                val |= 8
+        # distance to RE sites
+        re1, rs1, re2, rs2 = map(int, (re1, rs1, re2, rs2))
+        diff11 = re1 - ps1
+        diff12 = ps1 - rs1
+        diff21 = re2 - ps2
+        diff22 = ps2 - rs2
+        if ((diff11 < re_proximity) or
+            (diff12 < re_proximity) or
+            (diff21 < re_proximity) or
+            (diff22 < re_proximity)):
+            if not '~' in read:
+                counts[5] += 1
+                outfil[5].write(read + '\n')
+                val |= 16
+        if (((diff11 > min_dist_to_re) and
+             (diff12 > min_dist_to_re)) or
+            ((diff21 > min_dist_to_re) and
+             (diff22 > min_dist_to_re))):
+            counts[10] += 1
+            outfil[10].write(read + '\n')
+            val |= 512
+        dif1 = re1 - rs1
+        dif2 = re2 - rs2
+        if (dif1 < min_frag_size) or (dif2 < min_frag_size):
+            counts[6] += 1
+            outfil[6].write(read + '\n')
+            val |= 32
+        if (dif1 > max_frag_size) or (dif2 > max_frag_size):
+            counts[7] += 1
+            outfil[7].write(read + '\n')
+            val |= 64
+        mask.append(val)
+    fhandler.close()
+    for k in outfil:
+        outfil[k].close()
+    out = open(_chunk_fnam(output, None, ichunk), 'wb')
+    mask.tofile(out)
+    out.close()
+    return counts, frag_count, nreads, first, first_read, prev_elts
+
+
+def _filter_over_represented_chunk(fnam, beg, end, ichunk, over_frags,
+                                   border_dup, output):
+    """
+    writes the ID of the reads, in a given byte range of the file, falling in
+    an over-represented RE fragment, and updates the bitmask of the chunk
+    (also with the duplicate found at the border with previous chunk, if any).
+
+    :returns: number of reads filtered
+    """
+    count = 0
+    out = open(_chunk_fnam(output, 8, ichunk), 'w')
+    filtered = []
+    fhandler = open(fnam)
+    fhandler.seek(beg)
+    pos = beg
+    nread = 0
+    while pos < end:
+        line = fhandler.readline()
+        if not line:
+            break
+        pos += len(line)
+        read, cr1, _, _, _, rs1, _, cr2, _, _, _, rs2, _ = line.split('\t', 12)
+        if (cr1, rs1) in over_frags or (cr2, rs2) in over_frags:
+            count += 1
+            out.write(read + '\n')
+            filtered.append(nread)
+        nread += 1
+    fhandler.close()
+    out.close()
+    # update bitmask of the chunk
+    mask = np.fromfile(_chunk_fnam(output, None, ichunk), dtype=np.uint16)
+    mask[filtered] |= 128
+    if border_dup:
+        mask[0] |= 256
+    mask.tofile(_chunk_fnam(output, None, ichunk))
+    return count
+
+
+def _filter_parallel(fnam, max_molecule_length, over_represented,
+                     max_frag_size, min_frag_size, re_proximity,
+                     min_dist_to_re, output, nthreads):
+    """
+    parallel version of the filtering, the file of reads is split in chunks
+    filtered independently, the per-chunk results are then reduced.
+    """
+    # more chunks than processes to balance the load
+    chunks = _chunk_boundaries(fnam, nthreads * 4)
+    pool = mu.Pool(nthreads)
+    try:
+        procs = [pool.apply_async(_filter_chunk,
+                                  args=(fnam, beg, end, ichunk,
+                                        max_molecule_length, max_frag_size,
+                                        min_dist_to_re, re_proximity,
+                                        min_frag_size, output))
+                 for ichunk, (beg, end) in enumerate(chunks)]
+        results = [proc.get() for proc in procs]
+        masked = dict((k, {'name': FILTERS[k], 'reads': 0}) for k in FILTERS)
+        # reduce counts of reads per RE fragment
+        frag_count = {}
+        total = 0
+        for counts, chunk_frag_count, nreads, _, _, _ in results:
+            for k in counts:
+                masked[k]['reads'] += counts[k]
+            for frag, count in chunk_frag_count.iteritems():
+                try:
+                    frag_count[frag] += count
+                except KeyError:
+                    frag_count[frag] = count
+            total += nreads
+        # reduce duplicates found at the borders of chunks
+        border_dups = set()
+        for ichunk in xrange(1, len(results)):
+            _, _, _, first, first_read, _ = results[ichunk]
+            if first is not None and first == results[ichunk - 1][5]:
+                border_dups.add(ichunk)
+                masked[9]['reads'] += 1
+        # over-represented RE fragments
+        cut = int((1 - over_represented) * len(frag_count) + 0.5)
+        cut = sorted(frag_count.itervalues())[cut - 1]
+        over_frags = frozenset(frag for frag, count in frag_count.iteritems()
+                               if count > cut)
+        del frag_count
+        procs = [pool.apply_async(_filter_over_represented_chunk,
+                                  args=(fnam, beg, end, ichunk, over_frags,
+                                        ichunk in border_dups, output))
+                 for ichunk, (beg, end) in enumerate(chunks)]
+        masked[8]['reads'] = sum(proc.get() for proc in procs)
+    finally:
+        # all results are collected, or a job failed and the others are not
+        # waited for
+        pool.terminate()
+        pool.join()
+    # merge ID files and bitmasks, keeping the order of the reads file
+    out = open(output + '_bitmask.bin', 'wb')
+    for ichunk in xrange(len(chunks)):
+        chunk_fnam = _chunk_fnam(output, None, ichunk)
+        fhandler = open(chunk_fnam, 'rb')
+        copyfileobj(fhandler, out)
+        fhandler.close()
+        remove(chunk_fnam)
+    out.close()
+    for k in masked:
+        masked[k]['fnam'] = output + '_' + masked[k]['name'].replace(' ', '_') + '.tsv'
+        out = open(masked[k]['fnam'], 'w')
+        for ichunk in xrange(len(chunks)):
+            if k == 9 and ichunk in border_dups:
+                out.write(results[ichunk][4] + '\n')
+            chunk_fnam = _chunk_fnam(output, k, ichunk)
+            fhandler = open(chunk_fnam)
+            for line in fhandler:
+                out.write(line)
+            fhandler.close()
+            remove(chunk_fnam)
+        out.close()
+    return masked, total
+
+
 def _filter_same_frag(fnam, max_molecule_length, output):
     # t0 = time()
     masked = {1 : {'name': 'self-circle'       , 'reads': 0}, 
@@ -256,7 +664,7 @@ def _filter_same_frag(fnam, max_molecule_length, output):
     return masked
 
 def _filter_duplicates(fnam, output):
-    total = 0
+    total = 1
     masked = {9 : {'name': 'duplicated'        , 'reads': 0}}
     outfil = {}
     for k in masked:
@@ -4,7 +4,10 @@
 Definition and mapping of restriction enymes
 """
 
-from re import compile
+from re                          import compile
+from pytadbit.utils.genome_cache import get_cache_dir, load_re_sites
+from pytadbit.utils.genome_cache import store_re_sites
+import numpy as np
 
 
 def count_re_fragments(fnam):
@@ -70,7 +73,8 @@ def map_re_sites_nochunk(enzyme_name, genome_seq, verbose=False):
         print 'Found %d RE sites' % count
     return frags
 
-def map_re_sites(enzyme_name, genome_seq, frag_chunk=100000, verbose=False):
+def map_re_sites(enzyme_name, genome_seq, frag_chunk=100000, verbose=False,
+                 cache_dir=None):
     """
     map all restriction enzyme (RE) sites of a given enzyme in a genome.
     Position of a RE site is defined as the genomic coordinate of the first
@@ -92,7 +96,15 @@ def map_re_sites(enzyme_name, genome_seq, frag_chunk=100000, verbose=False):
        chromosome
     :param 100000 frag_chunk: in order to optimize the search for nearby RE
        sites, each chromosome is splitted into chunks.
+    :param None cache_dir: directory of the cache where RE sites are stored
+       (e.g. ~/.tadbit/cache, see :mod:`pytadbit.utils.genome_cache`). By
+       default the cache is not used
     """
+    if get_cache_dir(cache_dir):
+        return _chunk_re_sites(map_re_sites_array(enzyme_name, genome_seq,
+                                                  cache_dir=cache_dir,
+                                                  verbose=verbose),
+                               frag_chunk)
     enzyme      = RESTRICTION_ENZYMES[enzyme_name]
     enz_pattern = compile(enzyme.replace('|', ''))
     enz_cut     = enzyme.index('|') + 1 # re search starts at 0
@@ -136,6 +148,86 @@ def map_re_sites(enzyme_name, genome_seq, frag_chunk=100000, verbose=False):
         print 'Found %d RE sites' % count
     return frags
 
+def map_re_sites_array(enzyme_name, genome_seq, cache_dir=None,
+                       verbose=False):
+    """
+    map all restriction enzyme (RE) sites of a given enzyme in a genome (see
+    :func:`pytadbit.mapping.restriction_enzymes.map_re_sites`).
+
+    :param enzyme_name: name of the enzyme to map (upper/lower case are
+       important)
+    :param genome_seq: a dictionary containing the genomic sequence by
+       chromosome
+    :param None cache_dir: directory of the cache where RE sites are stored,
+       in order to reuse them for the same genome and enzyme (e.g.
+       ~/.tadbit/cache, see :mod:`pytadbit.utils.genome_cache`). By default
+       the cache is not used
+
+    :returns: a dictionary with, for each chromosome, a sorted numpy array
+       of RE sites (starting with 1 and ending with the length of the
+       chromosome)
+    """
+    cache_dir = get_cache_dir(cache_dir)
+    frags = load_re_sites(enzyme_name, genome_seq, cache_dir)
+    if frags is not None:
+        if verbose:
+            print 'Loaded RE sites from cache'
+        return frags
+    frags = dict((crm, np.array(sites, dtype=np.int64)) for crm, sites in
+                 map_re_sites_nochunk(enzyme_name, genome_seq,
+                                      verbose=verbose).iteritems())
+    store_re_sites(frags, enzyme_name, genome_seq, cache_dir)
+    return frags
+
+def _chunk_re_sites(sites_array, frag_chunk):
+    """
+    converts the output of map_re_sites_array into the one of map_re_sites:
+    each chunk contains its RE sites, plus the closest ones in previous and
+    next chunks
+    """
+    frags = {}
+    for crm, sites in sites_array.iteritems():
+        nchunks = int(sites[-1]) / frag_chunk + 1
+        bounds = np.searchsorted(sites, np.arange(nchunks + 1) * frag_chunk)
+        bounds[-1] = len(sites)
+        sites = sites.tolist()
+        frags[crm] = dict((i, sites[max(0, bounds[i] - 1):bounds[i + 1] + 1])
+                          for i in xrange(nchunks))
+    return frags
+
+def closest_re_sites(sites, pos, len_seq, frag_chunk=100000):
+    """
+    Finds, for a batch of reads mapped on the same chromosome, the closest RE
+    sites upstream and downstream. Same result as the search done by
+    :func:`pytadbit.parsers.map_parser.read_read` using
+    :func:`pytadbit.mapping.restriction_enzymes.map_re_sites`.
+
+    :param sites: numpy array of RE sites of a chromosome (from
+       :func:`pytadbit.mapping.restriction_enzymes.map_re_sites_array`)
+    :param pos: numpy array of read positions
+    :param len_seq: numpy array with the length of each read
+    :param 100000 frag_chunk: reads mapped after the last chunk of this size
+       of the chromosome are skipped
+
+    :returns: numpy arrays with the position of the reads (reads mapped
+       partly outside the chromosome are moved inside), the position of the
+       upstream RE site, of the downstream RE site and a boolean array with
+       the reads that are kept
+    """
+    last = sites[-1]
+    kept = pos / frag_chunk <= last / frag_chunk
+    # case where part of the read is mapped outside chromosome
+    outside = kept & (pos >= last)
+    if (pos[outside] - last + 1 >= len_seq[outside]).any():
+        raise Exception('Read mapped mostly outside ' +
+                        'chromosome\n')
+    pos = np.where(outside, last - 1, pos)
+    idx = np.searchsorted(sites, pos, side='right')
+    idx[~kept] = 0
+    next_re = sites[idx]
+    prev_re = sites[np.maximum(idx - 1, 0)]
+    return pos, prev_re, next_re, kept
+
 def complementary(seq):
     trs = dict([(nt1, nt2) for nt1, nt2 in zip('ATGCN', 'TACGN')])
     return ''.join([trs[s] for s in seq[::-1]])
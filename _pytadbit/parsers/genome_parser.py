@@ -4,15 +4,20 @@
 convert a bunch of fasta files, or a single multi fasta file, into a dictionary
 """
 
-from collections import OrderedDict
 from pytadbit.utils.file_handling import magic_open
+from pytadbit.utils.genome_cache  import Genome, fasta_key, get_cache_dir
+from pytadbit.utils.genome_cache  import load_genome, store_genome
 import re
 
 def parse_fasta(f_names, chr_names=None, chr_filter=None, chr_regexp=None,
-                verbose=True):
+                verbose=True, cache_dir=None):
     """
     Parse a list of fasta files, or just one fasta.
 
+    If a cache directory is given, parsed genomes are stored in it (see
+    :mod:`pytadbit.utils.genome_cache`), and loaded from it next time the same
+    files are parsed with the same parameters.
+
     WARNING: The order is important
 
     :param f_names: list of pathes to files, or just a single path
@@ -20,6 +25,9 @@ def parse_fasta(f_names, chr_names=None, chr_filter=None, chr_regexp=None,
        are passed, then chromosome names will be inferred from fasta headers
     :param None chr_filter: use only chromosome in the input list
     :param None chr_regexp: use only chromosome matching
+    :param None cache_dir: directory of the cache of parsed genomes (e.g.
+       ~/.tadbit/cache, see :mod:`pytadbit.utils.genome_cache`). By default
+       the cache is not used
 
     :returns: a sorted dictionary with chromosome names as keys, and sequences
        as values (sequence in upper case)
@@ -29,6 +37,16 @@ def parse_fasta(f_names, chr_names=None, chr_filter=None, chr_regexp=None,
     if isinstance(chr_names, str):
         chr_names = [chr_names]
 
+    cache_dir = get_cache_dir(cache_dir)
+    key = None
+    if cache_dir and all(isinstance(f, basestring) for f in f_names):
+        key = fasta_key(f_names, chr_names, chr_filter, chr_regexp, cache_dir)
+        genome_seq = load_genome(key, cache_dir)
+        if genome_seq is not None:
+            if verbose:
+                print 'Loaded %d chromosomes from cache' % len(genome_seq)
+            return genome_seq
+
     if chr_filter:
         bad_chrom = lambda x: not x in chr_filter
     else:
@@ -39,7 +57,7 @@ def parse_fasta(f_names, chr_names=None, chr_filter=None, chr_regexp=None,
     else:
         chr_regexp = re.compile('.*')
 
-    genome_seq = OrderedDict()
+    genome_seq = Genome()
     if len(f_names) == 1:
         header = None
         seq = []
@@ -88,4 +106,7 @@ def parse_fasta(f_names, chr_names=None, chr_filter=None, chr_regexp=None,
             genome_seq[header] = ''.join([l.rstrip() for l in fhandler]).upper()
         if 'UNWANTED' in genome_seq:
             del(genome_seq['UNWANTED'])
+    if key:
+        genome_seq.checksum = key
+        store_genome(genome_seq, key, cache_dir)
     return genome_seq
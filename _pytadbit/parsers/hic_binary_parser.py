@@ -0,0 +1,276 @@
+"""
+18 Oct 2026
+
+Binary, memory-mappable, storage of Hi-C matrices.
+
+The file contains, for each pair of chromosomes, the corresponding block of the
+upper triangle of the interaction matrix in Compressed Sparse Row format, plus
+the biases and the filtered (bad) columns. Only the blocks (and rows of these
+blocks) needed are read from disk.
+
+File layout:
+
+  - magic line
+  - offset of the header (20 digits) and new line
+  - raw arrays
+  - header: python dictionary with the resolution, chromosomes and position,
+    type and shape of each array
+
+"""
+
+from ast                           import literal_eval
+from collections                   import OrderedDict
+from pytadbit                      import HiC_data, SparseHiC_data
+from pytadbit.utils.normalize_hic  import _upper_triangle
+import numpy as np
+
+MAGIC = 'TADbit binary Hi-C matrix v1\n'
+
+
+def is_hic_binary(fname):
+    """
+    :param fname: path to a file
+
+    :returns: True if the file is a binary Hi-C matrix
+    """
+    try:
+        with open(fname, 'rb') as fh:
+            return fh.read(len(MAGIC)) == MAGIC
+    except (IOError, TypeError):
+        return False
+
+
+def write_hic_binary(hic_data, fname):
+    """
+    Writes a HiC_data object (raw interaction counts, biases and filtered
+    columns) into a binary file that can be read by
+    :func:`pytadbit.parsers.hic_binary_parser.read_hic_binary`.
+
+    :param hic_data: HiC_data (or SparseHiC_data) object
+    :param fname: path to the output file
+    """
+    upper = _upper_triangle(hic_data)
+    if upper.dtype.kind == 'f' and not np.all(np.mod(upper.data, 1) == 0):
+        dtype = np.float32
+    else:
+        dtype = np.uint32
+    if hic_data.chromosomes:
+        chromosomes = [(crm, hic_data.section_pos[crm][0],
+                        hic_data.section_pos[crm][1])
+                       for crm in hic_data.chromosomes]
+    else:
+        chromosomes = [(None, 0, len(hic_data))]
+    out = open(fname, 'wb')
+    out.write(MAGIC)
+    out.write('%020d\n' % 0) # placeholder for the header position
+    arrays = {}
+
+    def _write(key, array):
+        # align arrays on 8 bytes
+        out.write('\0' * (-out.tell() % 8))
+        arrays[key] = (out.tell(), array.dtype.str, array.shape)
+        array.tofile(out)
+
+    for i, (crm1, beg1, end1) in enumerate(chromosomes):
+        for crm2, beg2, end2 in chromosomes[i:]:
+            block = upper[beg1:end1, beg2:end2].tocsr()
+            block.sum_duplicates()
+            _write(('indptr' , crm1, crm2), block.indptr.astype(np.int64))
+            _write(('indices', crm1, crm2), block.indices.astype(np.int32))
+            _write(('data'   , crm1, crm2), block.data.astype(dtype))
+    if hic_data.bias:
+        _write('bias', np.array([hic_data.bias.get(i, np.nan)
+                                 for i in xrange(len(hic_data))], dtype=float))
+    _write('bads', np.array(sorted(hic_data.bads), dtype=np.int64))
+    header = {'resolution'   : hic_data.resolution,
+              'chromosomes'  : chromosomes,
+              'symmetricized': hic_data.symmetricized,
+              'size'         : len(hic_data),
+              'arrays'       : arrays}
+    pos = out.tell()
+    out.write(repr(header))
+    out.seek(len(MAGIC))
+    out.write('%020d\n' % pos)
+    out.close()
+
+
+class HiCBinaryFile(object):
+    """
+    Memory mapped access to a binary Hi-C matrix written with
+    :func:`pytadbit.parsers.hic_binary_parser.write_hic_binary`.
+
+    :param fname: path to the binary file
+    """
+    def __init__(self, fname):
+        self.fname = fname
+        fhandler = open(fname, 'rb')
+        if fhandler.read(len(MAGIC)) != MAGIC:
+            raise IOError('ERROR: %s is not a TADbit binary matrix' % fname)
+        pos = int(fhandler.readline())
+        fhandler.seek(pos)
+        header = literal_eval(fhandler.read())
+        fhandler.close()
+        self.resolution    = header['resolution']
+        self.symmetricized = header['symmetricized']
+        self.size          = header['size']
+        self._arrays       = header['arrays']
+        self.chromosomes   = OrderedDict((crm, (beg, end)) for crm, beg, end
+                                         in header['chromosomes'])
+
+    def _array(self, key):
+        offset, dtype, shape = self._arrays[key]
+        if not shape[0]:
+            return np.zeros(shape, dtype=dtype)
+        return np.memmap(self.fname, dtype=dtype, mode='r', offset=offset,
+                         shape=shape)
+
+    def bias(self):
+        """
+        :returns: array of biases (None if the matrix was not normalized)
+        """
+        if not 'bias' in self._arrays:
+            return None
+        return self._array('bias')
+
+    def bads(self):
+        """
+        :returns: array with the index of the filtered columns
+        """
+        return self._array('bads')
+
+    def _regions(self, focus):
+        """
+        converts a focus into a list of (chromosome, first bin, last bin)
+        """
+        if focus is None:
+            return [(crm, 0, end - beg)
+                    for crm, (beg, end) in self.chromosomes.iteritems()]
+        if isinstance(focus, str):
+            focus = [focus]
+        if (isinstance(focus, tuple) and len(focus) == 3
+            and isinstance(focus[1], int)):
+            # bins overlapping the region
+            crm, beg, end = focus
+            nbins = self.chromosomes[crm][1] - self.chromosomes[crm][0]
+            return [(crm, min(nbins, beg / self.resolution),
+                     min(nbins, (end - 1) / self.resolution + 1))]
+        return [(crm, 0, self.chromosomes[crm][1] - self.chromosomes[crm][0])
+                for crm in focus]
+
+    def _block(self, crm1, beg1, end1, crm2, beg2, end2):
+        """
+        reads the cells of the upper triangle of the matrix between a given
+        range of bins of two chromosomes
+
+        :returns: rows, columns and values (rows and columns relative to the
+           chromosome start)
+        """
+        indptr = self._array(('indptr', crm1, crm2))
+        lo, hi = int(indptr[beg1]), int(indptr[end1])
+        rows = np.repeat(np.arange(beg1, end1),
+                         np.diff(np.asarray(indptr[beg1:end1 + 1])))
+        cols = np.asarray(self._array(('indices', crm1, crm2))[lo:hi])
+        vals = np.asarray(self._array(('data', crm1, crm2))[lo:hi])
+        keep = (cols >= beg2) & (cols < end2)
+        return rows[keep], cols[keep], vals[keep]
+
+    def get_hic_data(self, focus=None, normalized=False, sparse=False):
+        """
+        Loads a region of the matrix into a HiC_data object
+
+        :param None focus: chromosome name, or list of chromosome names, or
+           tuple with chromosome name and start and end positions in genomic
+           coordinates (e.g. ('chr1', 1000000, 2000000)). By default the full
+           genome is loaded
+        :param False normalized: divide the counts by the biases (the biases
+           are not kept in the resulting object)
+        :param False sparse: returns a
+           :class:`pytadbit.hic_data.SparseHiC_data` object
+
+        :returns: a HiC_data (or SparseHiC_data) object
+        """
+        regions = self._regions(focus)
+        # position of each region in the new matrix
+        starts = []
+        size = 0
+        for _, beg, end in regions:
+            starts.append(size)
+            size += end - beg
+        bias = self.bias()
+        if normalized and bias is None:
+            raise Exception('ERROR: matrix not normalized')
+        # get cells
+        rows = []
+        cols = []
+        vals = []
+        order = dict((crm, i) for i, crm in enumerate(self.chromosomes))
+        for i, (crm1, beg1, end1) in enumerate(regions):
+            for j, (crm2, beg2, end2) in enumerate(regions):
+                if order[crm1] > order[crm2] or (crm1 == crm2 and j < i):
+                    continue
+                row, col, val = self._block(crm1, beg1, end1, crm2, beg2, end2)
+                rows.append(row - beg1 + starts[i])
+                cols.append(col - beg2 + starts[j])
+                if normalized:
+                    val = val / (bias[row + self.chromosomes[crm1][0]] *
+                                 bias[col + self.chromosomes[crm2][0]])
+                vals.append(val)
+        rows = np.concatenate(rows) if rows else np.zeros(0, dtype=int)
+        cols = np.concatenate(cols) if cols else np.zeros(0, dtype=int)
+        vals = np.concatenate(vals) if vals else np.zeros(0)
+        # regions requested out of the file order give cells below the diagonal
+        rows, cols = np.minimum(rows, cols), np.maximum(rows, cols)
+        # index conversion from the file to the new matrix
+        new_index = {}
+        for (crm, beg, end), start in zip(regions, starts):
+            shift = self.chromosomes[crm][0] + beg
+            for k in xrange(end - beg):
+                new_index[k + shift] = k + start
+        chromosomes = OrderedDict()
+        dict_sec = {}
+        for (crm, beg, end), start in zip(regions, starts):
+            if crm is None:
+                chromosomes = None
+                break
+            chromosomes[crm] = end - beg
+            for k in xrange(end - beg):
+                dict_sec[(crm, k + beg)] = k + start
+        kwargs = dict(chromosomes=chromosomes, dict_sec=dict_sec,
+                      resolution=self.resolution,
+                      masked=dict((new_index[b], True) for b in self.bads()
+                                  if b in new_index),
+                      symmetricized=self.symmetricized)
+        if sparse:
+            hic_data = SparseHiC_data.from_coo(rows, cols, vals, size, **kwargs)
+        else:
+            vals = vals.tolist()
+            hic_data = HiC_data(
+                [(r * size + c, v) for r, c, v in zip(rows.tolist(),
+                                                      cols.tolist(), vals)] +
+                [(c * size + r, v) for r, c, v in zip(rows.tolist(),
+                                                      cols.tolist(), vals)
+                 if r != c], size, **kwargs)
+        if bias is not None and not normalized:
+            hic_data.bias = dict((new_index[k], float(b))
+                                 for k, b in enumerate(bias) if k in new_index)
+        return hic_data
+
+
+def read_hic_binary(fname, focus=None, normalized=False, sparse=False):
+    """
+    Loads a binary Hi-C matrix, or a region of it, into a HiC_data object.
+    Only the needed parts of the file are read.
+
+    :param fname: path to a binary file generated by
+       :func:`pytadbit.parsers.hic_binary_parser.write_hic_binary`
+    :param None focus: chromosome name, or list of chromosome names, or tuple
+       with chromosome name and start and end positions in genomic coordinates
+       (e.g. ('chr1', 1000000, 2000000)). By default the full genome is loaded
+    :param False normalized: divide the counts by the biases
+    :param False sparse: returns a :class:`pytadbit.hic_data.SparseHiC_data`
+       object
+
+    :returns: a HiC_data (or SparseHiC_data) object
+    """
+    return HiCBinaryFile(fname).get_hic_data(focus=focus, normalized=normalized,
+                                             sparse=sparse)
@@ -7,7 +7,10 @@ from warnings                import warn
 from math                    import sqrt, isnan
 from pytadbit.parsers.gzopen import gzopen
 from collections             import OrderedDict
-from pytadbit                import HiC_data
+from itertools               import islice
+from pytadbit                import HiC_data, SparseHiC_data
+from pytadbit.parsers.hic_binary_parser import is_hic_binary, read_hic_binary
+import numpy as np
 
 HIC_DATA = True
 
@@ -303,6 +306,10 @@ def read_matrix(things, parser=None, hic=True, resolution=1, **kwargs):
     :param 1 resolution: resolution of the matrix
     :param True hic: if False, TADbit assumes that files contains normalized
        data
+    :param None focus: in the case of binary matrices (see
+       :func:`pytadbit.parsers.hic_binary_parser.write_hic_binary`), load only
+       a chromosome, a list of chromosomes or a region (e.g.
+       ('chr1', 1000000, 2000000))
     :returns: the corresponding matrix concatenated into a huge list, also
        returns number or rows
 
@@ -327,6 +334,9 @@ def read_matrix(things, parser=None, hic=True, resolution=1, **kwargs):
                                      chromosomes=chromosomes,
                                      resolution=resolution,
                                      symmetricized=sym, masked=masked))
+        elif isinstance(thing, str) and is_hic_binary(thing):
+            matrices.append(read_hic_binary(thing, focus=kwargs.get('focus'),
+                                            normalized=not hic))
         elif isinstance(thing, str):
             try:
                 matrix, size, header, masked, sym = parser(gzopen(thing))
@@ -387,40 +397,136 @@ def load_hic_data_from_reads(fnam, resolution, **kwargs):
        chromosome
     :param False get_sections: for very very high resolution, when the column
        index does not fit in memory
+    :param False sparse: store the interaction matrix in NumPy arrays (upper
+       triangle only) using :class:`pytadbit.hic_data.SparseHiC_data`, instead
+       of a python dictionary. Uses much less memory at high resolution
+    :param 1000000 chunk_size: number of reads to be parsed at once before
+       being added to the matrix
     """
-    sections = []
-    genome_seq = OrderedDict()
+    return load_hic_data_at_resolutions(fnam, [resolution], **kwargs)[resolution]
+
+
+def load_hic_data_at_resolutions(fnam, resolutions, **kwargs):
+    """
+    Reads once a tsv file with reads1 and reads2, and bins the interactions at
+    several resolutions.
+
+    :param fnam: tsv file with reads1 and reads2
+    :param resolutions: list of resolutions (size of a bin in bases)
+    :param False get_sections: for very very high resolution, when the column
+       index does not fit in memory
+    :param False sparse: store the interaction matrices in NumPy arrays
+       (:class:`pytadbit.hic_data.SparseHiC_data`), instead of python
+       dictionaries
+    :param 1000000 chunk_size: number of reads to be parsed at once before
+       being added to the matrices
+
+    :returns: a dictionary of HiC_data objects, keys being resolutions
+    """
+    get_sections = kwargs.get('get_sections', True)
+    sparse = kwargs.get('sparse', False)
+    chunk_size = kwargs.get('chunk_size', 1000000)
     fhandler = open(fnam)
+    genome = OrderedDict()
     line = fhandler.next()
-    size = 0
     while line.startswith('#'):
         if line.startswith('# CRM '):
             crm, clen = line[6:].split()
-            genome_seq[crm] = int(clen) / resolution + 1
-            size += genome_seq[crm]
+            genome[crm] = int(clen)
         line = fhandler.next()
-    section_sizes = {}
-    if kwargs.get('get_sections', True):
-        for crm in genome_seq:
-            len_crm = genome_seq[crm]
-            section_sizes[(crm,)] = len_crm
-            sections.extend([(crm, i) for i in xrange(len_crm)])
-    dict_sec = dict([(j, i) for i, j in enumerate(sections)])
-    imx = HiC_data((), size, genome_seq, dict_sec, resolution=resolution)
+    # one matrix per resolution, with the offset of each chromosome in bins
+    imxs = OrderedDict()
+    offsets = {}
+    for reso in resolutions:
+        genome_seq = OrderedDict()
+        size = 0
+        sections = []
+        for crm in genome:
+            genome_seq[crm] = genome[crm] / reso + 1
+            offsets[reso, crm] = size, genome_seq[crm]
+            size += genome_seq[crm]
+            if get_sections:
+                sections.extend([(crm, i) for i in xrange(genome_seq[crm])])
+        dict_sec = dict([(j, i) for i, j in enumerate(sections)])
+        if sparse:
+            imxs[reso] = SparseHiC_data((), size, genome_seq, dict_sec,
+                                        resolution=reso)
+        else:
+            imxs[reso] = HiC_data((), size, genome_seq, dict_sec,
+                                  resolution=reso)
+    chunk = [line]
+    while True:
+        chunk.extend(islice(fhandler, chunk_size))
+        if not chunk:
+            break
+        cr1, ps1, cr2, ps2 = _parse_read_columns(chunk)
+        crms, idx = np.unique(np.concatenate((cr1, cr2)), return_inverse=True)
+        idx1, idx2 = idx[:len(cr1)], idx[len(cr1):]
+        for reso, imx in imxs.iteritems():
+            nbs = np.array([offsets.get((reso, crm), (-1, 0))[1]
+                            for crm in crms], dtype=np.int64)
+            off = np.array([offsets.get((reso, crm), (-1, 0))[0]
+                            for crm in crms], dtype=np.int64)
+            bin1 = ps1 / reso
+            bin2 = ps2 / reso
+            if get_sections:
+                valid = ((off[idx1] >= 0) & (bin1 < nbs[idx1]) &
+                         (off[idx2] >= 0) & (bin2 < nbs[idx2]))
+                bin1 = np.where(valid, off[idx1] + bin1, bin1)
+                bin2 = np.where(valid, off[idx2] + bin2, bin2)
+            _add_reads_to_matrix(imx, bin1, bin2)
+        chunk = []
+    fhandler.close()
+    for imx in imxs.itervalues():
+        imx.symmetricized = True
+    return imxs
+
+
+def _parse_read_columns(lines):
+    """
+    Vectorized parsing of the chromosome and position columns of the reads.
+
+    :param lines: list of lines of a TADbit tsv file with reads1 and reads2
+
+    :returns: chromosome and position of reads 1 and of reads 2, as numpy arrays
+    """
+    if all(l.count('\t') == 12 for l in lines):
+        block = ''.join(lines)
+        if not block.endswith('\n'):
+            block += '\n'
+        fields = block.replace('\n', '\t').split('\t')
+    else:
+        # not the standard 13 columns, slower parsing line by line
+        fields = []
+        for line in lines:
+            cols = line.split('\t', 9)
+            if len(cols) < 10:
+                raise ValueError('ERROR: expected at least 10 tab-separated '
+                                 'columns in reads file, found %d in:\n%s' % (
+                                     len(cols), line))
+            fields.extend(cols[:9] + [''] * 4)
+    cr1 = np.array(fields[1::13])
+    cr2 = np.array(fields[7::13])
     try:
-        while True:
-            _, cr1, ps1, _, _, _, _, cr2, ps2, _ = line.split('\t', 9)
-            try:
-                ps1 = dict_sec[(cr1, int(ps1) / resolution)]
-                ps2 = dict_sec[(cr2, int(ps2) / resolution)]
-            except KeyError:
-                ps1 = int(ps1) / resolution
-                ps2 = int(ps2) / resolution
-            imx[ps1, ps2] += 1
-            imx[ps2, ps1] += 1
-            line = fhandler.next()
-    except StopIteration:
-        pass
-    imx.symmetricized = True
-    return imx
+        ps1 = np.array(fields[2::13]).astype(np.int64)
+        ps2 = np.array(fields[8::13]).astype(np.int64)
+    except ValueError:
+        raise ValueError('ERROR: read positions (columns 3 and 9 of the reads '
+                         'file) should be integers')
+    return cr1, ps1, cr2, ps2
+
 
+def _add_reads_to_matrix(imx, bin1, bin2):
+    """
+    Add one interaction in cell (i, j) and one in cell (j, i) for each read
+    """
+    if isinstance(imx, SparseHiC_data):
+        imx.add_pairs(bin1, bin2)
+        return
+    size = len(imx)
+    pos, counts = np.unique(np.concatenate((bin1 * size + bin2,
+                                            bin2 * size + bin1)),
+                            return_counts=True)
+    get = imx.get
+    for k, v in zip(pos.tolist(), counts.tolist()):
+        imx[k] = get(k, 0) + v
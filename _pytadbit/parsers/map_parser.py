@@ -4,12 +4,22 @@
 
 from pytadbit.utils.file_handling         import magic_open
 from bisect                               import bisect_right as bisect
-from pytadbit.mapping.restriction_enzymes import map_re_sites
+from pytadbit.mapping.restriction_enzymes import map_re_sites_array
+from pytadbit.parsers.genome_parser       import parse_fasta
+from pytadbit.mapping.restriction_enzymes import closest_re_sites
+from itertools                            import islice
 from warnings                             import warn
-from sys                                  import stdout
 from subprocess                           import Popen
+from pytadbit.utils.extsort               import write_sorted_chunks
+from pytadbit.utils.extsort               import reduce_sorted_files, iter_merged
+import multiprocessing as mu
+import numpy as np
 import os
 
+# RE sites, set before creating the pool of processes parsing the reads (that
+# inherit it)
+_FRAGS = {}
+
 def parse_map(f_names1, f_names2=None, out_file1=None, out_file2=None,
               genome_seq=None, re_name=None, verbose=False, clean=True,
               **kwargs):
@@ -24,6 +34,10 @@ def parse_map(f_names1, f_names2=None, out_file1=None, out_file2=None,
     The position of reads mapped on reverse strand will be computed from the end of
     the read (original position + read length - 1)
 
+    Reads are sorted by external sort: each input file is parsed into sorted
+    temporary files of limited size (input files are parsed in parallel), and
+    these files are then merged with a k-way merge.
+
     :param f_names1: a list of path to sam/bam files corresponding to the
        mapping of read1, can also  be just one file
     :param f_names2: a list of path to sam/bam files corresponding to the
@@ -33,12 +47,25 @@ def parse_map(f_names1, f_names2=None, out_file1=None, out_file2=None,
     :param out_file2: path to outfile tab separated format containing mapped
        read2 information
     :param genome_seq: a dictionary generated by :func:`pyatdbit.parser.genome_parser.parse_fasta`.
-       containing the genomic sequence
+       containing the genomic sequence, or the path (or list of paths) to
+       the FASTA file(s) of the reference genome
     :param re_name: name of the restriction enzyme used
     :param True clean: remove temporary files required for indentification of
        multiple-contacts
     :param False compress: compress (gzip) input map files. This is done in the
        background while next MAP files are parsed, or while files are sorted.
+    :param 1 nthreads: number of input files parsed (or of intermediate files
+       merged) at the same time
+    :param None tmp_dir: directory where to write temporary files (by default
+       the directory of the output files)
+    :param 1000000 chunk_size: maximum number of reads per temporary file
+    :param None max_memory: maximum size (in Mb, approximate) of the reads kept
+       in memory by each process before being written to a temporary file
+    :param 64 fan_in: maximum number of temporary files merged at a time
+    :param None cache_dir: directory of the cache where the parsed genome and
+       the RE sites found in it are stored, to be reused in other runs with
+       the same genome and enzyme (e.g. ~/.tadbit/cache, see
+       :mod:`pytadbit.utils.genome_cache`). By default the cache is not used
     """
     # not nice, dirty fix in order to allow this function to only parse
     # one SAM file
@@ -52,10 +79,21 @@ def parse_map(f_names1, f_names2=None, out_file1=None, out_file2=None,
         raise Exception('ERROR: out_file2 AND f_names2 needed\n')
 
     frag_chunk = kwargs.get('frag_chunk', 100000)
+    nthreads   = kwargs.get('nthreads', 1)
+    tmp_dir    = kwargs.get('tmp_dir', None)
+    fan_in     = kwargs.get('fan_in', 64)
+    # max number of reads per intermediate files for sorting
+    chunk_size = kwargs.get('chunk_size', 1000000)
+    max_memory = kwargs.get('max_memory', None)
     if verbose:
         print 'Searching and mapping RE sites to the reference genome'
-    frags = map_re_sites(re_name, genome_seq, frag_chunk=frag_chunk,
-                         verbose=verbose)
+    if isinstance(genome_seq, (str, list)):
+        genome_seq = parse_fasta(genome_seq, verbose=verbose,
+                                 cache_dir=kwargs.get('cache_dir', None))
+    global _FRAGS
+    _FRAGS = map_re_sites_array(re_name, genome_seq,
+                                cache_dir=kwargs.get('cache_dir', None),
+                                verbose=verbose)
 
     if isinstance(f_names1, str):
         f_names1 = [f_names1]
@@ -68,170 +106,197 @@ def parse_map(f_names1, f_names2=None, out_file1=None, out_file2=None,
         fnames = (f_names1,)
         outfiles = (out_file1, )
 
-    # max number of reads per intermediate files for sorting
-    max_size = 1000000
-    
-    windows = {}
-    multis  = {}
-    procs   = []
-    for read in range(len(fnames)):
-        if verbose:
-            print 'Loading read' + str(read + 1)
-        windows[read] = {}
-        num = 0
-        # iteration over reads
-        nfile = 0
-        tmp_files = []
-        reads     = []
-        for fnam in fnames[read]:
-            try:
-                fhandler = magic_open(fnam)
-            except IOError:
-                warn('WARNING: file "%s" not found\n' % fnam)
-                continue
-            # get the iteration number of the iterative mapping
-            try:
-                num = int(fnam.split('.')[-1].split(':')[0])
-            except:
-                num += 1
-            # set read counter
+    # parse all input files, in parallel
+    pool = mu.Pool(nthreads) if nthreads > 1 else None
+    try:
+        jobs = {}
+        for read in range(len(fnames)):
+            for ifnam, fnam in enumerate(fnames[read]):
+                if not os.path.exists(fnam):
+                    warn('WARNING: file "%s" not found\n' % fnam)
+                    continue
+                args = (fnam, outfiles[read], frag_chunk, tmp_dir, chunk_size,
+                        max_memory)
+                if pool:
+                    jobs[read, ifnam] = pool.apply_async(_parse_map_file,
+                                                         args=args)
+                else:
+                    jobs[read, ifnam] = args
+        if pool:
+            pool.close()
+
+        windows = {}
+        multis  = {}
+        procs   = []
+        for read in range(len(fnames)):
             if verbose:
-                print 'loading file: %s' % (fnam)
-            # start parsing
-            read_count = 0
-            try:
-                while not False:
-                    for _ in xrange(max_size):
-                        try:
-                            reads.append(read_read(fhandler.next(), frags,
-                                                   frag_chunk))
-                        except KeyError:
-                            # Chromosome not in hash
-                            continue
-                        read_count += 1
-                    nfile += 1
-                    write_reads_to_file(reads, outfiles[read], tmp_files, nfile)
-            except StopIteration:
-                fhandler.close()
-                nfile += 1
-                write_reads_to_file(reads, outfiles[read], tmp_files, nfile)
-            windows[read][num] = read_count
-            if kwargs.get('compress', False) and fnam.endswith('.map'):
-                print 'compressing input MAP file'
-                procs.append(Popen(['gzip', fnam]))
-        nfile += 1
-        write_reads_to_file(reads, outfiles[read], tmp_files, nfile)
+                print 'Loading read' + str(read + 1)
+            windows[read] = {}
+            num = 0
+            tmp_files = []
+            for ifnam, fnam in enumerate(fnames[read]):
+                if not (read, ifnam) in jobs:
+                    continue
+                # get the iteration number of the iterative mapping
+                try:
+                    num = int(fnam.split('.')[-1].split(':')[0])
+                except:
+                    num += 1
+                if verbose:
+                    print 'loading file: %s' % (fnam)
+                if pool:
+                    fnam_tmp_files, read_count = jobs[read, ifnam].get()
+                else:
+                    fnam_tmp_files, read_count = _parse_map_file(
+                        *jobs[read, ifnam])
+                tmp_files.extend(fnam_tmp_files)
+                windows[read][num] = read_count
+                if kwargs.get('compress', False) and fnam.endswith('.map'):
+                    print 'compressing input MAP file'
+                    procs.append(Popen(['gzip', fnam]))
 
-        # we have now sorted temporary files
-        # we do merge sort for eah pair
-        if verbose:
-            stdout.write('Merge sort')
-            stdout.flush()
-        while len(tmp_files) > 1:
-            file1 = tmp_files.pop(0)
-            try:
-                file2 = tmp_files.pop(0)
-            except IndexError:
-                break
+            # we have now sorted temporary files, that we merge
             if verbose:
-                stdout.write('.')
-            stdout.flush()
-            nfile += 1
-            tmp_files.append(merge_sort(file1, file2, outfiles[read], nfile))
-        if verbose:
-            stdout.write('\n')
-        tmp_name = tmp_files[0]
-        
-        if verbose:
-            print 'Getting Multiple contacts'
-        reads_fh = open(outfiles[read], 'w')
-        ## Also pipe file header
-        # chromosome sizes (in order)
-        reads_fh.write('# Chromosome lengths (order matters):\n')
-        for crm in genome_seq:
-            reads_fh.write('# CRM %s\t%d\n' % (crm, len(genome_seq[crm])))
-        reads_fh.write('# Mapped\treads count by iteration\n')
-        for size in windows[read]:
-            reads_fh.write('# MAPPED %d %d\n' % (size, windows[read][size]))
+                print 'Merge sort'
+            tmp_files = reduce_sorted_files(tmp_files, outfiles[read],
+                                            fan_in=fan_in, nthreads=nthreads,
+                                            tmp_dir=tmp_dir)
 
-        ## Multicontacts
-        tmp_reads_fh = open(tmp_name)
-        try:
-            read_line = tmp_reads_fh.next()
-        except StopIteration:
-            raise StopIteration('ERROR!\n Nothing parsed, check input files and'
-                                ' chromosome names (in genome.fasta and SAM/MAP'
-                                ' files).')
-        prev_head = read_line.split('\t', 1)[0]
-        prev_head = prev_head.split('~' , 1)[0]
-        prev_read = read_line
-        multis[read] = 0
-        for read_line in tmp_reads_fh:
-            head = read_line.split('\t', 1)[0]
-            head = head.split('~' , 1)[0]
-            if head == prev_head:
-                multis[read] += 1
-                prev_read =  prev_read.strip() + '|||' + read_line
-            else:
-                reads_fh.write(prev_read)
-                prev_read = read_line
-            prev_head = head
-        reads_fh.write(prev_read)
-        reads_fh.close()
-        if clean:
-            os.system('rm -rf ' + tmp_name)
+            if verbose:
+                print 'Getting Multiple contacts'
+            reads_fh = open(outfiles[read], 'w')
+            ## Also pipe file header
+            # chromosome sizes (in order)
+            reads_fh.write('# Chromosome lengths (order matters):\n')
+            for crm in genome_seq:
+                reads_fh.write('# CRM %s\t%d\n' % (crm, len(genome_seq[crm])))
+            reads_fh.write('# Mapped\treads count by iteration\n')
+            for size in windows[read]:
+                reads_fh.write('# MAPPED %d %d\n' % (size, windows[read][size]))
+
+            ## Multicontacts
+            tmp_reads_fh = iter_merged(tmp_files)
+            try:
+                read_line = tmp_reads_fh.next()
+            except StopIteration:
+                raise StopIteration('ERROR!\n Nothing parsed, check input files '
+                                    'and chromosome names (in genome.fasta and '
+                                    'SAM/MAP files).')
+            prev_head = read_line.split('\t', 1)[0]
+            prev_head = prev_head.split('~' , 1)[0]
+            prev_read = read_line
+            multis[read] = 0
+            for read_line in tmp_reads_fh:
+                head = read_line.split('\t', 1)[0]
+                head = head.split('~' , 1)[0]
+                if head == prev_head:
+                    multis[read] += 1
+                    prev_read =  prev_read.strip() + '|||' + read_line
+                else:
+                    reads_fh.write(prev_read)
+                    prev_read = read_line
+                prev_head = head
+            reads_fh.write(prev_read)
+            reads_fh.close()
+            if clean:
+                for tmp_name in tmp_files:
+                    os.remove(tmp_name)
+    finally:
+        # all files are parsed, or a job failed and the others are not
+        # waited for
+        if pool:
+            pool.terminate()
+            pool.join()
+        # release the RE sites
+        _FRAGS = {}
     # wait for compression to finish
     for p in procs:
         p.communicate()
     return windows, multis
 
-def write_reads_to_file(reads, outfiles, tmp_files, nfile):
-    if not reads: # can be...
-        return
-    tmp_name = os.path.join(*outfiles.split('/')[:-1] +
-                            [('tmp_%03d_' % nfile) + outfiles.split('/')[-1]])
-    tmp_name = ('/' * outfiles.startswith('/')) + tmp_name
-    tmp_files.append(tmp_name)
-    out = open(tmp_name, 'w')
-    out.write(''.join(sorted(reads, key=lambda x: x.split('\t', 1)[0].split('~')[0])))
-    out.close()
-    del(reads[:]) # empty list
+def _parse_map_file(fnam, outfile, frag_chunk, tmp_dir, chunk_size,
+                    max_memory):
+    """
+    parse one MAP file into temporary files sorted by read ID
+
+    :returns: list of temporary files and number of reads parsed
+    """
+    fhandler = magic_open(fnam)
+    tmp_files, read_count = write_sorted_chunks(
+        _iter_reads(fhandler, _FRAGS, frag_chunk), outfile, tmp_dir=tmp_dir,
+        chunk_size=chunk_size, max_memory=max_memory)
+    fhandler.close()
+    return tmp_files, read_count
 
-def merge_sort(file1, file2, outfiles, nfile):
-    tmp_name = os.path.join(*outfiles.split('/')[:-1] +
-                            [('tmp_merged_%03d_' % nfile) + outfiles.split('/')[-1]])
-    tmp_name = ('/' * outfiles.startswith('/')) + tmp_name
-    tmp_file = open(tmp_name, 'w')
-    fh1 = open(file1)
-    fh2 = open(file2)
-    greater = lambda x, y: x.split('\t', 1)[0].split('~')[0] > y.split('\t', 1)[0].split('~')[0]
-    read1 = fh1.next()
-    read2 = fh2.next()
+def _iter_reads(fhandler, frags, frag_chunk, batch=100000):
+    """
+    parse MAP lines by batches, the closest RE sites of all the reads of a
+    batch are searched at once
+    """
     while True:
-        if greater(read2, read1):
-            tmp_file.write(read1)
-            try:
-                read1 = fh1.next()
-            except StopIteration:
-                tmp_file.write(read2)
-                break
-        else:
-            tmp_file.write(read2)
-            try:
-                read2 = fh2.next()
-            except StopIteration:
-                tmp_file.write(read1)
-                break
-    for read in fh1:
-        tmp_file.write(read)
-    for read in fh2:
-        tmp_file.write(read)
-    fh1.close()
-    fh2.close()
-    tmp_file.close()
-    os.system('rm -f ' + file1)
-    os.system('rm -f ' + file2)
-    return tmp_name
+        lines = list(islice(fhandler, batch))
+        if not lines:
+            break
+        names = []
+        crms  = []
+        posis = []
+        lens  = []
+        poss  = []
+        for line in lines:
+            name, seq, _, _, ali = line.split('\t', 5)[:5]
+            crm, strand, pos = ali.split(':', 3)[:3]
+            names.append(name)
+            crms.append(crm)
+            posis.append(strand == '+')
+            lens.append(len(seq))
+            poss.append(int(pos))
+        for line in format_reads(names, crms, posis, lens, poss, frags,
+                                 frag_chunk):
+            yield line
+
+def format_reads(names, crms, positive, len_seq, pos, frags, frag_chunk):
+    """
+    Search the closest RE sites of a batch of reads, and format them as
+    parsed reads (same output as :func:`pytadbit.parsers.map_parser.read_read`).
+
+    :param names: list of read IDs
+    :param crms: list of chromosome names
+    :param positive: list of booleans, True if the read is mapped on the
+       positive strand
+    :param len_seq: list of read lengths
+    :param pos: list of mapping positions (for the negative strand, the
+       position of the first nucleotide of the read)
+    :param frags: dictionary of RE sites from
+       :func:`pytadbit.mapping.restriction_enzymes.map_re_sites_array`
+    :param frag_chunk: as in
+       :func:`pytadbit.mapping.restriction_enzymes.map_re_sites`
+
+    :returns: list of formatted reads (reads on chromosomes not found in
+       frags are skipped)
+    """
+    positive = np.array(positive, dtype=bool)
+    len_seq  = np.array(len_seq, dtype=np.int64)
+    pos      = np.array(pos, dtype=np.int64)
+    # position of reads on the negative strand is the end of the read
+    pos      = np.where(positive, pos, pos + len_seq - 1)
+    prev_re  = np.zeros(len(pos), dtype=np.int64)
+    next_re  = np.zeros(len(pos), dtype=np.int64)
+    kept     = np.zeros(len(pos), dtype=bool)
+    crm_names, crm_idx = np.unique(crms, return_inverse=True)
+    for i, crm in enumerate(crm_names):
+        try:
+            sites = frags[crm]
+        except KeyError:
+            # Chromosome not in hash
+            continue
+        sel = np.where(crm_idx == i)[0]
+        (pos[sel], prev_re[sel],
+         next_re[sel], kept[sel]) = closest_re_sites(sites, pos[sel],
+                                                     len_seq[sel], frag_chunk)
+    return ['%s\t%s\t%d\t%d\t%d\t%d\t%d\n' % vals for vals, keep in
+            zip(zip(names, crms, pos.tolist(), positive.tolist(),
+                    len_seq.tolist(), prev_re.tolist(), next_re.tolist()),
+                kept.tolist()) if keep]
 
 def read_read(r, frags, frag_chunk):
     name, seq, _, _, ali = r.split('\t')[:5]
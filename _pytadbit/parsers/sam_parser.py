@@ -2,10 +2,19 @@
 17 nov. 2014
 """
 
-from bisect import bisect_right as bisect
 from pysam import Samfile
-from pytadbit.mapping.restriction_enzymes import map_re_sites
+from pytadbit.mapping.restriction_enzymes import map_re_sites_array
+from pytadbit.parsers.genome_parser       import parse_fasta
+from pytadbit.parsers.map_parser import format_reads
 from warnings import warn
+from pytadbit.utils.extsort import write_sorted_chunks
+from pytadbit.utils.extsort import reduce_sorted_files, iter_merged
+import multiprocessing as mu
+import os
+
+# RE sites, set before creating the pool of processes parsing the reads (that
+# inherit it)
+_FRAGS = {}
 
 def parse_sam(f_names1, f_names2=None, out_file1=None, out_file2=None,
               genome_seq=None, re_name=None, verbose=False, mapper=None,
@@ -27,10 +36,23 @@ def parse_sam(f_names1, f_names2=None, out_file1=None, out_file2=None,
     :param out_file1: path to outfile tab separated format containing mapped
        read2 information
     :param genome_seq: a dictionary generated by :func:`pyatdbit.parser.genome_parser.parse_fasta`.
-       containing the genomic sequence
+       containing the genomic sequence, or the path (or list of paths) to
+       the FASTA file(s) of the reference genome
     :param re_name: name of the restriction enzyme used
     :param None mapper: software used to map (supported are GEM and BOWTIE2).
        Guessed from file by default.
+    :param 1 nthreads: number of input files parsed (or of intermediate files
+       merged) at the same time
+    :param None tmp_dir: directory where to write temporary files (by default
+       the directory of the output files)
+    :param 1000000 chunk_size: maximum number of reads per temporary file
+    :param None max_memory: maximum size (in Mb, approximate) of the reads kept
+       in memory by each process before being written to a temporary file
+    :param 64 fan_in: maximum number of temporary files merged at a time
+    :param None cache_dir: directory of the cache where the parsed genome and
+       the RE sites found in it are stored, to be reused in other runs with
+       the same genome and enzyme (e.g. ~/.tadbit/cache, see
+       :mod:`pytadbit.utils.genome_cache`). By default the cache is not used
     """
     # not nice, dirty fix in order to allow this function to only parse
     # one SAM file
@@ -44,10 +66,20 @@ def parse_sam(f_names1, f_names2=None, out_file1=None, out_file2=None,
         raise Exception('ERROR: out_file2 AND f_names2 needed\n')
 
     frag_chunk = kwargs.get('frag_chunk', 100000)
+    nthreads   = kwargs.get('nthreads', 1)
+    tmp_dir    = kwargs.get('tmp_dir', None)
+    fan_in     = kwargs.get('fan_in', 64)
+    chunk_size = kwargs.get('chunk_size', 1000000)
+    max_memory = kwargs.get('max_memory', None)
     if verbose:
         print 'Searching and mapping RE sites to the reference genome'
-    frags = map_re_sites(re_name, genome_seq, frag_chunk=frag_chunk,
-                         verbose=verbose)
+    if isinstance(genome_seq, (str, list)):
+        genome_seq = parse_fasta(genome_seq, verbose=verbose,
+                                 cache_dir=kwargs.get('cache_dir', None))
+    global _FRAGS
+    _FRAGS = map_re_sites_array(re_name, genome_seq,
+                                cache_dir=kwargs.get('cache_dir', None),
+                                verbose=verbose)
 
     if isinstance(f_names1, str):
         f_names1 = [f_names1]
@@ -60,93 +92,142 @@ def parse_sam(f_names1, f_names2=None, out_file1=None, out_file2=None,
         fnames = (f_names1,)
         outfiles = (out_file1, )
 
-    for read in range(len(fnames)):
-        if verbose:
-            print 'Loading read' + str(read + 1)
-        windows = {}
-        reads    = []
-        num = 0
-        for fnam in fnames[read]:
-            try:
-                fhandler = Samfile(fnam)
-            except IOError:
-                print 'WARNING: file "%s" not found' % fnam
-                continue
-            except ValueError:
-                raise Exception('ERROR: not a SAM/BAM file\n%s' % fnam)
-            # get the iteration number of the iterative mapping
-            try:
-                num = int(fnam.split('.')[-1].split(':')[0])
-            except:
-                num += 1
-            windows.setdefault(num, 0)
-            # guess mapper used
-            if not mapper:
-                mapper = fhandler.header['PG'][0]['ID']
-            if mapper.lower()=='gem':
-                condition = lambda x: x[1][1] != 1
-            elif mapper.lower() in ['bowtie', 'bowtie2']:
-                condition = lambda x: 'XS' in dict(x)
-            else:
-                warn('WARNING: unrecognized mapper used to generate file\n')
-                condition = lambda x: x[1][1] != 1
-            if verbose:
-                print 'loading %s file: %s' % (mapper, fnam)
-            # iteration over reads
-            i = 0
-            crm_dict = {}
-            while True:
-                try:
-                    crm_dict[i] = fhandler.getrname(i)
-                    i += 1
-                except ValueError:
-                    break
-            for r in fhandler:
-                if r.is_unmapped:
+    # parse all input files, in parallel
+    pool = mu.Pool(nthreads) if nthreads > 1 else None
+    try:
+        jobs = {}
+        for read in range(len(fnames)):
+            for ifnam, fnam in enumerate(fnames[read]):
+                if not os.path.exists(fnam):
+                    print 'WARNING: file "%s" not found' % fnam
                     continue
-                if condition(r.tags):
-                    continue
-                positive = not r.is_reverse
-                crm      = crm_dict[r.tid]
-                len_seq  = len(r.seq)
-                if positive:
-                    pos = r.pos + 1
+                args = (fnam, outfiles[read], frag_chunk, mapper, verbose,
+                        tmp_dir, chunk_size, max_memory)
+                if pool:
+                    jobs[read, ifnam] = pool.apply_async(_parse_sam_file,
+                                                         args=args)
                 else:
-                    pos = r.pos + len_seq + 1
-                try:
-                    frag_piece = frags[crm][pos / frag_chunk]
-                except KeyError:
-                    # Chromosome not in hash
+                    jobs[read, ifnam] = args
+        if pool:
+            pool.close()
+
+        for read in range(len(fnames)):
+            if verbose:
+                print 'Loading read' + str(read + 1)
+            windows = {}
+            tmp_files = []
+            num = 0
+            for ifnam, fnam in enumerate(fnames[read]):
+                if not (read, ifnam) in jobs:
                     continue
-                idx = bisect(frag_piece, pos)
+                # get the iteration number of the iterative mapping
                 try:
-                    next_re = frag_piece[idx]
-                except IndexError:
-                    # case where part of the read is mapped outside chromosome
-                    count = 0
-                    while idx >= len(frag_piece) and count < len_seq:
-                        pos -= 1
-                        count += 1
-                        frag_piece = frags[crm][pos / frag_chunk]
-                        idx = bisect(frag_piece, pos)
-                    if count >= len_seq:
-                        raise Exception('Read mapped mostly outside ' +
-                                        'chromosome\n')
-                    next_re    = frag_piece[idx]
-                prev_re    = frag_piece[idx - 1 if idx else 0]
-                name       = r.qname
-                reads.append('%s\t%s\t%d\t%d\t%d\t%d\t%d\n' % (
-                    name, crm, pos, positive, len_seq, prev_re, next_re))
-                windows[num] += 1
-        reads_fh = open(outfiles[read], 'w')
-        ## write file header
-        # chromosome sizes (in order)
-        reads_fh.write('## Chromosome lengths (order matters):\n')
-        for crm in genome_seq:
-            reads_fh.write('# CRM %s\t%d\n' % (crm, len(genome_seq[crm])))
-        reads_fh.write('## Number of mapped reads by iteration\n')
-        for size in windows:
-            reads_fh.write('# MAPPED %d %d\n' % (size, windows[size]))
-        reads_fh.write(''.join(sorted(reads)))
-        reads_fh.close()
-    del reads
+                    num = int(fnam.split('.')[-1].split(':')[0])
+                except:
+                    num += 1
+                windows.setdefault(num, 0)
+                if pool:
+                    fnam_tmp_files, read_count = jobs[read, ifnam].get()
+                else:
+                    fnam_tmp_files, read_count = _parse_sam_file(
+                        *jobs[read, ifnam])
+                tmp_files.extend(fnam_tmp_files)
+                windows[num] += read_count
+            tmp_files = reduce_sorted_files(tmp_files, outfiles[read],
+                                            fan_in=fan_in, nthreads=nthreads,
+                                            tmp_dir=tmp_dir)
+            reads_fh = open(outfiles[read], 'w')
+            ## write file header
+            # chromosome sizes (in order)
+            reads_fh.write('## Chromosome lengths (order matters):\n')
+            for crm in genome_seq:
+                reads_fh.write('# CRM %s\t%d\n' % (crm, len(genome_seq[crm])))
+            reads_fh.write('## Number of mapped reads by iteration\n')
+            for size in windows:
+                reads_fh.write('# MAPPED %d %d\n' % (size, windows[size]))
+            reads_fh.writelines(iter_merged(tmp_files))
+            reads_fh.close()
+            for tmp_name in tmp_files:
+                os.remove(tmp_name)
+    finally:
+        # all files are parsed, or a job failed and the others are not
+        # waited for
+        if pool:
+            pool.terminate()
+            pool.join()
+        # release the RE sites
+        _FRAGS = {}
+
+def _parse_sam_file(fnam, outfile, frag_chunk, mapper, verbose, tmp_dir,
+                    chunk_size, max_memory):
+    """
+    parse one SAM/BAM file into temporary files sorted by read ID
+
+    :returns: list of temporary files and number of reads parsed
+    """
+    try:
+        fhandler = Samfile(fnam)
+    except ValueError:
+        raise Exception('ERROR: not a SAM/BAM file\n%s' % fnam)
+    # guess mapper used
+    if not mapper:
+        mapper = fhandler.header['PG'][0]['ID']
+    if mapper.lower()=='gem':
+        condition = lambda x: x[1][1] != 1
+    elif mapper.lower() in ['bowtie', 'bowtie2']:
+        condition = lambda x: 'XS' in dict(x)
+    else:
+        warn('WARNING: unrecognized mapper used to generate file\n')
+        condition = lambda x: x[1][1] != 1
+    if verbose:
+        print 'loading %s file: %s' % (mapper, fnam)
+    tmp_files, read_count = write_sorted_chunks(
+        _iter_reads(fhandler, condition, _FRAGS, frag_chunk), outfile,
+        tmp_dir=tmp_dir, chunk_size=chunk_size, max_memory=max_memory)
+    fhandler.close()
+    return tmp_files, read_count
+
+def _iter_reads(fhandler, condition, frags, frag_chunk, batch=100000):
+    """
+    parse SAM/BAM reads by batches, the closest RE sites of all the reads of a
+    batch are searched at once
+    """
+    # iteration over reads
+    i = 0
+    crm_dict = {}
+    while True:
+        try:
+            crm_dict[i] = fhandler.getrname(i)
+            i += 1
+        except ValueError:
+            break
+    names = []
+    crms  = []
+    posis = []
+    lens  = []
+    poss  = []
+    for r in fhandler:
+        if r.is_unmapped:
+            continue
+        if condition(r.tags):
+            continue
+        positive = not r.is_reverse
+        len_seq  = len(r.seq)
+        names.append(r.qname)
+        crms.append(crm_dict[r.tid])
+        posis.append(positive)
+        lens.append(len_seq)
+        # for reads in the negative strand, format_reads adds len_seq - 1
+        poss.append(r.pos + 1 if positive else r.pos + 2)
+        if len(names) == batch:
+            for line in format_reads(names, crms, posis, lens, poss, frags,
+                                     frag_chunk):
+                yield line
+            names = []
+            crms  = []
+            posis = []
+            lens  = []
+            poss  = []
+    for line in format_reads(names, crms, posis, lens, poss, frags,
+                             frag_chunk):
+        yield line
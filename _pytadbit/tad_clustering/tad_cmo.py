@@ -22,9 +22,13 @@ from copy         import deepcopy
 
 # for aleigen:
 from numpy import median
+from tempfile   import mkdtemp
+from shutil     import rmtree
+import os
 
 import re
 from subprocess import Popen, PIPE
+import numpy as np
 
 
 def _sort_match(matches):
@@ -35,6 +39,8 @@ def core_nw_long(p_scores, penalty, l_p1, l_p2):
     """
     Core of the long Needleman-Wunsch algorithm that aligns matrices
     """
+    if isinstance(p_scores, np.ndarray):
+        p_scores = p_scores.tolist()
     scores = virgin_score(penalty, l_p1 + 1, l_p2 + 1)
     ins = rmv = 0
     lpen = 4
@@ -137,40 +143,54 @@ def core_nw_long(p_scores, penalty, l_p1, l_p2):
 
 def core_nw(p_scores, penalty, l_p1, l_p2):
     """
-    Core of the fast Needleman-Wunsch algorithm that aligns matrices
+    Core of the fast Needleman-Wunsch algorithm that aligns matrices.
+
+    The score matrix is filled by anti-diagonals, all cells of an
+    anti-diagonal at once: cell (i, j) is stored at [i + j, i].
     """
-    scores = virgin_score(penalty, l_p1 + 1, l_p2 + 1)
-    for i in xrange(1, l_p1 + 1):
-        for j in xrange(1, l_p2 + 1):
-            match  = p_scores[i - 1][j - 1] + scores[i - 1][j - 1]
-            insert = scores[i - 1][j] + penalty
-            delete = scores[i][j - 1] + penalty
-            scores[i][j] = max((match, insert, delete))
+    p_scores = np.asarray(p_scores, dtype=float)
+    scores = np.zeros((l_p1 + l_p2 + 1, l_p1 + 1))
+    rows = np.arange(l_p1 + 1)
+    scores[rows, rows] = penalty * rows
+    cols = np.arange(l_p2 + 1)
+    scores[cols, 0] = penalty * cols
+    for diag in xrange(2, l_p1 + l_p2 + 1):
+        beg = max(1, diag - l_p2)
+        end = min(l_p1, diag - 1) + 1
+        rows = np.arange(beg, end)
+        match  = (p_scores[rows - 1, diag - rows - 1] +
+                  scores[diag - 2, beg - 1:end - 1])
+        insert = scores[diag - 1, beg - 1:end - 1] + penalty
+        delete = scores[diag - 1, beg:end] + penalty
+        scores[diag, beg:end] = np.maximum(match, np.maximum(insert, delete))
+    # cells are only read along the path
+    score = scores.item
+    p_score = p_scores.item
     align1 = []
     align2 = []
-    i = l_p1 
-    j = l_p2 
+    i = l_p1
+    j = l_p2
     while i and j:
-        score = scores[i][j]
-        value = scores[i - 1][j - 1] + p_scores[i - 1][j - 1]
-        if _equal(score, value):
+        current = score(i + j, i)
+        value = score(i + j - 2, i - 1) + p_score(i - 1, j - 1)
+        if _equal(current, value):
             i -= 1
             j -= 1
-            align1.insert(0, i)
-            align2.insert(0, j)
-        elif _equal(score, scores[i - 1][j] + penalty):
+            align1.append(i)
+            align2.append(j)
+        elif _equal(current, score(i + j - 1, i - 1) + penalty):
             i -= 1
-            align1.insert(0, i)
-            align2.insert(0, '-')
-        elif _equal(score, scores[i][j - 1] + penalty):
+            align1.append(i)
+            align2.append('-')
+        elif _equal(current, score(i + j - 1, i) + penalty):
             j -= 1
-            align1.insert(0, '-')
-            align2.insert(0, j)
+            align1.append('-')
+            align2.append(j)
         else:
-            for scr in scores:
-                print ' '.join(['%7s' % (round(y, 4)) for y in scr])
             raise Exception('Something  is failing and it is my fault...')
-    return align1, align2, scores[i][j]
+    align1.reverse()
+    align2.reverse()
+    return align1, align2, score(i + j, i)
 
 
 def _equal(a, b, cut_off=1e-9):
@@ -181,7 +201,7 @@ def _equal(a, b, cut_off=1e-9):
 
 
 def optimal_cmo(hic1, hic2, num_v=None, max_num_v=None, verbose=False,
-                method='frobenius', long_nw=True, long_dist=True):
+                method='frobenius', long_nw=True, long_dist=True, beam=None):
     """
     Calculates the optimal contact map overlap between 2 matrices
 
@@ -201,6 +221,10 @@ def optimal_cmo(hic1, hic2, num_v=None, max_num_v=None, verbose=False,
        distance will be the result of the last value of the Needleman-Wunsch
        algorithm. If 'frobenius' a modification of the Frobenius distance will
        be used
+    :param None beam: by default all the combinations of signs of the
+       eigenvectors are tried (2**num_v alignments). If given, only the
+       combinations extending one of the best beam combinations found with
+       one eigenvector less are tried (2 * beam * num_v alignments at most).
 
     :returns: two lists, one per aligned matrix, plus a dict summarizing the
         goodness of the alignment with the distance between matrices, their 
@@ -238,8 +262,17 @@ def optimal_cmo(hic1, hic2, num_v=None, max_num_v=None, verbose=False,
     nw = core_nw_long if long_nw else core_nw
     dister = _get_dist_long if long_dist else _get_dist
     best_alis = []
+    # the distance only depends on the alignment
+    dists = {}
+    prefixes = [()]
     for num in xrange(1, num_v + 1):
-        for factors in product([1, -1], repeat=num):
+        if beam:
+            signs = [prefix + (sign, ) for prefix in prefixes
+                                  for sign in (1, -1)]
+        else:
+            signs = product([1, -1], repeat=num)
+        found = []
+        for factors in signs:
             vec1p = factors * vec1[:, :num]
             vec2p = vec2[:, :num]
             p_scores = _prescoring(vec1p, vec2p, l_p1, l_p2)
@@ -247,9 +280,13 @@ def optimal_cmo(hic1, hic2, num_v=None, max_num_v=None, verbose=False,
             align1, align2, dist = nw(p_scores, penalty, l_p1, l_p2)
             try:
                 if method == 'frobenius':
-                    dist = dister(align1, align2, hic1, hic2)
+                    key = tuple(align1), tuple(align2)
+                    if not key in dists:
+                        dists[key] = dister(align1, align2, hic1, hic2)
+                    dist = dists[key]
                 else:
                     dist *= -1
+                found.append((dist, factors))
                 if dist < nearest:
                     if not penalty:
                         for scr in p_scores:
@@ -259,6 +296,9 @@ def optimal_cmo(hic1, hic2, num_v=None, max_num_v=None, verbose=False,
                     best_pen = penalty
             except IndexError as e:
                 print e
+        if beam:
+            prefixes = [factors for _, factors in
+                        sorted(found, key=lambda x: x[0])[:beam]]
     try:
         align1, align2 = best_alis
     except ValueError:
@@ -288,14 +328,11 @@ def virgin_score(penalty, l_p1, l_p2):
 
 def _prescoring(vc1, vc2, l_p1, l_p2):
     """
-    yes... this is the bottle neck, almost 2/3 of the time spent here
+    Scalar products between all pairs of rows of the two matrices of
+    eigenvectors (summed in the same order as row by row, so that the
+    alignments do not depend on rounding).
     """
-    p_score = []
-    for i in xrange(l_p1):
-        vci = vc1[i].__mul__
-        p_score.append([vci(vc2[j]).sum() for j in xrange(l_p2)])
-    return p_score
-    #return [[sum(vc1[i] * vc2[j]) for j in xrange(l_p2)] for i in xrange(l_p1)]
+    return (vc1[:l_p1, None, :] * vc2[None, :l_p2, :]).sum(axis=2)
 
 
 def _get_dist(align1, align2, tad1, tad2):
@@ -399,8 +436,10 @@ def matrix2binnary_contacts(tad1, tad2):
     return contacts1, contacts2
 
 
-def _run_aleigen(contacts1, contacts2, num_v):
+def _run_aleigen(contacts1, contacts2, num_v, external=False):
     """
+    Aligns two binary contact maps (as aleigen does), and computes the
+    contact map overlap score:
 
         - c1, c2 = number of contacts of the first and second contact map
                    (after removing non-matching columns/rows)
@@ -408,16 +447,68 @@ def _run_aleigen(contacts1, contacts2, num_v):
           of the computed overlap
         - score = 2*CMO/(C1+C2)
 
+    :param contacts1: list of contacts (pairs of indexes) of the first map
+    :param contacts2: list of contacts (pairs of indexes) of the second map
+    :param num_v: maximum number of eigenvectors to use
+    :param False external: use the aleigen binary instead of
+       :func:`optimal_cmo` (needs aleigen in the PATH)
+
+    :returns: the two lists of aligned indexes, and a list with the score
+    """
+    if external:
+        return _run_aleigen_binary(contacts1, contacts2, num_v)
+    cmap1 = _contact_map(contacts1)
+    cmap2 = _contact_map(contacts2)
+    # nothing to align
+    if not len(cmap1) or not len(cmap2):
+        return [], [], [0.]
+    num_v = min(num_v, len(cmap1), len(cmap2))
+    ali1, ali2, _ = optimal_cmo(cmap1, cmap2, max_num_v=num_v, method='score',
+                                long_nw=False, long_dist=False)
+    align1 = []
+    align2 = []
+    for el1, el2 in zip(ali1, ali2):
+        if el1 != '-' and el2 != '-':
+            align1.append(el1)
+            align2.append(el2)
+    sub1 = np.triu(cmap1[np.ix_(align1, align1)], 1)
+    sub2 = np.triu(cmap2[np.ix_(align2, align2)], 1)
+    cnt1 = sub1.sum()
+    cnt2 = sub2.sum()
+    cmo = (sub1 * sub2).sum()
+    score = 2. * cmo / (cnt1 + cnt2) if cnt1 + cnt2 else 0.
+    return align1, align2, [score]
+
+
+def _contact_map(contacts):
+    """
+    Symmetric binary matrix from a list of contacts
+    """
+    contacts = np.array(contacts, dtype=int).reshape(-1, 2)
+    size = contacts.max() + 1 if len(contacts) else 0
+    cmap = np.zeros((size, size))
+    cmap[contacts[:, 0], contacts[:, 1]] = 1
+    cmap[contacts[:, 1], contacts[:, 0]] = 1
+    return cmap
+
+
+def _run_aleigen_binary(contacts1, contacts2, num_v):
+    """
+    Runs the aleigen binary on two lists of contacts (see
+    :func:`_run_aleigen`), writing them in a temporary directory.
     """
-    f_string = '/tmp/lala%s.txt'
+    tmp_dir = mkdtemp(prefix='aleigen_')
+    f_string = os.path.join(tmp_dir, 'contacts%s.txt')
     f_name1 = f_string % (1)
     f_name2 = f_string % (2)
-    write_contacts(contacts1, contacts2, f_string)
     sc_str = re.compile('Score\s+C1\s+C2\s+CMO\n([0-9.]+)\s+[0-9]+\s+.*')
-    out = Popen('aleigen %s %s %s' % (f_name1, f_name2, num_v),
-                shell=True, stdout=PIPE).communicate()[0]
+    try:
+        write_contacts(contacts1, contacts2, f_string)
+        out = Popen(['aleigen', f_name1, f_name2, str(num_v)],
+                    stdout=PIPE).communicate()[0]
+    finally:
+        rmtree(tmp_dir)
     score = [float(c) for c in re.findall(sc_str, out)]
-    print out
     align1 = []
     align2 = []
     for line in out.split('\n')[2:]:
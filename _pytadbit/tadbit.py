@@ -4,15 +4,16 @@
 
 from os                           import path, listdir
 from pytadbit.parsers.hic_parser  import read_matrix
-from pytadbit.tadbit_py           import _tadbit_wrapper
+from pytadbit.tadbit_py           import _tadbit_wrapper, _tadbit_band_wrapper
 from math                         import isnan, sqrt
-from scipy.sparse.csr             import csr_matrix
-from scipy.stats                  import mannwhitneyu
+from scipy.sparse                 import triu
+from scipy.stats                  import norm
 import numpy as np
 
 
 def tadbit(x, remove=None, n_cpus=1, verbose=True,
-           max_tad_size="max", no_heuristic=0, use_topdom=False, topdom_window=5, **kwargs):
+           max_tad_size="max", no_heuristic=0, use_topdom=False, topdom_window=5,
+           banded=False, **kwargs):
     """
     The TADbit algorithm works on raw chromosome interaction count data.
     The normalization is neither necessary nor recommended,
@@ -47,6 +48,16 @@ def tadbit(x, remove=None, n_cpus=1, verbose=True,
     :param False get_weights: either to return the weights corresponding to the
        Hi-C count (weights are a normalization dependent of the count of each
        columns)
+    :param False banded: only the diagonal band of the matrices, of width
+       max_tad_size, is passed to TADbit (see
+       :func:`pytadbit.hic_data.HiC_data.get_as_band`), and the memory used is
+       proportional to size * max_tad_size instead of size * size. Interactions
+       between bins further than max_tad_size are not used, and TADs are at
+       most max_tad_size bins long. With max_tad_size='max' the result is the
+       same as in the default mode
+    :param None focus: in banded mode, a chromosome name, or a tuple with the
+       (start, end) position of the region (start, starting at 1, and both
+       start and end are inclusive) of the matrices to segment
 
     :returns: the :py:func:`list` of topologically associated domains'
        boundaries, and the corresponding list associated log likelihoods.
@@ -54,7 +65,30 @@ def tadbit(x, remove=None, n_cpus=1, verbose=True,
     """
     nums = [hic_data for hic_data in read_matrix(x, one=False)]
     
-    if not use_topdom:
+    if not use_topdom and banded:
+        beg, end = nums[0]._focus_coords(kwargs.get('focus'))[:2]
+        size = end - beg
+        max_tad_size = size if max_tad_size in ["max", "auto"] else max_tad_size
+        band = min(max_tad_size, size - 1)
+        nums = [num.get_as_band(band, focus=kwargs.get('focus')) for num in nums]
+        if not remove:
+            # if not given just remove columns with zero in diagonal
+            remove = (nums[0][::band + 1] == 0).astype(int).tolist()
+        n_cpus = n_cpus if n_cpus != 'max' else 0
+        _, nbks, passages, _, _, bkpts = \
+           _tadbit_band_wrapper(nums,             # list of bands of Hi-C data
+                                tuple(remove),    # columns marking filtered
+                                size,             # size of one row/column
+                                len(nums),        # number of matrices
+                                band,             # width of the band
+                                n_cpus,           # number of threads
+                                int(verbose),     # verbose 0/1
+                                max_tad_size,     # max_tad_size
+                                kwargs.get('ntads', -1) + 1,
+                                int(no_heuristic),# heuristic 0/1
+                                )
+        breaks = [i for i in xrange(size) if bkpts[i] == 1]
+    elif not use_topdom:
         size = len(nums[0])
         nums = [num.get_as_tuple() for num in nums]
         if not remove:
@@ -75,6 +109,8 @@ def tadbit(x, remove=None, n_cpus=1, verbose=True,
                            )
     
         breaks = [i for i in xrange(size) if bkpts[i + nbks * size] == 1]
+
+    if not use_topdom:
         scores = [p for p in passages if p > 0]
     
         result = {'start': [], 'end'  : [], 'score': []}
@@ -85,7 +121,7 @@ def tadbit(x, remove=None, n_cpus=1, verbose=True,
     else:
         result = {'start': [], 'end'  : [], 'score': [], 'tag': []}
     
-        ret = TopDom(nums[0],window_size=5)
+        ret = TopDom(nums[0],window_size=topdom_window)
         
         
         for key in sorted(ret):
@@ -179,122 +215,174 @@ def print_result_r(result, write=True):
 
 def TopDom(hic_data,window_size,statFilter=True):
     """
-    Python implementation of the algorithm TopDom for the identification of TADs. See http://www.ncbi.nlm.nih.gov/pubmed/26704975 and http://zhoulab.usc.edu/TopDom/ 
-
-    :param hic_data: a list corresponding to the Hi-C data 
+    Python implementation of the algorithm TopDom for the identification of TADs. See http://www.ncbi.nlm.nih.gov/pubmed/26704975 and http://zhoulab.usc.edu/TopDom/
+
+    Only the band of the matrix around the diagonal (2 x window_size
+    diagonals) is used to compute the statistics of each bin, with cumulative
+    sums and batched rank tests, so that time and memory grow linearly with
+    the number of bins.
+
+    :param hic_data: a HiC_data object, or the band of a symmetric Hi-C
+       matrix, as a numpy array of shape (size, band + 1) where the count of
+       cell (i, j) is at position (i, j - i) (e.g.:
+       ``hic_data.get_as_band(band).reshape(-1, band + 1)``), with band of at
+       least 2 x window_size - 1. Cells outside the band are considered empty
+       when looking for gaps
     :param window_size: window size parameter for the TopDom algorithm
-    :param True statFilter: whether to apply or not statistical filtering for false detection of TADs 
+    :param True statFilter: whether to apply or not statistical filtering for false detection of TADs
 
-    :returns: the :py:func:`list` of topologically associated domains, boundaries and gaps. Domains include the mean value 
+    :returns: the :py:func:`list` of topologically associated domains, boundaries and gaps. Domains include the mean value
         of computed p-values by Wilcox Ranksum Test as score while boundaries and gaps have a score of zero.
     """
-    n_bins = len(hic_data)
-    mean_cf = np.zeros(n_bins)
+    band, lower, last_nz = _topdom_band(hic_data, window_size)
+    n_bins = band.shape[0]
     pvalue = np.ones(n_bins)
-      
+
     local_ext = np.ones(n_bins)*(-0.5)
-    
+
     #Step 1
-    csr_mat = hic_data.get_hic_data_as_csr()
-    for i in xrange(n_bins):
-        diamond_mean = Get_Diamond_Matrix_Mean(data=csr_mat, i=i, size=window_size)
-        mean_cf[i] = diamond_mean
-        
+    mean_cf = Get_Diamond_Matrix_Mean(band=band, size=window_size)
+
     #Step 2
-    gap_idx = Which_Gap_Region(data=csr_mat)
+    gap_idx = Which_Gap_Region(last_nz=last_nz)
     proc_regions = Which_process_region(rmv_idx=gap_idx, n_bins=n_bins, min_size=3)
-    
+
     for key in proc_regions:
-        
+
         start = proc_regions[key]["start"]
         end = proc_regions[key]["end"]
-    
+
         #print "Process Regions from " + str(start) + " to " + str(end)
-      
+
         local_ext[start:end+1] = Detect_Local_Extreme(x=mean_cf[start:end+1])
-    
+
     if statFilter:
         #Step 3
-        lil_mat = csr_mat.todense()
-        for k in range(1,(2*window_size)):
-        
-          mat_row = []
-          mat_column = []
-          my_range = range((n_bins*k), (n_bins*n_bins), 1+n_bins)
-          mat_values = np.empty(len(my_range))
-          col_arr = 0 
-          for j in my_range:
-              mat_row.append(int(round(j/lil_mat.shape[0])))
-              mat_column.append(j%lil_mat.shape[0])
-              mat_values[col_arr] = lil_mat[int(round(j/lil_mat.shape[0])),j%lil_mat.shape[0]]
-              col_arr = col_arr + 1
-          
-          scale_values = scale(mat_values)
-          
-          for i in xrange(len(mat_row)):
-              lil_mat[mat_column[i],mat_row[i]] = scale_values[i]
-              
-        
+        # diagonals of the upper triangle replaced by the scaled values of
+        # the diagonals of the lower triangle
+        scaled = np.zeros_like(band)
+        for k in xrange(1, min(2 * window_size, n_bins)):
+            scaled[:n_bins - k, k] = scale(lower[:n_bins - k, k])
+
         for key in proc_regions:
             start = proc_regions[key]['start']
             end = proc_regions[key]['end']
-            
-            pvalue[start:end] = Get_Pvalue(data=lil_mat[start:end+1, start:end+1], size=window_size, scale=1)
-    
+
+            pvalue[start:end] = Get_Pvalue(scaled=scaled, start=start, end=end, size=window_size)
+
         for i in xrange(len(local_ext)):
             if local_ext[i] == -1 and pvalue[i] < 0.05:
                 local_ext[i] = -2
         local_ext[local_ext==-1] = 0
-        local_ext[local_ext==-2] = -1  
-        
+        local_ext[local_ext==-2] = -1
+
         pvalue_cut=0.05
     else:
         pvalue = None
         pvalue_cut=None
-        
+
     domains = Convert_Bin_To_Domain_TMP(n_bins=n_bins,
-                                  signal_idx=np.where(local_ext==-1)[0], 
-                                  gap_idx=np.where(local_ext==-0.5)[0], 
-                                  pvalues=pvalue, 
+                                  signal_idx=np.where(local_ext==-1)[0],
+                                  gap_idx=np.where(local_ext==-0.5)[0],
+                                  pvalues=pvalue,
                                   pvalue_cut=pvalue_cut)
-    
-        
+
+
     return domains
-    
-def Get_Diamond_Matrix_Mean(data, i, size):
 
-  n_bins = data.shape[1]
-  if i==n_bins-1:
-       return
-  
-  lowerbound = max( 0, i-size+1 )
-  upperbound = min( i+size+1, n_bins)
-      
-  return (data[lowerbound:(i+1),(i+1):upperbound].mean())
-  
-def Which_Gap_Region(data):
-  
-  n_bins = data.shape[1]
+def _topdom_band(hic_data, size):
+    """
+    :returns: the 2 x size first diagonals of the upper and lower triangles
+       of the matrix, as arrays where cell (i, k) corresponds to the cells
+       (i, i + k) and (i + k, i) respectively, and, for each bin, the
+       closest bin, before or at it, with which it interacts (-1 if none)
+    """
+    width = 2 * size
+    if isinstance(hic_data, np.ndarray):
+        if hic_data.ndim != 2 or hic_data.shape[1] < width:
+            raise Exception('ERROR: the band should be a 2D array with at ' +
+                            'least %d diagonals' % width)
+        n_bins = hic_data.shape[0]
+        band = hic_data[:, :width].astype(float)
+        lower = band
+        # smallest diagonal with a non-zero count, for each column
+        last_nz = np.empty(n_bins, dtype=int)
+        last_nz.fill(-1)
+        for k in xrange(min(hic_data.shape[1], n_bins) - 1, -1, -1):
+            rows = np.flatnonzero(hic_data[:n_bins - k, k])
+            last_nz[rows + k] = rows
+        return band, lower, last_nz
+    csr_mat = hic_data.get_hic_data_as_csr()
+    n_bins = csr_mat.shape[0]
+    band = np.zeros((n_bins, width))
+    lower = np.zeros((n_bins, width))
+    for k in xrange(min(width, n_bins)):
+        band[:n_bins - k, k] = csr_mat.diagonal(k)
+        lower[:n_bins - k, k] = csr_mat.diagonal(-k)
+    upper = triu(csr_mat + csr_mat.T).tocsc()
+    upper.eliminate_zeros()
+    upper.sort_indices()
+    last_nz = np.empty(n_bins, dtype=int)
+    last_nz.fill(-1)
+    ends = upper.indptr[1:]
+    has = ends > upper.indptr[:-1]
+    last_nz[has] = upper.indices[ends[has] - 1]
+    return band, lower, last_nz
+
+def Get_Diamond_Matrix_Mean(band, size):
+    """
+    Mean of the counts in the diamond (the square of size x size cells
+    between the upstream and downstream bins) of each bin, computed from the
+    cumulative sums of the rows of the band.
 
-  gap = np.zeros(n_bins)
-  
-  i=0
-  while i < n_bins:
-  
-    j = i + 1
-    while j < n_bins:
-      if data[i:j+1, i:j+1].sum() == 0:
-        gap[i:j+1] = -0.5
-        j = j+1
-      else:
-        break
-    
-    i = j  
-  
-  idx = np.where(gap==-0.5)[0]
-  
-  #return dict(zip(idx,idx))
-  return idx
+    :returns: an array with the mean of each bin (NaN for the last bin)
+    """
+    n_bins = band.shape[0]
+    csum = np.zeros_like(band)
+    csum[:, 1:] = np.cumsum(band[:, 1:], axis=1)
+    bins = np.arange(n_bins)
+    right = np.minimum(size, n_bins - 1 - bins)
+    total = np.zeros(n_bins)
+    for k in xrange(size):
+        rows = bins[k:] - k
+        total[k:] += (csum[rows, k + right[k:]] - csum[rows, k])
+    count = (np.minimum(bins, size - 1) + 1) * right
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean = total / count
+    mean[count == 0] = np.nan
+    return mean
+
+def Which_Gap_Region(last_nz):
+    """
+    :param last_nz: for each bin, the closest bin, before or at it, with
+       which it interacts (-1 if none)
+
+    :returns: the bins in squares of the matrix without interactions
+    """
+    n_bins = len(last_nz)
+    last_nz = last_nz.tolist()
+
+    gap = np.zeros(n_bins)
+
+    i=0
+    while i < n_bins:
+        # the square from i to j is empty if none of its columns interacts
+        # with a bin in between i and the column
+        first = last_nz[i]
+        j = i + 1
+        while j < n_bins:
+            first = max(first, last_nz[j])
+            if first >= i:
+                break
+            j = j + 1
+        if j > i + 1:
+            gap[i:j] = -0.5
+
+        i = j
+
+    idx = np.where(gap==-0.5)[0]
+
+    return idx
 
 def Which_process_region(rmv_idx, n_bins, min_size):
 
@@ -475,58 +563,80 @@ def scale(y):
     
     return x
 
-def Get_Pvalue(data, size, scale):
-    
-    n_bins = data.shape[0]
-    pvalue = np.ones(n_bins-1)
-  
-    for i in range(1,n_bins):
-        dia = Get_Diamond_Matrix2(data, i, size=size)
-        ups = Get_Upstream_Triangle(data, i, size=size)
-        downs = Get_Downstream_Triangle(data, i, size=size)
-            
-        wil_test =  mannwhitneyu(x=dia*scale, y=ups+downs, use_continuity=True, alternative='less')
-        pvalue[i-1] = wil_test.pvalue
-        
-  
-    pvalue[ np.isnan(pvalue) ] = 1
-    
-    return(pvalue)
-    
-def Get_Diamond_Matrix2(data, i, size):
-    
-    n_bins = data.shape[0]
-    #new_mat = np.ones_like(data)*np.NaN
-    new_mat = np.ones(shape=(size,size))*np.NaN
-    
-    for k in range(1,size+1):
-        if i-(k-1) >= 1 and i < n_bins:
-            lower = min(i+1, n_bins)
-            upper = min(i+size, n_bins)
-            new_mat[size-(k-1)-1,0:(upper-lower+1)] = data[i-(k-1)-1,lower-1:upper]
-    
-    new_mat = new_mat[np.logical_not(np.isnan(new_mat))]
-    
-    return ((new_mat.transpose()).flatten()).tolist()
+def _topdom_cells(size):
+    """
+    Cells used to test each bin, as offsets from the bin: row offset and
+    diagonal (column offset minus row offset)
 
-def Get_Upstream_Triangle(data, i, size):
-    
-    lower = max(1, i-size)
-    tmp_mat = data[lower-1:i,lower-1:i]
-    
-    triag = (np.triu(tmp_mat,k=1).flatten())
-    
-    return triag[triag!=0].tolist() 
+    :returns: the cells of the diamond, and of the upstream and downstream
+       triangles
+    """
+    dia = [(-k, k + l) for k in xrange(1, size + 1) for l in xrange(size)]
+    ups = [(-1 - k, k - l) for k in xrange(size + 1) for l in xrange(k)]
+    downs = [(k, l - k) for k in xrange(size) for l in xrange(k + 1, size)]
+    return (np.array(dia, dtype=int).reshape(-1, 2),
+            np.array(ups + downs, dtype=int).reshape(-1, 2))
 
-def Get_Downstream_Triangle(data, i, size):
-    
-    n_bins = data.shape[0]
-    if i==n_bins:
-        return NaN  
-  
-    upperbound = min(i+size, n_bins)
-    tmp_mat = data[i:upperbound, i:upperbound]
-    
-    triag = (np.triu(tmp_mat,k=1).flatten())
+def Get_Pvalue(scaled, start, end, size, chunk=4096):
+    """
+    One-sided Wilcoxon rank-sum (Mann-Whitney U) test, with continuity and
+    tie corrections, between the values in the diamond of each bin and the
+    values in the upstream and downstream triangles. Tests are computed in
+    batches of bins.
+
+    :param scaled: band of the matrix with the scaled values
+    :param start: first bin of the region to process
+    :param end: last bin of the region to process
+    :param size: window size
+    :param 4096 chunk: number of bins tested at a time
+
+    :returns: the p-values of the bins from start + 1 to end
+    """
+    dia, tri = _topdom_cells(size)
+    n_bins = scaled.shape[0]
+    bins = np.arange(start + 1, end + 1)
+    pvalue = np.ones(len(bins))
+
+    def _values(beg, cells):
+        rows = bins[beg:beg + chunk, None] + cells[None, :, 0]
+        valid = (rows >= start) & (rows + cells[None, :, 1] <= end)
+        vals = scaled[np.clip(rows, 0, n_bins - 1), cells[None, :, 1]]
+        return vals, valid
+
+    for beg in xrange(0, len(bins), chunk):
+        x, valid_x = _values(beg, dia)
+        y, valid_y = _values(beg, tri)
+        valid_x &= ~np.isnan(x)
+        valid_y &= y != 0
+        n1 = valid_x.sum(axis=1)
+        n2 = valid_y.sum(axis=1)
+        # ranks of the values of each bin, invalid values and NaNs (sorted
+        # last) are groups of their own
+        values = np.concatenate((np.where(valid_x, x, np.nan),
+                                 np.where(valid_y, y, np.nan)), axis=1)
+        order = np.argsort(values, axis=1, kind='mergesort')
+        values = np.take_along_axis(values, order, axis=1)
+        new = np.ones(values.shape, dtype=bool)
+        new[:, 1:] = values[:, 1:] != values[:, :-1]
+        firsts = np.flatnonzero(new)
+        cnt = np.diff(np.append(firsts, values.size)).astype(float)
+        ranks = np.repeat(firsts % values.shape[1] + (cnt + 1) / 2,
+                          cnt.astype(int)).reshape(values.shape)
+        # rank sum of the diamond among itself and the non-NaN values of the
+        # triangles: NaNs in the triangles are ranked after all other values
+        in_x = (order < x.shape[1]) & ~np.isnan(values)
+        rank_x = (ranks * in_x).sum(axis=1)
+        u1 = n1 * n2 - (rank_x - n1 * (n1 + 1) / 2.0)
+        # tie correction
+        ties = np.bincount(firsts // values.shape[1], weights=cnt**3 - cnt,
+                           minlength=len(values))
+        tot = (n1 + n2).astype(float)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            tie_cor = np.where(tot < 2, 1.0, 1.0 - ties / (tot**3 - tot))
+            sd = np.sqrt(tie_cor * n1 * n2 * (n1 + n2 + 1) / 12.0)
+            z = (u1 - (n1 * n2 / 2.0 + 0.5)) / sd
+        pvalue[beg:beg + chunk] = norm.sf(z)
 
-    return triag[triag!=0].tolist() 
+    pvalue[ np.isnan(pvalue) ] = 1
+
+    return(pvalue)
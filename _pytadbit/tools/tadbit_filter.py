@@ -12,6 +12,7 @@ from pytadbit.utils.file_handling import mkdir
 from string                       import ascii_letters
 from random                       import random
 from os                           import path, remove
+from multiprocessing              import cpu_count
 from shutil                       import copyfile
 from pytadbit.utils.sqlite_utils  import get_jobid, add_path, get_path_id, print_db
 from pytadbit.utils.sqlite_utils  import already_run, digest_parameters
@@ -40,7 +41,10 @@ def run(opts):
 
         # compute the intersection of the two read ends
         print 'Getting intersection between read 1 and read 2'
-        count, multiples = get_intersection(fname1, fname2, reads)
+        count, multiples = get_intersection(fname1, fname2, reads,
+                                            stream=True, nthreads=opts.cpus,
+                                            tmp_dir=opts.tmp,
+                                            max_memory=opts.max_memory)
 
         # compute insert size
         print 'Get insert size...'
@@ -68,7 +72,8 @@ def run(opts):
                               max_frag_size=opts.max_frag_size,
                               min_frag_size=opts.min_frag_size,
                               re_proximity=opts.re_proximity,
-                              min_dist_to_re=min_dist, fast=True)
+                              min_dist_to_re=min_dist, fast=True,
+                              nthreads=opts.cpus)
 
     n_valid_pairs = apply_filter(reads, mreads, masked,
                                  filters=opts.apply)
@@ -163,6 +168,9 @@ def save_to_db(opts, count, multiples, reads, mreads, n_valid_pairs, masked,
                        count, ' '.join(['%s:%d' % (k, multiples[k])
                                         for k in sorted(multiples)]),
                        median, mad, max_f))
+        if masked and masked.values()[0].get('bitmask'):
+            add_path(cur, masked.values()[0]['bitmask'], 'FILTER_BITMASK',
+                     jobid, opts.workdir)
         for f in masked:
             add_path(cur, masked[f]['fnam'], 'FILTER', jobid, opts.workdir)
             try:
@@ -318,6 +326,24 @@ def populate_args(parser):
                         help='''[%(default)s] to exclude read-ends falling too
                         close from RE site (pseudo-dangling-ends)''')
 
+    glopts.add_argument("-C", "--cpu", dest="cpus", type=int,
+                        default=0, help='''[%(default)s] Maximum number of CPU
+                        cores  available in the execution host. The reads are
+                        filtered in parallel chunks (if 0 all available)
+                        cores will be used''')
+
+    glopts.add_argument('--tmp', dest='tmp', action='store', default=None,
+                        metavar='PATH', type=str,
+                        help='''directory where to write temporary files used to
+                        sort pairs of reads (by default the output
+                        directory)''')
+
+    glopts.add_argument('--max_memory', dest='max_memory', metavar="INT",
+                        action='store', default=None, type=int,
+                        help='''maximum memory (in Mb, approximate) used to sort
+                        pairs of reads before writing them to temporary
+                        files''')
+
     glopts.add_argument('--tmpdb', dest='tmpdb', action='store', default=None,
                         metavar='PATH', type=str,
                         help='''if provided uses this directory to manipulate the
@@ -336,6 +362,12 @@ def check_options(opts):
 
     if not opts.workdir: raise Exception('ERROR: output option required.')
 
+    # number of cpus
+    if opts.cpus == 0:
+        opts.cpus = cpu_count()
+    else:
+        opts.cpus = min(opts.cpus, cpu_count())
+
     # check resume
     if not path.exists(opts.workdir) and opts.resume:
         print ('WARNING: can use output files, found, not resuming...')
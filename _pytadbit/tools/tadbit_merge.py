@@ -19,6 +19,7 @@ from string                       import ascii_letters
 from random                       import random
 from shutil                       import copyfile
 from warnings                     import warn
+import multiprocessing as mu
 import sqlite3 as lite
 import time
 
@@ -55,10 +56,10 @@ def run(opts):
                         'be merged')
 
     print 'loading first sample', mreads1
-    hic_data1 = load_hic_data_from_reads(mreads1, opts.reso)
+    hic_data1 = load_hic_data_from_reads(mreads1, opts.reso, sparse=opts.sparse)
 
     print 'loading second sample', mreads2
-    hic_data2 = load_hic_data_from_reads(mreads2, opts.reso)
+    hic_data2 = load_hic_data_from_reads(mreads2, opts.reso, sparse=opts.sparse)
 
     if opts.norm and biases1:
         bad_co1 = path.join(opts.workdir1, bad_co1)
@@ -99,10 +100,14 @@ def run(opts):
 
     if not opts.skip_comparison:
         print 'correlation between equidistant loci'
-        corr, _, bads = correlate_matrices(hic_data1, hic_data2, normalized=opts.norm,
-                                           remove_bad_columns=True,
-                                           savefig=decay_corr_fig,
-                                           savedata=decay_corr_dat, get_bads=True)
+        corr, _, scc, bads = correlate_matrices(hic_data1, hic_data2, normalized=opts.norm,
+                                                remove_bad_columns=True,
+                                                savefig=decay_corr_fig,
+                                                savedata=decay_corr_dat,
+                                                intra=True,
+                                                n_cpus=opts.cpus or mu.cpu_count(),
+                                                get_scc=True, get_bads=True)
+        print ' - stratum-adjusted correlation coefficient (SCC): %.3f' % scc
         print 'correlation between eigenvectors'
         eig_corr = eig_correlate_matrices(hic_data1, hic_data2, normalized=opts.norm,
                                           remove_bad_columns=True, nvect=6,
@@ -486,10 +491,21 @@ def populate_args(parser):
                         action='store_true', default=False,
                         help='''skip the comparison between replicates (faster).''')
 
+    glopts.add_argument("-C", "--cpu", dest="cpus", type=int,
+                        default=0, help='''[%(default)s] Maximum number of CPU
+                        cores  available in the execution host. Chromosomes
+                        are compared in parallel (if 0 all available cores
+                        will be used)''')
+
     glopts.add_argument('--skip_merge', dest='skip_merge',
                         action='store_true', default=False,
                         help='''skip the merge of replicates (faster).''')
 
+    glopts.add_argument('--sparse', dest='sparse',
+                        action='store_true', default=False,
+                        help='''store the Hi-C matrices in compact arrays, much
+                        lower memory usage at high resolution''')
+
     glopts.add_argument('--perc_zeros', dest='perc_zeros', metavar="FLOAT",
                         action='store', default=95, type=float, 
                         help=('[%(default)s%%] maximum percentage of zeroes '
@@ -19,6 +19,7 @@ from pytadbit.utils.extraviews    import nicer
 from pytadbit.utils.sqlite_utils  import get_path_id, add_path, print_db, get_jobid
 from pytadbit.utils.sqlite_utils  import digest_parameters
 from pytadbit                     import load_hic_data_from_reads
+from pytadbit.parsers.hic_binary_parser import is_hic_binary
 from pytadbit                     import get_dependencies_version
 from itertools                    import product
 from warnings                     import warn
@@ -67,16 +68,20 @@ def run_batch_job(exp, opts, m, u, l, s, outdir):
               'scale'  : float(s),
               'kforce' : 5}
 
+    muls = tuple(map(my_round, (m, u, l, s)))
+    dirname = 'cfg_%s_%s_%s_%s' % muls
+    mkdir(path.join(outdir, dirname))
+    # finished models are saved here, an interrupted job resumes from them
+    checkpoint = path.join(outdir, dirname, 'checkpoint_%s-%s.pick' % (
+        int(opts.rand), int(opts.rand) + opts.nmodels - 1))
     models = generate_3d_models(zscores, opts.reso, nloci,
                                 values=values, n_models=opts.nmodels,
                                 n_keep=opts.nkeep,
                                 n_cpus=opts.cpus, keep_all=True,
                                 start=int(opts.rand), container=None,
                                 config=optpar, coords=coords,
-                                zeros=zeros)
+                                zeros=zeros, checkpoint=checkpoint)
     # Save models
-    muls = tuple(map(my_round, (m, u, l, s)))
-    dirname = 'cfg_%s_%s_%s_%s' % muls
     runned = [int(mod['rand_init']) for mod in models]
     if not len(runned):
         raise Exception(("\n\n\nNothing to be done.\n\n"
@@ -723,8 +728,13 @@ def load_hic_data(opts):
     # Start reading the data
     crm = Chromosome(opts. crm)  # Create chromosome object
 
-    crm.add_experiment('test', exp_type='Hi-C', resolution=opts.reso,
-                       norm_data=opts.matrix)
+    if is_hic_binary(opts.matrix):
+        # load only the chromosome to be modeled
+        crm.add_experiment('test', exp_type='Hi-C', resolution=opts.reso,
+                           norm_data=opts.matrix, focus=opts.crm)
+    else:
+        crm.add_experiment('test', exp_type='Hi-C', resolution=opts.reso,
+                           norm_data=opts.matrix)
     # TODO: if not bad columns:...
     crm.experiments[-1].filter_columns(perc_zero=opts.perc_zero)
     if opts.beg > crm.experiments[-1].size:
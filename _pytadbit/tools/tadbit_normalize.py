@@ -11,6 +11,7 @@ from pytadbit.utils.sqlite_utils  import already_run, digest_parameters
 from pytadbit.utils.sqlite_utils  import add_path, get_jobid, print_db
 from pytadbit.utils.file_handling import mkdir
 from pytadbit.mapping.analyze     import plot_distance_vs_interactions, hic_map
+from pytadbit.parsers.hic_binary_parser import write_hic_binary
 from os                           import path, remove
 from string                       import ascii_letters
 from random                       import random
@@ -32,7 +33,7 @@ def run(opts):
         mreads = path.join(opts.workdir, load_parameters_fromdb(opts))
 
     print 'loading', mreads
-    hic_data = load_hic_data_from_reads(mreads, opts.reso)
+    hic_data = load_hic_data_from_reads(mreads, opts.reso, sparse=opts.sparse)
 
     mkdir(path.join(opts.workdir, '04_normalization'))
 
@@ -107,6 +108,15 @@ def run(opts):
     dump(hic_data, out)
     out.close()
 
+    # binary (memory-mappable) matrix
+    binary_path = None
+    if opts.binary:
+        print 'Saving binary genomic matrix'
+        binary_path = path.join(opts.workdir, '04_normalization',
+                                'hic-data_%s_%s.bin' % (nice(opts.reso),
+                                                        param_hash))
+        write_hic_binary(hic_data, binary_path)
+
     # to feed the save_to_db funciton
     intra_dir_nrm_fig = intra_dir_nrm_txt = None
     inter_dir_nrm_fig = inter_dir_nrm_txt = None
@@ -196,7 +206,7 @@ def run(opts):
                 intra_dir_raw_fig, intra_dir_raw_txt,
                 inter_dir_raw_fig, inter_dir_raw_txt,
                 genom_map_raw_fig, genom_map_raw_txt,
-                pickle_path, launch_time, finish_time)
+                pickle_path, binary_path, launch_time, finish_time)
 
 def save_to_db(opts, cis_trans_N_D, cis_trans_N_d, cis_trans_n_D, cis_trans_n_d,
                a2, bad_columns_file, bias_file, inter_vs_gcoord, mreads,
@@ -207,7 +217,7 @@ def save_to_db(opts, cis_trans_N_D, cis_trans_N_d, cis_trans_n_D, cis_trans_n_d,
                intra_dir_raw_fig, intra_dir_raw_txt,
                inter_dir_raw_fig, inter_dir_raw_txt,
                genom_map_raw_fig, genom_map_raw_txt,
-               pickle_path, launch_time, finish_time):
+               pickle_path, binary_path, launch_time, finish_time):
     if 'tmpdb' in opts and opts.tmpdb:
         # check lock
         while path.exists(path.join(opts.workdir, '__lock_db')):
@@ -258,6 +268,8 @@ def save_to_db(opts, cis_trans_N_D, cis_trans_N_d, cis_trans_n_D, cis_trans_n_d,
             pass
         jobid = get_jobid(cur)
         add_path(cur, pickle_path     , 'PICKLE'     , jobid, opts.workdir)
+        if binary_path:
+            add_path(cur, binary_path , 'HIC_BINARY' , jobid, opts.workdir)
         add_path(cur, bad_columns_file, 'BAD_COLUMNS', jobid, opts.workdir)
         add_path(cur, bias_file       , 'BIASES'     , jobid, opts.workdir)
         add_path(cur, inter_vs_gcoord , 'FIGURE'     , jobid, opts.workdir)
@@ -433,6 +445,17 @@ def populate_args(parser):
                       help='''only filter according to the percentage of zero
                       count or minimum count of reads''')
 
+    glopts.add_argument('--sparse', dest='sparse', action='store_true',
+                      default=False,
+                      help='''store the Hi-C matrix in compact arrays, much
+                      lower memory usage at high resolution''')
+
+    glopts.add_argument('--binary', dest='binary', action='store_true',
+                      default=False,
+                      help='''also save the Hi-C matrix (raw counts, biases and
+                      filtered columns) in a binary file that can be partly
+                      loaded (e.g. by tadbit segment or tadbit model)''')
+
     glopts.add_argument('--force', dest='force', action='store_true',
                       default=False,
                       help='overwrite previously run job')
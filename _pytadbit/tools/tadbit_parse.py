@@ -9,8 +9,10 @@ information needed
 from argparse                       import HelpFormatter
 from pytadbit                       import get_dependencies_version
 from pytadbit.parsers.genome_parser import parse_fasta
+from pytadbit.utils.genome_cache    import CACHE_SIZE, evict
 from pytadbit.parsers.map_parser    import parse_map
 from os                             import path, remove
+from multiprocessing                import cpu_count
 from string                         import ascii_letters
 from random                         import random
 from shutil                         import copyfile
@@ -59,13 +61,18 @@ def run(opts):
         # allows the use of cPickle genome to make it faster
         genome = load(open(opts.genome[0]))
     except UnpicklingError:
-        genome = parse_fasta(opts.genome, chr_regexp=opts.filter_chrom)
+        genome = parse_fasta(opts.genome, chr_regexp=opts.filter_chrom,
+                             cache_dir=opts.cache_dir)
 
     if not opts.skip:
         logging.info('parsing reads in %s project', name)
         counts, multis = parse_map(f_names1, f_names2, out_file1=out_file1,
                                    out_file2=out_file2, re_name=renz, verbose=True,
-                                   genome_seq=genome, compress=opts.compress_input)
+                                   genome_seq=genome, compress=opts.compress_input,
+                                   nthreads=opts.cpus, tmp_dir=opts.tmp,
+                                   max_memory=opts.max_memory,
+                                   cache_dir=opts.cache_dir)
+        evict(opts.cache_dir, opts.cache_size)
     else:
         counts = {}
         counts[0] = {}
@@ -308,6 +315,36 @@ def populate_args(parser):
                         done. This is done in background, while next MAP file is
                         processed, or while reads are sorted.''')
 
+    glopts.add_argument("-C", "--cpu", dest="cpus", type=int,
+                        default=0, help='''[%(default)s] Maximum number of CPU
+                        cores  available in the execution host. Input files
+                        are parsed, and temporary files merged, in parallel
+                        (if 0 all available) cores will be used''')
+
+    glopts.add_argument('--tmp', dest='tmp', action='store', default=None,
+                        metavar='PATH', type=str,
+                        help='''directory where to write temporary files used to
+                        sort reads (by default the output directory)''')
+
+    glopts.add_argument('--max_memory', dest='max_memory', metavar="INT",
+                        action='store', default=None, type=int,
+                        help='''maximum memory (in Mb, approximate) used by each
+                        process to sort reads before writing them to temporary
+                        files''')
+
+    glopts.add_argument('--cache_dir', dest='cache_dir', action='store',
+                        default=None, metavar='PATH', type=str,
+                        help='''directory where to store the parsed reference
+                        genome and the restriction enzyme sites found in it
+                        (e.g. ~/.tadbit/cache), reused by next runs with the
+                        same genome. By default no cache is used''')
+
+    glopts.add_argument('--cache_size', dest='cache_size', metavar="INT",
+                        action='store', default=CACHE_SIZE, type=int,
+                        help='''[%(default)s] maximum size (in Mb) of the cache,
+                        least recently used genomes and restriction enzyme
+                        sites are removed first''')
+
     glopts.add_argument('--tmpdb', dest='tmpdb', action='store', default=None,
                         metavar='PATH', type=str,
                         help='''if provided uses this directory to manipulate the
@@ -339,6 +376,12 @@ def check_options(opts):
     if not opts.genome: raise Exception('ERROR: genome parameter required.')
     if not opts.workdir: raise Exception('ERROR: workdir parameter required.')
 
+    # number of cpus
+    if opts.cpus == 0:
+        opts.cpus = cpu_count()
+    else:
+        opts.cpus = min(opts.cpus, cpu_count())
+
     # check skip
     if not path.exists(opts.workdir) and opts.skip:
         print ('WARNING: can use output files, found, not skipping...')
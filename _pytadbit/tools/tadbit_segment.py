@@ -12,16 +12,20 @@ from pytadbit.utils.sqlite_utils  import already_run, digest_parameters
 from pytadbit.utils.sqlite_utils  import add_path, get_jobid, print_db
 from pytadbit.utils.file_handling import mkdir
 from pytadbit.parsers.tad_parser  import parse_tads
+from pytadbit.parsers.hic_binary_parser import read_hic_binary
 from os                           import path, remove
 from time                         import sleep
 from shutil                       import copyfile
 from string                       import ascii_letters
 from random                       import random
+import multiprocessing as mu
 import sqlite3 as lite
 import time
 
 DESC = 'Finds TAD or compartment segmentation in Hi-C data.'
 
+_HIC_DATA = None
+
 def run(opts):
     check_options(opts)
     launch_time = time.localtime()
@@ -31,100 +35,128 @@ def run(opts):
         bad_co = opts.bad_co
         biases = opts.biases
         mreads = opts.mreads
+        binary = None if opts.binary == 'none' else opts.binary
         reso   = opts.reso
         inputs = []
     else:
         (bad_co, bad_co_id, biases, biases_id,
-         mreads, mreads_id, reso) = load_parameters_fromdb(opts)
+         mreads, mreads_id, binary, reso) = load_parameters_fromdb(opts)
         # store path ids to be saved in database
         inputs = bad_co_id, biases_id, mreads_id
 
-    mreads = path.join(opts.workdir, mreads)
-    bad_co = path.join(opts.workdir, bad_co)
-    biases = path.join(opts.workdir, biases)
-
     mkdir(path.join(opts.workdir, '05_segmentation'))
 
-    print 'loading %s \n    at resolution %s' % (mreads, nice(reso))
-    hic_data = load_hic_data_from_reads(mreads, reso)
-    hic_data.bads = dict((int(l.strip()), True) for l in open(bad_co))
-    print 'loading filtered columns %s' % (bad_co)
-    print '    with %d of %d filtered out columns' % (len(hic_data.bads),
-                                                      len(hic_data))
-    try:
-        hic_data.bias = dict((int(l.split()[0]), float(l.split()[1]))
-                             for l in open(biases))
-    except IOError:
-        if not opts.only_tads:
+    if binary:
+        # only the chromosomes needed are read from the binary matrix
+        binary = path.join(opts.workdir, binary)
+        hic_data = read_hic_binary(binary, focus=opts.crms,
+                                   sparse=opts.sparse)
+        if opts.reso and opts.reso != hic_data.resolution:
+            raise Exception(('ERROR: resolution of the binary matrix (%d) '
+                             'differs from the one requested (%d)') % (
+                                 hic_data.resolution, opts.reso))
+        reso = hic_data.resolution
+        print 'loading %s \n    at resolution %s' % (binary, nice(reso))
+        print '    with %d of %d filtered out columns' % (len(hic_data.bads),
+                                                          len(hic_data))
+        if not hic_data.bias and not opts.only_tads:
             raise Exception('ERROR: data should be normalized to get compartments')
+    else:
+        mreads = path.join(opts.workdir, mreads)
+        bad_co = path.join(opts.workdir, bad_co)
+        biases = path.join(opts.workdir, biases)
+        print 'loading %s \n    at resolution %s' % (mreads, nice(reso))
+        hic_data = load_hic_data_from_reads(mreads, reso, sparse=opts.sparse)
+        hic_data.bads = dict((int(l.strip()), True) for l in open(bad_co))
+        print 'loading filtered columns %s' % (bad_co)
+        print '    with %d of %d filtered out columns' % (len(hic_data.bads),
+                                                          len(hic_data))
+        try:
+            hic_data.bias = dict((int(l.split()[0]), float(l.split()[1]))
+                                 for l in open(biases))
+        except IOError:
+            if not opts.only_tads:
+                raise Exception('ERROR: data should be normalized to get compartments')
+
+    # the Hi-C data is shared with the processes searching for compartments
+    # and TADs (inherited when the processes are forked, not pickled)
+    global _HIC_DATA
+    _HIC_DATA = hic_data
+    # as when compartments are searched before TADs
+    if not opts.only_tads:
+        hic_data._filter_for_compartments()
 
-    # compartments
-    cmp_result = {}
+    # jobs, the biggest first: the compartment search (on all chromosomes),
+    # and the TAD search of each chromosome
+    jobs = []
     if not opts.only_tads:
         print 'Searching compartments'
         cmprt_dir = path.join(opts.workdir, '05_segmentation',
                               'compartments_%s' % (nice(reso)))
         mkdir(cmprt_dir)
-        firsts = hic_data.find_compartments(crms=opts.crms, savefig=cmprt_dir,
-                                            suffix=param_hash, log=cmprt_dir,
-                                            rich_in_A=opts.rich_in_A)
-
-        for crm in opts.crms or hic_data.chromosomes:
-            if not crm in firsts:
-                continue
-            ev_file = open(path.join(cmprt_dir,
-                                     '%s_EigVect_%s.tsv' % (crm, param_hash)), 'w')
-            ev_file.write('# first EV\tsecond EV\n')
-            ev_file.write('\n'.join(['\t'.join([str(v) for v in vs])
-                                     for vs in zip(*firsts[crm])]))
-            ev_file.close()
-
-        for crm in opts.crms or hic_data.chromosomes:
-            cmprt_file = path.join(cmprt_dir, '%s_%s.tsv' % (crm, param_hash))
-            hic_data.write_compartments(cmprt_file,
-                                        chroms=[crm])
-            cmp_result[crm] = {'path': cmprt_file,
-                               'num' : len(hic_data.compartments[crm])}
-
-    # TADs
-    tad_result = {}
+        jobs.append((_search_compartments,
+                     (cmprt_dir, param_hash, opts.crms, opts.rich_in_A)))
     if not opts.only_compartments:
         print 'Searching TADs'
         tad_dir = path.join(opts.workdir, '05_segmentation',
                              'tads_%s' % (nice(reso)))
         mkdir(tad_dir)
+        crms = []
         for crm in hic_data.chromosomes:
             if opts.crms and not crm in opts.crms:
                 continue
-            print '  - %s' % crm
-            matrix = hic_data.get_matrix(focus=crm)
             beg, end = hic_data.section_pos[crm]
-            size = len(matrix)
-            if size < 10:
-                print "     Chromosome too short (%d bins), skipping..." % size
+            if end - beg < 10:
+                print '  - %s' % crm
+                print "     Chromosome too short (%d bins), skipping..." % (
+                    end - beg)
                 continue
-            # transform bad column in chromosome referential
-            to_rm = tuple([1 if i in hic_data.bads else 0 for i in xrange(beg, end)])
-            # maximum size of a TAD
-            max_tad_size = size if opts.max_tad_size is None else opts.max_tad_size
-            result = tadbit([matrix], remove=to_rm,
-                            n_cpus=opts.cpus, verbose=False,
-                            max_tad_size=max_tad_size,
-                            no_heuristic=False)
-            tads = load_tad_height(result, size, beg, end, hic_data)
-            table = ''
-            table += '%s\t%s\t%s\t%s%s\n' % ('#', 'start', 'end', 'score', 'density')
-            for tad in tads:
-                table += '%s\t%s\t%s\t%s%s\n' % (
-                    tad, int(tads[tad]['start'] + 1), int(tads[tad]['end'] + 1),
-                    abs(tads[tad]['score']), '\t%s' % (round(
-                        float(tads[tad]['height']), 3)))
-            out_tad = path.join(tad_dir, '%s_%s.tsv' % (crm, param_hash))
-            out = open(out_tad, 'w')
-            out.write(table)
-            out.close()
-            tad_result[crm] = {'path' : out_tad,
-                               'num': len(tads)}
+            crms.append(crm)
+        crms.sort(key=lambda crm: (hic_data.section_pos[crm][0] -
+                                   hic_data.section_pos[crm][1]))
+        jobs.extend((_search_tads, (crm, tad_dir, param_hash,
+                                    opts.max_tad_size, opts.banded))
+                    for crm in crms)
+
+    # a process per job, with the available CPUs split between processes.
+    # Compartments are searched in this process, as the processes of a pool
+    # can not start the ones used by find_compartments
+    cpus = opts.cpus or mu.cpu_count()
+    nprocs = min(cpus, len(jobs))
+    n_cpus = max(1, cpus / max(1, nprocs))
+    pool_jobs = [job for job in jobs if job[0] is not _search_compartments]
+    local_jobs = [job for job in jobs if job[0] is _search_compartments]
+    npool = nprocs - len(local_jobs)
+    pool = mu.Pool(npool) if nprocs > 1 and npool > 0 else None
+
+    cmp_result = {}
+    tad_result = {}
+    try:
+        procs = []
+        for func, args in pool_jobs + local_jobs:
+            args += (n_cpus, )
+            if pool and func is not _search_compartments:
+                procs.append(pool.apply_async(func, args=args))
+            else:
+                procs.append(func(*args))
+        if pool:
+            pool.close()
+        for proc in procs:
+            name, result, wall_time = (proc if isinstance(proc, tuple)
+                                       else proc.get())
+            if name is None:
+                cmp_result = result
+                print '  - compartments done in %.1f s' % wall_time
+            else:
+                tad_result[name] = result
+                print '  - %s: %d TADs in %.1f s' % (name, result['num'],
+                                                     wall_time)
+    finally:
+        # all results are collected, or a job failed and the others are
+        # not waited for
+        if pool:
+            pool.terminate()
+            pool.join()
 
     finish_time = time.localtime()
 
@@ -132,6 +164,74 @@ def run(opts):
         save_to_db(opts, cmp_result, tad_result, reso, inputs, 
                    launch_time, finish_time)
 
+def _search_compartments(cmprt_dir, param_hash, crms, rich_in_A, n_cpus):
+    """
+    compartments of all chromosomes (the hmm is trained on all of them)
+    """
+    t0 = time.time()
+    hic_data = _HIC_DATA
+    firsts = hic_data.find_compartments(crms=crms, savefig=cmprt_dir,
+                                        suffix=param_hash, log=cmprt_dir,
+                                        rich_in_A=rich_in_A, n_cpus=n_cpus)
+
+    for crm in crms or hic_data.chromosomes:
+        if not crm in firsts:
+            continue
+        ev_file = open(path.join(cmprt_dir,
+                                 '%s_EigVect_%s.tsv' % (crm, param_hash)), 'w')
+        ev_file.write('# first EV\tsecond EV\n')
+        ev_file.write('\n'.join(['\t'.join([str(v) for v in vs])
+                                 for vs in zip(*firsts[crm])]))
+        ev_file.close()
+
+    cmp_result = {}
+    for crm in crms or hic_data.chromosomes:
+        cmprt_file = path.join(cmprt_dir, '%s_%s.tsv' % (crm, param_hash))
+        hic_data.write_compartments(cmprt_file,
+                                    chroms=[crm])
+        cmp_result[crm] = {'path': cmprt_file,
+                           'num' : len(hic_data.compartments[crm])}
+    return None, cmp_result, time.time() - t0
+
+
+def _search_tads(crm, tad_dir, param_hash, max_tad_size, banded, n_cpus):
+    """
+    TADs of one chromosome
+    """
+    t0 = time.time()
+    hic_data = _HIC_DATA
+    beg, end = hic_data.section_pos[crm]
+    size = end - beg
+    # transform bad column in chromosome referential
+    to_rm = tuple([1 if i in hic_data.bads else 0 for i in xrange(beg, end)])
+    # maximum size of a TAD
+    max_tad_size = size if max_tad_size is None else max_tad_size
+    if banded:
+        result = tadbit(hic_data, focus=crm, banded=True, remove=to_rm,
+                        n_cpus=n_cpus, verbose=False,
+                        max_tad_size=max_tad_size,
+                        no_heuristic=False)
+    else:
+        matrix = hic_data.get_matrix(focus=crm)
+        result = tadbit([matrix], remove=to_rm,
+                        n_cpus=n_cpus, verbose=False,
+                        max_tad_size=max_tad_size,
+                        no_heuristic=False)
+    tads = load_tad_height(result, size, beg, end, hic_data)
+    table = ''
+    table += '%s\t%s\t%s\t%s%s\n' % ('#', 'start', 'end', 'score', 'density')
+    for tad in tads:
+        table += '%s\t%s\t%s\t%s%s\n' % (
+            tad, int(tads[tad]['start'] + 1), int(tads[tad]['end'] + 1),
+            abs(tads[tad]['score']), '\t%s' % (round(
+                float(tads[tad]['height']), 3)))
+    out_tad = path.join(tad_dir, '%s_%s.tsv' % (crm, param_hash))
+    out = open(out_tad, 'w')
+    out.write(table)
+    out.close()
+    return crm, {'path' : out_tad, 'num': len(tads)}, time.time() - t0
+
+
 def save_to_db(opts, cmp_result, tad_result, reso, inputs,
                launch_time, finish_time):
     if 'tmpdb' in opts and opts.tmpdb:
@@ -248,8 +348,17 @@ def load_parameters_fromdb(opts):
         where NORMALIZE_OUTPUTs.JOBid = %d;
         """ % parse_jobid)
         reso = int(cur.fetchall()[0][0])
+        # binary matrix, given by the user or generated by tadbit normalize
+        binary = None if opts.binary == 'none' else opts.binary
+        if opts.binary is None:
+            cur.execute("""
+            select distinct Path from PATHs
+            where paths.jobid = %s and paths.Type = 'HIC_BINARY'
+            """ % parse_jobid)
+            binary = cur.fetchall()
+            binary = binary[0][0] if binary else None
         return (bad_co, bad_co_id, biases, biases_id,
-                mreads, mreads_id, reso)
+                mreads, mreads_id, binary, reso)
 
 def populate_args(parser):
     """
@@ -287,6 +396,14 @@ def populate_args(parser):
                         help='''path to file with precalculated biases by
                         columns''')
 
+    glopts.add_argument('--binary', dest='binary', metavar="PATH",
+                        action='store', default=None, type=str,
+                        help='''path to a binary matrix generated by tadbit
+                        normalize (--binary option); only the chromosomes
+                        needed are loaded. If not provided, the binary matrix
+                        found in the database is used (use "none" to skip it
+                        and load the valid-pairs file)''')
+
     glopts.add_argument('-r', '--resolution', dest='reso', metavar="INT",
                         action='store', default=None, type=int,
                         help='''resolution at which to output matrices''')
@@ -318,6 +435,11 @@ def populate_args(parser):
                         help='''search TAD boundaries break-point detection
                         algorithm''')
 
+    glopts.add_argument('--sparse', dest='sparse',
+                        action='store_true', default=False,
+                        help='''store the Hi-C matrix in compact arrays, much
+                        lower memory usage at high resolution''')
+
     glopts.add_argument('--perc_zeros', dest='perc_zeros', metavar="FLOAT",
                         action='store', default=95, type=float, 
                         help='maximum percentage of zeroes allowed per column')
@@ -337,12 +459,22 @@ def populate_args(parser):
                         help='''an integer defining the maximum size of TAD. Default
                         defines it as the number of rows/columns''')
 
+    glopts.add_argument('--banded', dest='banded', action='store_true',
+                        default=False,
+                        help='''only pass to TADbit the diagonal band of the
+                        matrix (of width max_tad_size), memory usage
+                        proportional to the number of bins times
+                        max_tad_size instead of the number of bins squared
+                        (use with --max_tad_size)''')
+
     glopts.add_argument("-C", "--cpu", dest="cpus", type=int,
                         default=0, help='''[%(default)s] Maximum number of CPU
                         cores  available in the execution host. If higher
                         than 1, tasks with multi-threading
                         capabilities will enabled (if 0 all available)
-                        cores will be used''')
+                        cores will be used. Chromosomes (and the search of
+                        compartments) are processed in parallel, the
+                        biggest first''')
 
     glopts.add_argument('--force', dest='force', action='store_true',
                         default=False,
@@ -0,0 +1,205 @@
+"""
+18 Oct 2026
+
+External sort of parsed reads: reads are written in sorted temporary files of
+bounded size that are then merged with a k-way merge.
+
+By default reads are sorted by read ID (see read_key), other orders can be used
+passing a key function (that should be defined at module level, in order to be
+used by several processes).
+"""
+
+from heapq           import merge
+from tempfile        import mkstemp
+import multiprocessing as mu
+import os
+
+
+def read_key(line):
+    """
+    key used to sort parsed reads: the read ID, without the suffix used to
+    identify multiple contacts (after '~')
+    """
+    return line.split('\t', 1)[0].split('~', 1)[0]
+
+
+def tmp_name(outfile, tmp_dir=None, prefix='tmp_'):
+    """
+    :param outfile: path to the final output file, used to name the temporary
+       file
+    :param None tmp_dir: directory where to create the temporary file (by
+       default the directory of outfile)
+
+    :returns: path to a new, unique, temporary file
+    """
+    if tmp_dir is None:
+        tmp_dir = os.path.dirname(os.path.abspath(outfile))
+    fd, fnam = mkstemp(prefix=prefix, suffix='_' + os.path.basename(outfile),
+                       dir=tmp_dir)
+    os.close(fd)
+    return fnam
+
+
+def write_sorted_chunks(lines, outfile, tmp_dir=None, chunk_size=1000000,
+                        max_memory=None, key=read_key, nthreads=1):
+    """
+    Writes an iterable of lines into temporary files, each sorted by read ID.
+
+    :param lines: iterable of lines (ending with a new line character)
+    :param outfile: path to the final output file, used to name the temporary
+       files
+    :param None tmp_dir: directory where to create the temporary files
+    :param 1000000 chunk_size: maximum number of lines per temporary file
+    :param None max_memory: maximum size, in Mb, of the lines kept in memory
+       before being written to a temporary file (approximate, as python
+       strings use more memory than their length)
+    :param read_key key: function returning the sorting key of a line
+    :param 1 nthreads: number of processes used to sort and write the
+       temporary files (while the next chunk of lines is being read). At most
+       nthreads + 1 chunks of lines are kept in memory
+
+    :returns: the list of temporary files and the number of lines
+    """
+    max_bytes = (max_memory * 1024 ** 2) if max_memory else float('inf')
+    pool = mu.Pool(nthreads) if nthreads > 1 else None
+    procs = []
+    tmp_files = []
+    nlines = 0
+    reads = []
+    size = 0
+
+    def _write(reads):
+        if not pool:
+            tmp_files.append(_write_chunk(reads, outfile, tmp_dir, key))
+            return
+        procs.append(pool.apply_async(_write_chunk,
+                                      args=(reads, outfile, tmp_dir, key)))
+        # bound the number of chunks waiting to be written
+        while len(procs) > nthreads:
+            tmp_files.append(procs.pop(0).get())
+
+    for line in lines:
+        reads.append(line)
+        size += len(line)
+        if len(reads) >= chunk_size or size >= max_bytes:
+            nlines += len(reads)
+            _write(reads)
+            reads = []
+            size = 0
+    if reads:
+        nlines += len(reads)
+        _write(reads)
+    if pool:
+        pool.close()
+        tmp_files.extend(proc.get() for proc in procs)
+        pool.join()
+    return tmp_files, nlines
+
+
+def _write_chunk(reads, outfile, tmp_dir, key=read_key):
+    fnam = tmp_name(outfile, tmp_dir)
+    out = open(fnam, 'w')
+    reads.sort(key=key)
+    out.writelines(reads)
+    out.close()
+    return fnam
+
+
+def _decorate(fnam, idx, key):
+    for line in open(fnam):
+        yield key(line), idx, line
+
+
+def iter_merged(fnames, key=read_key):
+    """
+    k-way merge of files sorted by read ID. For reads with the same ID, lines
+    from the first files come first.
+
+    :param fnames: list of sorted files
+    :param read_key key: function returning the sorting key of a line
+
+    :returns: an iterator over the sorted lines
+    """
+    return (line for _, _, line in
+            merge(*[_decorate(fnam, i, key) for i, fnam in enumerate(fnames)]))
+
+
+def merge_files(fnames, outfile, clean=True, key=read_key):
+    """
+    k-way merge of files sorted by read ID into a new file.
+
+    :param fnames: list of sorted files
+    :param outfile: path to the output file
+    :param True clean: remove input files
+    :param read_key key: function returning the sorting key of a line
+    """
+    out = open(outfile, 'w')
+    out.writelines(iter_merged(fnames, key))
+    out.close()
+    if clean:
+        for fnam in fnames:
+            os.remove(fnam)
+
+
+def reduce_sorted_files(fnames, outfile, fan_in=64, nthreads=1, tmp_dir=None,
+                        clean=True, key=read_key):
+    """
+    Merges groups of fan_in files sorted by read ID, in parallel, into
+    intermediate files until there are no more than fan_in files left.
+
+    :param fnames: list of sorted files
+    :param outfile: path to the final output file, used to name the
+       intermediate files
+    :param 64 fan_in: maximum number of files merged at a time (also maximum
+       number of files opened by a process)
+    :param 1 nthreads: number of processes used to merge the intermediate
+       files
+    :param None tmp_dir: directory where to create the intermediate files
+    :param True clean: remove input files
+    :param read_key key: function returning the sorting key of a line
+
+    :returns: list of at most fan_in sorted files
+    """
+    fan_in = max(2, fan_in)
+    fnames = list(fnames)
+    while len(fnames) > fan_in:
+        groups = [fnames[i:i + fan_in] for i in xrange(0, len(fnames), fan_in)]
+        outs = [tmp_name(outfile, tmp_dir, prefix='tmp_merged_')
+                for _ in groups]
+        if nthreads > 1:
+            pool = mu.Pool(min(nthreads, len(groups)))
+            procs = [pool.apply_async(merge_files,
+                                      args=(group, out, clean, key))
+                     for group, out in zip(groups, outs)]
+            pool.close()
+            pool.join()
+            for proc in procs:
+                proc.get()
+        else:
+            for group, out in zip(groups, outs):
+                merge_files(group, out, clean, key)
+        # intermediate files are always removed
+        clean = True
+        fnames = outs
+    return fnames
+
+
+def merge_sorted_files(fnames, outfile, fan_in=64, nthreads=1, tmp_dir=None,
+                       clean=True, key=read_key):
+    """
+    Merges files sorted by read ID, with at most fan_in files merged at a time.
+
+    :param fnames: list of sorted files
+    :param outfile: path to the output file
+    :param 64 fan_in: maximum number of files merged at a time
+    :param 1 nthreads: number of processes used to merge the intermediate
+       files
+    :param None tmp_dir: directory where to create the intermediate files
+    :param True clean: remove input files
+    :param read_key key: function returning the sorting key of a line
+    """
+    reduced = reduce_sorted_files(fnames, outfile, fan_in=fan_in,
+                                  nthreads=nthreads, tmp_dir=tmp_dir,
+                                  clean=clean, key=key)
+    # intermediate files are always removed
+    merge_files(reduced, outfile, clean or set(reduced) != set(fnames), key)
@@ -0,0 +1,339 @@
+"""
+18 Oct 2026
+
+Persistent, content-addressed, cache of parsed reference genomes and of the
+restriction enzyme (RE) sites found in them.
+
+Entries are identified by a checksum of their content (FASTA files checksum,
+chromosome filters, enzyme name) and are shared by all processes (files are
+written to a temporary name and renamed). The size of the cache is bounded:
+least recently used entries are removed first.
+
+The cache is only used when a cache directory is given (e.g.
+~/.tadbit/cache). Its maximum size (in Mb) can be changed with the
+TADBIT_CACHE_SIZE environment variable.
+"""
+
+from ast         import literal_eval
+from collections import OrderedDict
+from hashlib     import md5
+from mmap        import mmap, ACCESS_READ, ALLOCATIONGRANULARITY
+from warnings    import warn
+import os
+import numpy as np
+
+CACHE_SIZE = int(os.environ.get('TADBIT_CACHE_SIZE', 20000))
+
+GENOME_MAGIC = 'TADbit genome v1\n'
+
+# files below this size are always checksummed, larger ones only if they were
+# modified since the last time
+_MIN_MEMO_SIZE = 64 * 1024 ** 2
+
+
+class Genome(OrderedDict):
+    """
+    Sorted dictionary with chromosome names as keys, and sequences as values,
+    that remembers the checksum identifying its content in the cache.
+    """
+    checksum = None
+
+
+def get_cache_dir(cache_dir=None):
+    """
+    :param None cache_dir: path to the cache directory. If None (or False, or
+       empty) the cache is disabled
+
+    :returns: path to the cache directory, or None if the cache is disabled
+    """
+    return cache_dir or None
+
+
+def _checksum_file(fnam):
+    digest = md5()
+    fhandler = open(fnam, 'rb')
+    for block in iter(lambda: fhandler.read(1024 ** 2), ''):
+        digest.update(block)
+    fhandler.close()
+    return digest.hexdigest()
+
+
+def file_checksum(fnam, cache_dir=None):
+    """
+    Checksum of the content of a file. For big files the checksum is stored
+    in the cache, and only recomputed if the file was modified.
+
+    :param fnam: path to a file
+    :param None cache_dir: path to the cache directory
+
+    :returns: md5 checksum of the file
+    """
+    if not os.path.exists(fnam):
+        raise IOError('ERROR: file %s not found' % fnam)
+    cache_dir = get_cache_dir(cache_dir)
+    stat = os.stat(fnam)
+    if not cache_dir or stat.st_size < _MIN_MEMO_SIZE:
+        return _checksum_file(fnam)
+    stamp = (os.path.realpath(fnam), stat.st_ino, stat.st_size, stat.st_mtime)
+    memo_fnam = os.path.join(cache_dir, 'checksums')
+    try:
+        memo = literal_eval(open(memo_fnam).read())
+    except (IOError, SyntaxError, ValueError):
+        memo = {}
+    if stamp in memo:
+        return memo[stamp]
+    memo[stamp] = _checksum_file(fnam)
+    try:
+        _write_atomic(memo_fnam, lambda out: out.write(repr(memo)))
+    except (IOError, OSError):
+        pass
+    return memo[stamp]
+
+
+def genome_checksum(genome_seq):
+    """
+    :param genome_seq: a dictionary containing the genomic sequence by
+       chromosome
+
+    :returns: checksum of the genomic sequence (computed from the sequence
+       only if the genome was not loaded from the cache)
+    """
+    checksum = getattr(genome_seq, 'checksum', None)
+    if checksum:
+        return checksum
+    digest = md5()
+    for crm in genome_seq:
+        digest.update('>%s\n' % crm)
+        digest.update(genome_seq[crm])
+    return digest.hexdigest()
+
+
+def _write_atomic(fnam, writer):
+    """
+    writes to a temporary file that is then renamed, as other processes might
+    be reading the cache
+    """
+    dirname = os.path.dirname(fnam)
+    if not os.path.exists(dirname):
+        try:
+            os.makedirs(dirname)
+        except OSError:
+            # created by another process
+            if not os.path.isdir(dirname):
+                raise
+    tmp_fnam = '%s_tmp%d' % (fnam, os.getpid())
+    out = open(tmp_fnam, 'wb')
+    try:
+        writer(out)
+    finally:
+        out.close()
+    os.rename(tmp_fnam, fnam)
+
+
+def _touch(fnam):
+    try:
+        os.utime(fnam, None)
+    except OSError:
+        pass
+
+
+def evict(cache_dir=None, max_size=None, keep=None):
+    """
+    Removes the least recently used entries of the cache until its size is
+    below the limit.
+
+    :param None cache_dir: path to the cache directory
+    :param None max_size: maximum size of the cache in Mb (defaults to the
+       value of the TADBIT_CACHE_SIZE environment variable, or 20 Gb)
+    :param None keep: path to an entry that should not be removed
+
+    :returns: list of removed files
+    """
+    cache_dir = get_cache_dir(cache_dir)
+    if not cache_dir or not os.path.isdir(cache_dir):
+        return []
+    max_size = (CACHE_SIZE if max_size is None else max_size) * 1024 ** 2
+    entries = []
+    for fnam in os.listdir(cache_dir):
+        if not (fnam.startswith('genome_') or fnam.startswith('re_sites_')):
+            continue
+        if '_tmp' in fnam:
+            continue
+        fnam = os.path.join(cache_dir, fnam)
+        try:
+            stat = os.stat(fnam)
+        except OSError:
+            continue
+        entries.append((stat.st_mtime, stat.st_size, fnam))
+    total = sum(size for _, size, _ in entries)
+    removed = []
+    for _, size, fnam in sorted(entries):
+        if total <= max_size:
+            break
+        if fnam == keep:
+            continue
+        try:
+            os.remove(fnam)
+        except OSError:
+            continue
+        removed.append(fnam)
+        total -= size
+    return removed
+
+
+def fasta_key(f_names, chr_names=None, chr_filter=None, chr_regexp=None,
+              cache_dir=None):
+    """
+    :param f_names: list of paths to FASTA files
+    :param None chr_names: list of chromosome names
+    :param None chr_filter: list of chromosomes to keep
+    :param None chr_regexp: regular expression matching the chromosomes to
+       keep
+    :param None cache_dir: path to the cache directory
+
+    :returns: key identifying the genome parsed with these parameters
+    """
+    return md5(repr((
+        [file_checksum(fnam, cache_dir) for fnam in f_names],
+        list(chr_names) if chr_names else None,
+        sorted(chr_filter) if chr_filter else None,
+        chr_regexp or None))).hexdigest()
+
+
+def _genome_fnam(key, cache_dir):
+    return os.path.join(cache_dir, 'genome_%s.seq' % key)
+
+
+def store_genome(genome_seq, key, cache_dir=None, max_size=None):
+    """
+    Stores a genome in the cache. Each chromosome sequence is stored
+    uncompressed, aligned to be memory mapped.
+
+    :param genome_seq: a dictionary containing the genomic sequence by
+       chromosome
+    :param key: key identifying the genome (see
+       :func:`pytadbit.utils.genome_cache.fasta_key`)
+    :param None cache_dir: path to the cache directory
+    :param None max_size: maximum size of the cache in Mb
+    """
+    cache_dir = get_cache_dir(cache_dir)
+    if not cache_dir:
+        return
+    fnam = _genome_fnam(key, cache_dir)
+
+    def _write(out):
+        out.write(GENOME_MAGIC)
+        out.write('%020d\n' % 0) # placeholder for the header position
+        chromosomes = []
+        for crm in genome_seq:
+            out.write('\0' * (-out.tell() % ALLOCATIONGRANULARITY))
+            chromosomes.append((crm, out.tell(), len(genome_seq[crm])))
+            out.write(genome_seq[crm])
+        pos = out.tell()
+        out.write(repr(chromosomes))
+        out.seek(len(GENOME_MAGIC))
+        out.write('%020d\n' % pos)
+
+    try:
+        _write_atomic(fnam, _write)
+    except (IOError, OSError), e:
+        warn('WARNING: genome not cached (%s)' % e)
+        return
+    evict(cache_dir, max_size, keep=fnam)
+
+
+def load_genome(key, cache_dir=None, use_mmap=False):
+    """
+    Loads a genome from the cache.
+
+    :param key: key identifying the genome (see
+       :func:`pytadbit.utils.genome_cache.fasta_key`)
+    :param None cache_dir: path to the cache directory
+    :param False use_mmap: sequences are memory mapped (read-only mmap objects
+       that can be sliced and searched with regular expressions) instead of
+       being loaded in memory
+
+    :returns: a :class:`pytadbit.utils.genome_cache.Genome`, or None if the
+       genome is not in the cache
+    """
+    cache_dir = get_cache_dir(cache_dir)
+    if not cache_dir:
+        return None
+    fnam = _genome_fnam(key, cache_dir)
+    try:
+        fhandler = open(fnam, 'rb')
+    except IOError:
+        return None
+    if fhandler.read(len(GENOME_MAGIC)) != GENOME_MAGIC:
+        fhandler.close()
+        return None
+    pos = int(fhandler.readline())
+    fhandler.seek(pos)
+    chromosomes = literal_eval(fhandler.read())
+    genome_seq = Genome()
+    genome_seq.checksum = key
+    for crm, offset, length in chromosomes:
+        if use_mmap and length:
+            genome_seq[crm] = mmap(fhandler.fileno(), length,
+                                   access=ACCESS_READ, offset=offset)
+        else:
+            fhandler.seek(offset)
+            genome_seq[crm] = fhandler.read(length)
+    fhandler.close()
+    _touch(fnam)
+    return genome_seq
+
+
+def _re_sites_fnam(enzyme_name, genome_seq, cache_dir):
+    return os.path.join(cache_dir, 're_sites_%s_%s.npz' % (
+        enzyme_name, genome_checksum(genome_seq)))
+
+
+def load_re_sites(enzyme_name, genome_seq, cache_dir=None):
+    """
+    Loads RE sites from the cache.
+
+    :param enzyme_name: name of the enzyme
+    :param genome_seq: a dictionary containing the genomic sequence by
+       chromosome
+    :param None cache_dir: path to the cache directory
+
+    :returns: a dictionary with, for each chromosome, a numpy array of RE
+       sites, or None if they are not in the cache
+    """
+    cache_dir = get_cache_dir(cache_dir)
+    if not cache_dir:
+        return None
+    fnam = _re_sites_fnam(enzyme_name, genome_seq, cache_dir)
+    try:
+        arrays = np.load(fnam)
+        frags = dict((crm, arrays[crm]) for crm in arrays.files)
+    except (IOError, ValueError):
+        return None
+    _touch(fnam)
+    return frags
+
+
+def store_re_sites(frags, enzyme_name, genome_seq, cache_dir=None,
+                   max_size=None):
+    """
+    Stores RE sites in the cache.
+
+    :param frags: a dictionary with, for each chromosome, a numpy array of RE
+       sites
+    :param enzyme_name: name of the enzyme
+    :param genome_seq: a dictionary containing the genomic sequence by
+       chromosome
+    :param None cache_dir: path to the cache directory
+    :param None max_size: maximum size of the cache in Mb
+    """
+    cache_dir = get_cache_dir(cache_dir)
+    if not cache_dir:
+        return
+    fnam = _re_sites_fnam(enzyme_name, genome_seq, cache_dir)
+    try:
+        _write_atomic(fnam, lambda out: np.savez(out, **frags))
+    except (IOError, OSError), e:
+        warn('WARNING: RE sites not cached (%s)' % e)
+        return
+    evict(cache_dir, max_size, keep=fnam)
@@ -1,9 +1,172 @@
-from numpy import log, pi as pi_num, exp
+"""
+Hidden Markov models with gaussian emissions, used to label compartments.
+
+Emissions (E) are given, for each state, as a mean and a variance.
+
+The training (Baum-Welch) and decoding (Viterbi) are vectorized with NumPy
+over the states, and the training over all the observation sequences at once
+(padded to the length of the longest one). The pure python implementation is
+kept as reference (train_loops and best_path_loops).
+"""
+
+from numpy import log, pi as pi_num
+import numpy as np
 import sys
 
+def _safe_log(x):
+    """
+    log of probabilities, -inf for null (or negative) values
+    """
+    x = np.asarray(x, dtype=float)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(x > 0., np.log(np.where(x > 0., x, 1.)), float('-inf'))
+
 def best_path(probs, pi, T):
     """
-    Viterbi algorithm with backpointers
+    Viterbi algorithm with backpointers, in log space
+
+    :param probs: probabilities of each observation for each state (see
+       gaussian_prob), one row per state
+    :param pi: initial probabilities
+    :param T: transition probabilities
+
+    :returns: the most probable path of states and its log-likelihood
+    """
+    log_probs = _safe_log(probs)
+    log_pi    = _safe_log(pi)
+    log_T     = _safe_log(T)
+    n, m = log_probs.shape
+    backpt = np.zeros((m, n), dtype=int)
+    log_V  = log_probs[:, 0] + log_pi
+    states = np.arange(n)
+    for k in xrange(1, m):
+        # original state prob times transition prob (previous x next state)
+        prob = log_V[:, None] + log_T
+        backpt[k - 1] = prob.argmax(axis=0)
+        log_V = prob[backpt[k - 1], states] + log_probs[:, k]
+    # Follow the backtrack: get the path which maximize the path prob.
+    path = [0] * m
+    path[-1] = int(log_V.argmax())
+    backpt = backpt.tolist()
+    for k in xrange(m - 2, -1, -1):
+        path[k] = backpt[k][path[k + 1]]
+    return path, log_V[path[-1]]
+
+def gaussian_prob(x, E):
+    """
+    of x to follow the gaussian with given E
+    https://en.wikipedia.org/wiki/Normal_distribution
+
+    :returns: an array with one row per state (of the same shape as x)
+    """
+    E = np.asarray(E, dtype=float)
+    x = np.asarray(x, dtype=float)
+    shape = (-1, ) + (1, ) * x.ndim
+    mu  = E[:, 0].reshape(shape)
+    var = E[:, 1].reshape(shape)
+    return (2. * pi_num * var)**-0.5 * np.exp(-(x - mu)**2 / (2. * var))
+
+def forward_backward(probs, pi, T, lengths):
+    """
+    Scaled forward and backward algorithms, for several sequences at once.
+
+    :param probs: array of probabilities of each observation for each state,
+       of shape (sequences, observations, states). Sequences are padded to
+       the length of the longest
+    :param pi: initial probabilities
+    :param T: transition probabilities
+    :param lengths: length of each sequence
+
+    :returns: alphas and betas, of the same shape as probs, and scalars (one
+       per observation)
+    """
+    n_seqs, m, _ = probs.shape
+    alphas  = np.empty_like(probs)
+    betas   = np.ones_like(probs)
+    scalars = np.empty((n_seqs, m))
+    alpha = pi * probs[:, 0]
+    for k in xrange(m):
+        if k:
+            alpha = alphas[:, k - 1].dot(T) * probs[:, k]
+        scalars[:, k] = alpha.sum(axis=1)
+        alphas[:, k] = alpha / scalars[:, k, None]
+    for k in xrange(m - 2, -1, -1):
+        beta = ((betas[:, k + 1] * probs[:, k + 1]).dot(T.T) /
+                scalars[:, k + 1, None])
+        # betas are kept at one after the end of each sequence
+        betas[:, k] = np.where((k < lengths - 1)[:, None], beta, 1.)
+    return alphas, betas, scalars
+
+def train(pi, T, E, observations, verbose=False, threshold=1e-6, n_iter=1000):
+    """
+    Baum-Welch training of the model, on several sequences of observations.
+
+    :param pi: initial probabilities (updated)
+    :param T: transition probabilities, list of lists (updated)
+    :param E: emissions, array with the mean and variance of each state
+       (updated)
+    :param observations: list of sequences of observations
+    :param False verbose: print the convergence
+    :param 1e-6 threshold: training stops when parameters change less than
+       this value
+    :param 1000 n_iter: maximum number of iterations
+    """
+    n = len(T)
+    lengths = np.array([len(obs) for obs in observations])
+    m = lengths.max()
+    valid = np.arange(m)[None, :] < lengths[:, None]
+    x = np.zeros(valid.shape)
+    for h, obs in enumerate(observations):
+        x[h, :lengths[h]] = obs
+    new_pi = np.array(pi, dtype=float)
+    new_T  = np.array(T , dtype=float)
+    new_E  = np.array(E , dtype=float)
+    for it in xrange(n_iter):
+        old_pi, old_T, old_E = new_pi, new_T, new_E
+        probs = np.rollaxis(gaussian_prob(x, old_E), 0, 3)
+        probs[~valid] = 1.
+        alphas, betas, _ = forward_backward(probs, old_pi, old_T, lengths)
+        # probability of being in states i and j at times t and t+1
+        etas = (alphas[:, :-1, :, None] * old_T *
+                (probs[:, 1:] * betas[:, 1:])[:, :, None, :])
+        etas /= etas.sum(axis=(2, 3))[:, :, None, None]
+        etas[~valid[:, 1:]] = 0.
+        # probability of being in state i at time t
+        gammas = alphas * betas
+        gammas[~valid] = 0.
+        ### update initial probabilities
+        new_pi = etas[:, 0].sum(axis=(0, 2))
+        new_pi /= new_pi.sum()
+        ### update transitions
+        new_T = etas.sum(axis=(0, 1))
+        new_T /= new_T.sum(axis=1)[:, None]
+        ### update emissions
+        corrector = gammas.sum(axis=(0, 1))
+        new_E = old_E.copy()
+        upd = corrector > 0.
+        new_E[upd, 0] = ((gammas * x[:, :, None]).sum(axis=(0, 1))[upd] /
+                         corrector[upd])
+        new_E[upd, 1] = ((gammas * (x[:, :, None] - old_E[:, 0])**2
+                         ).sum(axis=(0, 1))[upd] / corrector[upd])
+        delta = max(np.abs(new_pi - old_pi).max(),
+                    np.abs(new_T  - old_T ).max(),
+                    np.abs(new_E  - old_E ).max())
+        if verbose:
+            print ("\rTraining: %03i/%04i (diff: %.8f)") % (it, n_iter, delta),
+            sys.stdout.flush()
+        if delta <= threshold:
+            break
+    if verbose:
+        print "\n"
+    pi[:] = new_pi.tolist()
+    for i in xrange(n):
+        T[i][:] = new_T[i].tolist()
+        E[i][0], E[i][1] = new_E[i]
+
+def best_path_loops(probs, pi, T):
+    """
+    Viterbi algorithm with backpointers (pure python implementation, see
+    best_path)
     """
     n = len(T)
     m = len(probs[0])
@@ -97,7 +260,11 @@ def update_parameters(corrector, pi, new_pi, T, new_T, E, new_E, delta):
             E[i][1] = new_E[i][1]
     return delta
 
-def train(pi, T, E, observations, verbose=False, threshold=1e-6, n_iter=1000):
+def train_loops(pi, T, E, observations, verbose=False, threshold=1e-6,
+                n_iter=1000):
+    """
+    Baum-Welch training of the model (pure python implementation, see train)
+    """
     delta = float('inf')
     for it in xrange(n_iter):
         # reset for new iteration
@@ -106,7 +273,7 @@ def train(pi, T, E, observations, verbose=False, threshold=1e-6, n_iter=1000):
         new_E  = [[0. for _ in i] for i in E]
         corrector = [0. for _ in xrange(len(T))]
         for h in xrange(len(observations)):
-            probs  = gaussian_prob(observations[h], E)
+            probs  = gaussian_prob(observations[h], E).tolist()
             alphas, scalars = get_alpha(probs, pi, T)
             betas  = get_beta(probs, T, scalars)
             etas   = get_eta(probs, T, alphas, betas)
@@ -149,21 +316,6 @@ def get_gamma(T, alphas, betas):
     m = len(alphas[0])
     return [[alphas[i][k] * betas[i][k]  for k in xrange(m)] for i in xrange(n)]
 
-def gaussian_prob(x, E):
-    """
-    of x to follow the gaussian with given E
-    https://en.wikipedia.org/wiki/Normal_distribution
-    """
-    probs = []
-    for d, (mu, sd) in enumerate(E):
-        pi2sd = (2. * pi_num * sd)**-0.5
-        inv2sd = 1. / (2. * sd)
-        probs.append([])
-        for obs in x:
-            p = pi2sd * exp(-(obs - mu)**2 * inv2sd)
-            probs[d].append(p)
-    return probs
-
 def get_alpha(probs, pi, T):
     """
     computes alphas using forward algorithm
@@ -51,6 +51,10 @@ matrix W of size N:
 
 """
 
+from scipy.sparse import triu
+import numpy as np
+
+
 def _update_S(W):
     S = {}
     meanS = 0.0
@@ -145,10 +149,120 @@ def iterative(hic_data, bads=None, iterations=0, max_dev=0.00001,
     return B
 
 
+def _upper_triangle(hic_data):
+    """
+    :returns: the upper triangle of a HiC_data matrix as a scipy CSR matrix,
+       without copying the data if the object is a SparseHiC_data
+    """
+    try:
+        hic_data._consolidate()
+        return hic_data._get_upper()
+    except AttributeError:
+        return triu(hic_data.get_hic_data_as_csr()).tocsr()
+
+
+def _symmetric_dot(upper, x, chunk=10000000):
+    """
+    Product of a symmetric matrix, stored as its upper triangle, by a vector.
+    Computed by blocks of rows in order to keep temporary arrays small.
+
+    :param upper: scipy CSR matrix with the upper triangle of the matrix
+    :param x: vector
+    :param 10000000 chunk: maximum number of cells processed at once
+    """
+    indptr, indices, data = upper.indptr, upper.indices, upper.data
+    size = upper.shape[0]
+    out = np.zeros(size)
+    beg = 0
+    while beg < size:
+        end = int(indptr.searchsorted(indptr[beg] + chunk, 'right')) - 1
+        end = min(size, max(beg + 1, end))
+        lo, hi = indptr[beg], indptr[end]
+        rows = np.repeat(np.arange(beg, end), np.diff(indptr[beg:end + 1]))
+        cols = indices[lo:hi]
+        vals = data[lo:hi]
+        out += np.bincount(rows, weights=vals * x[cols], minlength=size)
+        off = rows != cols
+        out += np.bincount(cols[off], weights=vals[off] * x[rows[off]],
+                           minlength=size)
+        beg = end
+    return out
+
+
+def iterative_sparse(hic_data, bads=None, iterations=0, max_dev=0.00001,
+                     verbose=False, log=None, **kwargs):
+    """
+    Implementation of iterative correction Imakaev 2012, vectorized version of
+    :func:`pytadbit.utils.normalize_hic.iterative`.
+
+    The matrix is never copied nor modified, only the vector of biases is
+    updated at each iteration (the corrected matrix being the raw matrix
+    divided by the product of biases).
+
+    :param hic_data: HiC_data (or SparseHiC_data) object
+    :param None bads: dictionary with column not to be considered
+    :param 0 iterations: number of iterations to do (99 if a fully smoothed
+       matrix with no visibility differences between columns is desired)
+    :param 0.00001 max_dev: maximum difference allowed between a row and the
+       mean value of all raws
+    :param None log: path to a file where to write the convergence log (one
+       line per iteration with minimum, mean and maximum sum of rows and the
+       maximum deviation)
+    :returns: a vector of biases (length equal to the size of the matrix)
+    """
+    if verbose:
+        print 'iterative correction (sparse)'
+    size = len(hic_data)
+    if not bads:
+        bads = {}
+    upper = _upper_triangle(hic_data)
+    good = np.ones(size, dtype=bool)
+    good[[b for b in bads if b < size]] = False
+    # rows with at least one interaction with a valid column
+    valid = good & (_symmetric_dot(upper, good.astype(float)) > 0)
+    nvalid = valid.sum()
+    if nvalid == 0:
+        raise ZeroDivisionError('ERROR: normalization failed, all bad columns')
+    if log:
+        log = open(log, 'w')
+        log.write('# iteration\tmin_sum\tmean_sum\tmax_sum\tdeviation\n')
+    if verbose:
+        print "  - computing baises"
+    B = np.ones(size)
+    try:
+        for it in xrange(iterations + 1):
+            S = _symmetric_dot(upper, np.where(valid, 1. / B, 0.)) / B
+            S = S[valid]
+            meanS = S.sum() / nvalid
+            B[valid] *= S / meanS
+            if iterations == 0: # exit before, we do not need to update B
+                break
+            dev = max(abs(S.min() / meanS - 1), abs(S.max() / meanS - 1))
+            if verbose:
+                print '   %15.3f %15.3f %15.3f %4s %9.5f' % (S.min(), meanS,
+                                                            S.max(), it, dev)
+            if log:
+                log.write('%d\t%f\t%f\t%f\t%f\n' % (it, S.min(), meanS,
+                                                      S.max(), dev))
+            if dev < max_dev:
+                break
+    finally:
+        if log:
+            log.close()
+    B[valid] *= meanS**.5
+    B[B == 0] = 1.
+    B[~valid] = 1.
+    return dict((i, b) for i, b in enumerate(B.tolist()))
+
+
 def expected(hic_data, bads=None, signal_to_noise=0.05, inter_chrom=False, **kwargs):
     """
     Computes the expected values by averaging observed interactions at a given
     distance in a given HiC matrix.
+
+    The sums of interactions at each distance are taken from the decay profile
+    cached in the HiC_data object (see
+    :func:`pytadbit.hic_data.HiC_data.get_decay`).
     
     :param hic_data: dictionary containing the interaction data
     :param None bads: dictionary with column not to be considered
@@ -168,38 +282,33 @@ def expected(hic_data, bads=None, signal_to_noise=0.05, inter_chrom=False, **kwa
     except AttributeError:
         pass
 
-    if size > 1200:
-        import sys
-        sys.setrecursionlimit(size + 100)
+    # genome-wide sums and number of cells at each distance
+    sums   = np.zeros(size + 1)
+    counts = np.zeros(size + 1, dtype=int)
+    for sec_sums, sec_counts, _ in hic_data.get_decay(bads=bads).itervalues():
+        dists = min(len(sec_sums), size + 1)
+        sums[:dists]   += sec_sums[:dists]
+        counts[:dists] += sec_counts[:dists]
+    sums   = sums.tolist()
+    counts = counts.tolist()
 
     expc = {}
     dist = 0
     while dist < size:
-        diag = []
-        new_dist, val = _meandiag(hic_data, dist, diag, min_n, size, bads)
-        for dist in range(dist, new_dist + 1):
+        # distances are grouped until enough interactions are observed
+        beg = dist
+        sum_diag = 0.
+        len_diag = 0
+        while True:
+            sum_diag += sums[dist]
+            len_diag += counts[dist]
+            if len_diag == 0:
+                val = 0.
+                break
+            if sum_diag > min_n or dist >= size:
+                val = sum_diag / len_diag
+                break
+            dist += 1
+        for dist in range(beg, dist + 2):
             expc[dist] = val
     return expc
-
-def _meandiag(hic_data, dist, diag, min_n, size, bads):
-    if hic_data.section_pos:
-        for crm in hic_data.section_pos:
-            for i in xrange(hic_data.section_pos[crm][0],
-                            hic_data.section_pos[crm][1] - dist):
-                if i in bads:
-                    continue
-                diag.append(hic_data[i, i + dist])
-    else:
-        for i in xrange(size - dist):
-            if i in bads:
-                continue
-            diag.append(hic_data[i, i + dist])
-    sum_diag = sum(diag)
-    if len(diag) == 0:
-        return dist + 1, 0.
-    if sum_diag > min_n:
-        return dist + 1, float(sum_diag) / len(diag)
-    elif dist >= size:
-        return dist + 1, float(sum_diag) / len(diag)
-    else:
-        return _meandiag(hic_data, dist + 1, diag, min_n, size, bads)
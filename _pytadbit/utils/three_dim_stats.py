@@ -4,13 +4,19 @@
 
 """
 
-from pytadbit.eqv_rms_drms import rmsdRMSD_wrapper
+from pytadbit.eqv_rms_drms import rmsdRMSD_pairs_wrapper
 from pytadbit.consistency import consistency_wrapper
-from itertools import combinations
+from multiprocessing.pool import ThreadPool
+from itertools import combinations, permutations, imap
 import numpy as np
 from math import pi, sqrt, cos, sin, acos
 
 
+# number of models per side of the blocks of pairs of models compared in each
+# task by calc_eqv_rmsd_matrix
+TILE_SIZE = 32
+
+
 def generate_sphere_points(n=100):
     """
     Returns list of 3d coordinates of points on a sphere using the
@@ -298,7 +304,7 @@ def calc_consistency(models, nloci, zeros, dcutoff=200):
 
 
 def calc_eqv_rmsd(models, nloci, zeros, dcutoff=200, one=False, what='score',
-                  normed=True):
+                  normed=True, n_cpus=1):
     """
     Calculates the RMSD, dRMSD, the number of equivalent positions and a score
     combining these three measures. The measure are done between a group of
@@ -315,6 +321,7 @@ def calc_eqv_rmsd(models, nloci, zeros, dcutoff=200, one=False, what='score',
        'drmsd' or 'eqv'
     :param True normed: normalize result by maximum value (only applies to rmsd
        and drmsd)
+    :param 1 n_cpus: number of threads used to compare the models
 
     :returns: a score of each pairwise comparison according to:
 
@@ -331,24 +338,137 @@ def calc_eqv_rmsd(models, nloci, zeros, dcutoff=200, one=False, what='score',
     if not what in ['score', 'rmsd', 'drmsd', 'eqv']:
         raise NotImplementedError("Only 'score', 'rmsd', 'drmsd' or 'eqv' " +
                                   "features are available\n")
+    stats = calc_eqv_rmsd_matrix(models, nloci, zeros, dcutoff, n_cpus=n_cpus)
+    if one:
+        return float(stats[2, 0, 1])
+    scores = eqv_rmsd_scores(stats, what=what, normed=normed).tolist()
+    return dict(((i, j), scores[i][j])
+                for i, j in permutations(xrange(len(models)), 2))
+
+
+def calc_eqv_rmsd_matrix(models, nloci, zeros, dcutoff=200, n_cpus=1,
+                         stats=None):
+    """
+    Calculates the number of equivalent positions, the RMSD and the dRMSD of
+    all pairs of models. Pairs are compared by blocks of TILE_SIZE x
+    TILE_SIZE models, the blocks being distributed between threads.
+
+    :param models: models to compare, indexed from 0
+    :param nloci: number of particles per model
+    :param zeros: list of True/False representing particles to skip
+    :param 200 dcutoff: distance in nanometer from which it is considered
+       that two particles are separated.
+    :param 1 n_cpus: number of threads used to compare the models
+    :param None stats: array with the already known comparisons between these
+       models (as returned by this function), with NaN for the pairs to be
+       computed. It is filled in place.
+
+    :returns: an array (float32) of shape (3, number of models, number of
+       models), with the number of equivalent positions, the RMSD and the
+       dRMSD of each pair of models
+    """
+    nmodels = len(models)
     # remove particles with zeros from calculation
     x = []
     y = []
     z = []
-    for m in xrange(len(models)):
+    for m in xrange(nmodels):
         x.append([models[m]['x'][i] for i in xrange(nloci) if zeros[i]])
         y.append([models[m]['y'][i] for i in xrange(nloci) if zeros[i]])
         z.append([models[m]['z'][i] for i in xrange(nloci) if zeros[i]])
     zeros = tuple([True for _ in xrange(len(x[0]))])
-    scores = rmsdRMSD_wrapper(x, y, z, zeros, len(zeros),
-                              dcutoff, range(len(models)), len(models),
-                              int(one), what, int(normed))
+    if stats is None:
+        stats = np.empty((3, nmodels, nmodels), dtype=np.float32)
+        stats.fill(np.nan)
+    todo = np.isnan(stats[0])
+    todo[np.tril_indices(nmodels)] = False
+    tasks = []
+    for beg1 in xrange(0, nmodels, TILE_SIZE):
+        for beg2 in xrange(beg1, nmodels, TILE_SIZE):
+            idx1, idx2 = np.nonzero(todo[beg1:beg1 + TILE_SIZE,
+                                         beg2:beg2 + TILE_SIZE])
+            if len(idx1):
+                tasks.append((x, y, z, zeros, dcutoff, idx1 + beg1,
+                              idx2 + beg2))
+    pool = ThreadPool(n_cpus) if n_cpus > 1 and len(tasks) > 1 else None
+    try:
+        for idx1, idx2, vals in (pool.imap_unordered if pool else imap)(
+            _compare_pairs, tasks):
+            stats[:, idx1, idx2] = vals
+            stats[:, idx2, idx1] = vals
+    finally:
+        # all the tiles are compared, or one failed and the others are not
+        # waited for
+        if pool:
+            pool.terminate()
+            pool.join()
+    for i in xrange(3):
+        np.fill_diagonal(stats[i], 0)
+    return stats
+
+
+def _compare_pairs(args):
+    """
+    Compares a list of pairs of models, passing to the C wrapper only the
+    models involved
+    """
+    x, y, z, zeros, dcutoff, idx1, idx2 = args
+    used, local = np.unique(np.concatenate((idx1, idx2)), return_inverse=True)
+    used = used.tolist()
+    vals = rmsdRMSD_pairs_wrapper([x[m] for m in used], [y[m] for m in used],
+                                  [z[m] for m in used], zeros, len(zeros),
+                                  dcutoff, local[:len(idx1)].tolist(),
+                                  local[len(idx1):].tolist())
+    return idx1, idx2, vals
+
+
+def eqv_rmsd_scores(stats, what='score', normed=True):
+    """
+    Combines the comparisons between models returned by
+    :func:`calc_eqv_rmsd_matrix` into the score matrix used for clustering
+    (see :func:`calc_eqv_rmsd`).
+
+    :param stats: array with the number of equivalent positions, the RMSD and
+       the dRMSD of each pair of models
+    :param 'score' what: values to return. Can be one of 'score', 'rmsd',
+       'drmsd' or 'eqv'
+    :param True normed: normalize result by maximum value (only applies to rmsd
+       and drmsd)
+
+    :returns: a symmetric array with the score of each pair of models, and
+       zeros in the diagonal
+    """
+    what = what.lower()
+    if not what in ['score', 'rmsd', 'drmsd', 'eqv']:
+        raise NotImplementedError("Only 'score', 'rmsd', 'drmsd' or 'eqv' " +
+                                  "features are available\n")
+    eqvs, rmsds, drmsds = stats
+    nmodels = len(eqvs)
+    if nmodels < 2:
+        return np.zeros((nmodels, nmodels))
+    upper = np.triu_indices(nmodels, 1)
+    # single precision, as in the C implementation
+    with np.errstate(divide='ignore', invalid='ignore'):
+        scores = eqvs * drmsds / rmsds
+        if what == 'rmsd':
+            scores = 1 - rmsds / rmsds[upper].max() if normed else rmsds
+        elif what == 'drmsd':
+            scores = 1 - drmsds / drmsds[upper].max() if normed else drmsds
+        elif what == 'eqv':
+            scores = scores * rmsds / drmsds
+        else:
+            scores = scores * (rmsds[upper].max() / drmsds[upper].max())
+    scores = scores.astype(float)
+    np.fill_diagonal(scores, 0)
     return scores
 
 
 def dihedral(a, b, c, d, e):
     """
     Calculates dihedral angle between 4 points in 3D (array with x,y,z)
+
+    Points can also be stacked in arrays of shape (..., 3), in which case an
+    array of angles is returned.
     """
     v1 = getNormedVector(b - a)
     v2 = getNormedVector(b - c)
@@ -356,20 +476,21 @@ def dihedral(a, b, c, d, e):
     v3 = getNormedVector(c - e)
     v1v2 = np.cross(v1, v2)
     v3v4 = np.cross(v3, v4)
-    sign = 1 if np.linalg.det([v2, v1v2, v3v4]) < 0 else -1
+    sign = np.where(np.linalg.det(np.stack([v2, v1v2, v3v4], axis=-2)) < 0,
+                    1, -1)
     angle = getAngle(v1v2, v3v4)
     return sign * angle
 
 
 def getNormedVector(dif):
-    return (dif) / np.linalg.norm(dif)
+    return (dif) / np.linalg.norm(dif, axis=-1, keepdims=True)
 
 
 def getAngle(v1v2, v2v3):
     return np.rad2deg(
-        np.arccos(np.dot(
-            v1v2   / np.linalg.norm(v1v2),
-            v2v3.T / np.linalg.norm(v2v3)))
+        np.arccos((
+            v1v2 / np.linalg.norm(v1v2, axis=-1, keepdims=True) *
+            v2v3 / np.linalg.norm(v2v3, axis=-1, keepdims=True)).sum(axis=-1))
         )
 
 
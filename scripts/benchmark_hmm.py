@@ -0,0 +1,99 @@
+"""
+18 Oct 2026
+
+Compares running time and results of the two implementations of the HMM
+used to label compartments (pure python and vectorized), trained on the
+genome-wide first eigenvectors.
+
+"""
+
+from pytadbit.parsers.hic_parser   import load_hic_data_from_reads
+from pytadbit.utils.hmm            import train, train_loops, gaussian_prob
+from pytadbit.utils.hmm            import best_path, best_path_loops
+from argparse                      import ArgumentParser
+from copy                          import deepcopy
+from time                          import time
+import numpy as np
+
+
+def main():
+    """
+    main function
+    """
+    opts = get_options()
+
+    print 'loading', opts.reads
+    hic_data = load_hic_data_from_reads(opts.reads, opts.reso)
+
+    print 'computing eigenvectors'
+    firsts = hic_data.find_compartments(label_compartments=None,
+                                        n_cpus=opts.cpus)
+    x = {}
+    for sec in firsts:
+        beg = hic_data.section_pos[sec][0]
+        vals = np.array([v for i, v in enumerate(firsts[sec][0])
+                         if not i + beg in hic_data.bads])
+        x[sec] = ((vals - vals.mean()) / vals.std()).tolist()
+    print '  - %d chromosomes, %d bins' % (len(x), sum(len(v) for v in
+                                                    x.values()))
+
+    for n in range(2, 6):
+        pi = [0.5 - ((n - 2) * 0.05)**2 if i == 0 or i == n - 1
+              else ((n - 2) * 0.05)**2 * 2 / (n - 2) for i in range(n)]
+        T = [[0.9 if i == j else 0.1 / (n - 1) for i in xrange(n)]
+             for j in xrange(n)]
+        E = np.asarray(zip(np.linspace(-1, 1, n), [1. / n] * n))
+        model1 = deepcopy((pi, T, E))
+        model2 = deepcopy((pi, T, E))
+
+        print 'Training HMM with %d states (%d iterations)' % (
+            n, opts.iterations)
+        t0 = time()
+        train_loops(*model1, observations=x.values(), threshold=1e-6,
+                    n_iter=opts.iterations)
+        t1 = time()
+        train(*model2, observations=x.values(), threshold=1e-6,
+              n_iter=opts.iterations)
+        t2 = time()
+        max_diff = max(np.abs(np.array(a, dtype=float) -
+                              np.array(b, dtype=float)).max()
+                       for a, b in zip(model1, model2))
+        print '  - python implementation    : %.2f sec' % (t1 - t0)
+        print '  - vectorized implementation: %.2f sec' % (t2 - t1)
+        print '  - maximum difference between parameters: %g' % max_diff
+
+        pi, T, E = model2
+        t0 = time()
+        paths1 = [best_path_loops(gaussian_prob(x[sec], E).tolist(), pi, T)[0]
+                  for sec in x]
+        t1 = time()
+        paths2 = [best_path(gaussian_prob(x[sec], E), pi, T)[0] for sec in x]
+        t2 = time()
+        print 'Viterbi decoding with %d states' % n
+        print '  - python implementation    : %.2f sec' % (t1 - t0)
+        print '  - vectorized implementation: %.2f sec' % (t2 - t1)
+        print '  - identical paths: %s' % (paths1 == paths2)
+
+
+def get_options():
+    """
+    parse option from call
+    """
+    parser = ArgumentParser(
+        usage="%(prog)s [options] [--cfg CONFIG_PATH]")
+    parser.add_argument('--reads', dest='reads', metavar="PATH", required=True,
+                        help='''path to a TADbit-generated file with filtered
+                        reads''')
+    parser.add_argument('-r', '--resolution', dest='reso', metavar="INT",
+                        type=int, required=True, help='resolution')
+    parser.add_argument('--iterations', dest='iterations', metavar="INT",
+                        type=int, default=1000,
+                        help='[%(default)s] maximum number of iterations')
+    parser.add_argument('-C', '--cpus', dest='cpus', metavar="INT", type=int,
+                        default=1, help='''[%(default)s] number of CPUs used
+                        to compute the eigenvectors''')
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    exit(main())
@@ -0,0 +1,70 @@
+"""
+18 Oct 2026
+
+Compares running time and resulting biases of the two implementations of
+the iterative correction (dictionary based and vectorized).
+
+"""
+
+from pytadbit.parsers.hic_parser   import load_hic_data_from_reads
+from pytadbit.utils.normalize_hic  import iterative, iterative_sparse
+from argparse                      import ArgumentParser
+from time                          import time
+
+
+def main():
+    """
+    main function
+    """
+    opts = get_options()
+
+    print 'loading', opts.reads
+    hic_data = load_hic_data_from_reads(opts.reads, opts.reso)
+    sparse_data = load_hic_data_from_reads(opts.reads, opts.reso, sparse=True)
+    hic_data.filter_columns(perc_zero=opts.perc_zeros, by_mean=False,
+                            silent=True)
+    bads = hic_data.bads
+
+    print 'Running iterative correction (%d iterations)' % opts.iterations
+    t0 = time()
+    bias1 = iterative(hic_data, bads=bads, iterations=opts.iterations,
+                      max_dev=opts.max_dev)
+    t1 = time()
+    bias2 = iterative_sparse(sparse_data, bads=bads, iterations=opts.iterations,
+                             max_dev=opts.max_dev, log=opts.log)
+    t2 = time()
+
+    max_diff = max(abs(bias1[i] - bias2[i]) / bias1[i] for i in bias1)
+    print '  - dictionary implementation: %.2f sec' % (t1 - t0)
+    print '  - vectorized implementation: %.2f sec' % (t2 - t1)
+    print '  - maximum relative difference between biases: %g' % max_diff
+
+
+def get_options():
+    """
+    parse option from call
+    """
+    parser = ArgumentParser(
+        usage="%(prog)s [options] [--cfg CONFIG_PATH]")
+    parser.add_argument('--reads', dest='reads', metavar="PATH", required=True,
+                        help='''path to a TADbit-generated file with filtered
+                        reads''')
+    parser.add_argument('-r', '--resolution', dest='reso', metavar="INT",
+                        type=int, required=True, help='resolution')
+    parser.add_argument('--iterations', dest='iterations', metavar="INT",
+                        type=int, default=10,
+                        help='[%(default)s] number of iterations')
+    parser.add_argument('--max_dev', dest='max_dev', metavar="FLOAT",
+                        type=float, default=0.00001,
+                        help='[%(default)s] maximum deviation between rows')
+    parser.add_argument('--perc_zeros', dest='perc_zeros', metavar="FLOAT",
+                        type=float, default=95,
+                        help='[%(default)s] maximum percentage of zeroes per '
+                        'column')
+    parser.add_argument('--log', dest='log', metavar="PATH", default=None,
+                        help='path to write the convergence log')
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    exit(main())
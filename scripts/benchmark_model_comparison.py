@@ -0,0 +1,97 @@
+"""
+18 Oct 2026
+
+Compares the running time of the all-against-all comparison of models
+(number of equivalent positions, RMSD and dRMSD) done by the former
+single-threaded C wrapper and by the tiled comparison, in parallel, on
+random-walk models. Also measures the comparison of new models only, as
+done by cluster_models after adding models.
+
+The former wrapper superimposes the models in place, one comparison after
+the other, so the coordinates it compares drift with the order of the
+comparisons. Most scores agree at float32 rounding level, but a distance
+close to dcutoff may change the number of equivalent positions of a pair
+by one (with the default options, one pair out of 124750 has a score 1.2%
+different).
+
+"""
+
+from pytadbit.eqv_rms_drms          import rmsdRMSD_wrapper
+from pytadbit.utils.three_dim_stats import calc_eqv_rmsd_matrix
+from pytadbit.utils.three_dim_stats import eqv_rmsd_scores
+from argparse                       import ArgumentParser
+from time                           import time
+import numpy as np
+
+
+def main():
+    """
+    main function
+    """
+    opts = get_options()
+
+    rnd = np.random.RandomState(opts.seed)
+    models = []
+    for _ in xrange(opts.nmodels):
+        coords = np.cumsum(rnd.normal(0, 50, size=(opts.nloci, 3)), axis=0)
+        models.append({'x': coords[:, 0].tolist(), 'y': coords[:, 1].tolist(),
+                       'z': coords[:, 2].tolist()})
+    zeros = (True, ) * opts.nloci
+    print '%d models of %d particles' % (opts.nmodels, opts.nloci)
+
+    t0 = time()
+    old = rmsdRMSD_wrapper([m['x'][:] for m in models],
+                           [m['y'][:] for m in models],
+                           [m['z'][:] for m in models], zeros, opts.nloci,
+                           opts.dcutoff, range(opts.nmodels), opts.nmodels,
+                           0, 'score', 1)
+    print '  - single-threaded C wrapper: %.2f sec' % (time() - t0)
+    old = np.array([[old.get((i, j), 0.) for j in xrange(opts.nmodels)]
+                    for i in xrange(opts.nmodels)])
+
+    for n_cpus in sorted(set([1, opts.cpus])):
+        t0 = time()
+        stats = calc_eqv_rmsd_matrix(models, opts.nloci, zeros, opts.dcutoff,
+                                     n_cpus=n_cpus)
+        print '  - tiled comparison (%d CPUs): %.2f sec' % (n_cpus,
+                                                             time() - t0)
+    new = eqv_rmsd_scores(stats)
+    pairs = np.triu_indices(opts.nmodels, 1)
+    diff = np.abs(old - new)[pairs] / np.abs(old).max()
+    print '  - maximum relative difference between scores: %g' % (diff.max())
+    print ('    (%d of %d pairs differ by more than 1e-5, former wrapper ' +
+           'drifting with its in-place superimpositions)') % (
+        (diff > 1e-5).sum(), len(diff))
+
+    nnew = opts.nmodels / 10
+    stats[:, -nnew:] = np.nan
+    stats[:, :, -nnew:] = np.nan
+    t0 = time()
+    calc_eqv_rmsd_matrix(models, opts.nloci, zeros, opts.dcutoff,
+                         n_cpus=opts.cpus, stats=stats)
+    print '  - comparison of %d new models (%d CPUs): %.2f sec' % (
+        nnew, opts.cpus, time() - t0)
+
+
+def get_options():
+    """
+    parse option from call
+    """
+    parser = ArgumentParser(
+        usage="%(prog)s [options] [--cfg CONFIG_PATH]")
+    parser.add_argument('--nmodels', dest='nmodels', metavar="INT", type=int,
+                        default=500, help='[%(default)s] number of models')
+    parser.add_argument('--nloci', dest='nloci', metavar="INT", type=int,
+                        default=100, help='[%(default)s] number of particles')
+    parser.add_argument('--dcutoff', dest='dcutoff', metavar="INT", type=int,
+                        default=200, help='''[%(default)s] distance cutoff for
+                        equivalent positions''')
+    parser.add_argument('-C', '--cpus', dest='cpus', metavar="INT", type=int,
+                        default=1, help='[%(default)s] number of CPUs')
+    parser.add_argument('--seed', dest='seed', metavar="INT", type=int,
+                        default=1, help='[%(default)s] random seed')
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    exit(main())
@@ -0,0 +1,78 @@
+"""
+18 Oct 2026
+
+Compares the throughput of the IMP and NumPy backends used to generate 3D
+models, and the correlation of the resulting models with the input Hi-C
+data.
+
+"""
+
+from pytadbit                    import Chromosome
+from pytadbit.imp.imp_modelling  import IMP
+from argparse                    import ArgumentParser
+from time                        import time
+
+
+def main():
+    """
+    main function
+    """
+    opts = get_options()
+
+    crm = Chromosome(name='chr')
+    crm.add_experiment('exp', opts.reso, hic_data=opts.matrix, silent=True)
+    exp = crm.experiments[0]
+    exp.filter_columns(silent=True)
+    exp.normalize_hic(silent=True, factor=None)
+    config = {'kforce': 5, 'maxdist': opts.maxdist, 'scale': opts.scale,
+              'upfreq': opts.upfreq, 'lowfreq': opts.lowfreq}
+    print 'modelling %d particles (%d models, %d CPUs)' % (
+        opts.end - opts.beg + 1, opts.nmodels, opts.cpus)
+
+    backends = ['numpy'] + (['imp'] if IMP else [])
+    for backend in backends:
+        t0 = time()
+        models = exp.model_region(opts.beg, opts.end, n_models=opts.nmodels,
+                                  n_keep=opts.nmodels, n_cpus=opts.cpus,
+                                  config=config, backend=backend)
+        elapsed = time() - t0
+        corr = models.correlate_with_real_data(
+            cutoff=int(2 * opts.reso * opts.scale))[0]
+        print '  - %-5s: %.2f sec, %.2f models/sec/CPU (correlation: %.3f)' % (
+            backend, elapsed, opts.nmodels / elapsed / opts.cpus, corr)
+    if not IMP:
+        print '  - IMP not found, only the NumPy backend was run'
+
+
+def get_options():
+    """
+    parse option from call
+    """
+    parser = ArgumentParser(
+        usage="%(prog)s [options] [--cfg CONFIG_PATH]")
+    parser.add_argument('--matrix', dest='matrix', metavar="PATH",
+                        required=True, help='path to a Hi-C matrix')
+    parser.add_argument('-r', '--resolution', dest='reso', metavar="INT",
+                        type=int, required=True, help='resolution')
+    parser.add_argument('--beg', dest='beg', metavar="INT", type=int,
+                        required=True, help='first bin to model')
+    parser.add_argument('--end', dest='end', metavar="INT", type=int,
+                        required=True, help='last bin to model')
+    parser.add_argument('--nmodels', dest='nmodels', metavar="INT", type=int,
+                        default=20, help='[%(default)s] number of models')
+    parser.add_argument('--maxdist', dest='maxdist', metavar="INT", type=int,
+                        default=500, help='[%(default)s] maximum distance')
+    parser.add_argument('--upfreq', dest='upfreq', metavar="FLOAT",
+                        type=float, default=1., help='[%(default)s] upfreq')
+    parser.add_argument('--lowfreq', dest='lowfreq', metavar="FLOAT",
+                        type=float, default=-0.6,
+                        help='[%(default)s] lowfreq')
+    parser.add_argument('--scale', dest='scale', metavar="FLOAT", type=float,
+                        default=0.01, help='[%(default)s] scale')
+    parser.add_argument('-C', '--cpus', dest='cpus', metavar="INT", type=int,
+                        default=1, help='[%(default)s] number of CPUs')
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    exit(main())
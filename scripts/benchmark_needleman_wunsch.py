@@ -0,0 +1,81 @@
+"""
+18 Oct 2026
+
+Compares running time and results of the two implementations of the
+Needleman-Wunsch alignment of TAD boundaries (pure python and vectorized),
+and of the sorted and progressive multiple alignments, on random TADs.
+
+"""
+
+from pytadbit.boundary_aligner.globally import needleman_wunsch
+from pytadbit.boundary_aligner.globally import needleman_wunsch_loops
+from pytadbit.boundary_aligner.aligner  import align
+from argparse                           import ArgumentParser
+from time                               import time
+import numpy as np
+
+
+def main():
+    """
+    main function
+    """
+    opts = get_options()
+
+    rnd = np.random.RandomState(opts.seed)
+    # experiments share most of their boundaries, with some noise
+    template = np.cumsum(rnd.randint(5, 100, size=opts.tads))
+    tads = []
+    for _ in xrange(opts.experiments):
+        brks = template + rnd.randint(-2, 3, size=opts.tads)
+        brks = brks[rnd.random_sample(opts.tads) > 0.1]
+        tads.append(sorted(set((brks * opts.reso).tolist())))
+    print '%d experiments with ~%d TADs each' % (opts.experiments,
+                                                 opts.tads * 0.9)
+
+    print 'Pairwise alignments (%d)' % (opts.experiments - 1)
+    t0 = time()
+    alis1 = [needleman_wunsch_loops(tads1, tads2, max_dist=opts.max_dist)
+             for tads1, tads2 in zip(tads, tads[1:])]
+    t1 = time()
+    alis2 = [needleman_wunsch(tads1, tads2, max_dist=opts.max_dist)
+             for tads1, tads2 in zip(tads, tads[1:])]
+    t2 = time()
+    print '  - python implementation    : %.2f sec' % (t1 - t0)
+    print '  - vectorized implementation: %.2f sec' % (t2 - t1)
+    print '  - identical alignments: %s' % (alis1 == alis2)
+
+    print 'Multiple alignment'
+    for progressive in (False, True):
+        t0 = time()
+        _, score, _, _ = align(tads, method='global', max_dist=opts.max_dist,
+                               progressive=progressive)
+        print '  - %-11s: %.2f sec (score: %.2f)' % (
+            'progressive' if progressive else 'sorted', time() - t0, score)
+
+
+def get_options():
+    """
+    parse option from call
+    """
+    parser = ArgumentParser(
+        usage="%(prog)s [options] [--cfg CONFIG_PATH]")
+    parser.add_argument('--experiments', dest='experiments', metavar="INT",
+                        type=int, default=12,
+                        help='[%(default)s] number of experiments to align')
+    parser.add_argument('--tads', dest='tads', metavar="INT", type=int,
+                        default=1000,
+                        help='[%(default)s] number of TADs per experiment')
+    parser.add_argument('-r', '--resolution', dest='reso', metavar="INT",
+                        type=int, default=20000,
+                        help='[%(default)s] resolution')
+    parser.add_argument('--max_dist', dest='max_dist', metavar="INT",
+                        type=int, default=100000,
+                        help='''[%(default)s] maximum distance between two
+                        aligned boundaries''')
+    parser.add_argument('--seed', dest='seed', metavar="INT", type=int,
+                        default=1, help='[%(default)s] random seed')
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    exit(main())
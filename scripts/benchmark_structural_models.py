@@ -0,0 +1,70 @@
+"""
+18 Oct 2026
+
+Measures the running time of the per-particle analyses of StructuralModels
+(contact matrix, interactions, density, distances and angles) on random-walk
+models.
+
+"""
+
+from pytadbit.imp.structuralmodels import StructuralModels
+from pytadbit.imp.impmodel         import IMPmodel
+from argparse                      import ArgumentParser
+from time                          import time
+import numpy as np
+
+
+def main():
+    """
+    main function
+    """
+    opts = get_options()
+
+    rnd = np.random.RandomState(opts.seed)
+    models = {}
+    for i in xrange(opts.nmodels):
+        coords = np.cumsum(rnd.normal(0, 50, size=(opts.nloci, 3)), axis=0)
+        models[i] = IMPmodel({'log_objfun' : [], 'objfun': float(i),
+                              'x'          : coords[:, 0].tolist(),
+                              'y'          : coords[:, 1].tolist(),
+                              'z'          : coords[:, 2].tolist(),
+                              'radius'     : 25, 'cluster': 'Singleton',
+                              'rand_init'  : str(i + 1), 'index': i})
+    models = StructuralModels(opts.nloci, models, {}, 1000,
+                              zeros=[True] * opts.nloci,
+                              config={'scale': 0.05})
+    print '%d models of %d particles' % (opts.nmodels, opts.nloci)
+
+    allm = range(opts.nmodels)
+    analyses = [
+        ('contact matrix', lambda: models.get_contact_matrix(cutoff=100)),
+        ('interactions', lambda: models._get_interactions(allm, 100)),
+        ('density', lambda: models._get_density(allm, 1, False)),
+        ('density (mass center)', lambda: models._get_density(allm, 3, True)),
+        ('median distance', lambda: models.median_3d_dist(
+            1, opts.nloci, plot=False)),
+        ('walking angle', lambda: models.walking_angle(plot=False)),
+        ('walking dihedral', lambda: models.walking_dihedral(plot=False))]
+    for name, func in analyses:
+        t0 = time()
+        func()
+        print '  - %-22s: %.2f sec' % (name, time() - t0)
+
+
+def get_options():
+    """
+    parse option from call
+    """
+    parser = ArgumentParser(
+        usage="%(prog)s [options] [--cfg CONFIG_PATH]")
+    parser.add_argument('--nmodels', dest='nmodels', metavar="INT", type=int,
+                        default=1000, help='[%(default)s] number of models')
+    parser.add_argument('--nloci', dest='nloci', metavar="INT", type=int,
+                        default=1000, help='[%(default)s] number of particles')
+    parser.add_argument('--seed', dest='seed', metavar="INT", type=int,
+                        default=1, help='[%(default)s] random seed')
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    exit(main())
@@ -0,0 +1,91 @@
+"""
+18 Oct 2026
+
+Measures the running time and the peak memory of the banded TADbit core
+(_tadbit_band_wrapper) on random matrices of increasing size, for a fixed
+band width.
+
+Each segmentation is run in a separate process, and the memory reported is
+the increase of its peak resident size. The slices are stored in banded form
+(O(n x band)), only the back pointers of the dynamic programming, one per bin
+and number of breaks (at most n / 5), grow faster (one byte each with a band
+smaller than 255 bins).
+
+"""
+
+from pytadbit.tadbit_py import _tadbit_band_wrapper
+from multiprocessing    import Process, Queue
+from argparse           import ArgumentParser
+from resource           import getrusage, RUSAGE_SELF
+from time               import time
+import numpy as np
+
+
+def random_band(size, band, tad_size, seed):
+    """
+    Random diagonal band (see BAND_IDX in tadbit.h) with a power-law decay
+    and TADs of about tad_size bins.
+    """
+    rnd = np.random.RandomState(seed)
+    dist = np.arange(band + 1)
+    obs = rnd.poisson(1000. / (dist + 1) ** 1.1, size=(size, band + 1))
+    tads = np.arange(size) // tad_size
+    within = tads[:, None] == tads[np.minimum(np.arange(size)[:, None] + dist,
+                                              size - 1)]
+    obs[within] += rnd.poisson(20, size=within.sum())
+    return np.ascontiguousarray(obs, dtype=np.int32)
+
+
+def segment(size, band, tad_size, seed, queue):
+    """
+    Runs TADbit on a random band, and returns the time and the increase of
+    the peak resident size (in Mb).
+    """
+    obs = random_band(size, band, tad_size, seed)
+    mem0 = getrusage(RUSAGE_SELF).ru_maxrss
+    t0 = time()
+    _, nbks, _, _, _, bkpts = _tadbit_band_wrapper(
+        [obs], tuple([0] * size), size, 1, band, 1, 0, band, 0, 0)
+    queue.put((time() - t0, (getrusage(RUSAGE_SELF).ru_maxrss - mem0) / 1024.,
+               nbks + 1))
+
+
+def main():
+    """
+    main function
+    """
+    opts = get_options()
+
+    print '%6s %10s %10s %12s %8s' % ('bins', 'time (s)', 'peak (Mb)',
+                                     'Mb/1000 bins', 'TADs')
+    for size in opts.sizes:
+        queue = Queue()
+        proc = Process(target=segment,
+                       args=(size, opts.band, opts.tad_size, opts.seed, queue))
+        proc.start()
+        elapsed, mem, ntads = queue.get()
+        proc.join()
+        print '%6d %10.2f %10.1f %12.2f %8d' % (size, elapsed, mem,
+                                                mem / size * 1000, ntads)
+
+
+def get_options():
+    """
+    parse option from call
+    """
+    parser = ArgumentParser(
+        usage="%(prog)s [options]")
+    parser.add_argument('--sizes', dest='sizes', type=int, nargs='+',
+                        default=[1000, 2000, 4000, 8000],
+                        help='number of bins of the matrices')
+    parser.add_argument('--band', dest='band', type=int, default=20,
+                        help='width of the band (maximum TAD size)')
+    parser.add_argument('--tad_size', dest='tad_size', type=int, default=12,
+                        help='size of the TADs in the random matrices')
+    parser.add_argument('--seed', dest='seed', type=int, default=1,
+                        help='random seed')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    exit(main())
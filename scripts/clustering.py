@@ -36,7 +36,7 @@ def main():
     paint_clustering(results, clusters, num, test_chr, tad_names)
 
 
-def get_distances(tad_matrices, max_num_v=8, n_cpus=8):
+def get_distances(tad_matrices, max_num_v=8, n_cpus=8, beam=None):
     """
     Calculates distances between all pair of tads in the chromosome.
     several CPUs can be used.
@@ -45,6 +45,9 @@ def get_distances(tad_matrices, max_num_v=8, n_cpus=8):
        more the slower... but the better the approximation). Number higher than
        15 should not be considered.
     :param 4 n_cpus: number of CPUs to use
+    :param None beam: number of combinations of signs of the eigenvectors
+       kept at each step (see
+       :func:`pytadbit.tad_clustering.tad_cmo.optimal_cmo`)
     
     :returns: a dict of distances
     """
@@ -57,7 +60,8 @@ def get_distances(tad_matrices, max_num_v=8, n_cpus=8):
         for j in xrange(i+1, num):
             jobs[(i, j)] = pool.apply_async(
                 optimal_cmo, args=(tad_matrices[i], tad_matrices[j]),
-                kwds={'max_num_v': max_num_v, 'method': 'frobenius'})
+                kwds={'max_num_v': max_num_v, 'method': 'frobenius',
+                      'beam': beam})
     pool.close()
     pool.join()
     for i in xrange(num):
@@ -191,25 +191,122 @@ static PyObject* rmsdRMSD_wrapper(PyObject* self, PyObject* args)
   }
 // cout << "START5" << endl << flush;
   delete[] xyzn;
-// cout << "START5" << endl << flush;
-  Py_DECREF(py_xs);
-// cout << "START5" << endl << flush;
-  Py_DECREF(py_ys);
-  Py_DECREF(py_zs);
-  Py_DECREF(py_models);
-  Py_CLEAR(py_xs);
-  Py_CLEAR(py_ys);
-  Py_CLEAR(py_zs);
-  Py_CLEAR(py_models);
   
   // give it to me
   return py_result;
 }
  
+/* The function doc string */
+PyDoc_STRVAR(rmsdRMSD_pairs_wrapper__doc__,
+"From lists of x, y and z coordinates of a group of models, and a given \n\
+threshold (nm), return the number of equivalent positions, the RMSD and the\n\
+dRMSD of each given pair of models. Each pair is aligned on a copy of the \n\
+coordinates, and the comparisons are done without holding the GIL.\n\
+   :param xs: list of lists of x coordinates, one per model.\n\
+   :param ys: list of lists of y coordinates, one per model.\n\
+   :param zs: list of lists of z coordinates, one per model.\n\
+   :param zeros: tuple of True/False representing particles to skip\n\
+   :param size: number of particles per model\n\
+   :param dcutoff: distance cutoff to consider 2 particles as equivalent \n\
+      in position (nm)\n\
+   :param idx1: list with the index of the first model of each pair\n\
+   :param idx2: list with the index of the second model of each pair\n\
+\n\
+   :returns: three lists with the number of equivalent positions, the RMSD \n\
+      and the dRMSD of each pair.\n\
+");
+
+static PyObject* rmsdRMSD_pairs_wrapper(PyObject* self, PyObject* args)
+{
+  PyObject *py_xs;
+  PyObject *py_ys;
+  PyObject *py_zs;
+  PyObject *py_zeros;
+  PyObject *py_idx1;
+  PyObject *py_idx2;
+  int size;
+  float thres;
+
+  if (!PyArg_ParseTuple(args, "OOOOifOO", &py_xs, &py_ys, &py_zs, &py_zeros,
+			&size, &thres, &py_idx1, &py_idx2))
+    return NULL;
+
+  int nmodels = PyList_Size(py_xs);
+  int npairs  = PyList_Size(py_idx1);
+  int i;
+  int j;
+  int k;
+  int *zeros = new int[size];
+  int *idx1  = new int[npairs];
+  int *idx2  = new int[npairs];
+  int *eqvs  = new int[npairs];
+  float *rmsds  = new float[npairs];
+  float *drmsds = new float[npairs];
+  float *coords = new float[nmodels * size * 3];
+  float *bufA   = new float[size * 3];
+  float *bufB   = new float[size * 3];
+  float **xyzA  = new float *[size];
+  float **xyzB  = new float *[size];
+
+  for (i=0; i<size; i++){
+    zeros[i] = PyObject_IsTrue(PyTuple_GET_ITEM(py_zeros, i));
+    xyzA[i] = bufA + 3 * i;
+    xyzB[i] = bufB + 3 * i;
+  }
+  for (j=0; j<nmodels; j++){
+    for (i=0; i<size; i++){
+      k = 3 * (j * size + i);
+      coords[k    ] = PyFloat_AS_DOUBLE(PyList_GET_ITEM(PyList_GET_ITEM(py_xs, j), i));
+      coords[k + 1] = PyFloat_AS_DOUBLE(PyList_GET_ITEM(PyList_GET_ITEM(py_ys, j), i));
+      coords[k + 2] = PyFloat_AS_DOUBLE(PyList_GET_ITEM(PyList_GET_ITEM(py_zs, j), i));
+    }
+  }
+  for (k=0; k<npairs; k++){
+    idx1[k] = PyInt_AsLong(PyList_GET_ITEM(py_idx1, k));
+    idx2[k] = PyInt_AsLong(PyList_GET_ITEM(py_idx2, k));
+  }
+
+  Py_BEGIN_ALLOW_THREADS
+  for (k=0; k<npairs; k++){
+    // the alignment modifies the coordinates
+    memcpy(bufA, coords + 3 * idx1[k] * size, 3 * size * sizeof(float));
+    memcpy(bufB, coords + 3 * idx2[k] * size, 3 * size * sizeof(float));
+    rmsdRMSD(xyzA, xyzB, zeros, size, thres, eqvs[k], rmsds[k], drmsds[k]);
+  }
+  Py_END_ALLOW_THREADS
+
+  PyObject * py_eqvs   = PyList_New(npairs);
+  PyObject * py_rmsds  = PyList_New(npairs);
+  PyObject * py_drmsds = PyList_New(npairs);
+  for (k=0; k<npairs; k++){
+    PyList_SET_ITEM(py_eqvs  , k, PyInt_FromLong(eqvs[k]));
+    PyList_SET_ITEM(py_rmsds , k, PyFloat_FromDouble(rmsds[k]));
+    PyList_SET_ITEM(py_drmsds, k, PyFloat_FromDouble(drmsds[k]));
+  }
+
+  // free
+  delete[] zeros;
+  delete[] idx1;
+  delete[] idx2;
+  delete[] eqvs;
+  delete[] rmsds;
+  delete[] drmsds;
+  delete[] coords;
+  delete[] bufA;
+  delete[] bufB;
+  delete[] xyzA;
+  delete[] xyzB;
+
+  // give it to me
+  return Py_BuildValue("NNN", py_eqvs, py_rmsds, py_drmsds);
+}
+
 static PyMethodDef Eqv_rms_drmsMethods[] =
   {
     {"rmsdRMSD_wrapper", rmsdRMSD_wrapper, METH_VARARGS, 
     rmsdRMSD_wrapper__doc__},
+    {"rmsdRMSD_pairs_wrapper", rmsdRMSD_pairs_wrapper, METH_VARARGS, 
+    rmsdRMSD_pairs_wrapper__doc__},
     {NULL, NULL, 0, NULL}
   };
 
@@ -3,7 +3,6 @@
 
 // Global variables. //
 
-int *_cache_index;
 int _max_cache_index;
 int n_processed;              // Number of slices processed so far.
 int n_to_process;             // Total number of slices to process.
@@ -88,10 +87,55 @@ destroy_tadbit_output(
 }
 
 
+// Bounds of the rows of the column 'j' that can be within the band.
+static inline int
+band_low(
+  const int i_low,
+  const int j,
+  const int band
+){
+   return j-band > i_low ? j-band : i_low;
+}
+
+static inline int
+band_high(
+  const int i_high,
+  const int j,
+  const int band
+){
+   return j+band+1 < i_high ? j+band+1 : i_high;
+}
+
+// Back pointers of 'DPwalk' stored as distances on 'size' bytes
+// (0 if the back pointer was not updated).
+static inline int
+get_back(
+  const unsigned char *back,
+  const long int pos,
+  const int size
+){
+   int k;
+   int dist = 0;
+   for (k = 0 ; k < size ; k++) dist |= back[pos*size+k] << (8*k);
+   return dist;
+}
+
+static inline void
+set_back(
+  unsigned char *back,
+  const long int pos,
+  const int size,
+  const int dist
+){
+   int k;
+   for (k = 0 ; k < size ; k++) back[pos*size+k] = (dist >> (8*k)) & 0xff;
+}
+
 void
 fg(
   // input //
   const int    n,
+  const int    band,
   const int    i_,
   const int    _i,
   const int    j_,
@@ -115,8 +159,8 @@ fg(
 //   cycles.                                                            
 //                                                                      
 // ARGUMENTS:                                                           
-//   See the function 'll' for the description of 'n', 'i_', '_i',      
-//      'j_', '_j', 'diag', 'k', 'dp', and 'w'.
+//   See the function 'll' for the description of 'n', 'band', 'i_',    
+//      '_i', 'j_', '_j', 'diag', 'k', 'dp', and 'w'.
 //   'a': parameter 'a' of the Poisson regression (see 'poiss_reg').    
 //   'b': parameter 'b' of the Poisson regression (see 'poiss_reg').    
 //   'da': computed differential of 'a' (see 'poiss_reg').              
@@ -152,16 +196,21 @@ fg(
 
    for (j = j_low ; j < j_high ; j++) {
       i_high = diag ? j : _i+1;
-      for (i = i_low ; i < i_high ; i++) {
+      // Column 'j' of the counts.
+      const int *kj = k + FULL_BAND_IDX(0, j, band);
+      for (i = band_low(i_low, j, band) ; i < band_high(i_high, j, band) ; i++) {
+         // Distance between bins (in the original matrix). Cells out
+         // of the band are not part of the model.
+         index = abs(dp[i]-dp[j]);
+         if (index > band) continue;
          // Retrieve value of the exponential from cache.
-         index = _cache_index[i+j*n];
          if (c[index] != c[index]) {
             //c[index] = exp(a+da+(b+db)*d[i+j*n]);
         	//c[index] = exp(a+da+(b+db)*log(abs(dp[i]-dp[j])));
         	c[index] = exp(a+da+(b+db)*fastlog(abs(dp[i]-dp[j])));
          }
          //tmp  =  w[i+j*n] * c[index] - k[i+j*n];
-         tmp  =  w[i]*w[j] * c[index] - k[i+j*n];
+         tmp  =  w[i]*w[j] * c[index] - kj[i];
          *f  +=  tmp;
          //*g  +=  tmp * d[i+j*n];
          //*g  +=  tmp * log(abs(dp[i]-dp[j]));
@@ -176,6 +225,7 @@ fg(
 double
 ll(
   const int    n,
+  const int    band,
   const int    i_,
   const int    _i,
   const int    j_,
@@ -197,15 +247,17 @@ ll(
 //                                                                      
 // ARGUMENTS:                                                           
 //   'n': row/column number of the counts.                              
+//   'band': maximum distance between bins (in the original matrix) of  
+//      the cells used in the model ('n-1' to use all cells).           
 //   'i_': first value of index i (row).                                
 //   '_i': last value of index i (row).                                 
 //   'j_': first value of index j (column).                             
 //   '_j': last value of index j (column).                              
 //   'diag': whether the block is half-diagonal (middle block).         
-//   'k': raw hiC counts.                                               
+//   'k': raw hiC counts (full band, see 'FULL_BAND_IDX').              
 //   'dp': array with the index of columns that are not removed.
 //   'w': array of row and column (by symmetry) sums. Weights measuring hiC bias are w[i]*w[j]
-//   'lg': log-gamma terms.                                             
+//   'lg': log-gamma terms (full band).                                 
 //   'c': address of an array of double for caching.                    
 //                                                                      
 // RETURN:                                                              
@@ -244,7 +296,7 @@ ll(
    // See the comment about 'tmp' in 'fg'.
    long double tmp; 
 
-   fg(n, i_, _i, j_, _j, diag, k, dp, w, a, b, da, db, c, &f, &g);
+   fg(n, band, i_, _i, j_, _j, diag, k, dp, w, a, b, da, db, c, &f, &g);
    //fg(n, i_, _i, j_, _j, diag, k, w, a, b, da, db, c, &f, &g);
 	  if((j_+_j*n)==40) {
 	          	 printf("lilmat");
@@ -262,8 +314,9 @@ ll(
 
       for (j = j_low ; j < j_high ; j++) {
          i_high = diag ? j : _i+1;
-         for (i = i_low ; i < i_high ; i++) {
-            index = _cache_index[i+j*n];
+         for (i = band_low(i_low, j, band) ; i < band_high(i_high, j, band) ; i++) {
+            index = abs(dp[i]-dp[j]);
+            if (index > band) continue;
             // Retrieve value of the exponential from cache.
             if (c[index] != c[index]) { // ERROR.
                //c[index] = exp(a+b*d[i+j*n]);
@@ -289,7 +342,7 @@ ll(
       da = (f*dgdb - g*dfdb) / denom;
       db = (g*dfda - f*dgda) / denom;
 
-      fg(n, i_, _i, j_, _j, diag, k, dp, w, a, b, da, db, c, &f, &g);
+      fg(n, band, i_, _i, j_, _j, diag, k, dp, w, a, b, da, db, c, &f, &g);
       //fg(n, i_, _i, j_, _j, diag, k, w, a, b, da, db, c, &f, &g);
 
       // Traceback if we are not going down the gradient. Cut the
@@ -298,7 +351,7 @@ ll(
       for (i = 0 ; (i < 20) && (f*f + g*g > oldgrad) ; i++) {
          da /= 2;
          db /= 2;
-         fg(n, i_, _i, j_, _j, diag, k, dp, w, a, b, da, db, c, &f, &g);
+         fg(n, band, i_, _i, j_, _j, diag, k, dp, w, a, b, da, db, c, &f, &g);
          //fg(n, i_, _i, j_, _j, diag, k, w, a, b, da, db, c, &f, &g);
       }
 
@@ -320,12 +373,15 @@ ll(
    // No need to reset the cache.
    for (j = j_low ; j < j_high ; j++) {
       i_high = diag ? j : _i+1;
-      for (i = i_low ; i < i_high ; i++) {
-         index = _cache_index[i+j*n];
+      const int *kj = k + FULL_BAND_IDX(0, j, band);
+      const double *lgj = lg + FULL_BAND_IDX(0, j, band);
+      for (i = band_low(i_low, j, band) ; i < band_high(i_high, j, band) ; i++) {
+         index = abs(dp[i]-dp[j]);
+         if (index > band) continue;
          // Retrieve value of the exponential from cache.
          //llik += c[index] + k[i+j*n]*(a+b*d[i+j*n]) - lg[i+j*n];
          //llik += c[index] + k[i+j*n]*(a+b*log(abs(dp[i]-dp[j]))) - lg[i+j*n];
-         llik += c[index] + k[i+j*n]*(a+b*fastlog(abs(dp[i]-dp[j]))) - lg[i+j*n];
+         llik += c[index] + kj[i]*(a+b*fastlog(abs(dp[i]-dp[j]))) - lgj[i];
 
       }
    }
@@ -349,17 +405,18 @@ fill_DP(
 //   'void *'                                                           
 //                                                                      
 // SIDE-EFFECTS:                                                        
-//   Update 'old_llik', 'new_llik' and 'new_bkpt_list' in place.        
+//   Update 'old_llik', 'new_llik' and 'back' in place.                 
 //                                                                      
 
    dpworker_arg *myargs = (dpworker_arg *) arg;
    const int n = myargs->n;
+   const int band = myargs->band;
    const double *llikmat = (const double *) myargs->llikmat;
    double *old_llik = (double *) myargs->old_llik;
    double *new_llik = (double *) myargs->new_llik;
    const int nbreaks = myargs->nbreaks;
-   int *new_bkpt_list = (int *) myargs->new_bkpt_list;
-   const int *old_bkpt_list = (const int *) myargs->old_bkpt_list;
+   const int back_size = myargs->back_size;
+   unsigned char *back = myargs->back;
 
    int i;
 
@@ -378,25 +435,22 @@ fill_DP(
       new_llik[j] = -INFINITY;
       int new_bkpt = -1;
 
-      // Cycle over start point 'i'.
-      for (i = 3 * nbreaks ; i < j-3 ; i++) {
+      // Cycle over start point 'i' (slices longer than 'band' are
+      // not stored in 'llikmat').
+      int i_low = j-band > 3 * nbreaks ? j-band : 3 * nbreaks;
+      for (i = i_low ; i < j-3 ; i++) {
 
          // If NAN the following condition evaluates to false.
-         double tmp = old_llik[i-1] + llikmat[i+j*n];
+         double tmp = old_llik[i-1] + llikmat[BAND_IDX(i,j,band)];
          if (tmp > new_llik[j]) {
             new_llik[j] = tmp;
             new_bkpt = i-1;
          }
       }
 
-      // Update breakpoint list (skip if log-lik is undefined).
+      // Update back pointer (skip if log-lik is undefined).
       // No need to use mutex because 'j' is different for every thread.
-      if (new_llik[j] > -INFINITY) {
-         for (i = 0 ; i < n ; i++) {
-            new_bkpt_list[j+i*n] = old_bkpt_list[new_bkpt+i*n];
-         }
-         new_bkpt_list[j+new_bkpt*n] = 1;
-      }
+      if (new_llik[j] > -INFINITY) set_back(back, j, back_size, j-new_bkpt);
    }
 
    return NULL;
@@ -408,23 +462,27 @@ DPwalk(
   // input //
   const double *llikmat,
   const int n,
+  const int band,
   const int MAXBREAKS,
   int n_threads,
   // output //
   double *mllik,
-  int *breakpoints
+  unsigned char *breakpoints
 ){
 // SYNOPSIS:                                                            
 //   Dynamic programming algorithm to compute the most likely position  
 //   of breakpoints given a matrix of slice maximum log-likelihood.     
 //                                                                      
 // PARAMETERS:                                                          
-//   '*llikmat': matrix of maximum log-likelihood values.               
+//   '*llikmat': matrix of maximum log-likelihood values (in banded     
+//        form, see 'BAND_IDX').                                        
 //   'n': row/col number of 'llikmat'.                                  
+//   'band': width of the band of 'llikmat'.                            
 //   'MAXBREAKS': The maximum number of breakpoints.                    
 //        -- output arguments --                                        
 //   '*mllik': maximum log-likelihood of the segmentations.             
-//   '*breakpoints': optimal breakpoints per number of breaks.          
+//   '*breakpoints': optimal breakpoints per number of breaks (bits,    
+//        see 'GET_BKPT').                                              
 //                                                                      
 // RETURN:                                                              
 //   'void'                                                             
@@ -434,26 +492,30 @@ DPwalk(
 //                                                                      
 
    int i;
+   int j;
+   int l;
    int nbreaks;
+   long int pos;
 
    double new_llik[n];
    double old_llik[n];
 
-   // Breakpoint lists. The first index (row) is the end of the slice,
-   // the second is 1 if this position is an end (breakpoint).
-   // These must be allocated from the heap because 'n' can be large.
-   int *new_bkpt_list = (int *) malloc(n*n * sizeof(int));
-   int *old_bkpt_list = (int *) malloc(n*n * sizeof(int));
+   // Back pointers. For a number of breaks (row) and the end of a
+   // slice (column), the distance to the previous breakpoint, or 0 if
+   // it was not updated (in which case the breakpoints are the same as
+   // with one break less). The distance is at most 'band+1', so it is
+   // stored on as few bytes as possible.
+   // This must be allocated from the heap because 'n' can be large.
+   const int back_size = band < 255 ? 1 : band < 65535 ? 2 : 4;
+   unsigned char *back = (unsigned char *)
+      calloc((long int) n*MAXBREAKS*back_size, sizeof(unsigned char));
 
    // Initializations.
-   // 'breakpoints' is a 'n' x 'MAXBREAKS' array. The first index (row)
-   // is 1 if there is a breakpoint at that location, the second index
-   // (column) is the number of breakpoints.
-   for (i = 0 ; i < n*MAXBREAKS ; i++) breakpoints[i] = 0;
-
-   for (i = 0 ; i < n*n ; i++) {
-      new_bkpt_list[i] = 0;
-      old_bkpt_list[i] = 0;
+   // 'breakpoints' is a 'n' x 'MAXBREAKS' array of bits. The first
+   // index (row) is 1 if there is a breakpoint at that location, the
+   // second index (column) is the number of breakpoints.
+   for (pos = 0 ; pos < (long int) n*MAXBREAKS ; pos++) {
+      CLEAR_BKPT(breakpoints, pos);
    }
 
    for (i = 0 ; i < MAXBREAKS ; i++) {
@@ -463,7 +525,7 @@ DPwalk(
    // Initialize 'old_llik' to the first line of 'llikmat' containing
    // the log-likelihood of segments starting at index 0.
    for (i = 0 ; i < n ; i++) {
-      old_llik[i] = llikmat[i*n];
+      old_llik[i] = i > band ? NAN : llikmat[BAND_IDX(0,i,band)];
       new_llik[i] = -INFINITY;
    }
 
@@ -475,12 +537,13 @@ DPwalk(
 
    dpworker_arg arg = {
       .n = n,
+      .band = band,
       .llikmat = llikmat,
       .old_llik = old_llik,
       .new_llik = new_llik,
       .nbreaks = 1,
-      .new_bkpt_list = new_bkpt_list,
-      .old_bkpt_list = old_bkpt_list,
+      .back_size = back_size,
+      .back = back,
    };
 
    pthread_t *tid = (pthread_t *) malloc(n_threads * sizeof(pthread_t));
@@ -489,10 +552,7 @@ DPwalk(
    for (nbreaks = 1 ; nbreaks < MAXBREAKS ; nbreaks++) {
 
       arg.nbreaks = nbreaks;
-      // Update breakpoint lists.
-      for (i = 0 ; i < n*n ; i++) {
-         old_bkpt_list[i] = new_bkpt_list[i];
-      }
+      arg.back = back + (long int) nbreaks*n*back_size;
       taskQ_i = 3 * nbreaks + 2;
 
       for (i = 0 ; i < n_threads ; i++) tid[i] = 0;
@@ -512,17 +572,22 @@ DPwalk(
       // Update full log-likelihoods.
       mllik[nbreaks] = new_llik[n-1];
 
-      // Record breakpoints.
       for (i = 0 ; i < n ; i++) {
          old_llik[i] = new_llik[i];
-         breakpoints[i+nbreaks*n] = new_bkpt_list[n-1+i*n];
+      }
+
+      // Record breakpoints (follow back pointers from the end).
+      for (l = nbreaks, j = n-1 ; l > 0 ; l--) {
+         int dist = get_back(back, j + (long int) l*n, back_size);
+         if (!dist) continue;
+         j -= dist;
+         SET_BKPT(breakpoints, j + (long int) nbreaks*n);
       }
 
    }
 
    free(tid);
-   free(new_bkpt_list);
-   free(old_bkpt_list);
+   free(back);
 
    return;
 
@@ -536,8 +601,9 @@ fill_llikmat(
 //   Compute the log-likelihood of the slices. The element (i,j) of     
 //   the matrix 'llikmat' will contain the log-likelihood  of the       
 //   slice starting at i and ending at j. the matrix is initialized     
-//   with nan because not all elements will be computed. The lower      
-//   triangular part is left out.                                       
+//   with nan because not all elements will be computed. The matrix     
+//   is stored in banded form (see 'BAND_IDX'), slices spanning more    
+//   than 'band' bins of the original matrix are left out.              
 //                                                                      
 // PARAMETERS:                                                          
 //   'arg': thread arguments (see header file for definition).          
@@ -552,6 +618,7 @@ fill_llikmat(
    llworker_arg *myargs = (llworker_arg *) arg;
    const int n = myargs->n;
    const int m = myargs->m;
+   const int band = myargs->band;
    const int **k = (const int **) myargs->k;
    //const double *d = (const double*) myargs->d;
    const int *dp = (const int*) myargs->dp;
@@ -565,22 +632,23 @@ fill_llikmat(
    int j;
    int l;
 
-   // Cache to speed up computation. Get the max of '_cache_index'
-   // in order to allocate the right size.
+   // Cache to speed up computation. The cache is indexed by the
+   // distance between bins, which is at most 'band'.
    double *c= (double *) malloc(_max_cache_index * sizeof(double));
    for (i = 0 ; i < _max_cache_index ; i++) c[i] = 0.0;
 
    int job_index;
+   const int n_jobs = n*(band+1);
    
    // Break out of the loop when task queue is empty.
    while (1) {
 
       pthread_mutex_lock(&tadbit_lock);
-      while ((taskQ_i < n*n) && (skip[taskQ_i] > 0)) {
+      while ((taskQ_i < n_jobs) && (skip[taskQ_i] > 0)) {
          // Fast forward to the next job.
          taskQ_i++;
       }
-      if (taskQ_i >= n*n) {
+      if (taskQ_i >= n_jobs) {
          // Task queue is empty. Exit loop and return
          pthread_mutex_unlock(&tadbit_lock);
          break;
@@ -590,8 +658,11 @@ fill_llikmat(
       pthread_mutex_unlock(&tadbit_lock);
 
       // Compute the log-likelihood of slice '(i,j)'.
-      i = job_index % n;
-      j = job_index / n;
+      i = job_index / (band+1);
+      j = i + job_index % (band+1);
+
+      // Slices out of the matrix or wider than the band.
+      if ((j > n-1) || (dp[j]-dp[i] > band)) continue;
 
       // Make sure that slices have minimum width 3.
       int cornered = (i == 1) || (i == 2) || (j == n-2) || (j == n-3);
@@ -599,13 +670,13 @@ fill_llikmat(
       if (cornered || slice_too_thin) continue;
 
       // Distinct parts of the array, no lock needed.
-      llikmat[i+j*n] = 0.0;
+      llikmat[job_index] = 0.0;
       for (l = 0 ; l < m ; l++) {
          // LABEL: slice ll summation.
-         llikmat[i+j*n] +=
-            ll(n,   0, i-1, i, j, 0, k[l], dp, w[l], lg[l], c) / 2 +
-        	ll(n,   i,   j, i, j, 1, k[l], dp, w[l], lg[l], c) +
-        	ll(n, j+1, n-1, i, j, 0, k[l], dp, w[l], lg[l], c) / 2;
+         llikmat[job_index] +=
+            ll(n, band,   0, i-1, i, j, 0, k[l], dp, w[l], lg[l], c) / 2 +
+        	ll(n, band,   i,   j, i, j, 1, k[l], dp, w[l], lg[l], c) +
+        	ll(n, band, j+1, n-1, i, j, 0, k[l], dp, w[l], lg[l], c) / 2;
             //ll(n,   0, i-1, i, j, 0, k[l], d, w[l], lg[l], c) / 2 +
             //ll(n,   i,   j, i, j, 1, k[l], d, w[l], lg[l], c) +
             //ll(n, j+1, n-1, i, j, 0, k[l], d, w[l], lg[l], c) / 2;
@@ -630,16 +701,18 @@ allocate_heur_job(
   char *skip,
   const int i0,
   const int j0,
-  const int n
+  const int n,
+  const int band
 ){
 // SYNOPSIS:                                                            
 //   Create or update thread jobs (used in pre-heuristic).
 //                                                                      
 // PARAMETERS:                                                          
-//   'skip': the job matrix to update in place.                         
+//   'skip': the job matrix to update in place (in banded form).        
 //   'i0': start position of the approximate TAD.                       
 //   'j0': end position of the approximate TAD.                         
 //   'n': number of rows/columns of the hiC matrix (or 'skip').         
+//   'band': width of the band of 'skip'.                               
 //                                                                      
 // RETURN:                                                              
 //   'void'                                                             
@@ -650,20 +723,31 @@ allocate_heur_job(
 
    int i;
    int j;
+   long int pos;
 
    for (j = j0-2 ; j < j0+3 ; j++)
-   for (i = i0-2 ; i < i0+3 ; i++)
-      if ((i+j*n > 0) && (i+j*n < n*n)) skip[i+j*n] = 0;
+   for (i = i0-2 ; i < i0+3 ; i++) {
+      // Positions are taken as in the full 'n' x 'n' matrix, so
+      // that rows out of the matrix wrap to the next column.
+      pos = i + (long int) j*n;
+      if ((pos > 0) && (pos < (long int) n*n)) {
+         int ii = pos % n;
+         int jj = pos / n;
+         if ((jj >= ii) && (jj-ii <= band))
+            skip[BAND_IDX(ii,jj,band)] = 0;
+      }
+   }
 
 }
 
 void
 allocate_new_jobs(
   char *skip,
-  const int *bkpts,
+  const unsigned char *bkpts,
   const int MAXBREAKS,
   const int nbreaks_opt,
-  const int n
+  const int n,
+  const int band
 ){
 // SYNOPSIS:                                                            
 //   Create or update thread jobs. For an approximate TAD defined by    
@@ -672,8 +756,9 @@ allocate_new_jobs(
 //                                                                      
 // PARAMETERS:                                                          
 // TODO Update parameters
-//   'skip': the job matrix to update in place.                         
+//   'skip': the job matrix to update in place (in banded form).        
 //   'n': number of rows/columns of the hiC matrix (or 'skip').         
+//   'band': width of the band of 'skip'.                               
 //                                                                      
 // RETURN:                                                              
 //   'void'                                                             
@@ -698,13 +783,13 @@ allocate_new_jobs(
       if (shift+nbreaks_opt < 0) continue;
       if (shift+nbreaks_opt > MAXBREAKS-1) break;
       for (i0 = 0, j0 = 0 ; j0 < n ; j0++) {
-         if (bkpts[j0+(shift+nbreaks_opt)*n]) {
+         if (GET_BKPT(bkpts, j0 + (long int) (shift+nbreaks_opt)*n)) {
 
             // Jobs for splitting the TAD.
-            for (j = i0 ; j < j0 ; j++)
-               skip[i0+j*n] = 0;
-            for (i = i0 ; i < j0 ; i++)
-               skip[i+j0*n] = 0;
+            for (j = i0 ; j < j0 && j-i0 <= band ; j++)
+               skip[BAND_IDX(i0,j,band)] = 0;
+            for (i = j0-band > i0 ? j0-band : i0 ; i < j0 ; i++)
+               skip[BAND_IDX(i,j0,band)] = 0;
 
             starts[i0] = 1;
             ends[j0] = 1;
@@ -715,9 +800,9 @@ allocate_new_jobs(
 
    // Jobs for merging the TADs.
    for (i = 0 ; i < n ; i++)
-   for (j = 0 ; j < n ; j++)
-      if (starts[i] && ends[j] && (j-i < 500) && (i < j))
-         skip[i+j*n] = 0;
+   for (j = i+1 ; j < n && j-i <= band ; j++)
+      if (starts[i] && ends[j] && (j-i < 500))
+         skip[BAND_IDX(i,j,band)] = 0;
 
    free(starts);
    free(ends);
@@ -799,7 +884,103 @@ tadbit
   // output //
   tadbit_output *seg
 )
-// TODO: write synopsis.
+// SYNOPSIS:                                                            
+//   Segment full 'n' x 'n' matrices of observations. The upper         
+//   triangle is stored in banded form covering the whole matrix and    
+//   passed to 'tadbit_band' (see there for the parameters). The        
+//   output 'llikmat' is converted back to a full 'n' x 'n' matrix.     
+//                                                                      
+{
+
+   const int N = n;
+
+   int i;
+   int j;
+   int k;
+
+   // Make sure the data is symmetric (only the rows and columns that
+   // are not removed are considered).
+   int symmetric = 1;
+   for (k = 0 ; k < m && symmetric ; k++) {
+   for (i = 0 ; i < N && symmetric ; i++) {
+   for (j = i+1 ; j < N && symmetric ; j++) {
+      if (remove[i] || remove[j]) continue;
+      if (obs[k][i+j*N] != obs[k][j+i*N]) symmetric = 0;
+   }
+   }
+   }
+   if (!symmetric) {
+      fprintf(stderr, "input matrix not symmetric: symmetrizing\n");
+   }
+
+   int **band_obs = (int **) malloc(m * sizeof(int *));
+   for (k = 0 ; k < m ; k++) {
+      band_obs[k] = (int *) malloc(N*N * sizeof(int));
+      for (i = 0 ; i < N ; i++)
+      for (j = i ; j < N ; j++)
+         band_obs[k][BAND_IDX(i,j,N-1)] = symmetric || i == j ?
+            obs[k][i+j*N] : obs[k][i+j*N] + obs[k][j+i*N];
+   }
+
+   tadbit_band((const int **) band_obs, remove, N, m, N-1, n_threads,
+         verbose, max_tad_size, nbrks, do_not_use_heuristic, seg);
+
+   for (k = 0 ; k < m ; k++) free(band_obs[k]);
+   free(band_obs);
+
+   if (seg->maxbreaks < 0) return;
+
+   // Full matrix of log-likelihoods (lower triangular part is NAN).
+   double *llikmat = (double *) malloc(N*N * sizeof(double));
+   for (j = 0 ; j < N ; j++)
+   for (i = 0 ; i < N ; i++)
+      llikmat[i+j*N] = i > j ? NAN : seg->llikmat[BAND_IDX(i,j,N-1)];
+   free(seg->llikmat);
+   seg->llikmat = llikmat;
+
+   return;
+
+}
+
+
+void
+tadbit_band
+(
+  // input //
+  const int **obs,
+  char *remove,
+  int n,
+  const int m,
+  const int band,
+  int n_threads,
+  const int verbose,
+  const int max_tad_size,
+  const int nbrks,
+  const int do_not_use_heuristic,
+  // output //
+  tadbit_output *seg
+)
+// SYNOPSIS:                                                            
+//   Segment matrices of observations given as a diagonal band. Only    
+//   the cells at a distance of at most 'band' bins from the diagonal   
+//   are used, and TADs are at most 'band' bins long. The memory used   
+//   is proportional to 'n' x 'band'.                                   
+//                                                                      
+// ARGUMENTS:                                                           
+//   'obs': (m) symmetric matrices of observations, upper triangle in   
+//        banded form (see 'BAND_IDX').                                 
+//   'remove': rows/columns to remove (freed by the function).          
+//   'n': number of rows/columns of the matrices.                       
+//   'm': number of matrices.                                           
+//   'band': width of the band ('n-1' for full matrices).               
+//   'n_threads': number of threads (0 to use all the processors).      
+//   'verbose': print progress.                                         
+//   'max_tad_size': maximum TAD size (if the heuristic is not used).   
+//   'nbrks': number of breaks (0 to find the optimum).                 
+//   'do_not_use_heuristic': compute all the slices.                    
+//        -- output arguments --                                        
+//   'seg': output struct, 'llikmat' is in banded form.                 
+//                                                                      
 {
 
    // Get thread number if set to 0 (max).
@@ -819,22 +1000,7 @@ tadbit
    int k;
    int l;
    int i0;
-
-   // Allocate memory and initialize variables. The distance
-   // matrix 'dist' is the distance to the main diagonal. Every
-   // element of coordinate (i,j) is on a diagonal; the distance
-   // is the log-shift to the main diagonal 'i-j'.
-
-   /* // Simplify input. Remove line and column if 0 on the diagonal. */
-   /* char *remove = (char *) malloc (N * sizeof(char)); */
-   /* for (i = 0 ; i < N ; i++) { */
-   /*    remove[i] = 0; */
-   /*    for (k = 0 ; k < m ; k++) { */
-   /*       if (obs[k][i+i*N] < 1) { */
-   /*          remove[i] = 1; */
-   /*       } */
-   /*    } */
-   /* } */
+   long int pos;
 
    // Update the dimension. 'N' is the original row/column number,
    // 'n' is the row/column number after removing rows and columns
@@ -843,14 +1009,6 @@ tadbit
       n -= remove[i];
    }
 
-//   double *init_dist = (double *) malloc(N*N * sizeof(double));
-//
-//   for (l = 0, i = 0; i < N ; i++) {
-//   for (j = 0; j < N ; j++) {
-//      init_dist[l] = log(abs(i-j));
-//      l++;
-//   }
-//   }
    fastlog_init(16);
 
    // Exit if there are too few rows/columns after removal.
@@ -858,52 +1016,46 @@ tadbit
       // Signal failure.
       seg->maxbreaks = -1;
       // Clean before exit.
-      //free(init_dist);
       free(remove);
       // Bye-bye.
       return;
    }
 
-   const int MAXBREAKS = n/5;
+   const int MAXBREAKS = n/MIN_TAD_SIZE;
+   // Number of cells stored per row.
+   const int W = band+1;
 
-   _cache_index = (int *) malloc(n*n * sizeof(int));
-   _max_cache_index = N+1;
-   // Allocate and copy.
+   // Distances between bins are at most 'band'.
+   _max_cache_index = W;
+   // 'dp' is the position in the original matrix of the rows/columns
+   // that are not removed.
+   int *dp = (int *) malloc(n * sizeof(int));
+   for (i0 = 0, j = 0 ; j < N ; j++) {
+      if (!remove[j]) {
+         dp[i0] = j;
+         i0++;
+      }
+   }
+   // Allocate and copy (see 'FULL_BAND_IDX'). Cells out of the band
+   // (in the original matrix) are set to 0 and not used.
    double **log_gamma  = (double **) malloc(m * sizeof(double *));
    int    **new_obs    = (int **) malloc(m * sizeof(int *));
-   //double *dist = (double *) malloc(n*n * sizeof(double));
-   int *dp = (int *) malloc(n * sizeof(int));
    for (k = 0 ; k < m ; k++) {
-      l = i0 = 0;
-      log_gamma[k] = (double *) malloc(n*n * sizeof(double));
-      new_obs[k] = (int *) malloc(n*n * sizeof(int));
-      for (j = 0 ; j < N ; j++) {
-    	  if (!remove[j]) {
-    		  dp[i0] = j;
-    		  i0++;
-    	  }
-		  for (i = 0 ; i < N ; i++) {
-			 if (remove[i] || remove[j]) continue;
-			 _cache_index[l] = i > j ? i-j : j-i;
-			 log_gamma [k][l] = lgamma(obs[k][i+j*N]+1);
-			 new_obs[k][l]    = obs[k][i+j*N];
-			 //dist[l] = init_dist[i+j*N];
-			 l++;
-		  }
+      log_gamma[k] = (double *) malloc(n*(2*band+1) * sizeof(double));
+      new_obs[k] = (int *) malloc(n*(2*band+1) * sizeof(int));
+      for (i = 0 ; i < n*(2*band+1) ; i++) {
+         log_gamma[k][i] = 0.0;
+         new_obs[k][i] = 0;
+      }
+      for (i = 0 ; i < n ; i++)
+      for (j = i ; j < n && dp[j]-dp[i] <= band ; j++) {
+         l = obs[k][BAND_IDX(dp[i],dp[j],band)];
+         log_gamma[k][FULL_BAND_IDX(i,j,band)] = lgamma(l+1);
+         log_gamma[k][FULL_BAND_IDX(j,i,band)] = lgamma(l+1);
+         new_obs[k][FULL_BAND_IDX(i,j,band)] = l;
+         new_obs[k][FULL_BAND_IDX(j,i,band)] = l;
       }
    }
-   /* fprintf(stderr, "WEIGHTS FROM INSIDE ME "); */
-   /* for (i = 0; i < 50; i++) */
-   /*   fprintf(stderr, "%f ", weights[0][i]); */
-   /* fprintf(stderr, "\n"); */
-
-   // We will not need the initial observations any more.
-   //free(init_dist);
-   obs = new_obs;
-
-   // Make sure the data is symmetric.
-   enforce_symmetry(obs, n, m);
-
 
    // Compute row/column sums (identical by symmetry).
    double **rowsums = (double **) malloc(m * sizeof(double *));
@@ -912,122 +1064,104 @@ tadbit
       for (i = 0 ; i < n ; i++) rowsums[k][i] = 0.0;
    }
 
+   // Rows and columns within the band in the original matrix are also
+   // within the band after removal.
    for (k = 0 ; k < m ; k++)
    for (i = 0 ; i < n ; i++)
-   for (j = 0 ; j < n ; j++)
-      rowsums[k][i] += obs[k][i+j*n];
-
-   // compute the weights.
-//   double **weights = (double **) malloc(m * sizeof(double *));
-//   for (k = 0 ; k < m ; k++) {
-//      weights[k] = (double *) malloc(n*n * sizeof(double));
-//      for (i = 0 ; i < n*n ; i++) weights[k][i] = 0.0;
-//      // Compute product.
-//      for (j = 0 ; j < n ; j++) {
-//      for (i = 0 ; i < n ; i++) {
-//         weights[k][i+j*n] = rowsums[k][i]*rowsums[k][j];
-//      }
-//      }
-//   }
-
-   // We don't need the row/column sums any more.
-   //for (l = 0 ; l < m ; l++) free(rowsums[l]);
-   //free(rowsums);
+   for (j = i-band > 0 ? i-band : 0 ; j < n && j <= i+band ; j++)
+      if (abs(dp[i]-dp[j]) <= band)
+         rowsums[k][i] += new_obs[k][FULL_BAND_IDX(i,j,band)];
 
    double *mllik = (double *) malloc(MAXBREAKS * sizeof(double));
-   int *bkpts = (int *) malloc(MAXBREAKS*n * sizeof(int));
-   double *llikmat = (double *) malloc(n*n * sizeof(double));
-   for (i = 0 ; i < n*n ; i++)
+   unsigned char *bkpts = (unsigned char *)
+      calloc(BKPT_BYTES((long int) n*MAXBREAKS), sizeof(unsigned char));
+   double *llikmat = (double *) malloc(n*W * sizeof(double));
+   for (i = 0 ; i < n*W ; i++)
       llikmat[i] = NAN;
 
    // 'skip' will contain only 0 or 1 and can be stored as 'char'.
-   char *skip = (char *) malloc(n*n * sizeof(char));
+   char *skip = (char *) malloc(n*W * sizeof(char));
 
    // Use the heuristic by default (hence the name of the parameter).
    // The parameter 'max_tad_size' is needed only in case the heuristic
    // is not used.
    if (do_not_use_heuristic) {
-      for (j = 0 ; j < n ; j++)
       for (i = 0 ; i < n ; i++)
-         // Also sets the lower triangular part of 'skip'.
-         skip[i+j*n] = (i >= j) || ((j-i) > max_tad_size) ? 1 : 0;
+      for (j = i ; j < i+W ; j++)
+         // Also sets the diagonal and the cells out of the matrix.
+         skip[BAND_IDX(i,j,band)] =
+            (i >= j) || (j > n-1) || ((j-i) > max_tad_size) ? 1 : 0;
    }
    else {
       if (verbose) {
          fprintf(stderr, "running pre-heuristic\n");
       }
 
-      for (i = 0 ; i < n*n ; i++) skip[i] = 1;
-
-      // 'S[i+j*n]' is the weighted sum of reads within the triangle
-      // defined by ('i','j') in the upper triangular matrix of
-      // observations.
-      double *S = (double *) malloc(n*n * sizeof(double));
-      for (i = 0 ; i < n*n ; i++) S[i] = 0.0;
-      for (j = 1 ; j < n ; j++) {
+      // 'S[BAND_IDX(i,j,band)]' is the weighted sum of reads within
+      // the triangle defined by ('i','j') in the upper triangular
+      // matrix of observations.
+      double *S = (double *) malloc(n*W * sizeof(double));
+      for (i = 0 ; i < n*W ; i++) S[i] = 0.0;
+      for (j = 1 ; j < n && j <= band ; j++) {
       for (i = 0 ; i < n-j ; i++) {
          double weighted_value = 0.0;
          for (l = 0 ; l < m ; l++) {
-        	weighted_value += obs[l][i+(i+j)*n]/(rowsums[l][i]*rowsums[l][(i+j)]);
-            //weighted_value += obs[l][i+(i+j)*n]/weights[l][i+(i+j)*n];
+        	weighted_value += new_obs[l][FULL_BAND_IDX(i,i+j,band)]/(rowsums[l][i]*rowsums[l][(i+j)]);
          }
-         S[i+(i+j)*n] = S[i+(i+j-1)*n] + S[i+1+(i+j)*n] -
-            S[i+1+(i+j-1)*n] + weighted_value;
+         // The sums of the triangles of width 0 and -1 are 0.
+         S[BAND_IDX(i,i+j,band)] = (j > 1 ? S[BAND_IDX(i,i+j-1,band)] +
+            S[BAND_IDX(i+1,i+j,band)] - S[BAND_IDX(i+1,i+j-1,band)] : 0.0) +
+            weighted_value;
       }
       }
 
-      double *heur_score = (double *) malloc(n*n * sizeof(double));
-      for (i = 0 ; i < n*n ; i++) heur_score[i] = NAN;
-      for (j = 1 ; j < n ; j++)
-      for (i = 0 ; i < j ; i++)
-    	  heur_score[i+j*n] = log(S[i+j*n]);
+      double *heur_score = (double *) malloc(n*W * sizeof(double));
+      for (i = 0 ; i < n*W ; i++) heur_score[i] = NAN;
+      for (i = 0 ; i < n ; i++)
+      for (j = i+1 ; j < n && j-i <= band ; j++)
+    	  heur_score[BAND_IDX(i,j,band)] = log(S[BAND_IDX(i,j,band)]);
 
       // Use dynamic programming to find approximate break points.
       // The matrix 'mllik' is used only to make the function call valid
       // (it is updated in place, but the value is disregarded), and
       // the heuristic score 'heur_score' plays the role of the
       // log-likelihood 'llikmat'.
-      DPwalk(heur_score, n, MAXBREAKS, n_threads, mllik, bkpts);
+      DPwalk(heur_score, n, band, MAXBREAKS, n_threads, mllik, bkpts);
 
       free(heur_score);
       free(S);
 
       // Create a thread job for each approximate TAD.
-      for (i = 0 ; i < n*n ; i++) skip[i] = 1;
+      for (i = 0 ; i < n*W ; i++) skip[i] = 1;
       for (j = 1 ; j < MAXBREAKS ; j++) {
          i0 = 0;
          for (i = 0 ; i < n ; i++) {
-            if (bkpts[i+j*n]) {
-               allocate_heur_job(skip, i0, i, n);
+            if (GET_BKPT(bkpts, i + (long int) j*n)) {
+               allocate_heur_job(skip, i0, i, n, band);
                i0 = i+1;
             }
          }
       }
 
-      // Erase the lower triangular part of 'skip'.
-      for (j = 0 ; j < n ; j++)
-      for (i = j ; i < n ; i++)
-         skip[i+j*n] = 1;
-
       // Allocate estimation of the log likelihood for all small
       // TADs (less than 3 bins).
       for (j = 6 ; j < n ; j++)
       for (i = j-6 ; i < j-3 ; i++)
-         skip[i+j*n] = 0;
+         if (j-i <= band) skip[BAND_IDX(i,j,band)] = 0;
 
       // Allocate jobs at the ends of the chromosomes/units because
       // these regions are a bit noisier.
       for (j = 1 ; j < 51 ; j++)
       for (i = 0 ; i < j-3 ; i++)
-         if (i < n && j < n) skip[i+j*n] = 0;
+         if (i < n && j < n && j-i <= band) skip[BAND_IDX(i,j,band)] = 0;
       for (j = n-51 ; j < n ; j++)
       for (i = n-51 ; i < j-3 ; i++)
-         if (i > 0 && j > 0) skip[i+j*n] = 0;
+         if (i > 0 && j > 0 && j-i <= band) skip[BAND_IDX(i,j,band)] = 0;
 
-      // Reset lower triangular part of 'skip'.
-      for (j = 0 ; j < n ; j++)
-      for (i = j ; i < n ; i++)
-         skip[i+j*n] = 1;
+      // Reset the diagonal and the cells out of the matrix.
+      for (i = 0 ; i < n ; i++)
+      for (j = i ; j < i+W ; j++)
+         if (i == j || j > n-1) skip[BAND_IDX(i,j,band)] = 1;
 
    } // End of pre-heuristic.
 
@@ -1038,7 +1172,8 @@ tadbit
    llworker_arg arg = {
       .n = n,
       .m = m,
-      .k = (const int **) obs,
+      .band = band,
+      .k = (const int **) new_obs,
       //.d = dist,
 	  .dp = dp,
       //.w = (const double **) weights,
@@ -1073,7 +1208,7 @@ tadbit
 
       // Initialize task queue.
       n_to_process = 0;
-      for (i = 0 ; i < n*n ; i++) {
+      for (i = 0 ; i < n*W ; i++) {
          // Skip all computation done in previous cycles.
          if (!isnan(llikmat[i])) skip[i] = 1;
          n_to_process += (1-skip[i]);
@@ -1105,7 +1240,7 @@ tadbit
       // segments. The breakpoints are found by dynamic programming.
       int maxbreaks = nbreaks_opt ? nbreaks_opt + 11 : MAXBREAKS;
       if (maxbreaks > MAXBREAKS) maxbreaks = MAXBREAKS;
-      DPwalk(llikmat, n, maxbreaks, n_threads, mllik, bkpts);
+      DPwalk(llikmat, n, band, maxbreaks, n_threads, mllik, bkpts);
 
       // Get optimal number of breaks by AIC.
       newAIC = -INFINITY;
@@ -1116,7 +1251,7 @@ tadbit
       }
       nbreaks_opt -= 1;
 
-      allocate_new_jobs(skip, bkpts, MAXBREAKS, nbreaks_opt, n);
+      allocate_new_jobs(skip, bkpts, MAXBREAKS, nbreaks_opt, n, band);
 
    }
 
@@ -1125,98 +1260,75 @@ tadbit
    pthread_mutex_destroy(&tadbit_lock);
    free(skip);
    free(tid);
-   free(_cache_index);
 
    nbreaks_opt = nbrks ? (int) nbrks - 1 : nbreaks_opt;
 
    // Compute breakpoint confidence by penalized dynamic progamming.
-   double *llikmatcpy = (double *) malloc (n*n * sizeof(double));
+   double *llikmatcpy = (double *) malloc (n*W * sizeof(double));
    double *mllikcpy = (double *) malloc(MAXBREAKS * sizeof(double));
-   int *bkptscpy = (int *) malloc(n*MAXBREAKS * sizeof(int));
+   const long int bkpt_bytes = BKPT_BYTES((long int) n*MAXBREAKS);
+   unsigned char *bkptscpy = (unsigned char *) malloc(bkpt_bytes);
    int *passages = (int *) malloc(n * sizeof(int));
-   for (i = 0 ; i < n*MAXBREAKS ; i++) bkptscpy[i] = bkpts[i];
-   for (i = 0 ; i < n*n ; i++) llikmatcpy[i] = llikmat[i];
+   for (pos = 0 ; pos < bkpt_bytes ; pos++) bkptscpy[pos] = bkpts[pos];
+   for (i = 0 ; i < n*W ; i++) llikmatcpy[i] = llikmat[i];
    for (i = 0 ; i < n ; i++) passages[i] = 0;
 
    for (l = 0 ; l < 10 ; l++) {
       i = 0;
       for (j = 0 ; j < n ; j++) {
-         if (bkptscpy[j+nbreaks_opt*n]) {
+         if (GET_BKPT(bkptscpy, j + (long int) nbreaks_opt*n)) {
             // Apply a constant penalty every time a TAD is present
             // in the final decomposition. The penalty is set to
             // 'm*6' because it is the expected log-likelihood gain
             // for adding a new TAD around the optimum log-likelihood.
-            llikmatcpy[i+j*n] -= m*6;
-            passages[j] += bkpts[j+nbreaks_opt*n];
+            if (j-i <= band) llikmatcpy[BAND_IDX(i,j,band)] -= m*6;
+            passages[j] += GET_BKPT(bkpts, j + (long int) nbreaks_opt*n);
             i = j+1;
          }
       }
-      if (i < n) llikmatcpy[i+(n-1)*n] -= m*6;
-      DPwalk(llikmatcpy, n, nbreaks_opt+1, n_threads, mllikcpy, bkptscpy);
+      if (i < n && n-1-i <= band) llikmatcpy[BAND_IDX(i,n-1,band)] -= m*6;
+      DPwalk(llikmatcpy, n, band, nbreaks_opt+1, n_threads, mllikcpy,
+            bkptscpy);
    }
    free(llikmatcpy);
    free(mllikcpy);
    free(bkptscpy);
 
-   
    // Resize output to match original.
-//   int p;
-//   double **resized_weights = (double **) malloc(m * sizeof(double *));
-//   for (l = 0 ; l < m ; l++) {
-//      resized_weights[l] = (double *) malloc(N*N * sizeof(double));
-//      for (i = 0 ; i < N*N ; i++) resized_weights[l][i] = 0.0;
-//   }
-//   for (k = 0 ; k < m ; k++) {
-//      for (l = 0, i = 0 ; i < N ; i++) {
-//         if (remove[i]) continue;
-//         for (p = 0, j = 0 ; j < N ; j++) {
-//            if (remove[j]) continue;
-//            resized_weights[k][i+j*N] = weights[k][l+p*n];
-//	    p++;
-//	 }
-//	 l++;
-//      }
-//   }
-
-   int *resized_bkpts = (int *) malloc(N*MAXBREAKS * sizeof(int));
+   unsigned char *resized_bkpts = (unsigned char *)
+      calloc(BKPT_BYTES((long int) N*MAXBREAKS), sizeof(unsigned char));
    int *resized_passages = (int *) malloc(N * sizeof(int));
-   for (i = 0 ; i < N*MAXBREAKS ; i++) resized_bkpts[i] = 0;
    for (i = 0 ; i < N ; i++) resized_passages[i] = 0;
 
-   for (l = 0, i = 0 ; i < N ; i++) {
-      if (remove[i]) continue;
-      resized_passages[i] = passages[l];
+   for (l = 0 ; l < n ; l++) {
+      resized_passages[dp[l]] = passages[l];
       for (j = 0 ; j < MAXBREAKS ; j++)
-         resized_bkpts[i+j*N] = bkpts[l+j*n];
-      l++;
+         if (GET_BKPT(bkpts, l + (long int) j*n))
+            SET_BKPT(resized_bkpts, dp[l] + (long int) j*N);
    }
 
    free(passages);
    free(bkpts);
 
-   double *resized_llikmat = (double *) malloc(N*N * sizeof(double));
-   for (i = 0 ; i < N*N ; i++) {
+   double *resized_llikmat = (double *) malloc(N*W * sizeof(double));
+   for (i = 0 ; i < N*W ; i++) {
       resized_llikmat[i] = NAN;
    }
 
-   for (l = 0, i = 0 ; i < N ; i++) {
-      if (remove[i]) continue;
-      for (k = 0, j = 0 ; j < N ; j++) {
-         if (remove[j]) continue;
-         resized_llikmat[i+j*N] = llikmat[l+k*n];
-         k++;
-      }
-      l++;
-   }
+   for (l = 0 ; l < n ; l++)
+   for (k = l ; k < n && dp[k]-dp[l] <= band ; k++)
+      resized_llikmat[BAND_IDX(dp[l],dp[k],band)] =
+         llikmat[BAND_IDX(l,k,band)];
    free(llikmat);
 
    for (k = 0 ; k < m ; k++) {
       free(new_obs[k]);
       free(log_gamma[k]);
+      free(rowsums[k]);
    }
    free(new_obs);
    free(log_gamma);
-   //free(dist);
+   free(rowsums);
    fastlog_free();
    free(dp);
    free(remove);
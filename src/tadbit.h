@@ -14,9 +14,33 @@
 #define TOLERANCE 1e-6
 #define MAXITER 10000
 
+// Banded storage of the upper triangle of a matrix. Only the cells
+// (i,j) such that '0 <= j-i <= band' are stored, row after row: the
+// cell (i,j) is at position 'i*(band+1)+(j-i)'. With 'band' equal to
+// 'n-1' the whole upper triangle is stored.
+#define BAND_IDX(i,j,band) ((i)*((band)+1)+(j)-(i))
+
+// Full band of a symmetric matrix (both sides of the diagonal), stored
+// column after column so that the cells of a column are contiguous:
+// the cell (i,j) such that '|i-j| <= band' is at position
+// 'j*(2*band+1)+band+i-j'.
+#define FULL_BAND_IDX(i,j,band) ((j)*(2*(band)+1)+(band)+(i)-(j))
+
+// TADs span at least 5 bins, so there are at most 'n/MIN_TAD_SIZE'
+// breakpoints.
+#define MIN_TAD_SIZE 5
+
+// Breakpoints are stored as bits: the bit 'j+l*n' is set if there is a
+// breakpoint at 'j' in the segmentation with 'l' breaks.
+#define BKPT_BYTES(size) (((size)+7)/8)
+#define GET_BKPT(bits,pos) (((bits)[(pos)/8] >> ((pos)%8)) & 1)
+#define SET_BKPT(bits,pos) ((bits)[(pos)/8] |= (unsigned char) (1 << ((pos)%8)))
+#define CLEAR_BKPT(bits,pos) ((bits)[(pos)/8] &= (unsigned char) ~(1 << ((pos)%8)))
+
 typedef struct {
    const int n;
    const int m;
+   const int band;
    const int **k;
    //const double *d;
    const int *dp;
@@ -30,12 +54,15 @@ typedef struct {
 
 typedef struct {
    const int n;
+   const int band;
    const double *llikmat;
    double *old_llik;
    double *new_llik;
    int nbreaks;
-   int *new_bkpt_list;
-   const int *old_bkpt_list;
+   // Back pointers are stored as distances (at most 'band+1') on
+   // 'back_size' bytes.
+   int back_size;
+   unsigned char *back;
 } dpworker_arg;
 
 
@@ -48,7 +75,7 @@ typedef struct {
    int *passages;
    double *llikmat;
    double *mllik;
-   int *bkpts;
+   unsigned char *bkpts;
 } tadbit_output;
 
 
@@ -71,6 +98,24 @@ tadbit(
 );
 
 
+void
+tadbit_band(
+  /* input */
+  const int **obs,
+  char *remove,
+  int n,
+  const int m,
+  const int band,
+  int n_threads,
+  const int verbose,
+  const int max_tad_size,
+  const int nbrks,
+  const int do_not_use_heuristic,
+  /* output */
+  tadbit_output *seg
+);
+
+
 void
 destroy_tadbit_output(
    tadbit_output *seg
@@ -124,7 +124,7 @@ tadbit_R_call(
    for (i = 0 ; i < maxbreaks ; i++) mllik[i] = seg->mllik[i];
    // Remove first column associated with 0 breaks. Itcontains only
    // 0s and shifts the index in R (vectors start at position 1).
-   for (i = N ; i < N*(maxbreaks-1) ; i++) bkpts[i-N] = seg->bkpts[i];
+   for (i = N ; i < N*(maxbreaks-1) ; i++) bkpts[i-N] = GET_BKPT(seg->bkpts, i);
 
 
    // Set 'dim' attributes.
@@ -23,6 +23,19 @@ PyDoc_STRVAR(_tadbit_wrapper__doc__,
     :argument 1 do_not_use_heuristic: whether to use or not some heuristics\n\
     :returns: a python list with each\n");
 
+PyDoc_STRVAR(_tadbit_band_wrapper__doc__,
+"Run tadbit_band function in tadbit.c.\n\
+    :argument bands: a python list of buffers (e.g. numpy arrays of int32) with the diagonal band of each matrix (see BAND_IDX in tadbit.h).\n\
+    :argument remove: a python tuple of booleans mapping positively columns to remove.\n\
+    :argument 0 n: number of rows or columns in the matrix\n\
+    :argument 0 m: number of matrices\n\
+    :argument 0 band: width of the band (distance to the diagonal of the last cells stored)\n\
+    :argument 0 n_threads: number of threads to use\n\
+    :argument 0 verbose: whether to display more/less information about process\n\
+    :argument 0 max_tad_size: an integer defining maximum size of TAD.\n\
+    :argument 1 do_not_use_heuristic: whether to use or not some heuristics\n\
+    :returns: a python list with the maximum number of breaks, the optimal number of breaks, the passages, None (the log-likelihoods of the slices are not returned), the maximum log-likelihoods and the breakpoints for the optimal number of breaks\n");
+
 
 /* The wrapper to the underlying C function */
 static PyObject *_tadbit_wrapper (PyObject *self, PyObject *args){
@@ -75,7 +88,7 @@ static PyObject *_tadbit_wrapper (PyObject *self, PyObject *args){
   int dim = MAXBREAKS * n;
   py_bkpts = PyList_New(dim);
   for(i = 0 ; i < dim; i++)
-    PyList_SetItem(py_bkpts, i, PyInt_FromLong(seg->bkpts[i]));
+    PyList_SetItem(py_bkpts, i, PyInt_FromLong(GET_BKPT(seg->bkpts, i)));
 
   // get passages
   py_passages = PyList_New(n);
@@ -113,10 +126,113 @@ static PyObject *_tadbit_wrapper (PyObject *self, PyObject *args){
   return py_result;
 }
 
+/* The wrapper to the banded version of the underlying C function */
+static PyObject *_tadbit_band_wrapper (PyObject *self, PyObject *args){
+  PyObject *py_bands;
+  PyObject *py_remove;
+  int n;
+  int m;
+  int band;
+  int n_threads;
+  const int verbose;
+  const int max_tad_size;
+  const int nbks;
+  const int do_not_use_heuristic;
+  /* output */
+  tadbit_output *seg;
+
+  if (!PyArg_ParseTuple(args, "O!O!iiiiiiii:tadbit_band",
+			&PyList_Type, &py_bands, &PyTuple_Type, &py_remove,
+			&n, &m, &band, &n_threads,
+			&verbose, &max_tad_size, &nbks, &do_not_use_heuristic))
+    return NULL;
+  if (PyList_GET_SIZE(py_bands) != m) {
+    PyErr_SetString(PyExc_ValueError, "wrong number of bands");
+    return NULL;
+  }
+  if (PyTuple_GET_SIZE(py_remove) != n) {
+    PyErr_SetString(PyExc_ValueError, "wrong size of remove");
+    return NULL;
+  }
+  // the bands are read directly from the buffers (no copy)
+  int i, j;
+  const void *buffer;
+  Py_ssize_t buffer_len;
+  const int **obs;
+  obs = malloc(m * sizeof(int*));
+  for (i = 0 ; i < m ; i++) {
+    if (PyObject_AsReadBuffer(PyList_GET_ITEM(py_bands, i), &buffer, &buffer_len)) {
+      free(obs);
+      return NULL;
+    }
+    if (buffer_len != (Py_ssize_t) n*(band+1) * sizeof(int)) {
+      free(obs);
+      PyErr_SetString(PyExc_ValueError, "wrong size of band buffer");
+      return NULL;
+    }
+    obs[i] = (const int *) buffer;
+  }
+  seg = (tadbit_output *) malloc(sizeof(tadbit_output));
+
+  char *remove = (char *) malloc (n * sizeof(char));
+  for (j = 0 ; j < n ; j++){
+    remove[j] = PyInt_AS_LONG(PyTuple_GET_ITEM(py_remove, j)); // automatic casting into char
+  }
+
+  // run tadbit
+  tadbit_band(obs, remove, n, m, band, n_threads, verbose, max_tad_size, nbks, do_not_use_heuristic, seg);
+  free(obs);
+
+  if (seg->maxbreaks < 0) {
+    free(seg);
+    PyErr_SetString(PyExc_ValueError, "too few rows/columns to segment");
+    return NULL;
+  }
+
+  // store each tadbit output
+
+  // declare python objects to store lists
+  PyObject * py_bkpts;
+  PyObject * py_mllik;
+  PyObject * py_result;
+  PyObject * py_passages;
+
+  // get bkpts (only for the optimal number of breaks)
+  py_bkpts = PyList_New(n);
+  for(i = 0 ; i < n; i++)
+    PyList_SetItem(py_bkpts, i, PyInt_FromLong(GET_BKPT(seg->bkpts, i + (long int) seg->nbreaks_opt * n)));
+
+  // get passages
+  py_passages = PyList_New(n);
+  for(i = 0 ; i < n; i++)
+    PyList_SetItem(py_passages, i, PyFloat_FromDouble(seg->passages[i]));
+
+  // get mllik
+  py_mllik = PyList_New(seg->maxbreaks);
+  for(i = 0 ; i < seg->maxbreaks ; i++)
+    PyList_SetItem(py_mllik, i, PyFloat_FromDouble(seg->mllik[i]));
+
+  // group results into a python list
+  py_result = PyList_New(6);
+
+  Py_INCREF(Py_None);
+  PyList_SetItem(py_result, 0, PyInt_FromLong(seg->maxbreaks));
+  PyList_SetItem(py_result, 1, PyInt_FromLong(seg->nbreaks_opt));
+  PyList_SetItem(py_result, 2, py_passages);
+  PyList_SetItem(py_result, 3, Py_None);
+  PyList_SetItem(py_result, 4, py_mllik);
+  PyList_SetItem(py_result, 5, py_bkpts);
+
+  destroy_tadbit_output(seg);
+
+  return py_result;
+}
+
 /* A list of all the methods defined by this module. */
 /* The {NULL, NULL} entry indicates the end of the method definitions */
 static PyMethodDef tadbit_py_methods[] = {
 	{"_tadbit_wrapper",  _tadbit_wrapper, METH_VARARGS, _tadbit_wrapper__doc__},
+	{"_tadbit_band_wrapper",  _tadbit_band_wrapper, METH_VARARGS, _tadbit_band_wrapper__doc__},
 	{NULL, NULL}      /* sentinel */
 };
 
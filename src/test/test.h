@@ -9,12 +9,12 @@
 #include "tadbit.h"
 
 int _max_cache_index;
-int *_cache_index;
 
 double
 ll
 (
   const int    n,
+  const int    band,
   const int    i_,
   const int    _i,
   const int    j_,
@@ -180,7 +180,7 @@ test_tadbit
    g_assert_cmpint(seg->nbreaks_opt, ==, 1);
    // Check the position of the optimal break.
    for (int i = 0 ; i < 20 ; i++) {
-      g_assert_cmpint(seg->bkpts[i+1*20], == , i == 9);
+      g_assert_cmpint(GET_BKPT(seg->bkpts, i+1*20), == , i == 9);
    }
 
    // Check the computed weights.
@@ -201,28 +201,28 @@ test_ll
 (void)
 {
 
-   double lg[400] = {0};
-   double *c = malloc(21 * sizeof(double));
+   // Full band of the matrix (see 'FULL_BAND_IDX').
+   double lg[20*39] = {0};
+   double *c = malloc(20 * sizeof(double));
 
    double w[400] = {[0 ... 399] = 1.0};
    //double d[400];
    int dp[20];
-   int C[400];
+   int k[20*39] = {0};
 
-   _cache_index = C;
-   _max_cache_index = 21;
+   _max_cache_index = 20;
 
    for (int j = 0 ; j < 20 ; j++) {
       for (int i = 0 ; i < 20 ; i++) {
          //d[i+j*20] = log(abs(j-i));
     	 dp[j] = j;
-         C[i+j*20] = abs(j-i);
+         k[FULL_BAND_IDX(i,j,19)] = ideal_matrix_20x20[i+j*20];
       }
    }
 
    fastlog_init(16);
    //double loglik1 = ll(20, 0, 9, 0, 9, 1, ideal_matrix_20x20, d, w, lg, c);
-   double loglik1 = ll(20, 0, 9, 0, 9, 1, ideal_matrix_20x20, dp, w, lg, c);
+   double loglik1 = ll(20, 19, 0, 9, 0, 9, 1, k, dp, w, lg, c);
    // Value checked manually with R. The value is sensitive to
    // the value of the estimates, which is why the  precision
    // cannot be higher than 0.1.
@@ -230,17 +230,17 @@ test_ll
 
    // Check symmetry/reproducibility.
    //double loglik2 = ll(20, 10, 19, 10, 19, 1, ideal_matrix_20x20, d, w, lg, c);
-   double loglik2 = ll(20, 10, 19, 10, 19, 1, ideal_matrix_20x20, dp, w, lg, c);
+   double loglik2 = ll(20, 19, 10, 19, 10, 19, 1, k, dp, w, lg, c);
    g_assert_cmpfloat(abs(loglik1-loglik2), <, 1e-12);
 
    // Same as above, checked manually with R.
    //loglik1 = ll(20, 0, 9, 10, 19, 0, ideal_matrix_20x20, d, w, lg, c);
-   loglik1 = ll(20, 0, 9, 10, 19, 0, ideal_matrix_20x20, dp, w, lg, c);
+   loglik1 = ll(20, 19, 0, 9, 10, 19, 0, k, dp, w, lg, c);
    g_assert_cmpfloat(abs(loglik1-3036.8), <, 1e-1);
 
    // Check symmetry/reproducibility again.
    //loglik2 = ll(20, 10, 19, 0, 9, 0, ideal_matrix_20x20, d, w, lg, c);
-   loglik2 = ll(20, 10, 19, 0, 9, 0, ideal_matrix_20x20, dp, w, lg, c);
+   loglik2 = ll(20, 19, 10, 19, 0, 9, 0, k, dp, w, lg, c);
    g_assert_cmpfloat(abs(loglik1-loglik2), <, 1e-12);
 
    free(c);
@@ -9,24 +9,44 @@ matplotlib.use('Agg')
 
 import unittest
 from pytadbit                             import Chromosome, load_chromosome
+from pytadbit                             import Experiment
 from pytadbit                             import tadbit, batch_tadbit
+from pytadbit.tadbit                      import TopDom
 from pytadbit.tad_clustering.tad_cmo      import optimal_cmo
+from pytadbit.tad_clustering.tad_cmo      import _run_aleigen
+from pytadbit.tad_clustering.tad_cmo      import matrix2binnary_contacts
 from pytadbit.imp.structuralmodels        import load_structuralmodels
+from pytadbit.utils                       import three_dim_stats
+from pytadbit.utils.three_dim_stats       import calc_eqv_rmsd_matrix
 from pytadbit.imp.impmodel                import load_impmodel_from_cmm
+from pytadbit.imp                         import imp_modelling
 from pytadbit.eqv_rms_drms                import rmsdRMSD_wrapper
 from pytadbit.parsers.genome_parser       import parse_fasta
 from pytadbit.mapping.restriction_enzymes import map_re_sites, RESTRICTION_ENZYMES
+from pytadbit.mapping.restriction_enzymes import map_re_sites_array
 from pytadbit.parsers.hic_parser          import load_hic_data_from_reads, read_matrix
+from pytadbit.parsers.hic_parser          import load_hic_data_at_resolutions
+from pytadbit.parsers.hic_binary_parser   import write_hic_binary, read_hic_binary
+from pytadbit.utils.genome_cache          import evict
 from pytadbit.mapping.analyze             import hic_map, plot_distance_vs_interactions
 from pytadbit.mapping.analyze             import insert_sizes, plot_iterative_mapping
 from pytadbit.mapping.analyze             import correlate_matrices, eig_correlate_matrices
 from pytadbit.mapping.filter              import filter_reads, apply_filter
+from pytadbit.utils.normalize_hic         import iterative, iterative_sparse
+from pytadbit.utils.hmm                   import train, train_loops, gaussian_prob
+from pytadbit.utils.hmm                   import best_path, best_path_loops
+from pytadbit.boundary_aligner.globally   import needleman_wunsch
+from pytadbit.boundary_aligner.globally   import needleman_wunsch_loops
+from pytadbit.boundary_aligner.aligner    import align, guide_order
 
 from random                               import random, seed
-from os                                   import system, path, chdir
+from os                                   import system, path, chdir, utime
 from re                                   import finditer
+from cPickle                              import dump, dumps, loads
+from cPickle                              import HIGHEST_PROTOCOL
 from warnings                             import warn, catch_warnings, simplefilter
 from distutils.spawn                      import find_executable
+from numpy                                import array, allclose, isnan
 
 import sys
 
@@ -82,6 +102,30 @@ class TestTadbit(unittest.TestCase):
         self.assertEqual(exp1['start'], breaks)
         self.assertEqual(exp1['score'], scores)
 
+        # banded mode, with the band covering the whole matrix, or not
+        hic = read_matrix(PATH + '/40Kb/chrT/chrT_A.tsv')
+        exp5 = tadbit(hic, max_tad_size="max", verbose=False, banded=True)
+        self.assertEqual(exp5, tadbit(hic, max_tad_size="max", verbose=False))
+        exp5 = tadbit(hic, max_tad_size=10, verbose=False, banded=True)
+        self.assertEqual(len(hic.get_as_band(10)), 50 * 11)
+        self.assertTrue(all(e - s < 10 for s, e in zip(exp5['start'],
+                                                       exp5['end'])))
+
+        # TopDom, from the Hi-C data or from the band of the matrix
+        hic = read_matrix(PATH + '/20Kb/chrT/chrT_D.tsv')
+        tads = TopDom(hic, window_size=5)
+        self.assertEqual([tads[k]['start'] for k in sorted(tads)],
+                         [0, 5, 14, 38, 40, 43, 97])
+        self.assertEqual([tads[k]['end'] for k in sorted(tads)],
+                         [4, 13, 38, 40, 42, 96, 100])
+        self.assertEqual([tads[k]['tag'] for k in sorted(tads)],
+                         ['domain', 'domain', 'domain', 'gap', 'domain',
+                          'domain', 'domain'])
+        self.assertEqual([round(tads[k]['score'], 4) for k in sorted(tads)],
+                         [0.6252, 0.5365, 0.5776, 10, 0.5694, 0.495, 0.3369])
+        self.assertEqual(TopDom(hic.get_as_band(9).reshape(-1, 10),
+                                window_size=5), tads)
+
         if CHKTIME:
             print '1', time() - t0
 
@@ -141,6 +185,40 @@ class TestTadbit(unittest.TestCase):
         self.assertEqual(round(-11.002, 3), round(score1, 3))
         self.assertEqual(round(0.001, 1), round(pval1, 1))
         self.assertTrue(abs(0.04 - pval2) < 0.1)
+        # randomizations are reproducible, in parallel or not
+        pvals = [test_chr.align_experiments(randomize=True, rnd_num=100,
+                                            rnd_method='shuffle', seed=1,
+                                            n_cpus=n_cpus)[1][1]
+                 for n_cpus in (1, 2)]
+        self.assertEqual(pvals[0], pvals[1])
+        pval3 = test_chr.align_experiments(randomize=True, rnd_num=1000,
+                                           rnd_method='shuffle', seed=1,
+                                           early_stop=2)[1][1]
+        self.assertTrue(pval3 > 2. / 1000)
+        # vectorized Needleman-Wunsch gives the same alignments
+        tads = [[xpr.tads[x]['brk'] * xpr.resolution for x in xpr.tads]
+                for xpr in test_chr.experiments]
+        for tads1, tads2 in zip(tads, tads[1:]):
+            self.assertEqual(needleman_wunsch(tads1, tads2),
+                             needleman_wunsch_loops(tads1, tads2))
+        # progressive multiple alignment
+        aligneds, score, _, _ = align(tads, method='global', progressive=True)
+        self.assertEqual(len(aligneds), 4)
+        self.assertEqual(len(set(len(ali) for ali in aligneds)), 1)
+        # the identical pair is aligned first, then the sequence closest to
+        # it (scores only depend on the distance between first boundaries)
+        tads_x = [100000, 300000, 500000, 700000, 900000]
+        tads_y = [101000, 300000, 500000, 800000, 900000]
+        tads_z = [150000, 600000, 900000]
+        order, (first, score) = guide_order([tads_z, tads_x, tads_y, tads_x],
+                                            needleman_wunsch)
+        self.assertEqual(order, [1, 3, 2, 0])
+        self.assertEqual(first, [tads_x, tads_x])
+        self.assertEqual(score, 0)
+        aligneds = align([tads_z, tads_x, tads_y, tads_x], method='global',
+                         progressive=True)[0]
+        self.assertEqual([[b for b in ali if b != '-'] for ali in aligneds],
+                         [tads_z, tads_x, tads_y, tads_x])
         if CHKTIME:
             print '3', time() - t0
 
@@ -218,6 +296,34 @@ class TestTadbit(unittest.TestCase):
         #self.assertEqual(align2,[0, 1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12])
         self.assertEqual(align1, [0, 1, 2, '-', '-', 3, 4, 5, 6, 7, 8, '-', 9])
         self.assertEqual(align2, [0, 1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12])
+        # pruning the combinations of signs of the eigenvectors
+        align1b, align2b, _ = optimal_cmo(all_tads[1], all_tads[3], 7,
+                                          method='score', beam=4)
+        self.assertEqual((align1, align2), (align1b, align2b))
+        # fast Needleman-Wunsch and in-process aleigen (values obtained with
+        # the loop implementation of core_nw)
+        expected = {
+            (3, 6): ([0, 1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12],
+                     [0, 1, 2, 3, 4, 5, '-', 6, 7, 8, 9, 10, '-'],
+                     [0, 1, 2, 3, 4, 5, 6, 7, 8, 9, 10],
+                     [0, 1, 2, 3, 4, 5, 6, 7, 8, 9, 10], 0.428571),
+            (9, 6): ([0, 1, 2, 3, 4, 5, 6, 7, 8, 9, 10],
+                     [0, 1, 2, 3, 4, 5, 6, 7, 8, 9, 10],
+                     [0, 1, 3, 4, 5, 6, 7, 8, 9, 10],
+                     [0, 1, 2, 3, 4, 5, 6, 8, 9, 10], 0.564103),
+            (4, 10): ([0, 1, 2, 3, 4, 5, 6, 7, 8],
+                      [0, '-', '-', 1, 2, 3, '-', '-', 4],
+                      [0, 1, 2, 3, 7], [0, 1, 2, 3, 4], 0.545455)}
+        for (tad1, tad2), (ali1, ali2, ale1, ale2, score) in expected.items():
+            tad1, tad2 = all_tads[tad1], all_tads[tad2]
+            self.assertEqual(optimal_cmo(tad1, tad2, min(7, len(tad2)),
+                                         method='score', long_nw=False)[:2],
+                             (ali1, ali2))
+            contacts1, contacts2 = matrix2binnary_contacts(tad1, tad2)
+            ale = _run_aleigen(contacts1, contacts2, 7)
+            self.assertEqual(ale[:2], (ale1, ale2))
+            self.assertEqual(round(ale[2][0], 6), score)
+        self.assertEqual(_run_aleigen([], [(0, 1)], 7), ([], [], [0.]))
         if CHKTIME:
             print '6', time() - t0
         
@@ -319,6 +425,12 @@ class TestTadbit(unittest.TestCase):
         sumz = sum([exp._zscores[k1][k2] for k1 in exp._zscores.keys()
                     for k2 in exp._zscores[k1]])
         self.assertEqual(round(sumz, 4), round(4059.2877, 4))
+        # vectorized iterative correction
+        hic_data = exp.hic_data[0]
+        bias1 = iterative(hic_data, bads=hic_data.bads, iterations=10)
+        bias2 = iterative_sparse(hic_data, bads=hic_data.bads, iterations=10)
+        self.assertEqual([round(bias1[i], 8) for i in xrange(len(hic_data))],
+                         [round(bias2[i], 8) for i in xrange(len(hic_data))])
         if CHKTIME:
             print '9', time() - t0
 
@@ -339,6 +451,49 @@ class TestTadbit(unittest.TestCase):
         hic_data = exp.hic_data[0]
         hic_data.find_compartments(label_compartments='cluster')
         self.assertEqual(len(hic_data.compartments[None]), 39)
+        # same compartments as before the vectorization
+        self.assertEqual(
+            ''.join('%s%d-%d ' % (c['type'], c['start'], c['end'])
+                    for c in hic_data.compartments[None]),
+            'B0-0 B1-2 B3-4 B5-7 B8-9 B10-11 B12-12 B13-14 B15-15 B16-17 '
+            'B18-18 B19-19 B20-23 B24-26 B27-27 B28-28 B29-29 B30-41 B42-42 '
+            'B43-46 B47-48 B49-53 B54-55 A56-59 B60-63 A64-66 B67-67 A68-68 '
+            'B69-71 A72-74 B75-76 A77-80 B81-81 A82-83 B84-84 A85-85 B86-92 '
+            'A93-93 B94-99 ')
+        self.assertEqual([round(c['dens'], 3)
+                          for c in hic_data.compartments[None]],
+                         [0.225, 0.746, 0.816, 1.018, 0.564, 0.502, 0.138,
+                          0.465, 0.135, 0.537, 0.101, 0.035, 0.926, 0.703,
+                          0.073, 0.069, 0.096, 12.458, 0.135, 1.234, 0.341,
+                          1.82, 0.275, 1.381, 1.131, 0.509, 0.066, 0.064,
+                          0.616, 0.448, 0.247, 0.952, 0.065, 0.333, 0.092,
+                          0.094, 3.625, 0.074, 5.892])
+        # vectorized HMM against the pure python implementation
+        firsts = hic_data.find_compartments(label_compartments=None)
+        obs = [[v for v in firsts[None][0] if not isnan(v)]]
+        models = []
+        for fun in (train_loops, train):
+            pi = [0.5, 0.5]
+            T = [[0.9, 0.1], [0.1, 0.9]]
+            E = array([[-0.1, 0.5], [0.1, 0.5]])
+            fun(pi, T, E, obs, n_iter=50)
+            models.append((pi, T, E))
+        self.assertTrue(allclose(models[0][1], models[1][1]))
+        self.assertTrue(allclose(models[0][2], models[1][2]))
+        self.assertEqual(
+            best_path(gaussian_prob(obs[0], E), pi, T)[0],
+            best_path_loops(gaussian_prob(obs[0], E).tolist(), pi, T)[0])
+        # decay profiles are kept until biases or filtered columns change
+        decay = hic_data.get_decay()
+        self.assertTrue(decay is hic_data.get_decay())
+        self.assertEqual(decay[None][1][0], len(hic_data) - len(hic_data.bads))
+        self.assertEqual(sum(decay[None][0]), (hic_data.sum() + sum(
+            hic_data[i, i] for i in xrange(len(hic_data))
+            if not i in hic_data.bads)) / 2.)
+        # ... and are not pickled
+        self.assertEqual(loads(dumps(hic_data))._decay_cache, {})
+        hic_data.bads = {}
+        self.assertFalse(decay is hic_data.get_decay())
         # self.assertEqual(round(hic_data.compartments[None][24]['dens'], 5),
         #                  0.75434)
         if CHKTIME:
@@ -441,11 +596,6 @@ class TestTadbit(unittest.TestCase):
         if CHKTIME:
             t0 = time()
 
-        try:
-            __import__('IMP')
-        except ImportError:
-            warn('IMP not found, skipping test\n')
-            return
         test_chr = Chromosome(name='Test Chromosome', max_tad_size=260000)
         test_chr.add_experiment('exp1', 20000, tad_def=exp4,
                                 hic_data=PATH + '/20Kb/chrT/chrT_D.tsv',
@@ -454,6 +604,75 @@ class TestTadbit(unittest.TestCase):
         exp.load_hic_data(PATH + '/20Kb/chrT/chrT_A.tsv', silent=True)
         exp.filter_columns(silent=True)
         exp.normalize_hic(silent=True, factor=None)
+        # modelling without IMP
+        models = exp.model_region(51, 71, n_models=4, n_keep=2, n_cpus=1,
+                                  backend='numpy',
+                                  config={'kforce': 5, 'maxdist': 500,
+                                          'scale': 0.01,
+                                          'upfreq': 1.0, 'lowfreq': -0.6})
+        self.assertEqual(len(models), 2)
+        self.assertEqual(len(models[0]['x']), 21)
+        self.assertTrue(models[0]['objfun'] <= models[1]['objfun'])
+        self.assertTrue(models.correlate_with_real_data(cutoff=200)[0] > 0.2)
+        # restraints computed once for all models are the ones computed for
+        # each pair of IMP particles before (values obtained with the
+        # per-pair code)
+        kinds, pairs, dists, kforces = imp_modelling.compute_restraints()
+        self.assertEqual(
+            [(n, tuple(pairs[n]), imp_modelling.RESTRAINT_TYPES[kinds[n]],
+              round(dists[n], 4), round(kforces[n], 4))
+             for n in (0, 1, 2, 38, 50, 104, 105)],
+            [(0, (0, 1), 'addHn', 200.0, 5),
+             (1, (0, 2), 'addHu', 400.0, 5),
+             (2, (0, 14), 'addHl', 410.5017, 1.2833),
+             (38, (4, 9), 'addHa', 239.3097, 1.2099),
+             (50, (5, 13), 'addHl', 353.7719, 0.7849),
+             (104, (18, 20), 'addHu', 400.0, 5),
+             (105, (19, 20), 'addHu', 200.0, 5)])
+        self.assertEqual([(kinds == k).sum() for k in xrange(4)],
+                         [16, 23, 10, 57])
+        self.assertEqual(round(dists.sum(), 2), 36011.21)
+        self.assertEqual(round(kforces.sum(), 2), 267.83)
+        # resuming from an interrupted checkpoint (last record incomplete)
+        out = open('lala-checkpoint~', 'wb')
+        dump(imp_modelling._checkpoint_header('numpy'), out,
+             HIGHEST_PROTOCOL)
+        for rand_init in (1, 3):
+            dump(imp_modelling._generate_model(rand_init, 'numpy'), out,
+                 HIGHEST_PROTOCOL)
+        out.write(dumps(imp_modelling._generate_model(2, 'numpy'),
+                        HIGHEST_PROTOCOL)[:-100])
+        out.close()
+        resumed = exp.model_region(51, 71, n_models=4, n_keep=2, n_cpus=1,
+                                   backend='numpy',
+                                   checkpoint='lala-checkpoint~',
+                                   config={'kforce': 5, 'maxdist': 500,
+                                           'scale': 0.01,
+                                           'upfreq': 1.0, 'lowfreq': -0.6})
+        self.assertFalse(path.exists('lala-checkpoint~'))
+        for i in xrange(len(models)):
+            self.assertEqual(
+                [resumed[i][k] for k in ('rand_init', 'objfun', 'x', 'y', 'z')],
+                [models[i][k] for k in ('rand_init', 'objfun', 'x', 'y', 'z')])
+        # ... but not with other parameters
+        out = open('lala-checkpoint~', 'wb')
+        dump(imp_modelling._checkpoint_header('numpy'), out,
+             HIGHEST_PROTOCOL)
+        out.close()
+        self.assertRaises(ValueError, exp.model_region, 51, 71, n_models=4,
+                          n_keep=2, n_cpus=1, backend='numpy',
+                          checkpoint='lala-checkpoint~',
+                          config={'kforce': 5, 'maxdist': 600, 'scale': 0.01,
+                                  'upfreq': 1.0, 'lowfreq': -0.6})
+        system('rm -f lala-checkpoint~')
+        self.assertRaises(ValueError, exp.model_region, 51, 71, n_models=4,
+                          n_keep=2, n_cpus=1, backend='lala')
+
+        try:
+            __import__('IMP')
+        except ImportError:
+            warn('IMP not found, skipping test\n')
+            return
         models = exp.model_region(51, 71, n_models=40, n_keep=25,
                                   n_cpus=4,
                                   config={'kforce': 5, 'maxdist': 500,
@@ -494,6 +713,39 @@ class TestTadbit(unittest.TestCase):
             self.assertTrue(5 <= len(models.clusters.keys()) <= 7)
         models.cluster_models(method='ward', verbose=False, dcutoff=200)
         self.assertTrue(2 <= len(models.clusters.keys()) <= 3)
+        # comparisons are reused when adding models, in parallel
+        clusters = dict(models.clusters)
+        models.define_best_models(15)
+        models.cluster_models(method='ward', verbose=False, dcutoff=200)
+        models.define_best_models(25)
+        models.cluster_models(method='ward', verbose=False, dcutoff=200,
+                              n_cpus=2)
+        self.assertEqual(dict(models.clusters), clusters)
+        # by tiles of 4 models, the threads compare the same values, and only
+        # the pairs involving one of the 10 new models
+        mods = [models[m] for m in xrange(25)]
+        serial = calc_eqv_rmsd_matrix(mods, models.nloci, models._zeros, 200)
+        stats = serial.copy()
+        stats[:, 15:] = stats[:, :, 15:] = float('nan')
+        tile_size = three_dim_stats.TILE_SIZE
+        compare_pairs = three_dim_stats._compare_pairs
+        computed = []
+        def _count_pairs(args):
+            computed.append(zip(args[5], args[6]))
+            return compare_pairs(args)
+        three_dim_stats.TILE_SIZE = 4
+        three_dim_stats._compare_pairs = _count_pairs
+        try:
+            threaded = calc_eqv_rmsd_matrix(mods, models.nloci, models._zeros,
+                                            200, n_cpus=2, stats=stats)
+        finally:
+            three_dim_stats.TILE_SIZE = tile_size
+            three_dim_stats._compare_pairs = compare_pairs
+        self.assertTrue(len(computed) > 1)
+        self.assertEqual(sorted(p for tile in computed for p in tile),
+                         [(i, j) for i in xrange(25)
+                          for j in xrange(max(i + 1, 15), 25)])
+        self.assertTrue((threaded == serial).all())
         d = models.cluster_analysis_dendrogram()
         self.assertEqual(d['icoord'], [[5., 5., 15., 15.]])
         # align models
@@ -599,6 +851,46 @@ class TestTadbit(unittest.TestCase):
         self.assertEqual(vals[3],  [4.0, 124.97, 274.0, 2.05, 254.0],)
         self.assertEqual(vals[16], [17.0, -62.84, 201.0, -3.20, 77.0])
         self.assertEqual(vals[15], [16.0, -132.38, 286.0, -12.70, 124.0])
+        # values of the per-particle analyses before their vectorization
+        models = load_structuralmodels('models.pick')
+        cmap = models.get_contact_matrix(cutoff=300)
+        self.assertEqual([round(sum(v for v in row if v >= 0), 2)
+                          for row in cmap],
+                         [1.0, 2.0, 2.12, 3.24, 5.4, 4.92, 5.44, 4.2, 4.6, 5.8,
+                          4.6, 3.36, 3.0, 2.92, 4.0, 5.56, 4.12, 3.0, 4.88,
+                          5.0, 3.0])
+        self.assertTrue(isnan(cmap[2][2]))
+        self.assertEqual([round(v, 2) for v in cmap[2][:2] + cmap[2][3:8]],
+                         [0.0, 1.0, 1.0, 0.0, 0.12, 0.0, 0.0])
+        inter = models._get_interactions(range(5), 300)
+        self.assertEqual([inter[0], inter[10], inter[20]],
+                         [[1, 1, 1, 1, 1], [4, 4, 4, 4, 5], [3, 3, 3, 3, 3]])
+        dens = models._get_density(range(5), 2, False)
+        self.assertEqual(len(dens), 19)
+        self.assertEqual(dens[0], [None] * 5)
+        self.assertEqual([[round(v, 2) for v in d] for d in (dens[2], dens[3],
+                                                             dens[-1])],
+                         [[100.07, 100.25, 100.22, 100.14, 100.24],
+                          [123.41, 121.44, 133.29, 128.63, 133.47],
+                          [199.03, 199.48, 199.07, 199.63, 155.37]])
+        dens = models._get_density(range(5), 2, True)
+        self.assertEqual([[round(v, 2) for v in d] for d in (dens[2], dens[3],
+                                                             dens[-1])],
+                         [[100.06, 100.07, 100.1, 100.1, 100.53],
+                          [100.22, 100.35, 100.3, 100.22, 100.34],
+                          [244.2, 243.65, 238.48, 246.45, 227.97]])
+        models.walking_angle(savedata='model.walkang', plot=False)
+        vals = [l.split() for l in open('model.walkang').readlines()[1:]]
+        self.assertEqual(vals[4], ['5', '-114.523', '258.0', '32.847', '201.0'])
+        models.walking_dihedral(savedata='model.walkdih', plot=False)
+        vals = [l.split() for l in open('model.walkdih').readlines()[1:]]
+        self.assertEqual(vals[0], ['1', 'nan', 'nan', 'nan', 'nan'])
+        self.assertEqual(vals[1], ['2', 'nan', 'nan', '-4.154', '106.0'])
+        self.assertEqual(vals[3], ['4', '153.972', '317.0', '5.915', '143.0'])
+        self.assertEqual(vals[12],
+                         ['13', '139.186', '307.0', '-28.863', '141.0'])
+        self.assertEqual(vals[17], ['18', '34.611', '73.0', '62.186', '150.0'])
+        self.assertEqual(vals[18], ['19', 'nan', 'nan', '34.611', '73.0'])
         # write cmm
         models.write_cmm('.', model_num=2)
         models.write_cmm('.', models=range(5))
@@ -693,6 +985,23 @@ class TestTadbit(unittest.TestCase):
             else:
                 same_seed = False
                 genome = parse_fasta('test.fa~')
+            frags = map_re_sites('DPNII', genome)
+            frags_array = map_re_sites_array('DPNII', genome)
+            for crm in genome:
+                self.assertEqual(sorted(set(sum(frags[crm].values(), []))),
+                                 frags_array[crm].tolist())
+            # genome and RE sites loaded from the cache
+            for _ in xrange(2):
+                genome_bis = parse_fasta('test.fa~', verbose=False,
+                                         cache_dir='cache~')
+                self.assertEqual(genome, genome_bis)
+                self.assertEqual(frags, map_re_sites('DPNII', genome_bis,
+                                                     cache_dir='cache~'))
+            self.assertEqual(frags, map_re_sites('DPNII', genome,
+                                                 cache_dir=False))
+            self.assertEqual(len(evict('cache~', max_size=0)), 2)
+            self.assertRaises(IOError, parse_fasta, 'lala-missing~',
+                              cache_dir='cache~')
             # PARSE SAM
             if ali == 'map':
                 from pytadbit.parsers.map_parser import parse_map as parser
@@ -706,11 +1015,38 @@ class TestTadbit(unittest.TestCase):
             parser(['test_read1.%s~' % (ali)], ['test_read2.%s~' % (ali)],
                    './lala1-%s~' % (ali), './lala2-%s~' % (ali), genome,
                    re_name='DPNII', mapper='GEM')
+            # external sort with small chunks, merged in several rounds
+            parser(['test_read1.%s~' % (ali)], ['test_read2.%s~' % (ali)],
+                   './lala1-%s-bis~' % (ali), './lala2-%s-bis~' % (ali), genome,
+                   re_name='DPNII', mapper='GEM', chunk_size=100, fan_in=3,
+                   nthreads=2)
+            for rd in ['1', '2']:
+                self.assertEqual(open('lala%s-%s~' % (rd, ali)).read(),
+                                 open('lala%s-%s-bis~' % (rd, ali)).read())
+            # the RE sites are not kept once the files are parsed
+            self.assertEqual(sys.modules[parser.__module__]._FRAGS, {})
+            # the same input file given twice is parsed twice
+            parsed = parser(['test_read1.%s~' % (ali)] * 2, None,
+                            './lala1-%s-ter~' % (ali), None, genome,
+                            re_name='DPNII', mapper='GEM', nthreads=2)
+            if ali == 'map':
+                self.assertEqual(parsed[0][0], {1: 6000, 2: 6000})
 
             # GET INTERSECTION
             from pytadbit.mapping import get_intersection
             get_intersection('lala1-%s~' % (ali), 'lala2-%s~' % (ali),
                              'lala-%s~' % (ali))
+            # bounded memory intersection, sorted in several rounds
+            get_intersection('lala1-%s~' % (ali), 'lala2-%s~' % (ali),
+                             'lala-%s-bis~' % (ali), stream=True,
+                             chunk_size=100, fan_in=3, nthreads=2)
+            self.assertEqual(open('lala-%s~' % (ali)).read(),
+                             open('lala-%s-bis~' % (ali)).read())
+            get_intersection('lala1-%s~' % (ali), 'lala2-%s~' % (ali),
+                             'lala-%s-bis~' % (ali), stream=True,
+                             sort_by='read')
+            self.assertEqual(sorted(open('lala-%s~' % (ali))),
+                             sorted(open('lala-%s-bis~' % (ali))))
             # FILTER
             masked = filter_reads('lala-%s~' % (ali), verbose=False,
                                   fast=(ali=='map'))
@@ -727,10 +1063,46 @@ class TestTadbit(unittest.TestCase):
             else:
                 self.assertTrue (masked[5]['reads'] > 1000)
             self.assertEqual(masked[9]['reads'], 1000)
+        # parallel and serial filtering should give the same files
+        masked = filter_reads('lala-map~', verbose=False, fast=True, nthreads=3,
+                              savedata='lala-stats~')
+        masked_serial = filter_reads('lala-map~', output='lala-map-serial~',
+                                     verbose=False, fast=False,
+                                     savedata='lala-stats-serial~')
+        # all the reads are counted in the total, also the first one
+        nreads = len([True for l in open('lala-map~') if not l.startswith('#')])
+        self.assertEqual(open('lala-stats~').next(),
+                         'Mapped both\t%d\n' % nreads)
+        self.assertEqual(open('lala-stats~').read(),
+                         open('lala-stats-serial~').read())
+        for k in masked:
+            self.assertEqual(masked[k]['reads'], masked_serial[k]['reads'])
+            self.assertEqual(open(masked[k]['fnam']).read(),
+                             open(masked_serial[k]['fnam']).read())
         apply_filter('lala-map~', 'lala-map-filt~', masked, filters=[1],
                      reverse=True, verbose=False)
         self.assertEqual(len([True for l in open('lala-map-filt~')
                               if not l.startswith('#')]), 1000)
+        # without bitmask, walking along the files of filtered read IDs
+        for k in masked_serial:
+            del masked_serial[k]['bitmask']
+        for reverse in [False, True]:
+            apply_filter('lala-map~', 'lala-map-filt~', masked,
+                         filters=[2, 5, 9], reverse=reverse, verbose=False)
+            apply_filter('lala-map~', 'lala-map-filt-serial~', masked_serial,
+                         filters=[2, 5, 9], reverse=reverse, verbose=False)
+            self.assertEqual(open('lala-map-filt~').read(),
+                             open('lala-map-filt-serial~').read())
+        # bitmask not used if the reads file changed since filtering
+        open(masked[1]['bitmask'], 'r+b').write(
+            '\0' * path.getsize(masked[1]['bitmask']))
+        utime('lala-map~', (0, 0))
+        apply_filter('lala-map~', 'lala-map-filt~', masked,
+                     filters=[2, 5, 9], verbose=False)
+        apply_filter('lala-map~', 'lala-map-filt-serial~', masked_serial,
+                     filters=[2, 5, 9], verbose=False)
+        self.assertEqual(open('lala-map-filt~').read(),
+                         open('lala-map-filt-serial~').read())
         d = plot_iterative_mapping('lala1-map~', 'lala2-map~')
         self.assertEqual(d[0][1], 6000)
 
@@ -744,6 +1116,61 @@ class TestTadbit(unittest.TestCase):
         if CHKTIME:
             t0 = time()
         hic_data1 = load_hic_data_from_reads('lala-map~', resolution=10000)
+        hic_data1_sparse = load_hic_data_from_reads('lala-map~', resolution=10000,
+                                                    sparse=True)
+        self.assertEqual(hic_data1_sparse, hic_data1)
+        self.assertEqual(hic_data1_sparse.get_matrix(focus='chr2'),
+                         hic_data1.get_matrix(focus='chr2'))
+        hic_datas = load_hic_data_at_resolutions('lala-map~', [10000, 100000])
+        self.assertEqual(hic_datas[10000], hic_data1)
+        self.assertEqual(hic_datas[100000],
+                         load_hic_data_from_reads('lala-map~', resolution=100000))
+        # reads with other number of columns are parsed line by line
+        out = open('lala-reads~', 'w')
+        out.write('# CRM chr1\t1000\n')
+        out.write('\t'.join(['r1', 'chr1', '100'] + ['0'] * 4 +
+                            ['chr1', '500'] + ['0'] * 4) + '\n')
+        out.write('\t'.join(['r2', 'chr1', '150'] + ['0'] * 4 +
+                            ['chr1', '900'] + ['0'] * 3) + '\n')
+        out.write('\t'.join(['r3', 'chr1', '800'] + ['0'] * 4 +
+                            ['chr1', '850'] + ['0'] * 5) + '\n')
+        out.close()
+        hic_data3 = load_hic_data_from_reads('lala-reads~', resolution=500)
+        self.assertEqual(hic_data3[0, 1], 2)
+        self.assertEqual(hic_data3[1, 1], 2)
+        out = open('lala-reads~', 'a')
+        out.write('\t'.join(['r4', 'chr1', '800', 'chr1', '850']) + '\n')
+        out.close()
+        self.assertRaises(ValueError, load_hic_data_from_reads, 'lala-reads~',
+                          resolution=500)
+        hic_data1.bads = {3: True, 150: True}
+        write_hic_binary(hic_data1, 'lala-map.bin~')
+        hic_data1_bin = read_hic_binary('lala-map.bin~')
+        self.assertEqual(hic_data1_bin, hic_data1)
+        self.assertEqual(hic_data1_bin.bads, hic_data1.bads)
+        self.assertEqual(read_hic_binary('lala-map.bin~', focus='chr2',
+                                         sparse=True).get_matrix(),
+                         hic_data1.get_matrix(focus='chr2'))
+        # chromosomes requested out of the file order
+        crms = list(hic_data1.chromosomes)[1::-1]
+        hic_data_rev = read_hic_binary('lala-map.bin~', focus=crms)
+        hic_data_rev_sparse = read_hic_binary('lala-map.bin~', focus=crms,
+                                              sparse=True)
+        self.assertEqual(hic_data_rev_sparse.get_matrix(),
+                         hic_data_rev.get_matrix())
+        size = len(hic_data_rev)
+        inter = [(i, j) for i in xrange(0, hic_data_rev.chromosomes[crms[0]], 5)
+                 for j in xrange(hic_data_rev.chromosomes[crms[0]], size)]
+        self.assertTrue(sum(hic_data_rev[i, j] for i, j in inter) > 0)
+        self.assertEqual([hic_data_rev_sparse[i, j] for i, j in inter],
+                         [hic_data_rev[i, j] for i, j in inter])
+        self.assertEqual([hic_data_rev_sparse[j, i] for i, j in inter],
+                         [hic_data_rev[i, j] for i, j in inter])
+        exp = Experiment('binary', 10000, hic_data='lala-map.bin~',
+                         focus='chr2', silent=True)
+        self.assertEqual(exp.size, len(hic_data1.get_matrix(focus='chr2')))
+        self.assertFalse('focus' in exp.description)
+        hic_data1.bads = {}
         hic_map(hic_data1, savedata='lala-map.tsv~', savefig='lala.pdf~')
         hic_map(hic_data1, by_chrom='intra', savedata='lala-maps~', savefig='lalalo~')
         hic_map(hic_data1, by_chrom='inter', savedata='lala-maps~', savefig='lalala~')
@@ -766,6 +1193,8 @@ class TestTadbit(unittest.TestCase):
         corr =  [round(i,3) for i in corr[0]]
         self.assertEqual(corr, [0.755, 0.729, 0.804, 0.761, 0.789, 0.776, 0.828,
                                 0.757, 0.797, 0.832])
+        corr, _, scc = correlate_matrices(hic_data1, hic_data2, get_scc=True)
+        self.assertEqual(round(scc, 3), 0.947)
         
         ecorr = eig_correlate_matrices(hic_data1, hic_data2)
         ecorr = [round(i,3) for i in reduce(lambda x, y:x+y, ecorr)]